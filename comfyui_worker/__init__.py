@@ -0,0 +1,7 @@
+"""
+Shared ComfyUI runtime helpers for the RunPod serverless handlers.
+
+Each handler image copies this package next to handler.py (see the
+Dockerfiles), so everything here must stay importable with only the
+dependencies listed in requirements-handler.txt.
+"""
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Job cancellation for the ComfyUI handlers.
+
+RunPod doesn't tell a running handler that its job was cancelled, so a
+cancelled prompt used to keep sampling until the monitor's timeout and
+block the next job on the worker. `watch_job_cancellation()` starts a
+small poller per job that checks, every CANCEL_POLL_INTERVAL seconds:
+
+- the RunPod job status (needs RUNPOD_ENDPOINT_ID and RUNPOD_AI_API_KEY /
+  RUNPOD_API_KEY, which serverless workers normally have)
+- an optional cancel-flag URL (JOB_CANCEL_URL with `{job_id}`, or
+  `cancel_url` in the job input) answering {"cancelled": true} or
+  {"status": "CANCELLED"}
+
+On cancellation the prompt is interrupted (/interrupt) and removed from
+the queue (/queue delete), the job's freshly written input files are
+deleted, and the prompt's watcher is woken so the monitor returns at once.
+Monitors check `job_cancelled(job_id)` on every iteration.
+"""
+
+import os
+import time
+import logging
+import threading
+from typing import Dict, List, Any, Optional
+
+import requests
+
+from .client import get_comfyui_client
+from .events import get_event_stream, watch_prompt
+
+logger = logging.getLogger(__name__)
+
+CANCEL_POLL_INTERVAL = float(os.environ.get('CANCEL_POLL_INTERVAL', '1.0'))
+JOB_CANCEL_URL = os.environ.get('JOB_CANCEL_URL')  # e.g. https://app.example.com/api/jobs/{job_id}/cancelled
+RUNPOD_STATUS_URL = 'https://api.runpod.ai/v2/{endpoint_id}/status/{job_id}'
+COMFYUI_INPUT_DIR = os.environ.get('COMFYUI_INPUT_DIR', '/app/comfyui/input')
+
+# Input names of loader nodes that point at files in ComfyUI's input directory
+INPUT_FILE_KEYS = ('image', 'video', 'audio', 'mask')
+
+
+def workflow_input_files(workflow: Optional[Dict], since: float, input_dir: str = COMFYUI_INPUT_DIR) -> List[str]:
+    """Input files a workflow loads that were written after `since` (i.e. for this job)"""
+    files = []
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict) or 'Load' not in node.get('class_type', ''):
+            continue
+        for key in INPUT_FILE_KEYS:
+            value = (node.get('inputs') or {}).get(key)
+            if not isinstance(value, str) or not value:
+                continue
+            path = os.path.normpath(os.path.join(input_dir, value.split(' [')[0]))
+            if not path.startswith(os.path.normpath(input_dir) + os.sep):
+                continue
+            try:
+                if os.path.getmtime(path) >= since - 1:
+                    files.append(path)
+            except OSError:
+                pass
+    return files
+
+
+class JobCancellation:
+    """Cancel state of one job plus the poller that detects it"""
+
+    def __init__(self, job_id: str, runpod_job_id: Optional[str] = None, cancel_url: Optional[str] = None,
+                 interval: float = CANCEL_POLL_INTERVAL):
+        self.job_id = job_id
+        self.runpod_job_id = runpod_job_id
+        self.cancel_url = cancel_url or (JOB_CANCEL_URL.format(job_id=job_id) if JOB_CANCEL_URL else None)
+        self.interval = interval
+        self.started = time.time()
+        self.prompt_id = None
+        self.workflow = None
+        self.reason = None
+        self._event = threading.Event()
+        self._stopped = threading.Event()
+        self._lock = threading.Lock()
+        self._session = requests.Session()
+        self._thread = None
+
+        endpoint_id = os.environ.get('RUNPOD_ENDPOINT_ID')
+        api_key = os.environ.get('RUNPOD_AI_API_KEY') or os.environ.get('RUNPOD_API_KEY')
+        self.status_url = None
+        self.status_headers = {}
+        if endpoint_id and api_key and runpod_job_id:
+            self.status_url = RUNPOD_STATUS_URL.format(endpoint_id=endpoint_id, job_id=runpod_job_id)
+            self.status_headers = {'Authorization': f"Bearer {api_key}"}
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def start(self) -> 'JobCancellation':
+        if self.status_url or self.cancel_url:
+            self._thread = threading.Thread(target=self._poll, name=f"cancel-{self.job_id}", daemon=True)
+            self._thread.start()
+        return self
+
+    def attach_prompt(self, prompt_id: str, workflow: Optional[Dict] = None):
+        """Prompt (and workflow, for input cleanup) to tear down if the job is cancelled"""
+        with self._lock:
+            self.prompt_id = prompt_id
+            self.workflow = workflow
+        if self.cancelled:
+            self._teardown()
+
+    def _poll(self):
+        while not self._stopped.wait(self.interval):
+            reason = self._check()
+            if reason:
+                self.cancel(reason)
+                return
+
+    def _check(self) -> Optional[str]:
+        if self.status_url:
+            try:
+                response = self._session.get(self.status_url, headers=self.status_headers, timeout=5)
+                if response.status_code == 200 and response.json().get('status') == 'CANCELLED':
+                    return 'cancelled on RunPod'
+            except Exception as e:
+                logger.debug(f"RunPod status check failed: {e}")
+
+        if self.cancel_url:
+            try:
+                response = self._session.get(self.cancel_url, timeout=5)
+                if response.status_code == 200:
+                    data = response.json()
+                    if data.get('cancelled') or str(data.get('status', '')).upper() == 'CANCELLED':
+                        return 'cancel flag set'
+            except Exception as e:
+                logger.debug(f"Cancel flag check failed: {e}")
+
+        return None
+
+    def cancel(self, reason: str = 'cancelled'):
+        """Mark the job cancelled and stop its prompt"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self.reason = reason
+            self._event.set()
+        logger.warning(f"🛑 Job {self.job_id} {reason}, stopping ComfyUI prompt")
+        self._teardown()
+
+    def _teardown(self):
+        with self._lock:
+            prompt_id, workflow = self.prompt_id, self.workflow
+        if not prompt_id:
+            return
+
+        comfyui = get_comfyui_client()
+        watcher = watch_prompt(prompt_id)
+        try:
+            # Drop it if still pending, then stop it if it is the one executing
+            # (older ComfyUI ignores prompt_id and interrupts whatever runs, which
+            # may be another job's prompt when the worker runs several)
+            comfyui.post("/queue", json={"delete": [prompt_id]}, timeout=5)
+            if watcher.live:
+                running = watcher.status == 'running'
+            else:
+                queue = comfyui.get("/queue", timeout=5).json()
+                running = any(len(item) > 1 and item[1] == prompt_id for item in queue.get('queue_running', []))
+            if running:
+                comfyui.post("/interrupt", json={"prompt_id": prompt_id}, timeout=5)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not interrupt prompt {prompt_id}: {e}")
+
+        # Wake the monitor right away instead of waiting for ComfyUI's interrupted event
+        get_event_stream().mark_interrupted(prompt_id, self.reason)
+
+        for path in workflow_input_files(workflow, self.started):
+            try:
+                os.remove(path)
+                logger.info(f"🧹 Removed input file of cancelled job: {path}")
+            except OSError as e:
+                logger.warning(f"⚠️ Could not remove {path}: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        with _jobs_lock:
+            if _jobs.get(self.job_id) is self:
+                del _jobs[self.job_id]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
+
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+
+
+def watch_job_cancellation(job: Dict[str, Any], job_id: str) -> JobCancellation:
+    """Start watching a RunPod job for cancellation; use as a context manager around the job"""
+    job_input = job.get('input') or {}
+    cancellation = JobCancellation(
+        job_id,
+        runpod_job_id=job.get('id'),
+        cancel_url=job_input.get('cancel_url') or job_input.get('cancelUrl')
+    )
+    with _jobs_lock:
+        _jobs[job_id] = cancellation
+    return cancellation.start()
+
+
+def attach_prompt(job_id: str, prompt_id: str, workflow: Optional[Dict] = None):
+    """Register the ComfyUI prompt a job queued, if the job is being watched"""
+    with _jobs_lock:
+        cancellation = _jobs.get(job_id)
+    if cancellation is not None:
+        cancellation.attach_prompt(prompt_id, workflow)
+
+
+def job_cancelled(job_id: str) -> bool:
+    with _jobs_lock:
+        cancellation = _jobs.get(job_id)
+    return cancellation is not None and cancellation.cancelled
+
+
+def cancelled_result(job_id: str) -> Dict[str, Any]:
+    """Result returned by a monitor whose job was cancelled"""
+    with _jobs_lock:
+        cancellation = _jobs.get(job_id)
+    reason = cancellation.reason if cancellation else 'cancelled'
+    logger.info(f"🛑 Job {job_id} released after cancellation ({reason})")
+    return {
+        'success': False,
+        'status': 'cancelled',
+        'error': f"Job cancelled ({reason})"
+    }
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+"""
+Cached ComfyUI node catalog (/object_info).
+
+Handlers used to guess which nodes a worker has (face swap always stripped
+TeaCache, style transfer always replaced ReduxAdvanced) and only found out
+about a missing class or input when ComfyUI rejected the prompt or failed
+mid-execution. `get_node_catalog()` fetches /object_info once per ComfyUI
+build and persists a compact copy (class -> required/optional input names
+and types, output types, whether it is an output node) under
+NODE_CATALOG_DIR. The file is keyed by the
+ComfyUI git commit plus a hash of every custom node package, so a new
+image or custom node invalidates it and a warm worker reads it from disk
+without asking ComfyUI at all.
+
+Only class names, input names and types are cached: combo values (model
+and LoRA file lists) change whenever files land on the volume, so callers
+that need them still ask ComfyUI directly.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Any, Optional
+
+from .client import get_comfyui_client
+
+logger = logging.getLogger(__name__)
+
+COMFYUI_DIR = os.environ.get('COMFYUI_DIR', '/app/comfyui')
+NODE_CATALOG_DIR = os.environ.get(
+    'NODE_CATALOG_DIR',
+    '/runpod-volume/comfyui_node_catalog' if os.path.isdir('/runpod-volume') else '/tmp/comfyui_node_catalog'
+)
+# Bumped when the compact format changes, so older files are refetched
+CATALOG_FORMAT = 2
+
+
+def _git_head(path: str) -> Optional[str]:
+    """Commit a git checkout is at, read from .git without running git"""
+    git_dir = os.path.join(path, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD')) as f:
+            head = f.read().strip()
+        if not head.startswith('ref: '):
+            return head
+        ref = head[5:]
+        ref_path = os.path.join(git_dir, ref)
+        if os.path.exists(ref_path):
+            with open(ref_path) as f:
+                return f.read().strip()
+        with open(os.path.join(git_dir, 'packed-refs')) as f:
+            for line in f:
+                if line.rstrip().endswith(f" {ref}"):
+                    return line.split()[0]
+    except OSError:
+        pass
+    return None
+
+
+def _fingerprint(path: str) -> str:
+    """Git commit of a directory, or its mtime when it isn't a checkout"""
+    head = _git_head(path)
+    if head:
+        return head
+    try:
+        return str(int(os.path.getmtime(path)))
+    except OSError:
+        return 'missing'
+
+
+def build_key(comfyui_dir: str = COMFYUI_DIR) -> str:
+    """Identifies a ComfyUI build: its commit plus every custom node package"""
+    parts = [f"comfyui={_fingerprint(comfyui_dir)}"]
+    custom_nodes = os.path.join(comfyui_dir, 'custom_nodes')
+    try:
+        entries = sorted(os.listdir(custom_nodes))
+    except OSError:
+        entries = []
+    for name in entries:
+        if name.startswith('.') or name == '__pycache__' or name.endswith('.disabled'):
+            continue
+        parts.append(f"{name}={_fingerprint(os.path.join(custom_nodes, name))}")
+    return hashlib.sha1('\n'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+def _input_type(spec: Any) -> str:
+    """Type name of an /object_info input spec; combo inputs are lists of choices"""
+    if isinstance(spec, (list, tuple)) and spec:
+        spec = spec[0]
+    if isinstance(spec, (list, tuple)):
+        return 'COMBO'
+    return str(spec)
+
+
+def compact_object_info(object_info: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+    """Strip /object_info down to what validation needs"""
+    catalog = {}
+    for class_type, info in object_info.items():
+        inputs = info.get('input') or {}
+        catalog[class_type] = {
+            'required': {name: _input_type(spec) for name, spec in (inputs.get('required') or {}).items()},
+            'optional': {name: _input_type(spec) for name, spec in (inputs.get('optional') or {}).items()},
+            'output': list(info.get('output') or []),
+            'output_node': bool(info.get('output_node'))
+        }
+    return catalog
+
+
+class NodeCatalog:
+    """Node classes and their inputs available on one ComfyUI build"""
+
+    def __init__(self, nodes: Dict[str, Dict[str, Any]], key: str, source: str):
+        self.nodes = nodes
+        self.key = key
+        self.source = source  # 'disk' or 'comfyui'
+
+    def has(self, class_type: str) -> bool:
+        return class_type in self.nodes
+
+    def required_inputs(self, class_type: str) -> Dict[str, str]:
+        return (self.nodes.get(class_type) or {}).get('required', {})
+
+    def output_types(self, class_type: str) -> List[str]:
+        return (self.nodes.get(class_type) or {}).get('output', [])
+
+    def is_output_node(self, class_type: str) -> Optional[bool]:
+        """ComfyUI's `output_node` flag for a class; None when the class is unknown"""
+        node = self.nodes.get(class_type)
+        return None if node is None else bool(node.get('output_node'))
+
+    def problems(self, workflow: Optional[Dict]) -> List[str]:
+        """Unknown class_types and missing required inputs in an API-format workflow"""
+        problems = []
+        for node_id, node in (workflow or {}).items():
+            if not isinstance(node, dict):
+                continue
+            class_type = node.get('class_type')
+            if class_type not in self.nodes:
+                problems.append(f"node {node_id}: unknown class_type {class_type}")
+                continue
+            inputs = node.get('inputs') or {}
+            for name in self.required_inputs(class_type):
+                if name not in inputs:
+                    problems.append(f"node {node_id} ({class_type}): missing required input '{name}'")
+        return problems
+
+
+def _catalog_path(key: str) -> str:
+    return os.path.join(NODE_CATALOG_DIR, f"object_info_v{CATALOG_FORMAT}_{key}.json")
+
+
+def load_catalog(key: str) -> Optional[NodeCatalog]:
+    try:
+        with open(_catalog_path(key)) as f:
+            return NodeCatalog(json.load(f), key, 'disk')
+    except (OSError, ValueError):
+        return None
+
+
+def fetch_catalog(key: str) -> Optional[NodeCatalog]:
+    """Fetch /object_info from the running ComfyUI and persist it for this build"""
+    try:
+        response = get_comfyui_client().get("/object_info", timeout=30)
+        if response.status_code != 200:
+            logger.warning(f"⚠️ /object_info returned {response.status_code}")
+            return None
+        nodes = compact_object_info(response.json())
+    except Exception as e:
+        logger.warning(f"⚠️ Could not fetch ComfyUI node catalog: {e}")
+        return None
+
+    try:
+        os.makedirs(NODE_CATALOG_DIR, exist_ok=True)
+        path = _catalog_path(key)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(nodes, f, separators=(',', ':'))
+        os.replace(temp_path, path)
+    except OSError as e:
+        logger.warning(f"⚠️ Could not persist node catalog: {e}")
+
+    logger.info(f"📚 Cached ComfyUI node catalog for build {key} ({len(nodes)} node classes)")
+    return NodeCatalog(nodes, key, 'comfyui')
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_node_catalog(refresh: bool = False) -> Optional[NodeCatalog]:
+    """Node catalog of the local ComfyUI build, or None if it can't be determined"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None or refresh:
+            key = build_key()
+            catalog = None if refresh else load_catalog(key)
+            if catalog is not None:
+                logger.info(f"📚 Loaded ComfyUI node catalog for build {key} from disk ({len(catalog.nodes)} node classes)")
+            else:
+                catalog = fetch_catalog(key)
+            if catalog is not None:
+                _catalog = catalog
+        return _catalog
+
+
+def cached_node_catalog() -> Optional[NodeCatalog]:
+    """Node catalog if already loaded or persisted for this build; never asks ComfyUI"""
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = load_catalog(build_key())
+        return _catalog
+
+
+def node_available(class_type: str) -> Optional[bool]:
+    """Whether ComfyUI has a node class; None when the catalog is unavailable"""
+    catalog = get_node_catalog()
+    if catalog is None:
+        return None
+    if not catalog.has(class_type) and catalog.source == 'disk':
+        catalog = get_node_catalog(refresh=True) or catalog
+    return catalog.has(class_type)
+
+
+def check_workflow_nodes(workflow: Optional[Dict]) -> List[str]:
+    """Problems that would make ComfyUI reject or fail a workflow (empty if unknown)"""
+    if getattr(workflow, 'prevalidated', False):
+        # Rendered from a template whose node classes and required inputs already passed this build's catalog
+        return []
+    catalog = get_node_catalog()
+    if catalog is None:
+        return []
+    problems = catalog.problems(workflow)
+    if problems and catalog.source == 'disk':
+        # A stale file shouldn't fail a job: confirm against the live ComfyUI
+        catalog = get_node_catalog(refresh=True) or catalog
+        problems = catalog.problems(workflow)
+    return problems
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Pooled HTTP client for the local ComfyUI server.
+
+All handlers talk to ComfyUI through one `ComfyUIClient` per process so
+queueing, polling and /view downloads reuse keep-alive connections instead
+of opening a new TCP connection for every request. The base URL comes from
+COMFYUI_URL (default http://127.0.0.1:8188); callers pass paths such as
+"/prompt" or "/history/<prompt_id>" and a timeout suited to the call.
+"""
+
+import os
+import logging
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+COMFYUI_URL = os.environ.get('COMFYUI_URL', 'http://127.0.0.1:8188').rstrip('/')
+
+# Connections kept open to ComfyUI (monitor, /view downloads and uploads can overlap)
+POOL_SIZE = int(os.environ.get('COMFYUI_POOL_SIZE', '8'))
+
+# Used when a call doesn't pass its own timeout
+DEFAULT_TIMEOUT = 30
+
+
+class ComfyUIClient:
+    """Keep-alive requests session bound to a single ComfyUI base URL"""
+
+    def __init__(self, base_url: str = COMFYUI_URL, pool_size: int = POOL_SIZE):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def url(self, path: str = '/') -> str:
+        if not path.startswith('/'):
+            path = f"/{path}"
+        return f"{self.base_url}{path}"
+
+    def request(self, method: str, path: str, timeout: Optional[float] = DEFAULT_TIMEOUT, **kwargs) -> requests.Response:
+        return self.session.request(method, self.url(path), timeout=timeout, **kwargs)
+
+    def get(self, path: str, timeout: Optional[float] = DEFAULT_TIMEOUT, **kwargs) -> requests.Response:
+        return self.request('GET', path, timeout=timeout, **kwargs)
+
+    def post(self, path: str, timeout: Optional[float] = DEFAULT_TIMEOUT, **kwargs) -> requests.Response:
+        return self.request('POST', path, timeout=timeout, **kwargs)
+
+    def view(self, filename: str, subfolder: str = '', type_dir: str = 'output', timeout: Optional[float] = DEFAULT_TIMEOUT) -> requests.Response:
+        """GET /view for a generated file"""
+        params = {'filename': filename, 'type': type_dir}
+        if subfolder:
+            params['subfolder'] = subfolder
+        return self.get('/view', params=params, timeout=timeout)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_comfyui_client() -> ComfyUIClient:
+    """Process-wide ComfyUI client"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = ComfyUIClient()
+            logger.info(f"🔗 ComfyUI client using {_client.base_url} (pool size {POOL_SIZE})")
+        return _client
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Several RunPod jobs per worker.
+
+Each worker took one job at a time through decode, queue, poll, download,
+upload and webhooks, so the GPU sat idle while a job decoded its base64
+input or waited on S3 and webhooks (up to 120 s). With JOB_CONCURRENCY
+above 1, `serverless_config()` registers the handler with RunPod's
+`concurrency_modifier`, and RunPod hands the worker up to that many jobs
+at once. ComfyUI's own queue still runs one prompt at a time on the GPU;
+the CPU stages of the other jobs (input ingestion and validation before,
+upload and webhooks after) overlap with it.
+
+RunPod awaits handlers on a single event loop, so the synchronous
+handlers run on a thread pool of JOB_CONCURRENCY threads. Per-job state
+lives in each handler call and in registries keyed by job or prompt id
+(cancellation, residency reports, prompt watchers); the shared singletons
+(ComfyUI client, event stream, supervisor) are thread-safe.
+
+The modifier drops back to one job while the supervisor waits to
+recycle ComfyUI or ComfyUI is restarting, so the worker drains instead
+of taking on jobs that would have to wait anyway.
+"""
+
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Callable
+
+from .supervisor import get_supervisor
+
+logger = logging.getLogger(__name__)
+
+JOB_CONCURRENCY = max(1, int(os.environ.get('JOB_CONCURRENCY', '1')))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _job_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_CONCURRENCY, thread_name_prefix='runpod-job')
+        return _executor
+
+
+def concurrency_modifier(current_concurrency: int) -> int:
+    """Jobs this worker should run at once (RunPod calls this between jobs)"""
+    supervisor = get_supervisor()
+    if supervisor.owns_process and (supervisor.recycle_reason or not supervisor.ready):
+        if current_concurrency > 1:
+            logger.info("⏸️ Taking one job at a time until ComfyUI is recycled or restarted")
+        return 1
+    return JOB_CONCURRENCY
+
+
+def concurrent_handler(handler: Callable[[Dict], Any]) -> Callable[[Dict], Any]:
+    """Async wrapper running a synchronous handler on the job thread pool"""
+    async def run(job: Dict) -> Any:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(_job_executor(), handler, job)
+    return run
+
+
+def serverless_config(handler: Callable[[Dict], Any]) -> Dict[str, Any]:
+    """Arguments for runpod.serverless.start(); concurrent when JOB_CONCURRENCY > 1"""
+    if JOB_CONCURRENCY <= 1:
+        return {"handler": handler}
+    logger.info(f"🔀 Accepting up to {JOB_CONCURRENCY} concurrent jobs per worker")
+    return {
+        "handler": concurrent_handler(handler),
+        "concurrency_modifier": concurrency_modifier
+    }
@@ -0,0 +1,453 @@
+#!/usr/bin/env python3
+"""
+ComfyUI websocket event stream shared by all handlers.
+
+ComfyUI pushes execution events over /ws?clientId=<id> to the client that
+queued a prompt:
+- execution_start / execution_cached
+- executing (node=None once the prompt is finished and stored in history)
+- progress (sampler step value/max for the running node)
+- executed (output of a finished output node, see PromptWatcher.on_executed)
+- execution_success / execution_error / execution_interrupted
+- binary preview frames while a sampler runs (see PromptWatcher.on_preview),
+  only sent when ComfyUI is started with --preview-method
+
+Handlers call `subscribe()` before POSTing /prompt (using the returned client
+id), `track_prompt()` with the new prompt_id, and then `watch_prompt()` in the
+monitor. While the socket stays up the monitors skip the /queue and /history
+polling and finish the instant the terminal event arrives; if the socket was
+down at queue time or drops afterwards they fall back to polling.
+"""
+
+import json
+import time
+import struct
+import uuid
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Any, Optional, Tuple, Callable
+
+try:
+    import websocket  # websocket-client
+except ImportError:
+    websocket = None
+
+from .client import COMFYUI_URL
+
+logger = logging.getLogger(__name__)
+
+# Terminal prompt states, only reached on the final `executing` (node=None) event
+TERMINAL_STATES = ('success', 'error', 'interrupted')
+
+# How many prompts we keep state for (covers prompts that finish before a watcher attaches)
+MAX_TRACKED_PROMPTS = 256
+
+# Binary websocket frames (ComfyUI server.BinaryEventTypes)
+PREVIEW_IMAGE = 1
+PREVIEW_IMAGE_WITH_METADATA = 4
+PREVIEW_IMAGE_TYPES = {1: 'image/jpeg', 2: 'image/png'}
+
+
+class PromptState:
+    """Execution state of a single prompt, updated from websocket events"""
+
+    def __init__(self, prompt_id: str):
+        self.prompt_id = prompt_id
+        self.epoch = None  # socket epoch the prompt was queued under (None = not covered by the socket)
+        self.status = 'pending'  # pending -> running -> success/error/interrupted
+        self.outcome = None  # set by execution_success/error/interrupted, applied on the final `executing`
+        self.current_node = None
+        self.progress_value = 0
+        self.progress_max = 0
+        self.progress_node = None
+        self.cached_nodes = []
+        self.completed_nodes = []  # executed nodes, in order
+        self.node_times = OrderedDict()  # node_id -> [started, finished]
+        self.outputs = {}
+        self.error = None
+        self.queued_at = None
+        self.started_at = None
+        self.finished_at = None
+        self.output_listeners = []
+        self.preview_listeners = []
+
+
+class PromptWatcher:
+    """Per-job view on a prompt's websocket state"""
+
+    def __init__(self, stream: 'ComfyUIEventStream', state: PromptState):
+        self._stream = stream
+        self._state = state
+
+    @property
+    def prompt_id(self) -> str:
+        return self._state.prompt_id
+
+    @property
+    def live(self) -> bool:
+        """True while the socket the prompt was queued under has stayed connected"""
+        epoch = self._state.epoch
+        return epoch is not None and self._stream.connected and self._stream.epoch == epoch
+
+    @property
+    def finished(self) -> bool:
+        return self._state.status in TERMINAL_STATES
+
+    @property
+    def status(self) -> str:
+        return self._state.status
+
+    @property
+    def current_node(self) -> Optional[str]:
+        return self._state.current_node
+
+    @property
+    def progress(self) -> Dict[str, Any]:
+        """Latest sampler progress in the same shape as ComfyUI's progress event"""
+        return {
+            'value': self._state.progress_value,
+            'max': self._state.progress_max,
+            'node': self._state.progress_node
+        }
+
+    @property
+    def cached_nodes(self) -> List[str]:
+        return list(self._state.cached_nodes)
+
+    @property
+    def completed_nodes(self) -> List[str]:
+        """Nodes that finished executing (cached nodes are not included)"""
+        return list(self._state.completed_nodes)
+
+    @property
+    def node_timings(self) -> List[Tuple[str, float, Optional[float]]]:
+        """(node_id, started, finished) for every node that ran, in execution order"""
+        with self._stream.condition:
+            return [(node_id, times[0], times[1]) for node_id, times in self._state.node_times.items()]
+
+    @property
+    def queued_at(self) -> Optional[float]:
+        return self._state.queued_at
+
+    @property
+    def started_at(self) -> Optional[float]:
+        return self._state.started_at
+
+    @property
+    def finished_at(self) -> Optional[float]:
+        return self._state.finished_at
+
+    @property
+    def outputs(self) -> Dict[str, Any]:
+        return dict(self._state.outputs)
+
+    @property
+    def error(self) -> Optional[Dict]:
+        return self._state.error
+
+    def on_executed(self, callback: Callable[[str, Dict], None]):
+        """Call `callback(node_id, output)` for every output node as it executes.
+
+        Outputs that already arrived are replayed immediately. Callbacks run on
+        the event thread, so they must only hand work off (e.g. to a pool).
+        """
+        with self._stream.condition:
+            self._state.output_listeners.append(callback)
+            replay = list(self._state.outputs.items())
+        for node_id, output in replay:
+            self._stream._notify_output(callback, node_id, output)
+
+    def on_preview(self, callback: Callable[[bytes, str, Optional[str]], None]):
+        """Call `callback(image_bytes, mime_type, node_id)` for every sampler preview frame.
+
+        Runs on the event thread; callbacks must be cheap and hand off any encoding.
+        """
+        with self._stream.condition:
+            self._state.preview_listeners.append(callback)
+
+    def sleep(self, seconds: float) -> bool:
+        """Sleep up to `seconds`, waking early when the prompt finishes.
+
+        Returns True if the prompt is finished.
+        """
+        deadline = time.time() + seconds
+        with self._stream.condition:
+            while not self.finished:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._stream.condition.wait(remaining)
+        return self.finished
+
+    def close(self):
+        self._stream.release(self.prompt_id)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+class ComfyUIEventStream:
+    """Background websocket subscriber that tracks prompt state by prompt_id"""
+
+    def __init__(self, base_url: str = COMFYUI_URL, client_id: Optional[str] = None):
+        self.base_url = base_url.rstrip('/')
+        self.client_id = client_id or f"runpod-worker-{uuid.uuid4().hex}"
+        self.condition = threading.Condition()
+        self.connected = False
+        self.epoch = 0  # bumped on every (re)connect
+        self._prompts = OrderedDict()
+        self._running_prompt = None  # previews without metadata belong to the prompt executing now
+        self._thread = None
+
+    @property
+    def ws_url(self) -> str:
+        scheme = 'wss' if self.base_url.startswith('https://') else 'ws'
+        host = self.base_url.split('://', 1)[-1]
+        return f"{scheme}://{host}/ws?clientId={self.client_id}"
+
+    def start(self, wait: float = 2.0) -> bool:
+        """Start the subscriber thread (once) and wait briefly for the socket"""
+        if websocket is None:
+            return False
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='comfyui-events', daemon=True)
+            self._thread.start()
+
+        deadline = time.time() + wait
+        with self.condition:
+            while not self.connected and time.time() < deadline:
+                self.condition.wait(max(0.0, deadline - time.time()))
+            return self.connected
+
+    def track(self, prompt_id: str, epoch: Optional[int]):
+        """Record the socket epoch a freshly queued prompt is covered by"""
+        with self.condition:
+            state = self._get_state(prompt_id)
+            state.epoch = epoch
+            state.queued_at = time.time()
+
+    def requeue(self, prompt_id: str, epoch: Optional[int]):
+        """Reset a prompt re-queued under the same id (e.g. after a ComfyUI restart), keeping its listeners"""
+        with self.condition:
+            # Reset in place: watchers hold on to the state object
+            state = self._get_state(prompt_id)
+            fresh = PromptState(prompt_id)
+            for name, value in vars(fresh).items():
+                if name not in ('queued_at', 'output_listeners', 'preview_listeners'):
+                    setattr(state, name, value)
+            state.epoch = epoch
+            if self._running_prompt == prompt_id:
+                self._running_prompt = None
+            self.condition.notify_all()
+
+    def watch(self, prompt_id: str) -> PromptWatcher:
+        with self.condition:
+            return PromptWatcher(self, self._get_state(prompt_id))
+
+    def mark_interrupted(self, prompt_id: str, reason: Optional[str] = None):
+        """Finish a prompt locally (e.g. job cancelled) without waiting for ComfyUI's events"""
+        with self.condition:
+            state = self._get_state(prompt_id)
+            if state.status not in TERMINAL_STATES:
+                state.status = 'interrupted'
+                state.error = state.error or {'exception_message': reason or 'interrupted'}
+                state.finished_at = time.time()
+            self.condition.notify_all()
+
+    def release(self, prompt_id: str):
+        with self.condition:
+            self._prompts.pop(prompt_id, None)
+
+    def _get_state(self, prompt_id: str) -> PromptState:
+        state = self._prompts.get(prompt_id)
+        if state is None:
+            state = PromptState(prompt_id)
+            self._prompts[prompt_id] = state
+            while len(self._prompts) > MAX_TRACKED_PROMPTS:
+                self._prompts.popitem(last=False)
+        return state
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            ws = None
+            try:
+                ws = websocket.create_connection(self.ws_url, timeout=5)
+                ws.settimeout(30)
+                with self.condition:
+                    self.connected = True
+                    self.epoch += 1
+                    self.condition.notify_all()
+                logger.info(f"🔌 Connected to ComfyUI event stream ({self.client_id})")
+                backoff = 0.5
+
+                while True:
+                    try:
+                        message = ws.recv()
+                    except websocket.WebSocketTimeoutException:
+                        continue
+                    if isinstance(message, str):
+                        self._handle_message(message)
+                    elif message:
+                        self._handle_binary(message)
+
+            except Exception as e:
+                if self.connected:
+                    logger.warning(f"⚠️ ComfyUI event stream dropped: {e}")
+            finally:
+                with self.condition:
+                    self.connected = False
+                    self.condition.notify_all()
+                if ws is not None:
+                    try:
+                        ws.close()
+                    except Exception:
+                        pass
+
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 5.0)
+
+    def _handle_message(self, message: str):
+        try:
+            event = json.loads(message)
+        except ValueError:
+            return
+
+        event_type = event.get('type')
+        data = event.get('data') or {}
+        prompt_id = data.get('prompt_id')
+        if not prompt_id:
+            return
+
+        listeners = []
+        with self.condition:
+            state = self._get_state(prompt_id)
+
+            if event_type == 'execution_start':
+                state.status = 'running'
+                state.started_at = time.time()
+                self._running_prompt = prompt_id
+            elif event_type == 'execution_cached':
+                state.cached_nodes.extend(data.get('nodes') or [])
+            elif event_type == 'executing':
+                node = data.get('node')
+                now = time.time()
+                if state.current_node is not None and state.current_node != node:
+                    state.completed_nodes.append(state.current_node)
+                    state.node_times[state.current_node][1] = now
+                if node is None:
+                    # Final event: ComfyUI has stored the prompt in /history by now
+                    state.status = state.outcome or 'success'
+                    state.current_node = None
+                    state.finished_at = now
+                    if self._running_prompt == prompt_id:
+                        self._running_prompt = None
+                else:
+                    if state.status == 'pending':
+                        state.status = 'running'
+                    if node != state.current_node:
+                        state.node_times[node] = [now, None]
+                    state.current_node = node
+            elif event_type == 'progress':
+                state.progress_value = data.get('value', 0)
+                state.progress_max = data.get('max', 0)
+                state.progress_node = data.get('node')
+            elif event_type == 'executed':
+                node = data.get('node')
+                if node is not None:
+                    state.outputs[node] = data.get('output') or {}
+                    listeners = list(state.output_listeners)
+            elif event_type == 'execution_success':
+                state.outcome = 'success'
+            elif event_type == 'execution_error':
+                state.outcome = 'error'
+                state.error = data
+            elif event_type == 'execution_interrupted':
+                state.outcome = 'interrupted'
+                state.error = data
+
+            self.condition.notify_all()
+
+        for callback in listeners:
+            self._notify_output(callback, data.get('node'), data.get('output') or {})
+
+    def _handle_binary(self, message: bytes):
+        if len(message) < 8:
+            return
+
+        event_type = struct.unpack('>I', message[:4])[0]
+        prompt_id = None
+        node_id = None
+
+        if event_type == PREVIEW_IMAGE:
+            mime_type = PREVIEW_IMAGE_TYPES.get(struct.unpack('>I', message[4:8])[0], 'image/jpeg')
+            image_bytes = message[8:]
+        elif event_type == PREVIEW_IMAGE_WITH_METADATA:
+            metadata_length = struct.unpack('>I', message[4:8])[0]
+            try:
+                metadata = json.loads(message[8:8 + metadata_length])
+            except ValueError:
+                return
+            mime_type = metadata.get('image_type', 'image/jpeg')
+            prompt_id = metadata.get('prompt_id')
+            node_id = metadata.get('node_id')
+            image_bytes = message[8 + metadata_length:]
+        else:
+            return
+
+        with self.condition:
+            prompt_id = prompt_id or self._running_prompt
+            state = self._prompts.get(prompt_id) if prompt_id else None
+            if state is None or not state.preview_listeners:
+                return
+            listeners = list(state.preview_listeners)
+            node_id = node_id or state.current_node
+
+        for callback in listeners:
+            try:
+                callback(image_bytes, mime_type, node_id)
+            except Exception as e:
+                logger.warning(f"⚠️ Preview listener failed: {e}")
+
+    def _notify_output(self, callback: Callable[[str, Dict], None], node_id: str, output: Dict):
+        try:
+            callback(node_id, output)
+        except Exception as e:
+            logger.warning(f"⚠️ Output listener failed for node {node_id}: {e}")
+
+
+_event_stream = None
+_event_stream_lock = threading.Lock()
+
+
+def get_event_stream() -> ComfyUIEventStream:
+    """Process-wide ComfyUI event stream"""
+    global _event_stream
+    with _event_stream_lock:
+        if _event_stream is None:
+            _event_stream = ComfyUIEventStream()
+        return _event_stream
+
+
+def subscribe() -> Tuple[str, Optional[int]]:
+    """Connect the event stream and return (client_id, epoch) for queueing a prompt"""
+    stream = get_event_stream()
+    connected = stream.start()
+    return stream.client_id, (stream.epoch if connected else None)
+
+
+def track_prompt(prompt_id: str, epoch: Optional[int]):
+    """Mark a prompt queued with `subscribe()`'s client id as covered by the socket"""
+    if prompt_id:
+        get_event_stream().track(prompt_id, epoch)
+
+
+def watch_prompt(prompt_id: str) -> PromptWatcher:
+    """Watch a queued prompt; the watcher is only live if the prompt was tracked"""
+    return get_event_stream().watch(prompt_id)
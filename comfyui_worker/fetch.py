@@ -0,0 +1,407 @@
+#!/usr/bin/env python3
+"""
+Reference-based job inputs, fetched with parallel ranged downloads.
+
+Images and videos arrived inline as base64 (`referenceImageData`,
+`originalImageData`, `videoData`, the `image` of LoadImage nodes 40 and
+142, ...), a third larger than the file and close to RunPod's request
+size limit for long fps-boost videos. Every one of those inputs now also
+accepts a reference in place of the base64 string:
+
+- an HTTPS URL (a presigned URL, a CDN link, ...) whose host resolves
+  only to public addresses; plain HTTP, private, loopback and link-local
+  hosts are refused, and redirects are not followed. Downloads connect to
+  the address that was checked (TLS still verifies the hostname), so a
+  second DNS answer can't point them elsewhere
+- `s3://<bucket>/<key>`, or `{"s3Key": "<key>", "bucket": "<bucket>"}`
+  (the bucket defaults to INPUT_S3_BUCKET / AWS_S3_BUCKET and must be one
+  of INPUT_S3_ALLOWED_BUCKETS), fetched through a presigned URL made with
+  the worker's S3 credentials
+
+`download_to_file()` requests the first INPUT_FETCH_PART_MB part, whose
+Content-Range gives the file size, then fetches the remaining parts over
+up to INPUT_FETCH_CONNECTIONS connections (with per-part retries). Each
+part is written at its offset into a temporary file that replaces the
+target once complete. Servers without range support answer the first
+request with the whole file, which is streamed to disk as it is. Files
+over INPUT_FETCH_MAX_MB are refused.
+
+`supervised_handler()` calls `prefetch_inputs(job['input'])` the moment a
+job arrives, so the downloads overlap with waiting for ComfyUI and
+validating the workflow. When the handler later saves an input
+(`inputs.save_base64_input()`), `fetch_input()` takes the prefetched
+file and renames it into place, or fetches it then if it wasn't
+prefetched. Prefetched files no handler claimed are removed when the job
+ends.
+"""
+
+import os
+import time
+import uuid
+import socket
+import shutil
+import ipaddress
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Any, Optional, Tuple, Union
+from urllib.parse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+COMFYUI_INPUT_DIR = os.environ.get('COMFYUI_INPUT_DIR', '/app/comfyui/input')
+
+FETCH_CONNECTIONS = max(1, int(os.environ.get('INPUT_FETCH_CONNECTIONS', '8')))
+FETCH_PART_SIZE = max(1, int(float(os.environ.get('INPUT_FETCH_PART_MB', '8')) * 1024 * 1024))
+FETCH_TIMEOUT = float(os.environ.get('INPUT_FETCH_TIMEOUT', '60'))
+FETCH_MAX_BYTES = int(float(os.environ.get('INPUT_FETCH_MAX_MB', '2048')) * 1024 * 1024)
+FETCH_RETRIES = 3
+
+INPUT_S3_BUCKET = os.getenv('INPUT_S3_BUCKET') or os.getenv('AWS_S3_BUCKET') or os.getenv('S3_BUCKET') or ''
+# Buckets the worker's credentials may presign for a job (comma-separated)
+INPUT_S3_ALLOWED_BUCKETS = frozenset(
+    bucket.strip()
+    for bucket in (os.getenv('INPUT_S3_ALLOWED_BUCKETS') or INPUT_S3_BUCKET).split(',')
+    if bucket.strip()
+)
+PRESIGNED_URL_SECONDS = 900
+
+# Top-level job input keys and LoadImage-style node inputs that may hold a reference
+INPUT_KEYS = ('referenceImageData', 'originalImageData', 'newFaceImageData', 'maskImageData', 'imageData', 'videoData')
+NODE_INPUT_NAMES = ('image', 'video')
+
+# Both are recognised as references so plain HTTP is refused rather than decoded as base64
+URL_SCHEMES = ('https://', 'http://')
+S3_SCHEME = 's3://'
+
+# Inputs of all concurrent jobs downloading at once (each with its own part connections)
+MAX_PREFETCHES = 4
+STREAM_CHUNK = 1024 * 1024
+
+
+def is_reference(value: Any) -> bool:
+    """Whether an input value is a URL or S3 reference rather than inline data"""
+    if isinstance(value, str):
+        return value.startswith(URL_SCHEMES) or value.startswith(S3_SCHEME)
+    return isinstance(value, dict) and bool(value.get('s3Key') or value.get('url'))
+
+
+def reference_id(value: Any) -> str:
+    """Canonical string form of a reference"""
+    if isinstance(value, str):
+        return value
+    if value.get('s3Key'):
+        return f"{S3_SCHEME}{value.get('bucket') or INPUT_S3_BUCKET}/{str(value['s3Key']).lstrip('/')}"
+    return str(value['url'])
+
+
+def _describe(reference: str) -> str:
+    # Presigned URLs carry credentials in the query string
+    return reference.split('?', 1)[0]
+
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def get_input_s3_client():
+    """Process-wide S3 client for input references"""
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            import boto3
+            _s3_client = boto3.client(
+                's3',
+                aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID') or os.getenv('S3_ACCESS_KEY_ID'),
+                aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY') or os.getenv('S3_SECRET_ACCESS_KEY'),
+                region_name=os.getenv('AWS_REGION') or os.getenv('S3_REGION') or 'us-east-1'
+            )
+        return _s3_client
+
+
+def _check_url(url: str) -> Union[ipaddress.IPv4Address, ipaddress.IPv6Address]:
+    """Refuse anything but HTTPS to hosts that resolve only to public addresses; returns one of them"""
+    parts = urlsplit(url)
+    if parts.scheme != 'https' or not parts.hostname:
+        raise ValueError(f"input URLs must be https: {_describe(url)}")
+    try:
+        infos = socket.getaddrinfo(parts.hostname, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except socket.gaierror as e:
+        raise ValueError(f"cannot resolve input URL host {parts.hostname}: {e}")
+    addresses = [ipaddress.ip_address(info[4][0].split('%', 1)[0]) for info in infos]
+    for address in addresses:
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f"input URL host {parts.hostname} resolves to non-public address {address}")
+    if not addresses:
+        raise ValueError(f"cannot resolve input URL host {parts.hostname}")
+    return addresses[0]
+
+
+def resolve_url(reference: str) -> str:
+    """HTTPS URL to download a reference from"""
+    if not reference.startswith(S3_SCHEME):
+        return reference
+    bucket, _, key = reference[len(S3_SCHEME):].partition('/')
+    if not bucket or not key:
+        raise ValueError(f"invalid S3 reference: {_describe(reference)}")
+    if bucket not in INPUT_S3_ALLOWED_BUCKETS:
+        raise ValueError(f"S3 bucket not allowed for inputs: {bucket}")
+    return get_input_s3_client().generate_presigned_url(
+        'get_object', Params={'Bucket': bucket, 'Key': key}, ExpiresIn=PRESIGNED_URL_SECONDS
+    )
+
+
+class _HostnameAdapter(HTTPAdapter):
+    """Sends SNI for and verifies the certificate against `hostname` while connecting to an address"""
+
+    def __init__(self, hostname: str):
+        self.hostname = hostname
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['server_hostname'] = self.hostname
+        kwargs['assert_hostname'] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+_local = threading.local()
+
+
+def _session(hostname: str) -> requests.Session:
+    # One keep-alive session per download thread and host (Session isn't thread-safe)
+    sessions = getattr(_local, 'sessions', None)
+    if sessions is None:
+        sessions = _local.sessions = {}
+    session = sessions.get(hostname)
+    if session is None:
+        session = sessions[hostname] = requests.Session()
+        session.mount('https://', _HostnameAdapter(hostname))
+    return session
+
+
+class _PinnedURL:
+    """A URL rewritten to the address its host passed the check with"""
+
+    def __init__(self, url: str):
+        address = _check_url(url)
+        parts = urlsplit(url)
+        port = f":{parts.port}" if parts.port else ''
+        host = f"[{address}]" if address.version == 6 else str(address)
+        self.hostname = parts.hostname
+        self.url = urlunsplit(('https', f"{host}{port}", parts.path, parts.query, ''))
+        self.headers = {'Host': f"{parts.hostname}{port}"}
+
+    def get(self, headers: dict) -> requests.Response:
+        # Redirects aren't followed: their targets would skip the host check
+        return _session(self.hostname).get(self.url, headers={**self.headers, **headers}, stream=True,
+                                           timeout=FETCH_TIMEOUT, allow_redirects=False)
+
+
+def _range_total(response: requests.Response) -> Optional[int]:
+    """Full size from a 206 response's `Content-Range: bytes a-b/total`"""
+    content_range = response.headers.get('Content-Range', '')
+    total = content_range.rpartition('/')[2]
+    return int(total) if total.isdigit() else None
+
+
+def _stream_to(response: requests.Response, fd: int, offset: int = 0, limit: Optional[int] = None) -> int:
+    written = 0
+    for chunk in response.iter_content(STREAM_CHUNK):
+        if limit is not None and written + len(chunk) > limit:
+            raise IOError(f"server sent more than {limit} bytes")
+        os.pwrite(fd, chunk, offset + written)
+        written += len(chunk)
+    return written
+
+
+def _fetch_part(target: _PinnedURL, fd: int, start: int, end: int):
+    """Download bytes start..end (inclusive) at their offset, with retries"""
+    for attempt in range(FETCH_RETRIES):
+        try:
+            with target.get({'Range': f"bytes={start}-{end}"}) as response:
+                if response.status_code != 206:
+                    raise IOError(f"range request answered with HTTP {response.status_code}")
+                size = end - start + 1
+                written = _stream_to(response, fd, start, size)
+                if written != size:
+                    raise IOError(f"got {written} of {size} bytes")
+                return
+        except (requests.RequestException, IOError) as e:
+            if attempt == FETCH_RETRIES - 1:
+                raise
+            logger.warning(f"⚠️ Retrying bytes {start}-{end} ({e})")
+            time.sleep(0.5 * 2 ** attempt)
+
+
+def _parts(size: int, part_size: int) -> List[Tuple[int, int]]:
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+
+def _remove_file(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def download_to_file(url: str, path: str, connections: int = FETCH_CONNECTIONS, part_size: int = FETCH_PART_SIZE) -> int:
+    """Download `url` into `path` with parallel range requests; returns the bytes written"""
+    target = _PinnedURL(url)
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        # The first part doubles as the size probe
+        with target.get({'Range': f"bytes=0-{part_size - 1}"}) as first:
+            first.raise_for_status()
+            if first.is_redirect:
+                raise IOError(f"input URL redirected (HTTP {first.status_code}); redirects are not followed")
+            size = _range_total(first) if first.status_code == 206 else None
+            if first.status_code != 206:
+                # No range support: this response is the whole file
+                length = first.headers.get('Content-Length', '')
+                if length.isdigit() and int(length) > FETCH_MAX_BYTES:
+                    raise IOError(f"input is {int(length)} bytes, over the {FETCH_MAX_BYTES} byte limit")
+                size = _stream_to(first, fd, limit=FETCH_MAX_BYTES)
+                parts = []
+            elif size is None:
+                raise IOError(f"unknown size in Content-Range: {first.headers.get('Content-Range')}")
+            elif size > FETCH_MAX_BYTES:
+                raise IOError(f"input is {size} bytes, over the {FETCH_MAX_BYTES} byte limit")
+            else:
+                received = _stream_to(first, fd, 0, part_size)
+                parts = _parts(size, part_size)[1:]
+                if received != min(size, part_size):
+                    parts.insert(0, (received, min(size, part_size) - 1))
+
+        if parts:
+            with ThreadPoolExecutor(max_workers=min(connections, len(parts)), thread_name_prefix='input-fetch') as pool:
+                for future in [pool.submit(_fetch_part, target, fd, start, end) for start, end in parts]:
+                    future.result()
+        os.close(fd)
+        fd = None
+        os.replace(temp_path, path)
+        return size
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        _remove_file(temp_path)
+        raise
+
+
+def fetch_reference(reference: Any, path: str) -> int:
+    """Download a reference into `path`; returns the bytes written"""
+    reference = reference_id(reference)
+    started = time.time()
+    size = download_to_file(resolve_url(reference), path)
+    elapsed = max(time.time() - started, 1e-3)
+    logger.info(f"📥 Fetched {_describe(reference)}: {size / 1048576:.1f} MB in {elapsed:.2f}s "
+                f"({size / 1048576 / elapsed:.1f} MB/s)")
+    return size
+
+
+class _Prefetch:
+    def __init__(self, reference: str, path: str):
+        self.reference = reference
+        self.path = path
+        self.future = None  # Future[int]
+        self.taken = False
+
+
+_pending = {}  # reference id -> [_Prefetch] not yet claimed by a handler
+_pending_lock = threading.Lock()
+_executor = None
+
+
+def _prefetch_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _pending_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_PREFETCHES, thread_name_prefix='input-prefetch')
+        return _executor
+
+
+class JobPrefetches:
+    """The inputs one job prefetched; `discard()` drops whatever the handler didn't use"""
+
+    def __init__(self, prefetches: Optional[List[_Prefetch]] = None):
+        self.prefetches = prefetches or []
+
+    def discard(self):
+        with _pending_lock:
+            unused = [prefetch for prefetch in self.prefetches if not prefetch.taken]
+            for prefetch in unused:
+                prefetch.taken = True
+                waiting = _pending.get(prefetch.reference, [])
+                if prefetch in waiting:
+                    waiting.remove(prefetch)
+                if not waiting:
+                    _pending.pop(prefetch.reference, None)
+        for prefetch in unused:
+            if not prefetch.future.cancel():
+                prefetch.future.add_done_callback(lambda _, path=prefetch.path: _remove_file(path))
+
+
+def _references(job_input: Any) -> List[str]:
+    """Reference ids among a job input's media inputs, in order"""
+    if not isinstance(job_input, dict):
+        return []
+    values = [job_input.get(key) for key in INPUT_KEYS]
+    workflow = job_input.get('workflow')
+    if isinstance(workflow, dict):
+        for node in workflow.values():
+            inputs = node.get('inputs') if isinstance(node, dict) else None
+            if isinstance(inputs, dict):
+                values.extend(inputs.get(name) for name in NODE_INPUT_NAMES)
+    return [reference_id(value) for value in values if is_reference(value)]
+
+
+def prefetch_inputs(job_input: Any, input_dir: str = COMFYUI_INPUT_DIR) -> JobPrefetches:
+    """Start downloading a job's referenced inputs in the background; never raises"""
+    try:
+        references = _references(job_input)
+        if not references:
+            return JobPrefetches()
+        os.makedirs(input_dir, exist_ok=True)
+        executor = _prefetch_executor()
+        prefetches = []
+        for reference in references:
+            prefetch = _Prefetch(reference, os.path.join(input_dir, f".prefetch_{uuid.uuid4().hex}"))
+            prefetch.future = executor.submit(fetch_reference, reference, prefetch.path)
+            with _pending_lock:
+                _pending.setdefault(reference, []).append(prefetch)
+            prefetches.append(prefetch)
+        logger.info(f"📥 Prefetching {len(prefetches)} referenced input(s): "
+                    f"{', '.join(_describe(reference) for reference in references)}")
+        return JobPrefetches(prefetches)
+    except Exception as e:
+        logger.warning(f"⚠️ Input prefetch skipped: {e}")
+        return JobPrefetches()
+
+
+def _take(reference: str) -> Optional[_Prefetch]:
+    with _pending_lock:
+        waiting = _pending.get(reference)
+        if not waiting:
+            return None
+        prefetch = waiting.pop(0)
+        if not waiting:
+            del _pending[reference]
+        prefetch.taken = True
+        return prefetch
+
+
+def fetch_input(reference: Any, path: str) -> int:
+    """Put a referenced input at `path`, from its prefetch if there is one; returns its size"""
+    prefetch = _take(reference_id(reference))
+    if prefetch is None:
+        return fetch_reference(reference, path)
+    try:
+        size = prefetch.future.result()
+    except BaseException:
+        _remove_file(prefetch.path)
+        raise
+    shutil.move(prefetch.path, path)
+    return size
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+Streaming finalization of ComfyUI outputs.
+
+Instead of waiting for the whole prompt to show up in /history and then
+downloading/uploading every file serially, an `OutputFinalizer` hands each
+output file to a small thread pool the moment its node reports `executed`
+on the event stream. The S3 upload of early outputs (and their IMAGE_READY
+webhooks) overlaps with the rest of the graph still running.
+
+When the prompt finishes, `collect()` is called with the final /history
+outputs: anything the stream did not deliver (polling fallback, reconnects)
+is submitted then, and the results of all files are returned in the order
+they were submitted.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Callable, Iterable
+
+logger = logging.getLogger(__name__)
+
+# Uploads running in parallel per job (S3 and ComfyUI /view are both I/O bound)
+DEFAULT_MAX_WORKERS = 3
+
+
+class OutputFinalizer:
+    """Finalize each output file once, as early as its node has executed.
+
+    `process_file(node_id, file_info, index)` does the per-file work
+    (download from /view, upload, webhook) and returns a result dict or
+    None to drop the file. `index` is the 1-based order the file was seen in.
+    `accept(node_id, file_info)` can filter out intermediate outputs.
+    """
+
+    def __init__(self,
+                 process_file: Callable[[str, Dict, int], Optional[Dict]],
+                 output_keys: Iterable[str] = ('images',),
+                 accept: Optional[Callable[[str, Dict], bool]] = None,
+                 max_workers: int = DEFAULT_MAX_WORKERS):
+        self.process_file = process_file
+        self.output_keys = tuple(output_keys)
+        self.accept = accept
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='comfyui-finalize')
+        self._futures = OrderedDict()
+        self._lock = threading.Lock()
+        self.streamed = 0  # files submitted from the event stream (before the final /history pass)
+
+    def attach(self, watcher) -> 'OutputFinalizer':
+        """Start finalizing outputs as the watcher's prompt executes them"""
+        watcher.on_executed(self._on_executed)
+        return self
+
+    def _on_executed(self, node_id: str, output: Dict):
+        self.streamed += self.submit_output(node_id, output)
+
+    def submit_output(self, node_id: str, output: Dict) -> int:
+        """Queue every not-yet-seen file of one node's output; returns how many were queued"""
+        submitted = 0
+        if not isinstance(output, dict):
+            return submitted
+
+        for key in self.output_keys:
+            for file_info in output.get(key) or []:
+                if not isinstance(file_info, dict) or not file_info.get('filename'):
+                    continue
+                if self.accept and not self.accept(node_id, file_info):
+                    continue
+
+                file_key = (file_info.get('type', 'output'), file_info.get('subfolder', ''), file_info['filename'])
+                with self._lock:
+                    if file_key in self._futures:
+                        continue
+                    index = len(self._futures) + 1
+                    self._futures[file_key] = self._executor.submit(self._run, node_id, file_info, index)
+                submitted += 1
+
+        return submitted
+
+    def _run(self, node_id: str, file_info: Dict, index: int) -> Optional[Dict]:
+        try:
+            return self.process_file(node_id, file_info, index)
+        except Exception as e:
+            logger.error(f"❌ Failed to finalize output {file_info.get('filename')} from node {node_id}: {e}")
+            return None
+
+    def collect(self, outputs: Optional[Dict[str, Any]] = None, timeout: Optional[float] = None) -> List[Dict]:
+        """Submit anything left in the final outputs and wait for every file's result"""
+        for node_id, output in (outputs or {}).items():
+            self.submit_output(node_id, output)
+
+        with self._lock:
+            futures = list(self._futures.values())
+
+        results = []
+        for future in futures:
+            result = future.result(timeout=timeout)
+            if result is not None:
+                results.append(result)
+
+        if self.streamed:
+            logger.info(f"⚡ {self.streamed}/{len(futures)} outputs were finalized while the workflow was still running")
+        return results
+
+    @property
+    def submitted(self) -> int:
+        with self._lock:
+            return len(self._futures)
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+def latent_batch_size(workflow: Optional[Dict]) -> int:
+    """Largest `batch_size` input in an API-format workflow (images per saver)"""
+    batch_size = 1
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict):
+            continue
+        node_batch = (node.get('inputs') or {}).get('batch_size')
+        if isinstance(node_batch, int) and node_batch > batch_size:
+            batch_size = node_batch
+    return batch_size
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+"""
+Indexed ComfyUI workflow graph for cheap rewrites.
+
+The handlers' rewrite passes (face swap's remove_unavailable_nodes /
+fix_workflow_parameters / add_automatic_face_detection, style transfer's
+adapt_style_transfer_workflow, the skin enhancers' LoRA and size fixes)
+each deep-copied the workflow or walked every node again, and removing a
+node rescanned every input of every node to find what linked to it.
+
+`WorkflowGraph` reads an API-format workflow once into `NodeRecord`s and
+keeps three indexes up to date:
+- forward: each record's `links` (input name -> (source id, output))
+- reverse: source id -> {(consumer id, input name)}
+- class: class_type -> node ids
+
+so bypass / splice / replace / remove / prune only touch the edges they
+change. Node input dicts are copied on read (links included), which is
+all the isolation the old deep copies provided; `to_workflow()`
+serializes the result back to ComfyUI JSON once at the end.
+"""
+
+import logging
+from typing import Dict, List, Any, Optional, Tuple, Iterable, Set
+
+logger = logging.getLogger(__name__)
+
+Link = Tuple[str, int]
+
+
+def is_link(value: Any) -> bool:
+    """Whether an input value is a [node_id, output_index] link"""
+    return (isinstance(value, list) and len(value) == 2 and isinstance(value[0], (str, int))
+            and isinstance(value[1], int) and not isinstance(value[1], bool))
+
+
+class NodeRecord:
+    """One workflow node: class, inputs, and its incoming links"""
+
+    __slots__ = ('id', 'class_type', 'inputs', 'links', 'extra')
+
+    def __init__(self, node_id: str, class_type: Optional[str], inputs: Dict[str, Any], extra: Optional[Dict[str, Any]] = None):
+        self.id = node_id
+        self.class_type = class_type
+        self.inputs = inputs
+        self.links = {}  # input name -> (source id, output index)
+        self.extra = extra  # other keys such as _meta, emitted unchanged
+
+    def __repr__(self):
+        return f"NodeRecord({self.id!r}, {self.class_type!r})"
+
+
+class WorkflowGraph:
+    """API-format workflow with forward, reverse and class indexes"""
+
+    def __init__(self, workflow: Optional[Dict[str, Any]] = None):
+        self.nodes = {}  # node id -> NodeRecord, in workflow order
+        self._consumers = {}  # source id -> {(consumer id, input name)}
+        self._by_class = {}  # class_type -> {node id: None} (ordered set)
+        self._raw = {}  # entries that aren't node objects, passed through untouched
+        for node_id, node in (workflow or {}).items():
+            if not isinstance(node, dict):
+                self._raw[str(node_id)] = node
+                continue
+            extra = {key: value for key, value in node.items() if key not in ('inputs', 'class_type')}
+            self.add(str(node_id), node.get('class_type'), node.get('inputs') or {}, extra or None)
+
+    # Lookups
+
+    def __contains__(self, node_id: str) -> bool:
+        return node_id in self.nodes
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def get(self, node_id: str) -> Optional[NodeRecord]:
+        return self.nodes.get(node_id)
+
+    def by_class(self, class_type: str) -> List[NodeRecord]:
+        return [self.nodes[node_id] for node_id in self._by_class.get(class_type, ())]
+
+    def has_class(self, class_type: str) -> bool:
+        return bool(self._by_class.get(class_type))
+
+    def class_types(self) -> List[str]:
+        return list(self._by_class)
+
+    def consumers(self, node_id: str) -> List[Tuple[str, str]]:
+        """(consumer id, input name) pairs that link to a node"""
+        return sorted(self._consumers.get(node_id, ()))
+
+    # Index maintenance
+
+    def _link(self, record: NodeRecord, name: str, value: Any):
+        if is_link(value):
+            source = (str(value[0]), value[1])
+            record.links[name] = source
+            self._consumers.setdefault(source[0], set()).add((record.id, name))
+
+    def _unlink(self, record: NodeRecord, name: str):
+        source = record.links.pop(name, None)
+        if source is not None:
+            consumers = self._consumers.get(source[0])
+            if consumers is not None:
+                consumers.discard((record.id, name))
+                if not consumers:
+                    del self._consumers[source[0]]
+
+    def _index_class(self, record: NodeRecord):
+        self._by_class.setdefault(record.class_type, {})[record.id] = None
+
+    def _unindex_class(self, record: NodeRecord):
+        ids = self._by_class.get(record.class_type)
+        if ids is not None:
+            ids.pop(record.id, None)
+            if not ids:
+                del self._by_class[record.class_type]
+
+    # Edits
+
+    def add(self, node_id: str, class_type: Optional[str], inputs: Dict[str, Any], extra: Optional[Dict[str, Any]] = None) -> NodeRecord:
+        """Add (or overwrite in place) a node; inputs are copied"""
+        record = self.nodes.get(node_id)
+        if record is not None:
+            for name in list(record.links):
+                self._unlink(record, name)
+            self._unindex_class(record)
+            record.class_type, record.inputs, record.extra = class_type, {}, extra
+        else:
+            record = NodeRecord(node_id, class_type, {}, extra)
+            self.nodes[node_id] = record
+        self._index_class(record)
+        for name, value in inputs.items():
+            value = list(value) if isinstance(value, list) else value
+            record.inputs[name] = value
+            self._link(record, name, value)
+        return record
+
+    def set_input(self, node_id: str, name: str, value: Any):
+        record = self.nodes[node_id]
+        self._unlink(record, name)
+        record.inputs[name] = value
+        self._link(record, name, value)
+
+    def drop_input(self, node_id: str, name: str):
+        record = self.nodes[node_id]
+        self._unlink(record, name)
+        record.inputs.pop(name, None)
+
+    def remove(self, node_id: str, keep_consumers: bool = False) -> List[Tuple[str, str]]:
+        """Remove a node; inputs that linked to it are dropped unless `keep_consumers`
+
+        Returns the (consumer id, input name) pairs that linked to it.
+        """
+        record = self.nodes.pop(node_id)
+        for name in list(record.links):
+            self._unlink(record, name)
+        self._unindex_class(record)
+        consumers = self.consumers(node_id)
+        if not keep_consumers:
+            for consumer_id, name in consumers:
+                self.drop_input(consumer_id, name)
+        return consumers
+
+    def bypass(self, node_id: str, input_name: Optional[str] = None) -> Optional[Link]:
+        """Remove a node and wire its consumers to what feeds `input_name` (default: its first linked input)
+
+        Consumers lose the input when the node has no linked input to pass through.
+        """
+        record = self.nodes[node_id]
+        if input_name is None:
+            input_name = next(iter(record.links), None)
+        source = record.links.get(input_name) if input_name is not None else None
+        consumers = self.remove(node_id, keep_consumers=True)
+        for consumer_id, name in consumers:
+            if source is not None:
+                self.set_input(consumer_id, name, [source[0], source[1]])
+                logger.info(f"🔧 Restoring connection: {consumer_id}.{name} -> {source[0]}.{source[1]}")
+            else:
+                self.drop_input(consumer_id, name)
+                logger.info(f"🔧 Removing connection from {consumer_id}.{name} to removed node {node_id}")
+        return source
+
+    def replace(self, node_id: str, class_type: str, inputs: Dict[str, Any], extra: Optional[Dict[str, Any]] = None) -> NodeRecord:
+        """Swap a node's class and inputs in place; its consumers keep linking to it"""
+        return self.add(node_id, class_type, inputs, extra)
+
+    def splice(self, source: Link, node_id: str, class_type: str, inputs: Dict[str, Any], input_name: str,
+               consumers: Optional[Iterable[Tuple[str, str]]] = None) -> NodeRecord:
+        """Insert a node after `source`: it takes `source` on `input_name` and feeds output 0 to the consumers
+
+        `consumers` defaults to every input currently linked to `source`.
+        """
+        source = (str(source[0]), source[1])
+        if consumers is None:
+            consumers = [(consumer_id, name) for consumer_id, name in self.consumers(source[0])
+                         if self.nodes[consumer_id].links.get(name) == source]
+        consumers = list(consumers)
+        record = self.add(node_id, class_type, {**inputs, input_name: [source[0], source[1]]})
+        for consumer_id, name in consumers:
+            self.set_input(consumer_id, name, [node_id, 0])
+        return record
+
+    def upstream(self, roots: Iterable[str]) -> Set[str]:
+        """Node ids the given nodes depend on, including themselves"""
+        seen = set()
+        stack = [node_id for node_id in roots if node_id in self.nodes]
+        while stack:
+            node_id = stack.pop()
+            if node_id in seen:
+                continue
+            seen.add(node_id)
+            stack.extend(source for source, _ in self.nodes[node_id].links.values() if source in self.nodes and source not in seen)
+        return seen
+
+    def prune(self, keep: Iterable[str]) -> List[str]:
+        """Remove every node that none of `keep` depends on; returns the removed ids"""
+        live = self.upstream(keep)
+        removed = [node_id for node_id in self.nodes if node_id not in live]
+        for node_id in removed:
+            self.remove(node_id, keep_consumers=True)
+        return removed
+
+    # Output
+
+    def to_workflow(self) -> Dict[str, Any]:
+        """ComfyUI API-format JSON"""
+        workflow = {}
+        for node_id, record in self.nodes.items():
+            node = {'inputs': record.inputs, 'class_type': record.class_type}
+            if record.extra:
+                node.update(record.extra)
+            workflow[node_id] = node
+        workflow.update(self._raw)
+        return workflow
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Streaming base64 decode of job inputs straight to disk.
+
+Handlers used to `base64.b64decode()` a whole image or video string and
+then write the bytes, so the JSON string, the decoded bytes and the
+parsed job dict sat in RAM together, about 2.5x the file size for a
+large fps-boost video. `decode_base64_to_file()` skips the data-URL
+prefix without copying the string, decodes DECODE_CHUNK_CHARS characters
+at a time (whitespace and line breaks are tolerated), and writes each
+chunk to a temporary file that replaces the target once complete, so
+ComfyUI never sees a partial input. `save_base64_input()` also drops
+the string from the job input it came from once it is on disk, so peak
+memory stays at one copy of the input plus a chunk, whatever its size.
+Inputs given as a URL or S3 reference instead of base64 are fetched
+(usually already prefetched) by `fetch.fetch_input()`.
+"""
+
+import os
+import base64
+import binascii
+import logging
+import threading
+from typing import Dict, Any, Optional
+
+from .fetch import fetch_input, is_reference
+
+logger = logging.getLogger(__name__)
+
+COMFYUI_INPUT_DIR = os.environ.get('COMFYUI_INPUT_DIR', '/app/comfyui/input')
+
+# Base64 characters decoded per step (a multiple of 4: 4 MiB of text, 3 MiB of bytes)
+DECODE_CHUNK_CHARS = 4 * 1024 * 1024
+
+
+def base64_payload_start(data: str) -> int:
+    """Index where the base64 payload starts, past a `data:<mime>;base64,` prefix"""
+    if data.startswith('data:'):
+        comma = data.find(',', 0, 256)
+        if comma != -1:
+            return comma + 1
+    return 0
+
+
+def decode_base64_to_file(data: str, path: str, chunk_chars: int = DECODE_CHUNK_CHARS) -> int:
+    """Decode a base64 string (optionally a data URL) into `path`; returns the bytes written
+
+    Raises ValueError for data that isn't base64.
+    """
+    chunk_chars -= chunk_chars % 4
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    written = 0
+    carry = ''
+    try:
+        with open(temp_path, 'wb') as f:
+            for start in range(base64_payload_start(data), len(data), chunk_chars):
+                piece = carry + ''.join(data[start:start + chunk_chars].split())
+                usable = len(piece) - len(piece) % 4
+                carry = piece[usable:]
+                if usable:
+                    decoded = base64.b64decode(piece[:usable], validate=True)
+                    f.write(decoded)
+                    written += len(decoded)
+            if carry.rstrip('='):
+                # Unpadded tail
+                decoded = base64.b64decode(carry + '=' * (-len(carry) % 4), validate=True)
+                f.write(decoded)
+                written += len(decoded)
+        os.replace(temp_path, path)
+    except (binascii.Error, ValueError) as e:
+        _discard(temp_path)
+        raise ValueError(f"invalid base64 data: {e}")
+    except BaseException:
+        _discard(temp_path)
+        raise
+    return written
+
+
+def _discard(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def save_base64_input(source: Dict[str, Any], key: str, filename: str, input_dir: str = COMFYUI_INPUT_DIR) -> Optional[int]:
+    """Decode (or fetch) `source[key]` into the ComfyUI input directory and drop it from `source`
+
+    Returns the bytes written, or None when `source` has no data under `key`.
+    """
+    data = source.get(key)
+    if is_reference(data):
+        os.makedirs(input_dir, exist_ok=True)
+        written = fetch_input(data, os.path.join(input_dir, filename))
+        source[key] = None
+        return written
+    if not isinstance(data, str) or not data or data == 'None':
+        return None
+    os.makedirs(input_dir, exist_ok=True)
+    written = decode_base64_to_file(data, os.path.join(input_dir, filename))
+    # The decoded file replaces the string: let it be freed
+    source[key] = None
+    return written
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+"""
+Non-blocking sink for ComfyUI's stdout/stderr.
+
+Echoing every ComfyUI line through `print`/`logger.info` decoded each line
+on the handler's interpreter and flooded the RunPod console with custom
+node chatter. The supervisor now hands the process output to
+`ComfyUILogSink.pump()`, which:
+
+- reads the pipe in large chunks (os.read, LOG_CHUNK_SIZE) and appends
+  them undecoded to a size-rotated local file (COMFYUI_LOG_FILE)
+- keeps the last COMFYUI_LOG_TAIL_LINES lines in a ring buffer
+- only forwards warning/error lines (and tracebacks) to the console
+
+`with_log_tail()` attaches that tail to FAILED webhooks and
+`comfyui_log_tail()` to error results, so a failed job shows what ComfyUI
+printed without digging through worker logs. The tail is process-wide, so
+it is only reported when the worker runs one job at a time
+(JOB_CONCURRENCY 1); with concurrent jobs it would mix their output.
+"""
+
+import os
+import logging
+import threading
+from collections import deque
+from typing import Dict, Any, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+COMFYUI_LOG_FILE = os.environ.get('COMFYUI_LOG_FILE', '/tmp/comfyui/comfyui.log')
+LOG_MAX_BYTES = int(os.environ.get('COMFYUI_LOG_MAX_BYTES', str(20 * 1024 * 1024)))
+LOG_BACKUPS = int(os.environ.get('COMFYUI_LOG_BACKUPS', '3'))
+TAIL_LINES = int(os.environ.get('COMFYUI_LOG_TAIL_LINES', '200'))
+# The tail can't be told apart per job when several share the worker
+REPORT_TAIL = int(os.environ.get('JOB_CONCURRENCY', '1')) <= 1
+LOG_CHUNK_SIZE = 64 * 1024
+
+# Lines tailed into webhooks / results
+REPORTED_TAIL_LINES = 50
+
+# Lines that still go to the RunPod console
+CONSOLE_MARKERS = (b'WARNING', b'WARN', b'ERROR', b'CRITICAL', b'Traceback', b'Exception', b'!!!', b'Error:')
+
+
+class ComfyUILogSink:
+    """Rotating log file plus an in-memory tail of the ComfyUI process output"""
+
+    def __init__(self, path: str = COMFYUI_LOG_FILE, max_bytes: int = LOG_MAX_BYTES,
+                 backups: int = LOG_BACKUPS, tail_lines: int = TAIL_LINES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._tail = deque(maxlen=tail_lines)
+        self._lock = threading.Lock()
+        self._file = None
+        self._size = 0
+        self._in_traceback = False
+
+    def _open(self):
+        if self._file is None:
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self._file = open(self.path, 'ab')
+                self._size = self._file.tell()
+            except OSError as e:
+                logger.warning(f"⚠️ Could not open ComfyUI log file {self.path}: {e}")
+                self._file = False  # don't retry on every chunk
+        return self._file or None
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        for index in range(self.backups - 1, 0, -1):
+            source = f"{self.path}.{index}"
+            if os.path.exists(source):
+                os.replace(source, f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def write(self, chunk: bytes):
+        with self._lock:
+            f = self._open()
+            if f is None:
+                return
+            try:
+                f.write(chunk)
+                f.flush()
+                self._size += len(chunk)
+                if self._size >= self.max_bytes:
+                    self._rotate()
+            except OSError as e:
+                logger.debug(f"ComfyUI log write failed: {e}")
+
+    def _line(self, line: bytes):
+        self._tail.append(line)
+        # Tracebacks are forwarded whole: they start with "Traceback" and end at an unindented line
+        if self._in_traceback:
+            self._in_traceback = line[:1] in (b' ', b'\t')
+            logger.warning(f"[ComfyUI] {line.decode('utf-8', errors='ignore')}")
+            return
+        if any(marker in line for marker in CONSOLE_MARKERS):
+            self._in_traceback = line.startswith(b'Traceback')
+            logger.warning(f"[ComfyUI] {line.decode('utf-8', errors='ignore')}")
+
+    def pump(self, stream, on_line: Optional[Callable[[bytes], None]] = None):
+        """Drain a process pipe until EOF; `on_line` sees every complete line (undecoded)"""
+        fd = stream.fileno()
+        pending = b''
+        try:
+            while True:
+                chunk = os.read(fd, LOG_CHUNK_SIZE)
+                if not chunk:
+                    break
+                self.write(chunk)
+                lines = (pending + chunk).split(b'\n')
+                pending = lines.pop()
+                for line in lines:
+                    line = line.rstrip(b'\r')
+                    if line:
+                        self._handle(line, on_line)
+            if pending:
+                self._handle(pending.rstrip(b'\r'), on_line)
+        except OSError as e:
+            logger.debug(f"ComfyUI log reader stopped: {e}")
+
+    def _handle(self, line: bytes, on_line: Optional[Callable[[bytes], None]]):
+        # One bad line (or startup watcher hiccup) must not stop draining the pipe
+        try:
+            self._line(line)
+            if on_line is not None:
+                on_line(line)
+        except Exception as e:
+            logger.debug(f"ComfyUI log line skipped: {e}")
+
+    def tail(self, lines: int = REPORTED_TAIL_LINES) -> str:
+        recent = list(self._tail)[-lines:]
+        return '\n'.join(line.decode('utf-8', errors='ignore') for line in recent)
+
+
+_sink = None
+_sink_lock = threading.Lock()
+
+
+def get_log_sink() -> ComfyUILogSink:
+    """Process-wide ComfyUI log sink"""
+    global _sink
+    with _sink_lock:
+        if _sink is None:
+            _sink = ComfyUILogSink()
+        return _sink
+
+
+def comfyui_log_tail(lines: int = REPORTED_TAIL_LINES) -> Optional[str]:
+    """Last ComfyUI output lines, or None if nothing was captured (or jobs run concurrently)"""
+    if not REPORT_TAIL:
+        return None
+    with _sink_lock:
+        sink = _sink
+    if sink is None:
+        return None
+    return sink.tail(lines) or None
+
+
+def with_log_tail(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Copy of a webhook payload with the ComfyUI log tail added if it reports a failure"""
+    if str(data.get('status', '')).upper() != 'FAILED' or 'comfyuiLogTail' in data:
+        return data
+    tail = comfyui_log_tail()
+    return {**data, 'comfyuiLogTail': tail} if tail else data
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+LoRA-affinity ordering of the prompts a worker queues.
+
+With several jobs per worker (JOB_CONCURRENCY), LoRA-heavy text-to-image
+and skin-enhancer jobs from different users reached ComfyUI in arrival
+order, alternating LoRA stacks, and ComfyUI re-patched the UNet weights
+on every switch. `queue_with_lora_affinity()` sits in front of a
+handler's queue function:
+
+- while ComfyUI already runs LORA_AFFINITY_QUEUE_DEPTH of this worker's
+  prompts, jobs wait here instead of in ComfyUI's FIFO queue
+- when a slot frees up, the next job is the oldest waiting one whose
+  LoraLoaderModelOnly / LoraLoader stack matches the stack queued last,
+  falling back to the oldest job
+- no job is passed over once it has waited LORA_AFFINITY_MAX_DELAY
+  seconds, so reordering delays a job by at most that plus one prompt
+
+A job that finds nothing in flight is queued at once, so a worker taking
+one job at a time never waits. A job cancelled while it waits leaves the
+line without queueing. Prompts are considered done when the event
+stream reports them finished; prompts the socket doesn't cover don't hold
+a slot. Stack switches are counted as queued and as they would have been
+in arrival order; `lora_affinity_report(job_id)` returns the counts and
+the estimated time saved (LORA_SWITCH_SECONDS per avoided switch).
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable, Tuple
+
+from .events import watch_prompt
+from .cancel import job_cancelled
+
+logger = logging.getLogger(__name__)
+
+LORA_AFFINITY_ENABLED = os.environ.get('LORA_AFFINITY', '1').lower() not in ('0', 'false', 'no')
+MAX_DELAY = float(os.environ.get('LORA_AFFINITY_MAX_DELAY', '20'))
+QUEUE_DEPTH = max(1, int(os.environ.get('LORA_AFFINITY_QUEUE_DEPTH', '1')))
+SWITCH_SECONDS = float(os.environ.get('LORA_SWITCH_SECONDS', '4'))
+
+LORA_CLASSES = ('LoraLoaderModelOnly', 'LoraLoader')
+
+# How often waiting jobs re-check whether ComfyUI finished a prompt
+POLL_INTERVAL = 0.25
+MAX_REPORTS = 64
+
+
+def lora_stack(workflow: Optional[Dict]) -> Tuple:
+    """The LoRAs a workflow patches in, as a comparable key"""
+    stack = []
+    for node in (workflow or {}).values():
+        if isinstance(node, dict) and node.get('class_type') in LORA_CLASSES:
+            inputs = node.get('inputs') or {}
+            stack.append((str(inputs.get('lora_name')), str(inputs.get('strength_model')), str(inputs.get('strength_clip'))))
+    return tuple(sorted(stack))
+
+
+class _Waiter:
+    def __init__(self, job_id: str, stack: Tuple):
+        self.job_id = job_id
+        self.stack = stack
+        self.arrived = time.time()
+
+
+class LoraAffinityScheduler:
+    """Orders this worker's prompts so identical LoRA stacks run back to back"""
+
+    def __init__(self, max_delay: float = MAX_DELAY, depth: int = QUEUE_DEPTH, enabled: bool = LORA_AFFINITY_ENABLED):
+        self.max_delay = max_delay
+        self.depth = depth
+        self.enabled = enabled
+        self.switches = 0  # stack switches in the order prompts were queued
+        self.fifo_switches = 0  # switches had they been queued in arrival order
+        self._waiting = []  # _Waiter, in arrival order
+        self._inflight = {}  # prompt id (or a waiter still queueing) -> job id
+        self._last_stack = None
+        self._last_arrival_stack = None
+        self._reports = OrderedDict()
+        self._condition = threading.Condition()
+
+    def _prune(self):
+        for key in list(self._inflight):
+            if isinstance(key, str):
+                watcher = watch_prompt(key)
+                if watcher.finished or not watcher.live:
+                    del self._inflight[key]
+
+    def _pick(self) -> _Waiter:
+        oldest = self._waiting[0]
+        if time.time() - oldest.arrived >= self.max_delay:
+            return oldest
+        for waiter in self._waiting:
+            if waiter.stack == self._last_stack:
+                return waiter
+        return oldest
+
+    def queue(self, job_id: str, workflow: Dict, queue: Callable[[], Optional[str]]) -> Optional[str]:
+        """Wait for this job's turn, then call `queue()` and return its prompt id
+
+        Returns None without queueing if the job is cancelled while waiting.
+        """
+        if not self.enabled:
+            return queue()
+
+        waiter = _Waiter(job_id, lora_stack(workflow))
+        with self._condition:
+            if waiter.stack != self._last_arrival_stack:
+                self.fifo_switches += 1
+                self._last_arrival_stack = waiter.stack
+            self._waiting.append(waiter)
+            while True:
+                if job_cancelled(job_id):
+                    self._waiting.remove(waiter)
+                    self._condition.notify_all()
+                    logger.info(f"🛑 Job {job_id} cancelled while waiting for its LoRA-affinity turn")
+                    return None
+                self._prune()
+                if len(self._inflight) < self.depth and self._pick() is waiter:
+                    break
+                self._condition.wait(POLL_INTERVAL)
+            jumped = self._waiting.index(waiter)
+            self._waiting.remove(waiter)
+            switched = waiter.stack != self._last_stack
+            if switched:
+                self.switches += 1
+            self._last_stack = waiter.stack
+            self._inflight[waiter] = job_id
+            self._record(waiter, jumped, switched)
+            self._condition.notify_all()
+
+        prompt_id = None
+        try:
+            prompt_id = queue()
+            return prompt_id
+        finally:
+            with self._condition:
+                del self._inflight[waiter]
+                if prompt_id:
+                    self._inflight[prompt_id] = job_id
+                self._condition.notify_all()
+
+    def _record(self, waiter: _Waiter, jumped: int, switched: bool):
+        avoided = max(0, self.fifo_switches - self.switches)
+        report = {
+            'loras': len(waiter.stack),
+            'waited_seconds': round(time.time() - waiter.arrived, 2),
+            'jumped_ahead_of': jumped,
+            'stack_switch': switched,
+            'worker_switches': self.switches,
+            'arrival_order_switches': self.fifo_switches,
+            'estimated_seconds_saved': round(avoided * SWITCH_SECONDS, 1)
+        }
+        self._reports[waiter.job_id] = report
+        while len(self._reports) > MAX_REPORTS:
+            self._reports.popitem(last=False)
+        if jumped:
+            logger.info(f"🎯 Job {waiter.job_id} moved ahead of {jumped} waiting job(s) to reuse the patched LoRA stack")
+        if waiter.stack and (jumped or switched):
+            logger.info(f"🎯 LoRA stack switches on this worker: {self.switches} (arrival order: {self.fifo_switches}, "
+                        f"~{report['estimated_seconds_saved']:.0f}s saved)")
+
+    def report(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._condition:
+            return self._reports.pop(job_id, None)
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_lora_scheduler() -> LoraAffinityScheduler:
+    """Process-wide LoRA-affinity scheduler"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LoraAffinityScheduler()
+        return _scheduler
+
+
+def queue_with_lora_affinity(job_id: str, workflow: Dict, queue: Callable[[], Optional[str]]) -> Optional[str]:
+    """Queue through the LoRA-affinity scheduler; `queue()` is the handler's own queue call"""
+    return get_lora_scheduler().queue(job_id, workflow, queue)
+
+
+def lora_affinity_report(job_id: str) -> Optional[Dict[str, Any]]:
+    """Wait, reordering and stack-switch counts for a job, for its result"""
+    return get_lora_scheduler().report(job_id)
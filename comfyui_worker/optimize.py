@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Pre-queue workflow optimizer.
+
+Frontend-built workflows carry nodes nothing saves: PreviewImage nodes,
+loaders left over from an earlier version of the graph, UI-only nodes.
+ComfyUI validates all of them and executes every preview (and whatever
+feeds it), and the residency check counted the models of dead loaders.
+`optimize_workflow()` runs right before each handler queues a workflow:
+
+- it walks back from the saving outputs (SaveImage, SaveVideo,
+  VHS_VideoCombine, ...) and drops every node none of them depends on;
+  a workflow without such outputs keeps its preview nodes as outputs,
+  and one without any outputs is left alone. Output nodes are the classes
+  the cached node catalog flags `output_node`; class-name markers only
+  stand in for classes the catalog doesn't know, or when there is none
+- it collapses pass-throughs that don't change their input: Reroute
+  nodes, and LoRA loaders at strength 0, whose consumers are wired
+  straight to the loader's model (and clip) source
+
+Node ids of the nodes that remain are unchanged. The per-job log line
+gives the nodes removed and an estimate of the execution time ComfyUI
+no longer spends on them: the mean from the node histograms for this
+generation type where there are samples, the progress tracker's
+per-class estimate otherwise.
+"""
+
+import logging
+from typing import Dict, List, Any, Optional, Set
+
+from .graph import WorkflowGraph
+from .catalog import NodeCatalog, cached_node_catalog
+from .progress import WorkflowProgress, reachable_nodes
+from .profiler import load_histograms
+from .templates import RenderedWorkflow
+
+logger = logging.getLogger(__name__)
+
+# Class-name markers of output nodes, used when the node catalog can't tell
+SAVE_MARKERS = ('Save', 'VideoCombine')
+PREVIEW_MARKERS = ('Preview',)
+
+REROUTE_CLASSES = ('Reroute',)
+
+# LoRA loaders: strength inputs, and the input passed through on each output
+LORA_PASS_THROUGH = {
+    'LoraLoaderModelOnly': (('strength_model',), ('model',)),
+    'LoraLoader': (('strength_model', 'strength_clip'), ('model', 'clip')),
+}
+
+
+def _is_output(class_type: Optional[str], markers) -> bool:
+    return bool(class_type) and any(marker in class_type for marker in markers)
+
+
+def _is_zero(value: Any) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value == 0
+
+
+def _collapse(graph: WorkflowGraph, node_id: str, passed: tuple) -> bool:
+    """Wire consumers of each output straight to the input it passes through"""
+    record = graph.get(node_id)
+    sources = [record.links.get(name) for name in passed]
+    if any(source is None for source in sources):
+        return False
+    for consumer_id, name in graph.consumers(node_id):
+        output = graph.get(consumer_id).links[name][1]
+        if output >= len(sources):
+            return False
+    for consumer_id, name in graph.consumers(node_id):
+        source = sources[graph.get(consumer_id).links[name][1]]
+        graph.set_input(consumer_id, name, [source[0], source[1]])
+    graph.remove(node_id, keep_consumers=True)
+    return True
+
+
+def collapse_pass_throughs(graph: WorkflowGraph) -> List[str]:
+    """Remove nodes that hand their input through unchanged; returns their ids"""
+    removed = []
+    for class_type in REROUTE_CLASSES:
+        for record in graph.by_class(class_type):
+            if _collapse(graph, record.id, (next(iter(record.links), None),)):
+                removed.append(record.id)
+    for class_type, (strengths, passed) in LORA_PASS_THROUGH.items():
+        for record in graph.by_class(class_type):
+            if all(_is_zero(record.inputs.get(name)) for name in strengths) and _collapse(graph, record.id, passed):
+                removed.append(record.id)
+    return removed
+
+
+def _output_kind(class_type: Optional[str], catalog: Optional[NodeCatalog]) -> Optional[str]:
+    """'save' or 'preview' for output nodes, None otherwise"""
+    flagged = catalog.is_output_node(class_type) if catalog is not None and class_type else None
+    if flagged is None:
+        flagged = _is_output(class_type, SAVE_MARKERS + PREVIEW_MARKERS)
+    if not flagged:
+        return None
+    return 'preview' if _is_output(class_type, PREVIEW_MARKERS) else 'save'
+
+
+def output_nodes(graph: WorkflowGraph, catalog: Optional[NodeCatalog] = None) -> List[str]:
+    """Saving output nodes, or the preview nodes when nothing saves"""
+    kinds = {node_id: _output_kind(record.class_type, catalog) for node_id, record in graph.nodes.items()}
+    saves = [node_id for node_id, kind in kinds.items() if kind == 'save']
+    if saves:
+        return saves
+    return [node_id for node_id, kind in kinds.items() if kind == 'preview']
+
+
+def estimated_seconds(workflow: Dict[str, Any], node_ids: Set[str], generation_type: Optional[str] = None) -> float:
+    """Rough execution time of some of a workflow's nodes"""
+    histograms = load_histograms(generation_type) if generation_type else {}
+    total = 0.0
+    for node_id in node_ids:
+        node = workflow[node_id]
+        histogram = histograms.get(node.get('class_type')) or {}
+        if histogram.get('count'):
+            total += histogram['sum'] / histogram['count']
+        else:
+            total += WorkflowProgress({node_id: node}).expected_seconds
+    return total
+
+
+def optimize_workflow(workflow: Dict[str, Any], job_id: str, generation_type: Optional[str] = None) -> Dict[str, Any]:
+    """Workflow without dead nodes and no-op pass-throughs; never raises"""
+    try:
+        graph = WorkflowGraph(workflow)
+        outputs = output_nodes(graph, cached_node_catalog())
+        if not outputs:
+            return workflow
+
+        collapsed = collapse_pass_throughs(graph)
+        pruned = graph.prune(outputs)
+        if not collapsed and not pruned:
+            return workflow
+
+        # Only nodes ComfyUI would have executed cost time; unused loaders were merely validated
+        executed = reachable_nodes(workflow)
+        removed = set(collapsed) | set(pruned)
+        seconds = estimated_seconds(workflow, removed & executed, generation_type)
+        logger.info(f"✂️ Optimized workflow for job {job_id}: removed {len(removed)} of {len(workflow)} nodes "
+                    f"({len(pruned)} unreachable, {len(collapsed)} pass-through), ~{seconds:.1f}s of execution saved")
+        optimized = graph.to_workflow()
+        if isinstance(workflow, RenderedWorkflow):
+            # Still a subset of the template, so the catalog check it passed still holds
+            optimized = RenderedWorkflow(optimized, workflow.template, workflow.version, workflow.prevalidated)
+        return optimized
+    except Exception as e:
+        logger.warning(f"⚠️ Workflow optimization skipped for job {job_id}: {e}")
+        return workflow
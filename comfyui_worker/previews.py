@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Opt-in live sampler previews.
+
+ComfyUI pushes a preview frame over the websocket for every sampler step
+when it runs with --preview-method. With the default latent2rgb method the
+frames are a cheap projection of the latent (no VAE decode), so enabling it
+adds no real GPU work.
+
+A `PreviewForwarder` takes those frames for one prompt, keeps at most one
+every LIVE_PREVIEW_INTERVAL seconds, downscales it to a small JPEG/WebP and
+hands it to the job's webhook, either inline as a data URL or as an S3 key
+that is overwritten in place. Jobs opt in with `"live_preview": true` (or
+`"s3"` for S3 delivery) in the job input.
+"""
+
+import io
+import os
+import time
+import base64
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional, Callable
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# latent2rgb is nearly free; "auto"/"taesd" give nicer previews at the cost of a small decoder
+PREVIEW_METHOD = os.environ.get('COMFYUI_PREVIEW_METHOD', 'latent2rgb')
+
+LIVE_PREVIEW_INTERVAL = float(os.environ.get('LIVE_PREVIEW_INTERVAL', '2.0'))
+LIVE_PREVIEW_MAX_SIZE = int(os.environ.get('LIVE_PREVIEW_MAX_SIZE', '256'))
+LIVE_PREVIEW_FORMAT = os.environ.get('LIVE_PREVIEW_FORMAT', 'JPEG').upper()  # JPEG or WEBP
+LIVE_PREVIEW_QUALITY = int(os.environ.get('LIVE_PREVIEW_QUALITY', '70'))
+
+PREVIEW_MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png'}
+PREVIEW_EXTENSIONS = {'JPEG': 'jpg', 'WEBP': 'webp', 'PNG': 'png'}
+
+
+def preview_launch_args() -> List[str]:
+    """ComfyUI command line flags that turn on sampler preview frames"""
+    if not PREVIEW_METHOD or PREVIEW_METHOD == 'none':
+        return []
+    return ['--preview-method', PREVIEW_METHOD]
+
+
+def live_preview_mode(job_input: Dict[str, Any]) -> Optional[str]:
+    """Return 'webhook', 's3' or None depending on the job's live_preview option"""
+    option = job_input.get('live_preview', job_input.get('livePreview'))
+    if not option or PREVIEW_METHOD == 'none':
+        return None
+    if isinstance(option, str) and option.lower() == 's3':
+        return 's3'
+    return 'webhook'
+
+
+class PreviewForwarder:
+    """Rate-limited, downscaled delivery of one prompt's sampler previews.
+
+    `send(preview)` receives a dict with either `image` (data URL) or `url`
+    (S3) plus `width`, `height`, `node` and a running `seq` number; the
+    handler wraps it into its own webhook payload. When `s3_client` and
+    `s3_bucket` are given, frames overwrite `<s3_prefix>/live.<ext>` instead
+    of being inlined. Nothing is sent once the watched prompt has finished,
+    so a late preview can never follow the completion webhook.
+    """
+
+    def __init__(self,
+                 send: Callable[[Dict], Any],
+                 interval: float = LIVE_PREVIEW_INTERVAL,
+                 max_size: int = LIVE_PREVIEW_MAX_SIZE,
+                 image_format: str = LIVE_PREVIEW_FORMAT,
+                 s3_client=None,
+                 s3_bucket: Optional[str] = None,
+                 s3_prefix: str = 'previews'):
+        self.send = send
+        self.interval = interval
+        self.max_size = max_size
+        self.image_format = image_format if image_format in PREVIEW_MIME_TYPES else 'JPEG'
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.s3_key = f"{s3_prefix.rstrip('/')}/live.{PREVIEW_EXTENSIONS[self.image_format]}"
+        self.sent = 0
+        self.dropped = 0
+        self._watcher = None
+        self._last_sent = 0.0
+        self._busy = False
+        self._closed = False
+        self._lock = threading.Lock()
+        # One worker: a frame still being encoded/sent makes newer ones drop instead of queueing up
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='comfyui-preview')
+
+    def attach(self, watcher) -> 'PreviewForwarder':
+        self._watcher = watcher
+        watcher.on_preview(self._on_preview)
+        return self
+
+    def _on_preview(self, image_bytes: bytes, mime_type: str, node_id: Optional[str]):
+        now = time.time()
+        with self._lock:
+            if self._closed or self._busy or now - self._last_sent < self.interval:
+                self.dropped += 1
+                return
+            self._busy = True
+            self._last_sent = now
+        self._executor.submit(self._deliver, image_bytes, mime_type, node_id)
+
+    def _encode(self, image_bytes: bytes, mime_type: str):
+        """Downscale to max_size on the long edge; returns (bytes, mime_type, width, height)"""
+        if Image is None:
+            return image_bytes, mime_type, None, None
+
+        image = Image.open(io.BytesIO(image_bytes))
+        image = image.convert('RGB')
+        image.thumbnail((self.max_size, self.max_size))
+
+        buffer = io.BytesIO()
+        image.save(buffer, format=self.image_format, quality=LIVE_PREVIEW_QUALITY)
+        return buffer.getvalue(), PREVIEW_MIME_TYPES[self.image_format], image.width, image.height
+
+    def _deliver(self, image_bytes: bytes, mime_type: str, node_id: Optional[str]):
+        try:
+            data, data_mime, width, height = self._encode(image_bytes, mime_type)
+            preview = {
+                'seq': self.sent + 1,
+                'node': node_id,
+                'width': width,
+                'height': height,
+                'mime_type': data_mime
+            }
+
+            if self.s3_client and self.s3_bucket:
+                self.s3_client.put_object(
+                    Bucket=self.s3_bucket,
+                    Key=self.s3_key,
+                    Body=data,
+                    ContentType=data_mime,
+                    CacheControl='no-cache'
+                )
+                preview['s3_key'] = self.s3_key
+                preview['url'] = f"https://{self.s3_bucket}.s3.amazonaws.com/{self.s3_key}?v={preview['seq']}"
+            else:
+                preview['image'] = f"data:{data_mime};base64,{base64.b64encode(data).decode('utf-8')}"
+
+            if self._closed or (self._watcher is not None and self._watcher.finished):
+                return
+            self.send(preview)
+            self.sent += 1
+        except Exception as e:
+            logger.warning(f"⚠️ Could not deliver live preview: {e}")
+        finally:
+            with self._lock:
+                self._busy = False
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._executor.shutdown(wait=False)
+        if self.sent:
+            logger.info(f"🖼️ Sent {self.sent} live previews ({self.dropped} frames skipped by rate limit)")
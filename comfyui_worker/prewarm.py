@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+"""
+Boot-time ComfyUI prewarm.
+
+Each handler's `prepare_comfyui_environment()` (model checks + starting
+ComfyUI) used to run inside the first job, so every cold worker made that
+job wait for the whole ComfyUI startup. Handlers now call `start_prewarm()`
+right before `runpod.serverless.start()`: the preparation runs on a
+background thread while the worker registers and fetches its first job,
+and the job only awaits the readiness future via `wait_for_comfyui()`.
+
+If the prewarm failed (or never ran, e.g. the module was imported by a
+test), `wait_for_comfyui()` runs the preparation itself as before, one
+job at a time when the worker runs several. Later jobs also wait here
+while the supervisor restarts or recycles ComfyUI.
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Optional
+
+from .supervisor import get_supervisor
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_future = None
+_lock = threading.Lock()
+_prepare_lock = threading.Lock()  # concurrent jobs must not launch ComfyUI twice
+
+
+def _run_steps(steps) -> bool:
+    started = time.time()
+    for step in steps:
+        if not step():
+            logger.error(f"❌ ComfyUI prewarm step {getattr(step, '__name__', step)} failed after {time.time() - started:.1f}s")
+            return False
+    logger.info(f"🔥 ComfyUI prewarmed in {time.time() - started:.1f}s")
+    return True
+
+
+def start_prewarm(*steps: Callable[[], bool]) -> Future:
+    """Run the preparation steps (in order, stopping at the first falsy one) in the background"""
+    global _executor, _future
+    with _lock:
+        if _future is None:
+            logger.info("🔥 Prewarming ComfyUI in the background before accepting jobs")
+            _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='comfyui-prewarm')
+            _future = _executor.submit(_run_steps, steps)
+        return _future
+
+
+def readiness() -> Optional[Future]:
+    """The prewarm future, or None when no prewarm was started"""
+    return _future
+
+
+def wait_for_comfyui(prepare: Callable[[], bool]) -> bool:
+    """Await the boot-time prewarm, falling back to `prepare()` if it didn't succeed"""
+    future = _future
+    if future is not None:
+        if not future.done():
+            logger.info("⏳ Waiting for ComfyUI prewarm to finish...")
+        try:
+            if future.result() and get_supervisor().wait_ready():
+                return True
+            logger.warning("⚠️ ComfyUI prewarm failed, preparing again for this job")
+        except Exception as e:
+            logger.warning(f"⚠️ ComfyUI prewarm did not complete ({e}), preparing again for this job")
+    with _prepare_lock:
+        return prepare()
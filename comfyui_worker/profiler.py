@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Per-node execution profiles and rolling per-class latency histograms.
+
+The event stream records when every node of a prompt starts and finishes
+(see events.PromptWatcher.node_timings). `profile_prompt()` turns that into
+a wall-time breakdown per node id and class_type, which the handlers return
+in the job result, and `record_node_histograms()` folds it into one
+histogram file per generation type under NODE_HISTOGRAM_DIR on the network
+volume, so slow classes (UNETLoader, CLIPTextEncode, KSampler, VAEDecode,
+SaveVideo, ...) can be compared by p50/p95 across all workers.
+
+Histograms use fixed log-spaced buckets; when a class passes
+HISTOGRAM_WINDOW samples every bucket is halved, so old runs fade out.
+"""
+
+import os
+import json
+import time
+import logging
+from typing import Dict, List, Any, Optional
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+NODE_HISTOGRAM_DIR = os.environ.get('NODE_HISTOGRAM_DIR', '/runpod-volume/comfyui_node_histograms')
+HISTOGRAM_WINDOW = int(os.environ.get('NODE_HISTOGRAM_WINDOW', '1000'))
+
+# Upper bounds (seconds) of the histogram buckets: 50ms doubling up to ~27 minutes, then overflow
+BUCKET_BOUNDS = [0.05 * 2 ** i for i in range(16)]
+
+
+def profile_prompt(watcher, workflow: Optional[Dict] = None) -> Dict[str, Any]:
+    """Wall time per executed node plus totals per class_type"""
+    workflow = workflow or {}
+    finished = watcher.finished_at or time.time()
+    nodes = []
+    by_class = {}
+
+    for node_id, started, ended in watcher.node_timings:
+        class_type = (workflow.get(node_id) or {}).get('class_type', 'unknown')
+        seconds = round(max(0.0, (ended or finished) - started), 3)
+        nodes.append({'node': node_id, 'class_type': class_type, 'seconds': seconds})
+        by_class[class_type] = round(by_class.get(class_type, 0.0) + seconds, 3)
+
+    for node_id in watcher.cached_nodes:
+        class_type = (workflow.get(node_id) or {}).get('class_type', 'unknown')
+        nodes.append({'node': node_id, 'class_type': class_type, 'seconds': 0.0, 'cached': True})
+
+    return {
+        'nodes': nodes,
+        'by_class': dict(sorted(by_class.items(), key=lambda item: item[1], reverse=True)),
+        'total': round(sum(by_class.values()), 3)
+    }
+
+
+def _bucket(seconds: float) -> int:
+    for index, bound in enumerate(BUCKET_BOUNDS):
+        if seconds <= bound:
+            return index
+    return len(BUCKET_BOUNDS)
+
+
+def histogram_percentile(histogram: Dict[str, Any], q: float) -> Optional[float]:
+    """Upper bucket bound at quantile q (an overestimate by at most one bucket)"""
+    buckets = histogram.get('buckets') or []
+    total = sum(buckets)
+    if not total:
+        return None
+    running = 0
+    for index, count in enumerate(buckets):
+        running += count
+        if running >= q * total:
+            return BUCKET_BOUNDS[index] if index < len(BUCKET_BOUNDS) else float('inf')
+    return float('inf')
+
+
+def _histogram_path(generation_type: str) -> str:
+    return os.path.join(NODE_HISTOGRAM_DIR, f"{generation_type}.json")
+
+
+def load_histograms(generation_type: str) -> Dict[str, Any]:
+    try:
+        with open(_histogram_path(generation_type)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def record_node_histograms(generation_type: str, profile: Dict[str, Any]):
+    """Add one job's per-class times to the generation type's histogram file"""
+    if not os.path.isdir(os.path.dirname(NODE_HISTOGRAM_DIR)):
+        return  # network volume not mounted
+
+    path = _histogram_path(generation_type)
+    try:
+        os.makedirs(NODE_HISTOGRAM_DIR, exist_ok=True)
+        with open(f"{path}.lock", 'w') as lock:
+            # Workers on other pods update the same file
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+
+            histograms = load_histograms(generation_type)
+            for node in profile.get('nodes', []):
+                if node.get('cached'):
+                    continue
+                histogram = histograms.setdefault(node['class_type'], {
+                    'buckets': [0] * (len(BUCKET_BOUNDS) + 1),
+                    'count': 0,
+                    'sum': 0.0
+                })
+                histogram['buckets'][_bucket(node['seconds'])] += 1
+                histogram['count'] += 1
+                histogram['sum'] = round(histogram['sum'] + node['seconds'], 3)
+
+                if histogram['count'] > HISTOGRAM_WINDOW:
+                    histogram['buckets'] = [count // 2 for count in histogram['buckets']]
+                    histogram['sum'] = round(histogram['sum'] / 2, 3)
+                    histogram['count'] = sum(histogram['buckets'])
+
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(histograms, f, separators=(',', ':'))
+            os.replace(temp_path, path)
+    except Exception as e:
+        logger.warning(f"⚠️ Could not update node histograms for {generation_type}: {e}")
+
+
+def finish_node_profile(watcher, workflow: Optional[Dict], generation_type: str) -> Dict[str, Any]:
+    """Profile a finished prompt, log its slowest classes and update the histograms"""
+    profile = profile_prompt(watcher, workflow)
+    if not profile['nodes']:
+        return profile
+
+    slowest = ', '.join(f"{class_type} {seconds:.1f}s" for class_type, seconds in list(profile['by_class'].items())[:5])
+    logger.info(f"🔬 Node profile ({profile['total']:.1f}s): {slowest}")
+    record_node_histograms(generation_type, profile)
+    return profile
+
+
+def histogram_report(generation_type: str) -> List[Dict[str, Any]]:
+    """Classes of one generation type ordered by p95 latency"""
+    report = []
+    for class_type, histogram in load_histograms(generation_type).items():
+        if not histogram.get('count'):
+            continue
+        report.append({
+            'class_type': class_type,
+            'count': histogram['count'],
+            'mean': round(histogram['sum'] / histogram['count'], 3),
+            'p50': histogram_percentile(histogram, 0.5),
+            'p95': histogram_percentile(histogram, 0.95)
+        })
+    return sorted(report, key=lambda row: row['p95'], reverse=True)
+
+
+if __name__ == '__main__':
+    # python -m comfyui_worker.profiler skin_enhancement
+    import sys
+    for row in histogram_report(sys.argv[1] if len(sys.argv) > 1 else 'text_to_image'):
+        print(f"{row['class_type']:<40} n={row['count']:<6} mean={row['mean']:<8} p50<={row['p50']:<8} p95<={row['p95']}")
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Workflow-aware progress for ComfyUI prompts.
+
+Instead of guessing from elapsed time, a `WorkflowProgress` walks the
+submitted API-format workflow once and assigns every node that will run an
+amount of work: sampler nodes count their `steps` (resolving SamplerCustom
+sigmas back to the scheduler), VAE decode and upscale passes get a fixed
+cost that grows with the video `length` / batch size, loaders and encoders
+a small one. While the prompt runs, the node order and per-step `progress`
+events from the websocket (see events.PromptWatcher) are folded into one
+global fraction, so the bar keeps moving through every pass instead of
+parking at a hard-coded percentage.
+
+Without a live event stream the fraction falls back to elapsed time against
+the graph's expected duration, capped below completion.
+"""
+
+import os
+import logging
+from typing import Dict, Any, Optional, Set
+
+logger = logging.getLogger(__name__)
+
+# Relative cost of one unit of work (one sampler step on the workflow's latent)
+DECODE_UNITS = 2.0  # VAE decode of one image
+DECODE_UNITS_PER_FRAME = 0.1  # extra decode cost per video frame
+ENCODE_UNITS = 1.0  # VAE encode of an input image
+UPSCALE_UNITS = 3.0  # model/latent upscale pass
+LOADER_UNITS = 1.0  # checkpoint/UNet/CLIP/VAE/LoRA load
+TEXT_ENCODE_UNITS = 0.5
+SAVE_UNITS = 0.5
+SAVE_UNITS_PER_FRAME = 0.05  # video encoders write every frame
+OTHER_UNITS = 0.2
+
+# Fallback pacing when no events are available (overridable per deployment)
+SECONDS_PER_UNIT = float(os.environ.get('PROGRESS_SECONDS_PER_UNIT', '1.5'))
+TIME_ESTIMATE_CAP = 0.9  # a time-based guess never claims the prompt is done
+
+SAMPLER_CLASSES = ('KSampler', 'KSamplerAdvanced', 'SamplerCustom', 'SamplerCustomAdvanced')
+FRAME_INPUTS = ('length', 'video_frames', 'num_frames', 'frame_count')
+OUTPUT_CLASS_MARKERS = ('Save', 'Preview', 'VideoCombine')
+
+
+def _is_link(value: Any) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def resolve_int(workflow: Dict, value: Any, keys=('value', 'int', 'steps'), depth: int = 4) -> Optional[int]:
+    """Literal int, or the int behind a link to a primitive/scheduler node"""
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if _is_link(value) and depth > 0:
+        source = workflow.get(str(value[0]))
+        if isinstance(source, dict):
+            inputs = source.get('inputs') or {}
+            for key in keys:
+                if key in inputs:
+                    return resolve_int(workflow, inputs[key], keys, depth - 1)
+    return None
+
+
+def is_sampler(class_type: str, inputs: Dict) -> bool:
+    """Nodes that run denoising steps (KSampler family, SamplerCustom, UltimateSDUpscale, ...)"""
+    if class_type in SAMPLER_CLASSES:
+        return True
+    if 'Sampler' in class_type and 'sigmas' in inputs:
+        return True
+    return 'steps' in inputs and 'Scheduler' not in class_type
+
+
+def sampler_steps(workflow: Dict, node: Dict) -> int:
+    """Number of denoising steps a sampler node will run"""
+    inputs = node.get('inputs') or {}
+
+    if 'sigmas' in inputs:
+        steps = resolve_int(workflow, inputs['sigmas'], keys=('steps',))
+    else:
+        steps = resolve_int(workflow, inputs.get('steps'))
+    steps = steps or 0
+
+    # KSamplerAdvanced only runs the [start_at_step, end_at_step) window
+    start = resolve_int(workflow, inputs.get('start_at_step'))
+    end = resolve_int(workflow, inputs.get('end_at_step'))
+    if start is not None or end is not None:
+        end = steps if end is None else min(end, steps)
+        steps = max(0, end - (start or 0))
+
+    return steps
+
+
+def workflow_frames(workflow: Dict) -> int:
+    """Largest video length in the workflow (1 for still images)"""
+    frames = 1
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        inputs = node.get('inputs') or {}
+        for key in FRAME_INPUTS:
+            value = resolve_int(workflow, inputs.get(key))
+            if value and value > frames:
+                frames = value
+    return frames
+
+
+def reachable_nodes(workflow: Dict) -> Set[str]:
+    """Nodes ComfyUI will actually execute: output nodes and everything they depend on"""
+    outputs = [
+        node_id for node_id, node in workflow.items()
+        if isinstance(node, dict) and any(marker in node.get('class_type', '') for marker in OUTPUT_CLASS_MARKERS)
+    ]
+    if not outputs:
+        return {node_id for node_id, node in workflow.items() if isinstance(node, dict)}
+
+    seen = set()
+    stack = list(outputs)
+    while stack:
+        node_id = stack.pop()
+        if node_id in seen or not isinstance(workflow.get(node_id), dict):
+            continue
+        seen.add(node_id)
+        for value in (workflow[node_id].get('inputs') or {}).values():
+            if _is_link(value):
+                stack.append(str(value[0]))
+    return seen
+
+
+def node_stage(class_type: Optional[str]) -> str:
+    """Coarse stage name for the node that is executing"""
+    if not class_type:
+        return 'processing'
+    if 'Loader' in class_type:
+        return 'loading_models'
+    if 'Sampler' in class_type:
+        return 'sampling'
+    if 'Upscale' in class_type:
+        return 'upscaling'
+    if 'Decode' in class_type:
+        return 'decoding'
+    if 'TextEncode' in class_type:
+        return 'processing_prompt'
+    if any(marker in class_type for marker in OUTPUT_CLASS_MARKERS):
+        return 'saving'
+    return 'processing'
+
+
+class WorkflowProgress:
+    """Global progress of one prompt, weighted by the work each node represents.
+
+    Call `update(watcher, elapsed)` on every monitor tick, then read
+    `percent(start, end)` to map the fraction into the handler's own range
+    (e.g. 10-95 with the remaining share reserved for uploads). The fraction
+    never goes backwards.
+    """
+
+    def __init__(self, workflow: Optional[Dict], seconds_per_unit: float = SECONDS_PER_UNIT):
+        self.workflow = workflow or {}
+        self.frames = workflow_frames(self.workflow)
+        self.batch_size = self._batch_size()
+        self.classes = {}
+        self.units = {}
+        self.steps = {}
+
+        for node_id in reachable_nodes(self.workflow):
+            node = self.workflow[node_id]
+            class_type = node.get('class_type', '')
+            self.classes[node_id] = class_type
+            self.units[node_id] = self._node_units(node_id, node)
+
+        self.total_units = sum(self.units.values()) or 1.0
+        self.total_steps = sum(self.steps.values())
+        self.expected_seconds = self.total_units * seconds_per_unit
+        self.historical = False  # expected_seconds measured from similar jobs (see timings.JobTimings)
+        self.fraction = 0.0
+        self.current_node = None
+        self.steps_done = 0
+
+    def _batch_size(self) -> int:
+        batch_size = 1
+        for node in self.workflow.values():
+            if isinstance(node, dict):
+                value = resolve_int(self.workflow, (node.get('inputs') or {}).get('batch_size'))
+                if value and value > batch_size:
+                    batch_size = value
+        return batch_size
+
+    def _node_units(self, node_id: str, node: Dict) -> float:
+        class_type = node.get('class_type', '')
+        inputs = node.get('inputs') or {}
+
+        if is_sampler(class_type, inputs):
+            self.steps[node_id] = sampler_steps(self.workflow, node)
+            if 'Upscale' in class_type:  # e.g. UltimateSDUpscale: upscale plus a tiled sampling pass
+                return self.steps[node_id] + UPSCALE_UNITS
+            return float(self.steps[node_id])
+        if 'Loader' in class_type:
+            return LOADER_UNITS
+        if 'Upscale' in class_type:
+            return UPSCALE_UNITS * self.batch_size
+        if 'VAEDecode' in class_type:
+            return DECODE_UNITS * self.batch_size + DECODE_UNITS_PER_FRAME * (self.frames - 1)
+        if 'VAEEncode' in class_type:
+            return ENCODE_UNITS
+        if 'TextEncode' in class_type:
+            return TEXT_ENCODE_UNITS
+        if any(marker in class_type for marker in OUTPUT_CLASS_MARKERS):
+            return SAVE_UNITS + SAVE_UNITS_PER_FRAME * (self.frames - 1)
+        return OTHER_UNITS
+
+    def update(self, watcher=None, elapsed: Optional[float] = None) -> float:
+        """Refresh the fraction from the watcher's events, or from elapsed time when not live"""
+        if watcher is not None and watcher.live:
+            fraction = self._event_fraction(watcher)
+        elif elapsed is not None:
+            fraction = min(TIME_ESTIMATE_CAP, elapsed / max(self.expected_seconds, 1.0))
+        else:
+            return self.fraction
+
+        self.fraction = max(self.fraction, min(1.0, fraction))
+        return self.fraction
+
+    def _event_fraction(self, watcher) -> float:
+        if watcher.finished:
+            self.current_node = None
+            return 1.0
+
+        cached = set(watcher.cached_nodes)
+        completed = [node_id for node_id in watcher.completed_nodes if node_id not in cached]
+        total = self.total_units - sum(self.units.get(node_id, 0.0) for node_id in cached)
+
+        done = sum(self.units.get(node_id, 0.0) for node_id in completed)
+        steps_done = sum(self.steps.get(node_id, 0) for node_id in completed)
+
+        self.current_node = watcher.current_node
+        progress = watcher.progress
+        if self.current_node in self.units and progress.get('node') == self.current_node and progress.get('max'):
+            step_fraction = min(1.0, progress.get('value', 0) / progress['max'])
+            done += self.units[self.current_node] * step_fraction
+            if self.current_node in self.steps:
+                steps_done += int(self.steps[self.current_node] * step_fraction)
+
+        self.steps_done = steps_done
+        return done / max(total, 1e-6)
+
+    def percent(self, start: float = 0, end: float = 100) -> int:
+        """Fraction mapped into [start, end]"""
+        return int(start + (end - start) * self.fraction)
+
+    @property
+    def stage(self) -> str:
+        return node_stage(self.classes.get(self.current_node))
+
+    def step_label(self) -> str:
+        """e.g. '25/65 steps' across all sampler passes, or '' when the graph has none"""
+        if not self.total_steps:
+            return ''
+        return f"{min(self.steps_done, self.total_steps)}/{self.total_steps} steps"
+
+    def use_expected_seconds(self, seconds: float):
+        """Replace the unit-based duration guess with a measured one"""
+        self.expected_seconds = seconds
+        self.historical = True
+
+    def estimated_remaining(self, elapsed: float) -> float:
+        """Seconds left: historical duration while the job is on pace, else extrapolated from the pace so far"""
+        if self.historical and elapsed < self.expected_seconds:
+            # The slower of "rest of the usual duration" and "share of it not done yet"
+            return max(self.expected_seconds - elapsed, self.expected_seconds * (1 - self.fraction))
+        if self.fraction >= 0.05:
+            return max(0.0, elapsed * (1 - self.fraction) / self.fraction)
+        return max(0.0, self.expected_seconds - elapsed)
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            'nodes': len(self.units),
+            'total_units': round(self.total_units, 1),
+            'total_steps': self.total_steps,
+            'frames': self.frames,
+            'batch_size': self.batch_size
+        }
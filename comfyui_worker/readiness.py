@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+ComfyUI startup readiness detection and startup timeline.
+
+The handlers' old readiness loops slept a fixed second between
+/system_stats probes (text_to_image added a /queue round-trip on top), so
+every cold start lost up to a second after ComfyUI was actually up, and a
+ComfyUI that crashed during startup was only noticed at the timeout.
+
+`StartupWatcher` is fed ComfyUI's log lines by the supervisor's log
+reader and waits for readiness by:
+- probing the TCP port with exponential backoff from 50ms up to 0.5s and
+  only issuing the HTTP check once the port accepts connections
+- waking immediately when ComfyUI logs "To see the GUI go to"
+- failing as soon as the process exits
+
+It also records a timeline (spawn, custom nodes loaded, GUI line, HTTP
+ready, models warm) in seconds since spawn, which the first job after
+each (re)start returns as `startup_timeline`.
+"""
+
+import time
+import socket
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+from typing import Dict, Any
+
+from .client import COMFYUI_URL, get_comfyui_client
+
+logger = logging.getLogger(__name__)
+
+GUI_LINE = b'To see the GUI go to'
+CUSTOM_NODES_LINE = b'Import times for custom nodes'
+
+BACKOFF_START = 0.05
+BACKOFF_MAX = 0.5
+
+
+def port_open(url: str = COMFYUI_URL, timeout: float = 0.25) -> bool:
+    parsed = urlparse(url)
+    port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+    try:
+        with socket.create_connection((parsed.hostname or '127.0.0.1', port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+class StartupTimeline:
+    """Seconds from spawning ComfyUI to each startup milestone"""
+
+    def __init__(self):
+        self.spawned_at = time.time()
+        self.events = OrderedDict([('spawn', 0.0)])
+        self._lock = threading.Lock()
+
+    def mark(self, name: str):
+        """Record a milestone (only its first occurrence counts)"""
+        with self._lock:
+            if name not in self.events:
+                self.events[name] = round(time.time() - self.spawned_at, 3)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'spawned_at': self.spawned_at, 'events': dict(self.events)}
+
+    def summary(self) -> str:
+        with self._lock:
+            return ', '.join(f"{name} {seconds:.2f}s" for name, seconds in self.events.items())
+
+
+class StartupWatcher:
+    """Waits for one ComfyUI process to become ready"""
+
+    def __init__(self, process):
+        self.process = process
+        self.timeline = StartupTimeline()
+        self._signal = threading.Event()
+
+    def feed(self, line: bytes):
+        """Called with every (undecoded) ComfyUI log line"""
+        if CUSTOM_NODES_LINE in line:
+            self.timeline.mark('custom_nodes_loaded')
+        elif GUI_LINE in line:
+            self.timeline.mark('gui_line')
+            self._signal.set()
+
+    def wait(self, timeout: float) -> bool:
+        comfyui = get_comfyui_client()
+        deadline = time.time() + timeout
+        delay = BACKOFF_START
+        while time.time() < deadline:
+            if self.process.poll() is not None:
+                self.timeline.mark('exited')
+                logger.error(f"❌ ComfyUI process exited with code {self.process.returncode} during startup")
+                return False
+
+            if port_open():
+                self.timeline.mark('port_open')
+                try:
+                    if comfyui.get("/system_stats", timeout=5).status_code == 200:
+                        self.timeline.mark('http_ready')
+                        logger.info(f"✅ ComfyUI ready ({self.timeline.summary()})")
+                        return True
+                except Exception:
+                    pass
+
+            if self._signal.wait(min(delay, max(0.0, deadline - time.time()))):
+                self._signal.clear()
+                delay = BACKOFF_START
+            else:
+                delay = min(delay * 2, BACKOFF_MAX)
+
+        logger.error(f"❌ ComfyUI failed to start within {timeout:.0f} seconds ({self.timeline.summary()})")
+        return False
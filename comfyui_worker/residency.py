@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+VRAM/RAM-aware model residency between jobs.
+
+ComfyUI keeps whatever the last prompt loaded, so a worker alternating
+between e.g. FLUX text-to-image, Flux Kontext and skin enhancement either
+keeps everything resident until it OOMs, or (with a blanket /free before
+every job) reloads the same multi-GB files from /runpod-volume each time.
+
+`ensure_model_residency()` runs right before a workflow is queued. It
+resolves the model files the workflow loads (UNet/checkpoint, text
+encoders, VAE, LoRAs, ...) and their sizes, compares the bytes that are
+not already resident with the free VRAM and host RAM from /system_stats,
+and only calls ComfyUI's /free (unload_models + free_memory) when the
+next job will not fit next to what is loaded. Otherwise the hot models
+stay resident.
+
+ComfyUI has no API for which models are loaded, so residency is tracked
+here from the workflows this worker queued since ComfyUI (re)started.
+The per-job report (evictions, reloads avoided) is logged and returned
+by `residency_report(job_id)` for the job result. When the worker runs
+several jobs at once, nothing is freed while ComfyUI still has other
+prompts queued or running: their models would be unloaded under them.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
+
+from .client import get_comfyui_client
+from .supervisor import get_supervisor
+
+logger = logging.getLogger(__name__)
+
+MODEL_ROOTS = [path for path in os.environ.get(
+    'COMFYUI_MODEL_ROOTS', '/runpod-volume:/runpod-volume/models:/app/comfyui/models:/workspace/models'
+).split(':') if path]
+
+# Working memory a prompt needs on top of its weights (activations, latents, VAE decode)
+HEADROOM_MB = float(os.environ.get('RESIDENCY_HEADROOM_MB', '3072'))
+
+# Loader input name -> model folders it is looked up in
+MODEL_INPUTS = {
+    'unet_name': ('unet', 'diffusion_models'),
+    'ckpt_name': ('checkpoints',),
+    'clip_name': ('clip', 'text_encoders', 'clip_vision'),
+    'clip_name1': ('clip', 'text_encoders'),
+    'clip_name2': ('clip', 'text_encoders'),
+    'clip_name3': ('clip', 'text_encoders'),
+    'vae_name': ('vae',),
+    'lora_name': ('loras',),
+    'control_net_name': ('controlnet',),
+    'model_name': ('upscale_models', 'sams', 'ultralytics'),
+    'style_model_name': ('style_models',),
+}
+
+MB = 1024 * 1024
+MAX_REPORTS = 64
+
+
+def _model_size(folders: Tuple[str, ...], name: str) -> int:
+    for root in MODEL_ROOTS:
+        for folder in folders:
+            path = os.path.join(root, folder, name)
+            try:
+                return os.path.getsize(path)
+            except OSError:
+                continue
+    return 0
+
+
+def workflow_model_files(workflow: Optional[Dict]) -> Dict[str, int]:
+    """Model files a workflow loads, mapped to their size in bytes (0 if not found)"""
+    files = {}
+    for node in (workflow or {}).values():
+        if not isinstance(node, dict):
+            continue
+        for key, value in (node.get('inputs') or {}).items():
+            folders = MODEL_INPUTS.get(key)
+            if folders is None and isinstance(value, dict) and value.get('on', True) and isinstance(value.get('lora'), str):
+                # rgthree Power Lora Loader: lora_1 = {"on": true, "lora": "...", "strength": 1}
+                folders, value = ('loras',), value['lora']
+            if folders and isinstance(value, str) and value and value.lower() != 'none':
+                model_key = f"{folders[0]}/{value}"
+                if model_key not in files:
+                    files[model_key] = _model_size(folders, value)
+    return files
+
+
+def memory_free(system_stats: Dict[str, Any]) -> Tuple[Optional[int], Optional[int]]:
+    """(free VRAM, free host RAM) in bytes from a /system_stats response"""
+    devices = system_stats.get('devices') or []
+    vram_free = devices[0].get('vram_free') if devices else None
+    ram_free = (system_stats.get('system') or {}).get('ram_free')
+    return vram_free, ram_free
+
+
+class ResidencyManager:
+    """Tracks which model files ComfyUI holds and frees memory only when a job won't fit"""
+
+    def __init__(self, headroom_mb: float = HEADROOM_MB):
+        self.headroom = int(headroom_mb * MB)
+        self.resident = OrderedDict()  # model key -> bytes, least recently used first
+        self.comfyui_started_at = None
+        self._reports = OrderedDict()
+        self._lock = threading.Lock()
+
+    def prepare(self, job_id: str, workflow: Optional[Dict]) -> Dict[str, Any]:
+        """Make room for a workflow's models if needed and report what stayed resident"""
+        with self._lock:
+            started_at = get_supervisor().started_at
+            if started_at != self.comfyui_started_at:
+                # ComfyUI was (re)started: nothing is loaded any more
+                self.resident.clear()
+                self.comfyui_started_at = started_at
+
+            required = workflow_model_files(workflow)
+            hits = [key for key in required if key in self.resident]
+            missing_bytes = sum(size for key, size in required.items() if key not in self.resident)
+            evictable = [key for key in self.resident if key not in required]
+
+            report = {
+                'required_models': len(required),
+                'required_mb': round(sum(required.values()) / MB),
+                'resident_hits': len(hits),
+                'reloads_avoided_mb': round(sum(required[key] for key in hits) / MB),
+                'evicted': [],
+                'freed': False
+            }
+
+            vram_free = ram_free = None
+            try:
+                vram_free, ram_free = memory_free(get_comfyui_client().get("/system_stats", timeout=5).json())
+            except Exception as e:
+                logger.warning(f"⚠️ Could not read ComfyUI memory stats: {e}")
+
+            fits_vram = vram_free is None or missing_bytes + self.headroom <= vram_free
+            fits_ram = ram_free is None or missing_bytes <= ram_free
+            if vram_free is not None:
+                report['vram_free_mb'] = round(vram_free / MB)
+
+            if evictable and not (fits_vram and fits_ram):
+                if self._busy():
+                    logger.info(f"🧠 Not freeing ComfyUI memory for job {job_id}: other prompts are still queued or running")
+                elif self._free():
+                    report['freed'] = True
+                    report['evicted'] = [key.split('/', 1)[-1] for key in evictable]
+                    report['resident_hits'] = 0
+                    report['reloads_avoided_mb'] = 0
+                    self.resident.clear()
+
+            for key, size in required.items():
+                self.resident.pop(key, None)
+                self.resident[key] = size
+
+            self._reports[job_id] = report
+            while len(self._reports) > MAX_REPORTS:
+                self._reports.popitem(last=False)
+
+        if report['freed']:
+            logger.info(f"🧠 Freed ComfyUI memory for job {job_id} ({missing_bytes / MB:.0f} MB of new models did not fit), evicted {', '.join(report['evicted'])}")
+        elif report['resident_hits']:
+            logger.info(f"🧠 Kept {report['resident_hits']}/{report['required_models']} models resident for job {job_id} ({report['reloads_avoided_mb']} MB reload avoided)")
+        return report
+
+    def _busy(self) -> bool:
+        try:
+            queue = get_comfyui_client().get("/queue", timeout=5).json()
+        except Exception:
+            return False
+        return bool(queue.get('queue_running') or queue.get('queue_pending'))
+
+    def _free(self) -> bool:
+        try:
+            response = get_comfyui_client().post("/free", json={"unload_models": True, "free_memory": True}, timeout=30)
+            return response.status_code == 200
+        except Exception as e:
+            logger.warning(f"⚠️ ComfyUI /free failed: {e}")
+            return False
+
+    def report(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            return self._reports.pop(job_id, None)
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+
+def get_residency_manager() -> ResidencyManager:
+    """Process-wide model residency manager"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = ResidencyManager()
+        return _manager
+
+
+def ensure_model_residency(job_id: str, workflow: Optional[Dict]) -> Dict[str, Any]:
+    """Call before queueing a workflow; never raises"""
+    try:
+        return get_residency_manager().prepare(job_id, workflow)
+    except Exception as e:
+        logger.warning(f"⚠️ Model residency check failed: {e}")
+        return {}
+
+
+def residency_report(job_id: str) -> Optional[Dict[str, Any]]:
+    """Evictions and reloads avoided for a job, for its result"""
+    return get_residency_manager().report(job_id)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of finished generations, shared through /runpod-volume.
+
+Users resubmit identical jobs (same prompt, seed, LoRA stack and size),
+e.g. after a webhook hiccup, and each resubmission re-ran the whole FLUX
+or Wan pipeline. `workflow_cache_key()` hashes a canonical form of the
+workflow that leaves out what changes between identical submissions:
+
+- `_meta` and other UI-only keys
+- the file-name part of `filename_prefix` (the frontend puts a timestamp
+  there), keeping its folder so a different destination is a miss
+- client ids
+
+Files a workflow loads from the ComfyUI input directory (LoadImage,
+VHS_LoadVideo, ...) are hashed by content rather than name. The key is
+also scoped by generation type and user.
+
+Each finished job stores its uploaded S3 keys/URLs as one small JSON file
+under RESULT_CACHE_DIR/<key[:2]>/<key>.json, which every worker mounting
+the volume can read. A hit is replayed through the handler's normal
+completion webhook and result without queueing anything on the GPU.
+Entries expire after RESULT_CACHE_TTL_HOURS, and the oldest are evicted
+once there are more than RESULT_CACHE_MAX_ENTRIES. Without
+/runpod-volume the cache is disabled.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from typing import Dict, List, Any, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+RESULT_CACHE_DIR = os.environ.get(
+    'RESULT_CACHE_DIR',
+    '/runpod-volume/result_cache' if os.path.isdir('/runpod-volume') else ''
+)
+RESULT_CACHE_ENABLED = os.environ.get('RESULT_CACHE_ENABLED', '1').lower() not in ('0', 'false', 'no')
+TTL_SECONDS = float(os.environ.get('RESULT_CACHE_TTL_HOURS', '72')) * 3600
+MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', '10000'))
+COMFYUI_INPUT_DIR = os.environ.get('COMFYUI_INPUT_DIR', '/app/comfyui/input')
+
+# Bump when the canonical form changes so old entries stop matching
+CACHE_FORMAT = 1
+
+# Inputs that differ between identical submissions
+VOLATILE_INPUTS = ('client_id',)
+PREFIX_INPUTS = ('filename_prefix',)
+
+# Inputs naming a file in the ComfyUI input directory
+FILE_INPUTS = ('image', 'video', 'audio', 'mask')
+
+# Sweep for expired/excess entries after this many stores per worker
+EVICT_EVERY = 50
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def _file_digest(path: str) -> Optional[str]:
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def _canonical_input(name: str, value: Any, input_dir: str) -> Any:
+    if name in PREFIX_INPUTS and isinstance(value, str):
+        # Keep the destination folder, drop the timestamped file name
+        return value.rsplit('/', 1)[0] if '/' in value else ''
+    if name in FILE_INPUTS and isinstance(value, str) and value and len(value) < 512:
+        # "name.png [input]" annotations are how the UI refers to input files
+        filename = value.split(' [', 1)[0]
+        digest = _file_digest(os.path.join(input_dir, filename))
+        if digest:
+            return {'sha256': digest}
+    return value
+
+
+def canonical_workflow(workflow: Dict[str, Any], input_dir: str = COMFYUI_INPUT_DIR) -> Dict[str, Any]:
+    """Workflow reduced to what determines its outputs"""
+    canonical = {}
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            continue
+        canonical[str(node_id)] = {
+            'class_type': node.get('class_type'),
+            'inputs': {
+                name: _canonical_input(name, value, input_dir)
+                for name, value in (node.get('inputs') or {}).items()
+                if name not in VOLATILE_INPUTS
+            }
+        }
+    return canonical
+
+
+def workflow_cache_key(workflow: Dict[str, Any], generation_type: str, user_id: Optional[str] = None) -> str:
+    """Content hash identifying a generation's result"""
+    payload = {
+        'format': CACHE_FORMAT,
+        'type': generation_type,
+        'user': user_id or '',
+        'workflow': canonical_workflow(workflow)
+    }
+    encoded = json.dumps(payload, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def cache_requested(job_input: Dict[str, Any]) -> bool:
+    """Jobs can opt out with "use_cache": false"""
+    return job_input.get('use_cache', True) is not False
+
+
+class ResultCache:
+    """Generation results by workflow hash, one JSON file per entry"""
+
+    def __init__(self, cache_dir: str = RESULT_CACHE_DIR, ttl: float = TTL_SECONDS, max_entries: int = MAX_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._stores = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return RESULT_CACHE_ENABLED and bool(self.cache_dir)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def lookup(self, key: str) -> Optional[Dict[str, Any]]:
+        """Stored result for a key, or None (missing, expired, or its files are gone)"""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if time.time() - entry.get('created_at', 0) > self.ttl:
+            self._discard(path)
+            return None
+        if not self._urls_alive(entry.get('urls') or []):
+            logger.info(f"🗃️ Cached result {key[:12]} points at deleted files, dropping it")
+            self._discard(path)
+            return None
+
+        try:
+            os.utime(path)  # most recently used entries survive eviction
+        except OSError:
+            pass
+        logger.info(f"🗃️ Result cache hit {key[:12]} (from job {entry.get('job_id')}, {time.time() - entry['created_at']:.0f}s old)")
+        return entry.get('result')
+
+    def store(self, key: str, result: Dict[str, Any], urls: List[str], job_id: str):
+        """Remember a finished job's result; `urls` are checked before it is replayed"""
+        if not self.enabled or not urls:
+            return
+        path = self._path(key)
+        entry = {'key': key, 'job_id': job_id, 'created_at': time.time(), 'urls': urls, 'result': result}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(entry, f, separators=(',', ':'))
+            os.replace(temp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"⚠️ Could not store result in cache: {e}")
+            return
+
+        with self._lock:
+            self._stores += 1
+            sweep = self._stores % EVICT_EVERY == 1
+        if sweep:
+            threading.Thread(target=self.evict, daemon=True, name='result-cache-evict').start()
+
+    def _urls_alive(self, urls: List[str]) -> bool:
+        for url in urls:
+            try:
+                if requests.head(url, timeout=5, allow_redirects=True).status_code >= 400:
+                    return False
+            except requests.RequestException:
+                # Can't tell: don't serve a result that may be gone
+                return False
+        return True
+
+    def _discard(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Remove expired entries, then the least recently used beyond max_entries"""
+        now = time.time()
+        entries = []
+        try:
+            for shard in os.scandir(self.cache_dir):
+                if not shard.is_dir():
+                    continue
+                for item in os.scandir(shard.path):
+                    if not item.name.endswith('.json'):
+                        continue
+                    try:
+                        mtime = item.stat().st_mtime
+                    except OSError:
+                        continue
+                    entries.append((mtime, item.path))
+        except OSError as e:
+            logger.debug(f"Result cache sweep failed: {e}")
+            return
+
+        # mtime is refreshed on every hit, so it tracks last use; creation time is checked on lookup
+        expired = [path for mtime, path in entries if now - mtime > self.ttl]
+        live = sorted((entry for entry in entries if now - entry[0] <= self.ttl), reverse=True)
+        excess = [path for _, path in live[self.max_entries:]]
+        for path in expired + excess:
+            self._discard(path)
+        if expired or excess:
+            logger.info(f"🗃️ Result cache sweep removed {len(expired)} expired and {len(excess)} excess entries")
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_result_cache() -> ResultCache:
+    """Process-wide result cache"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = ResultCache()
+        return _cache
+
+
+def lookup_result(cache_key: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Cached result for a key; never raises"""
+    if not cache_key:
+        return None
+    try:
+        return get_result_cache().lookup(cache_key)
+    except Exception as e:
+        logger.warning(f"⚠️ Result cache lookup failed: {e}")
+        return None
+
+
+def store_result(cache_key: Optional[str], result: Dict[str, Any], urls: List[str], job_id: str):
+    """Cache a finished job's result; never raises"""
+    if not cache_key:
+        return
+    try:
+        get_result_cache().store(cache_key, result, urls, job_id)
+    except Exception as e:
+        logger.warning(f"⚠️ Result cache store failed: {e}")
@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+ComfyUI process supervisor.
+
+Handlers used to `subprocess.Popen` ComfyUI and forget the handle, so a
+segfault or a slow host-RAM leak failed (or crawled through) every later
+job until RunPod killed the worker. `get_supervisor().start(cmd, ...)` now
+owns the process:
+
+- readiness is detected by `readiness.StartupWatcher` (port probing with
+  sub-second backoff plus ComfyUI's "To see the GUI" log line), and the
+  first job after each start gets the startup timeline in its result
+- its output goes to `logsink.ComfyUILogSink` (rotating file, ring-buffer
+  tail, warnings and errors only on the console)
+- a monitor thread checks `process.poll()` and /system_stats every
+  SUPERVISOR_INTERVAL seconds
+- when ComfyUI dies unexpectedly it is restarted with exponential backoff
+  (up to COMFYUI_MAX_RESTARTS consecutive failures), and every prompt that
+  was still queued or running is re-queued under its original prompt_id,
+  so the job monitoring it keeps waiting instead of failing
+- after COMFYUI_RECYCLE_AFTER_JOBS jobs, or once host RAM, the ComfyUI
+  process RSS or VRAM passes its ceiling, ComfyUI is recycled once no job
+  is running (see `supervised_handler()`); the next job waits for it in
+  `prewarm.wait_for_comfyui()`
+
+Queue functions call `supervise_prompt(prompt_id, workflow)` right after
+queueing so the supervisor knows what to re-queue.
+"""
+
+import os
+import time
+import signal
+import logging
+import threading
+import subprocess
+from typing import Dict, List, Any, Optional, Callable
+
+from .client import get_comfyui_client
+from .events import get_event_stream, subscribe
+from .readiness import StartupWatcher
+from .fetch import prefetch_inputs
+from .logsink import get_log_sink, comfyui_log_tail
+
+logger = logging.getLogger(__name__)
+
+SUPERVISOR_INTERVAL = float(os.environ.get('SUPERVISOR_INTERVAL', '5'))
+MAX_RESTARTS = int(os.environ.get('COMFYUI_MAX_RESTARTS', '5'))
+RESTART_BACKOFF_MAX = float(os.environ.get('COMFYUI_RESTART_BACKOFF_MAX', '60'))
+
+# Proactive recycling (0 disables a limit)
+RECYCLE_AFTER_JOBS = int(os.environ.get('COMFYUI_RECYCLE_AFTER_JOBS', '0'))
+MAX_RAM_PERCENT = float(os.environ.get('COMFYUI_MAX_RAM_PERCENT', '92'))
+MAX_RSS_MB = float(os.environ.get('COMFYUI_MAX_RSS_MB', '0'))
+MAX_VRAM_PERCENT = float(os.environ.get('COMFYUI_MAX_VRAM_PERCENT', '0'))
+
+# A restart that stays up this long resets the consecutive-failure count
+STABLE_SECONDS = 60
+
+
+def process_rss_mb(pid: int) -> Optional[float]:
+    """Resident set size of a process from /proc, or None where unavailable"""
+    try:
+        with open(f"/proc/{pid}/statm") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def memory_usage(system_stats: Dict[str, Any]) -> Dict[str, Optional[float]]:
+    """Host RAM and VRAM use in percent from a /system_stats response"""
+    system = system_stats.get('system') or {}
+    usage = {'ram_percent': None, 'vram_percent': None}
+    if system.get('ram_total'):
+        usage['ram_percent'] = 100.0 * (1 - system.get('ram_free', 0) / system['ram_total'])
+    devices = system_stats.get('devices') or []
+    if devices and devices[0].get('vram_total'):
+        device = devices[0]
+        usage['vram_percent'] = 100.0 * (1 - device.get('vram_free', 0) / device['vram_total'])
+    return usage
+
+
+class ComfyUISupervisor:
+    """Owns the ComfyUI process: start, health checks, restart and recycle"""
+
+    def __init__(self, interval: float = SUPERVISOR_INTERVAL):
+        self.interval = interval
+        self.process = None
+        self.cmd = None
+        self.cwd = None
+        self.env = None
+        self.timeout = 300
+        self.jobs_since_start = 0
+        self.active_jobs = 0  # jobs running on this worker right now (several with JOB_CONCURRENCY)
+        self.restarts = 0
+        self.started_at = None
+        self.recycle_reason = None
+        self._inflight = {}  # prompt_id -> {'workflow', 'client_id'}
+        self._ready = threading.Event()
+        self._lock = threading.RLock()
+        self._stopping = False
+        self._monitor = None
+        self.startup = None  # StartupWatcher of the current process
+        self._unreported_timeline = None
+
+    @property
+    def owns_process(self) -> bool:
+        return self.process is not None
+
+    @property
+    def ready(self) -> bool:
+        return self._ready.is_set()
+
+    def start(self, cmd: List[str], cwd: str, env: Optional[Dict[str, str]] = None, timeout: float = 300) -> bool:
+        """Launch ComfyUI, wait until it answers, and start supervising it"""
+        with self._lock:
+            self.stop()  # a previous launch that never became ready
+            self.cmd, self.cwd, self.env, self.timeout = cmd, cwd, env, timeout
+        ready = self._spawn()
+        with self._lock:
+            if self._monitor is None:
+                self._monitor = threading.Thread(target=self._run, name='comfyui-supervisor', daemon=True)
+                self._monitor.start()
+        return ready
+
+    def _spawn(self) -> bool:
+        """Launch ComfyUI and wait until it's ready; called without the lock held
+
+        Only the launch itself is locked, so track/release and job accounting
+        don't block for the whole startup.
+        """
+        with self._lock:
+            self._ready.clear()
+            process = self.process = subprocess.Popen(
+                self.cmd,
+                cwd=self.cwd,
+                env=self.env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                universal_newlines=False,
+                start_new_session=True  # lets stop() take down wrapper scripts and their children
+            )
+            self.started_at = time.time()
+            self.jobs_since_start = 0
+            startup = self.startup = StartupWatcher(process)
+            self._unreported_timeline = startup.timeline
+        logger.info(f"🚀 ComfyUI started with PID {process.pid}")
+        threading.Thread(target=self._log_output, args=(process, startup), name='comfyui-log', daemon=True).start()
+
+        if startup.wait(self.timeout):
+            self._ready.set()
+            return True
+        return False
+
+    def _log_output(self, process: subprocess.Popen, startup: StartupWatcher):
+        get_log_sink().pump(process.stdout, startup.feed)
+
+    def mark_startup(self, name: str):
+        """Add a milestone (e.g. models warm) to the current process's startup timeline"""
+        if self.startup is not None:
+            self.startup.timeline.mark(name)
+
+    def take_startup_timeline(self) -> Optional[Dict[str, Any]]:
+        """Startup timeline of the current process, returned once (to the first job after a start)"""
+        with self._lock:
+            timeline, self._unreported_timeline = self._unreported_timeline, None
+        return timeline.as_dict() if timeline is not None else None
+
+    def wait_ready(self, timeout: Optional[float] = None) -> bool:
+        """Block while a restart or recycle is in progress"""
+        if not self.owns_process:
+            return True
+        if not self._ready.is_set():
+            logger.info("⏳ Waiting for supervised ComfyUI restart...")
+        return self._ready.wait(timeout if timeout is not None else self.timeout + RESTART_BACKOFF_MAX)
+
+    def stop(self, timeout: float = 15):
+        """Terminate ComfyUI (and anything its launcher spawned) without triggering a crash restart"""
+        with self._lock:
+            process = self.process
+            if process is None or process.poll() is not None:
+                return
+            self._stopping = True
+            self._ready.clear()
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+                process.wait(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait(timeout=5)
+            except OSError:
+                pass
+            finally:
+                self._stopping = False
+
+    # In-flight prompts
+
+    def track(self, prompt_id: str, workflow: Dict, client_id: str):
+        with self._lock:
+            self._inflight[prompt_id] = {'workflow': workflow, 'client_id': client_id}
+
+    def release(self, prompt_id: str):
+        with self._lock:
+            self._inflight.pop(prompt_id, None)
+
+    def _prune_inflight(self):
+        """Forget prompts ComfyUI no longer has queued or running"""
+        with self._lock:
+            if not self._inflight:
+                return
+        try:
+            queue = get_comfyui_client().get("/queue", timeout=5).json()
+        except Exception:
+            return
+        queued = {item[1] for key in ('queue_running', 'queue_pending') for item in queue.get(key, []) if len(item) > 1}
+        with self._lock:
+            for prompt_id in list(self._inflight):
+                if prompt_id not in queued:
+                    del self._inflight[prompt_id]
+
+    def _requeue_inflight(self):
+        with self._lock:
+            inflight = dict(self._inflight)
+        if not inflight:
+            return
+
+        stream = get_event_stream()
+        client_id, epoch = subscribe()
+        for prompt_id, entry in inflight.items():
+            watcher = stream.watch(prompt_id)
+            if watcher.finished:
+                self.release(prompt_id)
+                continue
+            try:
+                response = get_comfyui_client().post("/prompt", json={
+                    "prompt": entry['workflow'],
+                    "client_id": client_id,
+                    "prompt_id": prompt_id
+                }, timeout=30)
+                new_id = response.json().get('prompt_id') if response.status_code == 200 else None
+                if new_id == prompt_id:
+                    stream.requeue(prompt_id, epoch)
+                    logger.warning(f"🔁 Re-queued in-flight prompt {prompt_id} after ComfyUI restart")
+                else:
+                    logger.error(f"❌ Could not re-queue prompt {prompt_id}: {response.text[:500]}")
+                    self.release(prompt_id)
+                    stream.mark_interrupted(prompt_id, 'ComfyUI crashed and the prompt could not be re-queued')
+            except Exception as e:
+                logger.error(f"❌ Could not re-queue prompt {prompt_id}: {e}")
+
+    # Health checks
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                with self._lock:
+                    process = self.process
+                    stopping = self._stopping
+                if process is None or stopping or not self._ready.is_set():
+                    continue  # starting up, or a restart/recycle is in progress
+                if process.poll() is not None:
+                    self._recover(process.returncode)
+                    continue
+
+                self._prune_inflight()
+                self._check_memory(process)
+                if self.restarts and time.time() - self.started_at > STABLE_SECONDS:
+                    self.restarts = 0
+            except Exception as e:
+                logger.warning(f"⚠️ ComfyUI supervisor check failed: {e}")
+
+    def _check_memory(self, process: subprocess.Popen):
+        if self.recycle_reason:
+            return
+        try:
+            usage = memory_usage(get_comfyui_client().get("/system_stats", timeout=5).json())
+        except Exception:
+            return
+        rss = process_rss_mb(process.pid)
+
+        reason = None
+        if MAX_RAM_PERCENT and usage['ram_percent'] is not None and usage['ram_percent'] > MAX_RAM_PERCENT:
+            reason = f"host RAM at {usage['ram_percent']:.0f}%"
+        elif MAX_RSS_MB and rss is not None and rss > MAX_RSS_MB:
+            reason = f"ComfyUI RSS at {rss:.0f} MB"
+        elif MAX_VRAM_PERCENT and usage['vram_percent'] is not None and usage['vram_percent'] > MAX_VRAM_PERCENT:
+            reason = f"VRAM at {usage['vram_percent']:.0f}%"
+        if not reason:
+            return
+        with self._lock:
+            if self.recycle_reason:
+                return
+            self.recycle_reason = reason
+        logger.warning(f"♻️ ComfyUI will be recycled after the current job ({reason})")
+
+    def _recover(self, returncode: int):
+        """Restart a crashed ComfyUI with backoff and re-queue what it was working on"""
+        logger.error(f"💥 ComfyUI exited unexpectedly with code {returncode}")
+        self._ready.clear()
+        while self.restarts < MAX_RESTARTS:
+            delay = min(2 ** self.restarts, RESTART_BACKOFF_MAX)
+            self.restarts += 1
+            logger.warning(f"🔁 Restarting ComfyUI in {delay:.0f}s (attempt {self.restarts}/{MAX_RESTARTS})")
+            time.sleep(delay)
+            if self._spawn():
+                break
+            self.stop()
+        else:
+            logger.error(f"❌ ComfyUI could not be restarted after {MAX_RESTARTS} attempts, giving up")
+            return
+        self._requeue_inflight()
+
+    # Recycling between jobs
+
+    def job_started(self):
+        with self._lock:
+            self.active_jobs += 1
+
+    def job_finished(self):
+        """Count a finished job and recycle ComfyUI in the background if a limit was hit"""
+        # Concurrent jobs finish on their own threads; count and decide under one lock
+        with self._lock:
+            self.active_jobs = max(0, self.active_jobs - 1)
+            if not self.owns_process:
+                return
+            self.jobs_since_start += 1
+            if not self.recycle_reason and RECYCLE_AFTER_JOBS and self.jobs_since_start >= RECYCLE_AFTER_JOBS:
+                self.recycle_reason = f"{self.jobs_since_start} jobs since start"
+            recycle = bool(self.recycle_reason) and not self.active_jobs
+        if recycle:
+            threading.Thread(target=self.recycle, name='comfyui-recycle', daemon=True).start()
+
+    def recycle(self):
+        self._prune_inflight()
+        with self._lock:
+            reason, self.recycle_reason = self.recycle_reason or 'requested', None
+            if self._inflight or self.active_jobs:
+                logger.info("♻️ Prompts or jobs still in flight, postponing ComfyUI recycle")
+                self.recycle_reason = reason
+                return
+            logger.info(f"♻️ Recycling ComfyUI ({reason})")
+            started = time.time()
+            self.stop()
+        if self._spawn():
+            logger.info(f"♻️ ComfyUI recycled in {time.time() - started:.1f}s")
+
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def get_supervisor() -> ComfyUISupervisor:
+    """Process-wide ComfyUI supervisor"""
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = ComfyUISupervisor()
+        return _supervisor
+
+
+def supervise_prompt(prompt_id: Optional[str], workflow: Optional[Dict]):
+    """Remember a queued prompt so it can be re-queued if ComfyUI crashes"""
+    if prompt_id and workflow:
+        get_supervisor().track(prompt_id, workflow, get_event_stream().client_id)
+
+
+def _failed(result: Dict) -> bool:
+    """Whether a handler result reports a failure ({'success': False} or a FAILED/error status)"""
+    status = str(result.get('status', '')).upper()
+    if status == 'CANCELLED':
+        return False
+    return result.get('success') is False or status in ('FAILED', 'ERROR')
+
+
+def supervised_handler(handler: Callable[[Dict], Any]) -> Callable[[Dict], Any]:
+    """Wrap a RunPod handler so ComfyUI can be recycled between jobs.
+
+    The first job after ComfyUI (re)started also gets its startup timeline,
+    and failed jobs get the tail of ComfyUI's output. Referenced inputs
+    start downloading before the handler runs.
+    """
+    def run(job: Dict) -> Any:
+        supervisor = get_supervisor()
+        supervisor.job_started()
+        prefetches = prefetch_inputs(job.get('input'))
+        try:
+            result = handler(job)
+            if isinstance(result, dict) and supervisor.owns_process:
+                timeline = supervisor.take_startup_timeline()
+                if timeline:
+                    result['startup_timeline'] = timeline
+                if _failed(result):
+                    tail = comfyui_log_tail()
+                    if tail:
+                        result['comfyui_log_tail'] = tail
+            return result
+        finally:
+            prefetches.discard()
+            supervisor.job_finished()
+    return run
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+"""
+Server-side workflow templates.
+
+Clients used to send the whole ComfyUI graph with every job and the
+handlers then patched hard-coded node ids ("13" in text_to_image, "1"/"3"
+in fps_boost, ...) and re-validated the graph each time. Templates move
+the graph into the worker: every generation type ships versioned files
+under workflow_templates/<name>.v<N>.json with
+
+- `graph`: the API-format workflow
+- `params`: parameter name -> type, default (or required) and the
+  [node_id, input] targets it is written to
+- `lora_chain` (optional): how a `loras` list is spliced in as a chain of
+  LoRA loader nodes between `source` and `consumers`; a `loras` parameter
+  can carry its own `chain` instead (text_to_video chains its high- and
+  low-noise models separately)
+
+Templates are structurally checked once when the registry loads and
+against the ComfyUI node catalog (node classes and required inputs) once
+per template per build, so a rendered workflow skips the per-job node
+check. A job then sends
+
+    {"template": "text_to_image", "template_version": 1,
+     "params": {"prompt": "...", "seed": 42, "loras": [...]}}
+
+`template` defaults to the handler's generation type and the version to
+the latest one. Jobs that send `workflow` keep using it as before.
+"""
+
+import os
+import re
+import json
+import random
+import logging
+import threading
+from typing import Dict, List, Any, Optional
+
+logger = logging.getLogger(__name__)
+
+TEMPLATE_DIR = os.environ.get(
+    'WORKFLOW_TEMPLATE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'workflow_templates')
+)
+
+TEMPLATE_FILE = re.compile(r'^(?P<name>[a-z0-9_]+)\.v(?P<version>\d+)\.json$')
+
+MAX_SEED = 2147483647
+
+
+class TemplateError(ValueError):
+    """A template or the parameters sent for it are invalid"""
+
+
+class RenderedWorkflow(dict):
+    """Workflow rendered from a template; serializes like a plain dict"""
+
+    def __init__(self, graph: Dict[str, Any], template: str, version: int, prevalidated: bool):
+        super().__init__(graph)
+        self.template = template
+        self.version = version
+        self.prevalidated = prevalidated
+
+
+def _is_link(value: Any) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[0], str) and isinstance(value[1], int)
+
+
+def _coerce(name: str, kind: str, value: Any) -> Any:
+    try:
+        if kind == 'string':
+            if not isinstance(value, str):
+                raise TypeError
+            return value
+        if kind == 'int' or kind == 'seed':
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or int(value) != value:
+                raise TypeError
+            return int(value)
+        if kind == 'number':
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise TypeError
+            return value
+        if kind == 'bool':
+            if not isinstance(value, bool):
+                raise TypeError
+            return value
+    except (TypeError, ValueError):
+        raise TemplateError(f"Parameter '{name}' must be of type {kind}, got {value!r}")
+    raise TemplateError(f"Parameter '{name}' has unknown type {kind}")
+
+
+def _lora_entries(param: str, value: Any) -> List[Dict[str, Any]]:
+    """Normalize a `loras` parameter to [{'name', 'strength'}], dropping 'None' entries"""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        raise TemplateError(f"Parameter '{param}' must be a list")
+    entries = []
+    for item in value:
+        if isinstance(item, str):
+            item = {'name': item}
+        if not isinstance(item, dict):
+            raise TemplateError(f"Invalid LoRA entry: {item!r}")
+        name = item.get('name') or item.get('lora_name') or item.get('modelName') or item.get('fileName')
+        if not name or name == 'None':
+            continue
+        strength = item.get('strength', item.get('strength_model', 1.0))
+        entries.append({'name': name, 'strength': _coerce(f'{param}.strength', 'number', strength)})
+    return entries
+
+
+class WorkflowTemplate:
+    """One versioned workflow graph and the parameters it accepts"""
+
+    def __init__(self, spec: Dict[str, Any], path: str = ''):
+        self.name = spec.get('name')
+        self.version = spec.get('version')
+        self.description = spec.get('description', '')
+        self.params = spec.get('params') or {}
+        self.lora_chain = spec.get('lora_chain')
+        self.path = path
+        graph = spec.get('graph') or {}
+        self._check(graph)
+        # Rendering parses this instead of deep-copying the dict
+        self._graph_json = json.dumps(graph, separators=(',', ':'))
+
+    def _chain(self, spec: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """LoRA chain spec a `loras` parameter splices in"""
+        return spec.get('chain') or self.lora_chain
+
+    def _chains(self) -> List[Dict[str, Any]]:
+        chains = [self._chain(spec) for spec in self.params.values() if spec.get('type') == 'loras']
+        if self.lora_chain:
+            chains.append(self.lora_chain)
+        return [chain for chain in chains if chain]
+
+    def _check(self, graph: Dict[str, Any]):
+        """Reject dangling links and parameters that target missing nodes or inputs"""
+        label = f"template {self.name} v{self.version}"
+        if not self.name or not isinstance(self.version, int):
+            raise TemplateError(f"{self.path}: template needs a name and an integer version")
+        if not graph:
+            raise TemplateError(f"{label}: empty graph")
+        for node_id, node in graph.items():
+            if not isinstance(node, dict) or not node.get('class_type'):
+                raise TemplateError(f"{label}: node {node_id} has no class_type")
+            for input_name, value in (node.get('inputs') or {}).items():
+                if _is_link(value) and value[0] not in graph:
+                    raise TemplateError(f"{label}: node {node_id} input '{input_name}' links to missing node {value[0]}")
+        for param, spec in self.params.items():
+            if spec.get('type') == 'loras':
+                if not self._chain(spec):
+                    raise TemplateError(f"{label}: parameter '{param}' needs a lora_chain")
+                continue
+            for node_id, input_name in spec.get('targets') or []:
+                if input_name not in (graph.get(node_id) or {}).get('inputs', {}):
+                    raise TemplateError(f"{label}: parameter '{param}' targets missing input {node_id}.{input_name}")
+        for chain in self._chains():
+            source = chain.get('source')
+            if not _is_link(source) or source[0] not in graph:
+                raise TemplateError(f"{label}: lora_chain source must link to a node in the graph")
+            for node_id, input_name in chain.get('consumers') or []:
+                if input_name not in (graph.get(node_id) or {}).get('inputs', {}):
+                    raise TemplateError(f"{label}: lora_chain consumer {node_id}.{input_name} is missing")
+            first_id = int(chain.get('first_node_id', 1000))
+            if str(first_id) in graph:
+                raise TemplateError(f"{label}: lora_chain first_node_id {first_id} is already used")
+
+    def render(self, params: Optional[Dict[str, Any]] = None, prevalidated: bool = False) -> RenderedWorkflow:
+        """Workflow with the given parameters injected"""
+        params = dict(params or {})
+        unknown = sorted(set(params) - set(self.params))
+        if unknown:
+            raise TemplateError(f"Unknown parameter(s) for {self.name} v{self.version}: {', '.join(unknown)}")
+
+        graph = json.loads(self._graph_json)
+        for name, spec in self.params.items():
+            kind = spec.get('type', 'string')
+            value = params.get(name)
+            if kind == 'loras':
+                self._splice_loras(graph, self._chain(spec), _lora_entries(name, value if name in params else spec.get('default')))
+                continue
+            if value is None:
+                if kind == 'seed' and 'default' not in spec:
+                    value = random.randint(0, MAX_SEED)
+                elif 'default' in spec:
+                    value = spec['default']
+                elif spec.get('required'):
+                    raise TemplateError(f"Missing required parameter '{name}' for {self.name} v{self.version}")
+                else:
+                    continue
+            if kind == 'seed' and value == -1:
+                value = random.randint(0, MAX_SEED)
+            value = _coerce(name, kind, value)
+            for node_id, input_name in spec.get('targets') or []:
+                graph[node_id]['inputs'][input_name] = value
+
+        return RenderedWorkflow(graph, self.name, self.version, prevalidated)
+
+    def sample_workflow(self) -> Dict[str, Any]:
+        """Render with placeholder parameters and one LoRA per chain, so every node the template can produce is present"""
+        params = {}
+        for name, spec in self.params.items():
+            if spec.get('type') == 'loras':
+                params[name] = [{'name': 'placeholder.safetensors', 'strength': 1.0}]
+            elif spec.get('required') and spec.get('type', 'string') == 'string':
+                params[name] = 'placeholder'
+        return dict(self.render(params))
+
+    def _splice_loras(self, graph: Dict[str, Any], chain: Dict[str, Any], loras: List[Dict[str, Any]]):
+        if not loras:
+            return
+        previous = list(chain['source'])
+        node_id = int(chain.get('first_node_id', 1000))
+        for lora in loras:
+            inputs = {chain.get('model_input', 'model'): previous, chain.get('name_input', 'lora_name'): lora['name']}
+            strength_input = chain.get('strength_input', 'strength_model')
+            inputs[strength_input] = lora['strength']
+            if chain.get('clip_strength_input'):
+                inputs[chain['clip_strength_input']] = lora['strength']
+            graph[str(node_id)] = {'class_type': chain['class_type'], 'inputs': inputs}
+            previous = [str(node_id), 0]
+            node_id += 1
+        for consumer_id, input_name in chain.get('consumers') or []:
+            graph[consumer_id]['inputs'][input_name] = previous
+
+
+class TemplateRegistry:
+    """All templates found in TEMPLATE_DIR, by name and version"""
+
+    def __init__(self, template_dir: str = TEMPLATE_DIR):
+        self.template_dir = template_dir
+        self.templates = {}  # name -> {version: WorkflowTemplate}
+        self._catalog_checked = {}  # (name, version) -> build key it passed on
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        try:
+            filenames = sorted(os.listdir(self.template_dir))
+        except OSError as e:
+            logger.warning(f"⚠️ No workflow templates at {self.template_dir}: {e}")
+            return
+        for filename in filenames:
+            match = TEMPLATE_FILE.match(filename)
+            if not match:
+                continue
+            path = os.path.join(self.template_dir, filename)
+            try:
+                with open(path) as f:
+                    template = WorkflowTemplate(json.load(f), path)
+                if (template.name, template.version) != (match.group('name'), int(match.group('version'))):
+                    raise TemplateError(f"{filename} declares {template.name} v{template.version}")
+            except (OSError, ValueError) as e:
+                logger.error(f"❌ Skipping workflow template {filename}: {e}")
+                continue
+            self.templates.setdefault(template.name, {})[template.version] = template
+        if self.templates:
+            summary = ', '.join(f"{name} v{max(versions)}" for name, versions in sorted(self.templates.items()))
+            logger.info(f"🧩 Loaded workflow templates: {summary}")
+
+    def get(self, name: str, version: Optional[int] = None) -> WorkflowTemplate:
+        versions = self.templates.get(name)
+        if not versions:
+            raise TemplateError(f"No workflow template named '{name}'")
+        if version is None:
+            return versions[max(versions)]
+        try:
+            return versions[int(version)]
+        except (KeyError, TypeError, ValueError):
+            raise TemplateError(f"Template '{name}' has no version {version} (available: {sorted(versions)})")
+
+    def _passes_catalog(self, template: WorkflowTemplate) -> bool:
+        """Check a template's node classes and required inputs against the ComfyUI catalog once per build"""
+        from .catalog import get_node_catalog
+
+        catalog = get_node_catalog()
+        if catalog is None:
+            return False
+        key = (template.name, template.version)
+        with self._lock:
+            if self._catalog_checked.get(key) == catalog.key:
+                return True
+        workflow = template.sample_workflow()
+        problems = catalog.problems(workflow)
+        if problems and catalog.source == 'disk':
+            catalog = get_node_catalog(refresh=True) or catalog
+            problems = catalog.problems(workflow)
+        if problems:
+            raise TemplateError(f"Template {template.name} v{template.version} doesn't fit this ComfyUI build: {'; '.join(problems[:10])}")
+        with self._lock:
+            self._catalog_checked[key] = catalog.key
+        return True
+
+    def render(self, name: str, params: Optional[Dict[str, Any]] = None, version: Optional[int] = None) -> RenderedWorkflow:
+        template = self.get(name, version)
+        return template.render(params, prevalidated=self._passes_catalog(template))
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_template_registry() -> TemplateRegistry:
+    """Process-wide workflow template registry"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = TemplateRegistry()
+        return _registry
+
+
+def resolve_workflow(job_input: Dict[str, Any], generation_type: str) -> Optional[Dict[str, Any]]:
+    """The job's raw `workflow` if it sent one, otherwise its template rendered with `params`
+
+    Returns None when the job sent neither; raises TemplateError for bad templates or parameters.
+    """
+    workflow = job_input.get('workflow')
+    if workflow:
+        return workflow
+    if 'template' not in job_input and 'params' not in job_input:
+        return None
+
+    name = job_input.get('template') or generation_type
+    version = job_input.get('template_version')
+    rendered = get_template_registry().render(name, job_input.get('params'), version)
+    logger.info(f"🧩 Rendered workflow template {rendered.template} v{rendered.version} ({len(rendered)} nodes)")
+    return rendered
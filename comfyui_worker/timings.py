@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""
+Historical job timings and ETA prediction.
+
+Every finished job appends one compact JSON line to JOB_TIMINGS_PATH on the
+shared network volume with its phase timings (queue wait, model load,
+sampling, decode, other nodes, upload) and two workflow signatures:
+
+- `sig`: node classes plus resolution, sampler steps, frame count, batch
+  size and LoRA count, so only truly comparable jobs share it
+- `fam`: node classes only, used while `sig` has too little history
+
+`EtaPredictor` reads the tail of that file once per worker and keeps the
+most recent samples per signature in memory. Its percentiles feed
+`WorkflowProgress.expected_seconds`, so `estimatedTimeRemaining` in the
+progress webhooks comes from how long the same kind of job actually took.
+"""
+
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+from collections import defaultdict, deque
+from typing import Dict, List, Any, Optional
+
+from .progress import WorkflowProgress, node_stage, resolve_int
+
+logger = logging.getLogger(__name__)
+
+# Shared by every worker attached to the network volume; nothing is written when it isn't mounted
+JOB_TIMINGS_PATH = os.environ.get('JOB_TIMINGS_PATH', '/runpod-volume/comfyui_job_timings.jsonl')
+
+# Samples kept per signature and needed before a prediction is trusted
+MAX_SAMPLES = 200
+MIN_SAMPLES = 3
+
+# Only the tail of the history file is read at startup
+HISTORY_TAIL_BYTES = 4 * 1024 * 1024
+
+PHASES = ('queue', 'load', 'sample', 'decode', 'other', 'upload')
+STAGE_PHASES = {
+    'loading_models': 'load',
+    'sampling': 'sample',
+    'decoding': 'decode',
+    'upscaling': 'decode'
+}
+
+
+def _hash(data: Any) -> str:
+    return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:16]
+
+
+def workflow_signature(tracker: WorkflowProgress) -> Dict[str, Any]:
+    """Canonical description of how expensive a workflow is, independent of prompts and seeds"""
+    workflow = tracker.workflow
+    classes = sorted(tracker.classes.values())
+
+    width = height = 0
+    loras = 0
+    for node_id in tracker.classes:
+        inputs = workflow[node_id].get('inputs') or {}
+        width = max(width, resolve_int(workflow, inputs.get('width')) or 0)
+        height = max(height, resolve_int(workflow, inputs.get('height')) or 0)
+        if 'lora_name' in inputs or 'Lora' in tracker.classes[node_id]:
+            loras += 1
+
+    return {
+        'classes': classes,
+        'resolution': [width, height],
+        'steps': tracker.total_steps,
+        'frames': tracker.frames,
+        'batch': tracker.batch_size,
+        'loras': loras
+    }
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(q * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+class EtaPredictor:
+    """Running per-signature percentiles over the append-only timing history"""
+
+    def __init__(self, path: str = JOB_TIMINGS_PATH):
+        self.path = path
+        self._samples = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+        self._lock = threading.Lock()
+        self._loaded = False
+
+    @property
+    def enabled(self) -> bool:
+        return os.path.isdir(os.path.dirname(self.path))
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not os.path.exists(self.path):
+            return
+
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(0, os.SEEK_END)
+                size = f.tell()
+                f.seek(max(0, size - HISTORY_TAIL_BYTES))
+                lines = f.read().splitlines()
+            if size > HISTORY_TAIL_BYTES:
+                lines = lines[1:]  # first line is probably cut
+
+            count = 0
+            for line in lines:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._add(record)
+                count += 1
+            logger.info(f"⏱️ Loaded {count} historical job timings from {self.path}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not read job timings history: {e}")
+
+    def _add(self, record: Dict):
+        for key in ('sig', 'fam'):
+            if record.get(key):
+                self._samples[record[key]].append(record)
+
+    def predict(self, signature: str, family: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """p50/p90 of the total and p50 of each phase, or None without enough history"""
+        with self._lock:
+            self._load()
+            samples = list(self._samples.get(signature) or [])
+            if len(samples) < MIN_SAMPLES and family:
+                samples = list(self._samples.get(family) or [])
+        if len(samples) < MIN_SAMPLES:
+            return None
+
+        totals = [record['total'] for record in samples if 'total' in record]
+        if not totals:
+            return None
+        prediction = {
+            'samples': len(totals),
+            'total_p50': percentile(totals, 0.5),
+            'total_p90': percentile(totals, 0.9)
+        }
+        for phase in PHASES:
+            values = [record[phase] for record in samples if phase in record]
+            if values:
+                prediction[phase] = percentile(values, 0.5)
+        return prediction
+
+    def record(self, record: Dict):
+        with self._lock:
+            self._load()
+            self._add(record)
+        if not self.enabled:
+            return
+        try:
+            # One short line per write keeps concurrent appends from interleaving
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record, separators=(',', ':')) + '\n')
+        except Exception as e:
+            logger.warning(f"⚠️ Could not append job timings: {e}")
+
+
+_predictor = None
+_predictor_lock = threading.Lock()
+
+
+def get_eta_predictor() -> EtaPredictor:
+    """Process-wide ETA predictor"""
+    global _predictor
+    with _predictor_lock:
+        if _predictor is None:
+            _predictor = EtaPredictor()
+        return _predictor
+
+
+class JobTimings:
+    """Phase timings of one job, recorded against its workflow signature.
+
+    Created when monitoring starts (the same origin the handlers measure
+    `elapsed` from). If there is enough history for the signature, the
+    tracker's expected duration is replaced by the historical median.
+    """
+
+    def __init__(self, tracker: WorkflowProgress, watcher=None):
+        self.tracker = tracker
+        self.watcher = watcher
+        self.started = time.time()
+        self.signature = workflow_signature(tracker)
+        self.sig = _hash(self.signature)
+        self.fam = _hash(self.signature['classes'])
+        self.prediction = None
+
+        try:
+            self.prediction = get_eta_predictor().predict(self.sig, self.fam)
+        except Exception as e:
+            logger.warning(f"⚠️ ETA prediction failed: {e}")
+
+        if self.prediction:
+            tracker.use_expected_seconds(self.prediction['total_p50'])
+            logger.info(f"⏱️ Expecting ~{int(self.prediction['total_p50'])}s (p90 {int(self.prediction['total_p90'])}s) from {self.prediction['samples']} similar jobs")
+
+    def phases(self, finished: Optional[float] = None) -> Dict[str, float]:
+        """Seconds spent in each phase; upload is everything after ComfyUI finished"""
+        finished = finished or time.time()
+        phases = dict.fromkeys(PHASES, 0.0)
+        watcher = self.watcher
+        if watcher is None or watcher.started_at is None:
+            return phases
+
+        phases['queue'] = max(0.0, watcher.started_at - self.started)
+        for node_id, node_start, node_end in watcher.node_timings:
+            phase = STAGE_PHASES.get(node_stage(self.tracker.classes.get(node_id)), 'other')
+            phases[phase] += max(0.0, (node_end or watcher.finished_at or finished) - node_start)
+        if watcher.finished_at:
+            phases['upload'] = max(0.0, finished - watcher.finished_at)
+        return phases
+
+    def record(self):
+        """Append this (successful) job to the history"""
+        finished = time.time()
+        record = {
+            'sig': self.sig,
+            'fam': self.fam,
+            'ts': int(finished),
+            'total': round(finished - self.started, 2)
+        }
+        record.update({phase: round(seconds, 2) for phase, seconds in self.phases(finished).items()})
+        try:
+            get_eta_predictor().record(record)
+            logger.info(f"⏱️ Job timings: {record}")
+        except Exception as e:
+            logger.warning(f"⚠️ Could not record job timings: {e}")
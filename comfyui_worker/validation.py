@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Compiled single-pass workflow validation.
+
+Each handler used to carry its own validate_*_workflow() that re-scanned
+the graph with ad-hoc checks (some rebuilt class_type lists per check) and
+answered with a bare True/False. The checks are now declared once per
+generation type in SCHEMAS:
+
+- `nodes`: node id -> expected class_type (None: any class)
+- `inputs`: node id -> inputs that node must carry
+- `any_of`: groups of class_types of which at least one must be present
+- `require_inputs`: every node needs an `inputs` dict
+- `strict_types`: a wrong class_type on a declared node is an error
+  rather than a warning
+
+`compile_schema()` turns a schema into a `WorkflowValidator` at import.
+One pass over the graph checks node structure, the declared nodes and
+inputs, and every link: it must point at an existing node, and when the
+node catalog is cached its output index and type must fit the input it
+feeds. The collected edges are then checked for cycles. Every problem is
+reported with the node and input it concerns.
+"""
+
+import logging
+from typing import Dict, List, Any, Optional, Tuple
+
+from .catalog import cached_node_catalog
+
+logger = logging.getLogger(__name__)
+
+# Wildcard types in /object_info; COMBO inputs accept links from primitive/widget nodes
+ANY_TYPES = ('*', 'COMBO')
+
+
+class WorkflowSchema:
+    """Declarative requirements a generation type places on a workflow"""
+
+    def __init__(self, nodes: Optional[Dict[str, Optional[str]]] = None,
+                 inputs: Optional[Dict[str, Tuple[str, ...]]] = None,
+                 any_of: Tuple[Tuple[str, ...], ...] = (),
+                 require_inputs: bool = False, strict_types: bool = True):
+        self.nodes = nodes or {}
+        self.inputs = inputs or {}
+        self.any_of = any_of
+        self.require_inputs = require_inputs
+        self.strict_types = strict_types
+
+
+SCHEMAS = {
+    'text_to_image': WorkflowSchema(
+        nodes={'1': None, '2': None, '3': None, '4': None, '5': None, '6': None, '12': None, '13': None},
+        inputs={'2': ('text',), '12': ('seed',)},
+        any_of=(('UNETLoader',),),
+        require_inputs=True
+    ),
+    'fps_boost': WorkflowSchema(
+        nodes={'1': None, '2': None, '3': None}  # VHS_LoadVideo, RIFE VFI, VHS_VideoCombine
+    ),
+    'flux_kontext': WorkflowSchema(
+        nodes={
+            '37': 'UNETLoader',
+            '38': 'DualCLIPLoader',
+            '39': 'VAELoader',
+            '6': 'CLIPTextEncode',
+            '142': 'LoadImage',  # Single image input
+            '42': 'FluxKontextImageScale',
+            '124': 'VAEEncode',
+            '177': 'ReferenceLatent',
+            '35': 'FluxGuidance',
+            '135': 'ConditioningZeroOut',
+            '31': 'KSampler',
+            '8': 'VAEDecode',
+            '199': 'SaveImage'
+        },
+        inputs={'6': ('text',), '31': ('seed',)}
+    ),
+    'text_to_video': WorkflowSchema(
+        # Nodes 90, 91, 114, 115 are optional custom LoRAs
+        nodes={
+            '71': 'CLIPLoader',
+            '72': 'CLIPTextEncode',  # Negative prompt
+            '73': 'VAELoader',
+            '74': 'EmptyHunyuanLatentVideo',
+            '75': 'UNETLoader',  # High noise model
+            '76': 'UNETLoader',  # Low noise model
+            '78': 'KSamplerAdvanced',  # Low noise sampler
+            '80': 'SaveVideo',
+            '81': 'KSamplerAdvanced',  # High noise sampler
+            '82': 'ModelSamplingSD3',  # High noise sampling
+            '83': 'LoraLoaderModelOnly',  # High noise LoRA
+            '85': 'LoraLoaderModelOnly',  # Low noise LoRA
+            '86': 'ModelSamplingSD3',  # Low noise sampling
+            '87': 'VAEDecode',
+            '88': 'CreateVideo',
+            '89': 'CLIPTextEncode'  # Positive prompt
+        },
+        inputs={'72': ('text',), '89': ('text',)}
+    ),
+    'image_to_video': WorkflowSchema(
+        nodes={node_id: None for node_id in (
+            '6', '7', '37', '38', '39', '48', '56', '65', '81', '89', '90', '91', '92', '93', '94', '8', '57', '131'
+        )},
+        require_inputs=True
+    ),
+    'skin_enhancement': WorkflowSchema(
+        nodes={node_id: None for node_id in ('8', '31', '39', '41', '114', '104', '115', '115_2')}
+    ),
+    'image_to_image_skin_enhancement': WorkflowSchema(
+        nodes={
+            # Preview nodes (7, 8, 9, 15, 21, 24, 28, 33, 34) are optional
+            **{str(node_id): None for node_id in (
+                1, 2, 3, 4, 5, 6, 10, 11, 12, 13, 14, 16, 17, 18, 19, 20, 22, 23, 25, 26, 29, 30, 31, 32, 38, 39, 40
+            )},
+            '40': 'LoadImage',  # Input image
+            '39': 'CheckpointLoaderSimple',  # Model loader
+            '29': 'Lora Loader Stack (rgthree)',  # LoRA loader
+            '31': 'KSampler',  # Main generation
+            '38': 'SaveImage',  # Output
+            '14': 'LayerMask: PersonMaskUltra V2',  # Person mask
+            '4': 'FaceParse(FaceParsing)',  # Face parsing
+        },
+        strict_types=False
+    ),
+    'style_transfer': WorkflowSchema(
+        # 42, 43, 44 vary between implementations
+        nodes={node_id: None for node_id in ('8', '31', '33', '37', '38', '41', '50', '51', '6', '27', '154', '155')},
+        any_of=(('StyleModelLoader', 'CLIPVisionEncode', 'ConditioningConcat'),),
+        require_inputs=True
+    ),
+    'face_swap': WorkflowSchema(
+        any_of=(('SaveImage', 'PreviewImage'),)
+    ),
+}
+
+
+def _is_link(value: Any) -> bool:
+    return (isinstance(value, list) and len(value) == 2 and isinstance(value[0], (str, int))
+            and isinstance(value[1], int) and not isinstance(value[1], bool))
+
+
+def _types_match(output_type: Any, input_type: Any) -> bool:
+    """ComfyUI's rule: wildcards match anything, comma-separated types match on any overlap"""
+    if not isinstance(output_type, str) or not isinstance(input_type, str):
+        return True
+    if output_type in ANY_TYPES or input_type in ANY_TYPES:
+        return True
+    return bool(set(output_type.split(',')) & set(input_type.split(',')))
+
+
+def _find_cycle(edges: Dict[str, List[str]]) -> Optional[List[str]]:
+    """A dependency cycle as a list of node ids, or None (iterative DFS)"""
+    state = {}  # node id -> 1 visiting, 2 done
+    for root in edges:
+        if root in state:
+            continue
+        path = [root]
+        stack = [iter(edges.get(root, ()))]
+        state[root] = 1
+        while stack:
+            nxt = next(stack[-1], None)
+            if nxt is None:
+                state[path.pop()] = 2
+                stack.pop()
+                continue
+            seen = state.get(nxt)
+            if seen == 1:
+                return path[path.index(nxt):] + [nxt]
+            if seen is None:
+                state[nxt] = 1
+                path.append(nxt)
+                stack.append(iter(edges.get(nxt, ())))
+    return None
+
+
+class WorkflowValidator:
+    """A schema compiled into lookup tables for a single pass over the graph"""
+
+    def __init__(self, name: str, schema: WorkflowSchema):
+        self.name = name
+        self.required_nodes = tuple(schema.nodes)
+        self.expected_types = {node_id: class_type for node_id, class_type in schema.nodes.items() if class_type}
+        self.required_inputs = {node_id: tuple(names) for node_id, names in schema.inputs.items()}
+        self.any_of = tuple(frozenset(group) for group in schema.any_of)
+        self.watched_classes = frozenset().union(*self.any_of) if self.any_of else frozenset()
+        self.require_inputs = schema.require_inputs
+        self.strict_types = schema.strict_types
+
+    def errors(self, workflow: Any, check_link_types: bool = True) -> Tuple[List[str], List[str]]:
+        """(errors, warnings) for an API-format workflow"""
+        if not isinstance(workflow, dict):
+            return [f"workflow must be a JSON object, got {type(workflow).__name__}"], []
+        if not workflow:
+            return ["workflow has no nodes"], []
+
+        errors = []
+        warnings = []
+        catalog = cached_node_catalog() if check_link_types else None
+        catalog_nodes = catalog.nodes if catalog is not None else None
+        edges = {}
+        seen_classes = set()
+
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict):
+                errors.append(f"node {node_id}: must be an object")
+                continue
+            class_type = node.get('class_type')
+            if not isinstance(class_type, str) or not class_type:
+                errors.append(f"node {node_id}: missing class_type")
+                continue
+            if class_type in self.watched_classes:
+                seen_classes.add(class_type)
+
+            expected = self.expected_types.get(node_id)
+            if expected is not None and class_type != expected:
+                message = f"node {node_id}: expected {expected}, got {class_type}"
+                (errors if self.strict_types else warnings).append(message)
+
+            inputs = node.get('inputs')
+            if inputs is None:
+                if self.require_inputs:
+                    errors.append(f"node {node_id} ({class_type}): missing inputs")
+                inputs = {}
+            elif not isinstance(inputs, dict):
+                errors.append(f"node {node_id} ({class_type}): inputs must be an object")
+                continue
+
+            for input_name in self.required_inputs.get(node_id, ()):
+                if input_name not in inputs:
+                    errors.append(f"node {node_id} ({class_type}): missing input '{input_name}'")
+
+            spec = catalog_nodes.get(class_type) if catalog_nodes is not None else None
+            for input_name, value in inputs.items():
+                if not _is_link(value):
+                    continue
+                source_id = str(value[0])
+                source = workflow.get(source_id)
+                if not isinstance(source, dict):
+                    errors.append(f"node {node_id} ({class_type}): input '{input_name}' links to missing node {source_id}")
+                    continue
+                edges.setdefault(node_id, []).append(source_id)
+
+                if spec is None:
+                    continue
+                source_spec = catalog_nodes.get(source.get('class_type'))
+                if source_spec is None:
+                    continue
+                outputs = source_spec.get('output') or []
+                if value[1] < 0 or value[1] >= len(outputs):
+                    errors.append(
+                        f"node {node_id} ({class_type}): input '{input_name}' links to output {value[1]} of node "
+                        f"{source_id} ({source['class_type']}), which has {len(outputs)} output(s)"
+                    )
+                    continue
+                input_type = spec['required'].get(input_name) or spec['optional'].get(input_name)
+                if input_type is not None and not _types_match(outputs[value[1]], input_type):
+                    errors.append(
+                        f"node {node_id} ({class_type}): input '{input_name}' expects {input_type}, but node "
+                        f"{source_id} ({source['class_type']}) output {value[1]} is {outputs[value[1]]}"
+                    )
+
+        for node_id in self.required_nodes:
+            if node_id not in workflow:
+                errors.append(f"missing required node {node_id}" + (f" ({self.expected_types[node_id]})" if node_id in self.expected_types else ''))
+
+        for group in self.any_of:
+            if not group & seen_classes:
+                errors.append(f"workflow needs at least one of: {', '.join(sorted(group))}")
+
+        if edges:
+            cycle = _find_cycle(edges)
+            if cycle:
+                errors.append(f"dependency cycle: {' -> '.join(cycle)}")
+
+        return errors, warnings
+
+
+def compile_schema(name: str, schema: WorkflowSchema) -> WorkflowValidator:
+    return WorkflowValidator(name, schema)
+
+
+VALIDATORS = {name: compile_schema(name, schema) for name, schema in SCHEMAS.items()}
+
+
+def workflow_errors(workflow: Any, generation_type: str) -> List[str]:
+    """Validate a workflow against its generation type's schema; logs and returns the errors"""
+    validator = VALIDATORS[generation_type]
+    errors, warnings = validator.errors(workflow)
+    for warning in warnings:
+        logger.warning(f"⚠️ {generation_type} workflow: {warning}")
+    if errors:
+        logger.error(f"❌ Invalid {generation_type} workflow: {'; '.join(errors[:10])}")
+    else:
+        logger.info(f"✅ {generation_type} workflow validation passed")
+    return errors
@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""
+Model warm-up at worker boot.
+
+Starting ComfyUI only gets the server up; the first real job still pays
+for loading the UNet, text encoders and VAE from the network volume.
+Handlers now remember a shrunken copy of the workflows they run
+(`remember_workflow()`): 1 sampler step, 64x64 latents, 1 frame, batch 1,
+prompts blanked, input images swapped for a tiny placeholder, video
+loaders swapped for two placeholder frames, LoRA loaders stripped (a
+job's LoRA must not outlive it on the volume) and savers replaced by
+PreviewImage. The copy is stored per generation type under
+WARMUP_WORKFLOW_DIR on the network volume.
+
+`warm_up_models()` runs as the last prewarm step: it queues that graph as
+soon as ComfyUI is up, so the same model files production uses are
+resident before the first job arrives, and logs how long it took as the
+worker's cold-start cost. On a fresh volume, or for a type no job has run
+yet, it shrinks the type's workflow template rendered with its default
+parameters instead. `models_warm` is only marked on the startup timeline
+once a warm-up graph actually ran. Warm-up problems are logged, never
+fatal.
+"""
+
+import os
+import copy
+import json
+import time
+import zlib
+import struct
+import hashlib
+import logging
+from typing import Dict, Any, Optional
+
+from .graph import WorkflowGraph
+from .optimize import LORA_PASS_THROUGH, collapse_pass_throughs
+from .client import get_comfyui_client
+from .events import subscribe, track_prompt, watch_prompt
+from .residency import ensure_model_residency, residency_report
+from .supervisor import get_supervisor
+from .catalog import get_node_catalog
+from .templates import TemplateError, get_template_registry
+
+logger = logging.getLogger(__name__)
+
+WARMUP_WORKFLOW_DIR = os.environ.get('WARMUP_WORKFLOW_DIR', '/runpod-volume/comfyui_warmup')
+WARMUP_TIMEOUT = float(os.environ.get('WARMUP_TIMEOUT', '300'))
+WARMUP_ENABLED = os.environ.get('COMFYUI_WARMUP', '1') not in ('0', 'false', 'False')
+COMFYUI_INPUT_DIR = os.environ.get('COMFYUI_INPUT_DIR', '/app/comfyui/input')
+
+WARMUP_SIZE = 64
+WARMUP_IMAGE = 'warmup_placeholder.png'
+
+# Literal inputs rewritten to the cheapest value that still loads every model
+SHRINK_INPUTS = {
+    'steps': 1,
+    'start_at_step': 0,
+    'end_at_step': 1,
+    'width': WARMUP_SIZE,
+    'height': WARMUP_SIZE,
+    'length': 1,
+    'video_frames': 1,
+    'num_frames': 1,
+    'frame_count': 1,
+    'batch_size': 1
+}
+PROMPT_INPUTS = ('text', 'prompt', 'clip_l', 't5xxl')
+IMAGE_LOADERS = ('LoadImage', 'LoadImageMask')
+# Video loaders whose output 0 is an IMAGE batch, so placeholder frames can stand in
+VIDEO_LOADERS = ('VHS_LoadVideo', 'VHS_LoadVideoPath', 'VHS_LoadVideoFFmpeg', 'VHS_LoadVideoFFmpegPath')
+WARMUP_FRAMES = 2
+
+_remembered = {}
+
+
+def _placeholder_png(size: int = WARMUP_SIZE) -> bytes:
+    """Plain grey RGB PNG, written without PIL"""
+    def chunk(tag: bytes, data: bytes) -> bytes:
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    rows = b''.join(b'\x00' + b'\x80' * (size * 3) for _ in range(size))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(rows))
+            + chunk(b'IEND', b''))
+
+
+def _is_link(value: Any) -> bool:
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+def _is_saver(class_type: str) -> bool:
+    return class_type.startswith('Save') or 'VideoCombine' in class_type
+
+
+def _strip_loras(graph: WorkflowGraph):
+    """Zero every LoRA loader and collapse the ones that become pass-throughs"""
+    for record in list(graph.nodes.values()):
+        if 'Lora' not in (record.class_type or ''):
+            continue
+        if record.class_type in LORA_PASS_THROUGH:
+            strengths = LORA_PASS_THROUGH[record.class_type][0]
+        else:
+            strengths = [name for name, value in record.inputs.items()
+                         if name.startswith('strength') and isinstance(value, (int, float)) and not isinstance(value, bool)]
+        for name in strengths:
+            graph.set_input(record.id, name, 0)
+    collapse_pass_throughs(graph)
+
+
+def _replace_video_loaders(graph: WorkflowGraph) -> bool:
+    """Feed placeholder frames where videos were loaded; False when a loader can't be replaced"""
+    for record in list(graph.nodes.values()):
+        class_type = record.class_type or ''
+        if 'LoadVideo' not in class_type:
+            continue
+        if class_type not in VIDEO_LOADERS:
+            return False
+        # Only the IMAGE output can be stood in for (frame_count, audio, video_info can't)
+        if any(graph.get(consumer_id).links[name][1] != 0 for consumer_id, name in graph.consumers(record.id)):
+            return False
+        frames_id = f"{record.id}_warmup"
+        graph.add(frames_id, 'LoadImage', {'image': WARMUP_IMAGE})
+        graph.replace(record.id, 'RepeatImageBatch', {'image': [frames_id, 0], 'amount': WARMUP_FRAMES})
+    return True
+
+
+def shrink_workflow(workflow: Dict) -> Optional[Dict]:
+    """Cheapest version of a workflow that still loads all of its models
+
+    None when the workflow can't be warmed up without a job's own inputs.
+    """
+    graph = copy.deepcopy(workflow)
+
+    for node_id in list(graph):
+        node = graph[node_id]
+        if not isinstance(node, dict):
+            del graph[node_id]
+            continue
+        class_type = node.get('class_type', '')
+        inputs = node.setdefault('inputs', {})
+
+        for key, value in SHRINK_INPUTS.items():
+            if isinstance(inputs.get(key), int) and not isinstance(inputs.get(key), bool):
+                inputs[key] = value
+        if 'TextEncode' in class_type:
+            for key in PROMPT_INPUTS:
+                if isinstance(inputs.get(key), str):
+                    inputs[key] = 'warmup'
+        if class_type in IMAGE_LOADERS:
+            inputs['image'] = WARMUP_IMAGE
+
+    # Savers would write files (and upload nothing); preview their images instead
+    for node_id in list(graph):
+        node = graph[node_id]
+        if not _is_saver(node.get('class_type', '')):
+            continue
+        images = node['inputs'].get('images')
+        if not _is_link(images):
+            # e.g. SaveVideo <- CreateVideo(images)
+            source = graph.get(str((node['inputs'].get('video') or [None])[0]))
+            images = (source or {}).get('inputs', {}).get('images')
+        if _is_link(images):
+            graph[node_id] = {'class_type': 'PreviewImage', 'inputs': {'images': images}}
+        else:
+            del graph[node_id]
+
+    indexed = WorkflowGraph(graph)
+    _strip_loras(indexed)
+    if not _replace_video_loaders(indexed):
+        return None
+    return indexed.to_workflow()
+
+
+def _workflow_path(generation_type: str) -> str:
+    return os.path.join(WARMUP_WORKFLOW_DIR, f"{generation_type}.json")
+
+
+def remember_workflow(generation_type: str, workflow: Optional[Dict]):
+    """Store the shrunken form of a production workflow for the next boot's warm-up"""
+    if not workflow or not os.path.isdir(os.path.dirname(WARMUP_WORKFLOW_DIR)):
+        return
+    try:
+        graph = shrink_workflow(workflow)
+        if graph is None:
+            return
+        data = json.dumps(graph, sort_keys=True, separators=(',', ':'))
+        digest = hashlib.sha1(data.encode('utf-8')).hexdigest()
+        if _remembered.get(generation_type) == digest:
+            return
+
+        os.makedirs(WARMUP_WORKFLOW_DIR, exist_ok=True)
+        path = _workflow_path(generation_type)
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, 'w') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        _remembered[generation_type] = digest
+    except Exception as e:
+        logger.warning(f"⚠️ Could not store warm-up workflow for {generation_type}: {e}")
+
+
+def _template_workflow(generation_type: str) -> Optional[Dict]:
+    """Shrunken default render of the type's workflow template, None when there is none"""
+    try:
+        template = get_template_registry().get(generation_type)
+        # Required parameters are prompts and input file names, which the shrink replaces anyway
+        params = {name: 'warmup' for name, spec in template.params.items()
+                  if spec.get('required') and spec.get('type', 'string') == 'string'}
+        return shrink_workflow(dict(template.render(params)))
+    except TemplateError as e:
+        logger.info(f"🔥 No usable {generation_type} workflow template for warm-up: {e}")
+        return None
+
+
+def _load_workflow(generation_type: str) -> Optional[Dict]:
+    """The remembered warm-up graph, or the template's when no job has run yet"""
+    try:
+        with open(_workflow_path(generation_type)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+    graph = _template_workflow(generation_type)
+    if graph is not None:
+        logger.info(f"🔥 No {generation_type} workflow seen yet, warming up from its template")
+    return graph
+
+
+def _wait(prompt_id: str, timeout: float) -> str:
+    comfyui = get_comfyui_client()
+    deadline = time.time() + timeout
+    with watch_prompt(prompt_id) as watcher:
+        while time.time() < deadline:
+            if watcher.finished:
+                return watcher.status
+            if not watcher.live:
+                history = comfyui.get(f"/history/{prompt_id}", timeout=10).json()
+                if prompt_id in history:
+                    return history[prompt_id].get('status', {}).get('status_str', 'success')
+            watcher.sleep(1)
+    return 'timeout'
+
+
+def warm_up_models(generation_type: str) -> bool:
+    """Run the remembered tiny graph so production models are resident; always returns True"""
+    # Load (or fetch once per ComfyUI build) the node catalog so the first job doesn't wait for /object_info
+    get_node_catalog()
+
+    if not WARMUP_ENABLED:
+        return True
+
+    graph = _load_workflow(generation_type)
+    if graph is None:
+        logger.info(f"🔥 No {generation_type} workflow seen yet and no template, skipping model warm-up")
+        return True
+
+    started = time.time()
+    try:
+        if any(node.get('class_type') in IMAGE_LOADERS for node in graph.values()):
+            os.makedirs(COMFYUI_INPUT_DIR, exist_ok=True)
+            with open(os.path.join(COMFYUI_INPUT_DIR, WARMUP_IMAGE), 'wb') as f:
+                f.write(_placeholder_png())
+
+        # Lets the residency manager count the warmed-up models as resident
+        ensure_model_residency(f"warmup-{generation_type}", graph)
+        residency_report(f"warmup-{generation_type}")
+
+        client_id, stream_epoch = subscribe()
+        response = get_comfyui_client().post("/prompt", json={"prompt": graph, "client_id": client_id}, timeout=30)
+        if response.status_code != 200:
+            logger.warning(f"⚠️ Warm-up graph rejected by ComfyUI: {response.text[:500]}")
+            return True
+
+        prompt_id = response.json().get('prompt_id')
+        track_prompt(prompt_id, stream_epoch)
+        status = _wait(prompt_id, WARMUP_TIMEOUT)
+        if status != 'success':
+            logger.warning(f"⚠️ Model warm-up for {generation_type} ended {status} after {time.time() - started:.1f}s")
+            return True
+        get_supervisor().mark_startup('models_warm')
+        logger.info(f"🔥 Model warm-up for {generation_type} finished - cold-start model load took {time.time() - started:.1f}s")
+    except Exception as e:
+        logger.warning(f"⚠️ Model warm-up for {generation_type} failed after {time.time() - started:.1f}s: {e}")
+    return True
@@ -10,12 +10,28 @@ import time
 import base64
 import logging
 import requests
-import subprocess
-import threading
 import boto3
-import copy
 from pathlib import Path
 from typing import Dict, List, Any, Optional
+
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.finalize import OutputFinalizer
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes, node_available
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.graph import WorkflowGraph
+from comfyui_worker.inputs import save_base64_input
 from botocore.exceptions import ClientError
 import runpod
 
@@ -23,6 +39,9 @@ import runpod
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # AWS S3 Configuration for direct storage (bandwidth optimization)
 AWS_REGION = os.environ.get('AWS_REGION') or os.environ.get('S3_REGION') or 'us-east-1'
 AWS_S3_BUCKET = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET') or 'tastycreative'
@@ -174,6 +193,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=120)
         response.raise_for_status()
@@ -183,54 +205,6 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
         logger.error(f"❌ Webhook failed: {e}")
         return False
 
-def validate_face_swap_workflow(workflow):
-    """
-    Validate workflow JSON for pure inpainting face swapping operations.
-    Look for essential nodes for direct inpainting approach.
-    """
-    try:
-        # Check for core inpainting nodes
-        core_nodes = []
-        save_nodes = []
-        
-        for node_id, node_data in workflow.items():
-            class_type = node_data.get('class_type', '')
-            
-            # Look for essential inpainting nodes
-            if any(keyword in class_type for keyword in [
-                'InpaintModelConditioning',  # Core inpainting
-                'KSampler',                  # Generation/sampling
-                'UNETLoader',                # Model loading
-                'VAEDecode',                 # VAE decoding
-                'LoraLoader',                # LoRA loading for ACE++
-                'FluxGuidance',              # Flux guidance
-                'LoadImage',                 # Image loading
-                'ImageConcanate',            # Image concatenation
-                'ImageToMask'                # Mask creation
-            ]):
-                core_nodes.append(f"{node_id}:{class_type}")
-            
-            # Look for SaveImage or PreviewImage nodes
-            if class_type in ['SaveImage', 'PreviewImage']:
-                save_nodes.append(node_id)
-        
-        if core_nodes:
-            print(f"✅ Found core inpainting nodes: {core_nodes}")
-        else:
-            print(f"⚠️ No specific inpainting nodes found - using basic image processing")
-        
-        if save_nodes:
-            print(f"✅ Found output nodes: {save_nodes}")
-            print(f"✅ Pure inpainting workflow validation passed")
-            return True
-        else:
-            print(f"❌ No SaveImage/PreviewImage nodes found in workflow")
-            return False
-            
-    except Exception as e:
-        print(f"❌ Error validating workflow: {str(e)}")
-        return False
-
 def create_fallback_workflow(original_image_name: str, new_face_image_name: str, params: dict) -> dict:
     """
     Create a simplified pure inpainting workflow.
@@ -488,7 +462,7 @@ def create_fallback_workflow(original_image_name: str, new_face_image_name: str,
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://localhost:8188/system_stats", timeout=5)
+        response = comfyui.get("/system_stats", timeout=5)
         if response.status_code == 200:
             logger.info("✅ ComfyUI is already running")
             return True
@@ -612,39 +586,9 @@ def start_comfyui():
         
         print(f"🔧 Starting ComfyUI with command: {' '.join(cmd)}")
         
-        def log_output(process, stream_name):
-            for line in iter(process.stdout.readline, b''):
-                try:
-                    decoded_line = line.decode('utf-8').strip()
-                    if decoded_line:
-                        print(f"[ComfyUI-{stream_name}] {decoded_line}")
-                except UnicodeDecodeError:
-                    pass
-        
-        # Start ComfyUI as background process from the ComfyUI directory
-        process = subprocess.Popen(cmd, 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.STDOUT,
-                                 cwd=comfyui_dir,
-                                 bufsize=1,
-                                 universal_newlines=False)
-        
-        # Start logging thread
-        log_thread = threading.Thread(target=log_output, args=(process, "stdout"))
-        log_thread.daemon = True
-        log_thread.start()
-        
-        # Wait for ComfyUI to start up
-        print("⏳ Waiting for ComfyUI to start...")
-        max_wait = 300  # 5 minutes
-        for i in range(max_wait):
-            if is_comfyui_running():
-                print(f"✅ ComfyUI started successfully after {i+1} seconds")
-                return True
-            time.sleep(1)
-            
-        print(f"❌ ComfyUI failed to start within {max_wait} seconds")
-        return False
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_dir, timeout=300)
         
     except Exception as e:
         print(f"❌ Error starting ComfyUI: {str(e)}")
@@ -652,74 +596,27 @@ def start_comfyui():
 
 def remove_unavailable_nodes(workflow: Dict) -> Dict:
     """Remove nodes that are not available (like TeaCache) from the workflow"""
-    import copy
-    workflow_cleaned = copy.deepcopy(workflow)
-    
-    # List of problematic nodes that commonly fail to import
-    problematic_nodes = ['TeaCache', 'TeaCacheNode']
+    graph = WorkflowGraph(workflow)
     
-    # Nodes to remove
-    nodes_to_remove = []
-    
-    # Find nodes that use problematic node types
-    for node_id, node_data in workflow_cleaned.items():
-        if isinstance(node_data, dict) and 'class_type' in node_data:
-            class_type = node_data['class_type']
-            if class_type in problematic_nodes:
-                nodes_to_remove.append(node_id)
-                logger.info(f"🔧 Removing unavailable node: {node_id} ({class_type})")
-    
-    # Store connections that need to be restored
-    connections_to_restore = {}
-    
-    # Find what each removed node was connected to
-    for node_id in nodes_to_remove:
-        if node_id in workflow_cleaned and 'inputs' in workflow_cleaned[node_id]:
-            # Store the input connections of the node we're removing
-            node_inputs = workflow_cleaned[node_id]['inputs']
-            for input_key, input_value in node_inputs.items():
-                if isinstance(input_value, list) and len(input_value) >= 2:
-                    source_node = str(input_value[0])
-                    source_output = input_value[1] if len(input_value) > 1 else 0
-                    connections_to_restore[node_id] = {
-                        'source_node': source_node,
-                        'source_output': source_output,
-                        'input_key': input_key
-                    }
-                    break  # Take the first meaningful connection
-    
-    # Remove the problematic nodes
-    for node_id in nodes_to_remove:
-        del workflow_cleaned[node_id]
-    
-    # Update connections to removed nodes and restore the chain
-    for node_id, node_data in workflow_cleaned.items():
-        if isinstance(node_data, dict) and 'inputs' in node_data:
-            inputs = node_data['inputs']
-            for input_key, input_value in list(inputs.items()):
-                # Check if input references a removed node
-                if isinstance(input_value, list) and len(input_value) >= 2:
-                    referenced_node = str(input_value[0])
-                    if referenced_node in nodes_to_remove:
-                        # Try to restore the connection by connecting to the source of the removed node
-                        if referenced_node in connections_to_restore:
-                            restore_info = connections_to_restore[referenced_node]
-                            new_connection = [restore_info['source_node'], restore_info['source_output']]
-                            inputs[input_key] = new_connection
-                            logger.info(f"🔧 Restoring connection: {node_id}.{input_key} -> {restore_info['source_node']}.{restore_info['source_output']}")
-                        else:
-                            # Remove this input connection if we can't restore it
-                            logger.info(f"🔧 Removing connection from {node_id}.{input_key} to removed node {referenced_node}")
-                            del inputs[input_key]
+    # Optional accelerator nodes that commonly fail to import; only bypassed when the node
+    # catalog says this ComfyUI build lacks them (or the catalog is unavailable)
+    optional_nodes = ['TeaCache', 'TeaCacheNode']
+    for class_type in optional_nodes:
+        if not graph.has_class(class_type) or node_available(class_type) is True:
+            continue
+        for node in graph.by_class(class_type):
+            logger.info(f"🔧 Removing unavailable node: {node.id} ({class_type})")
+            # Consumers are rewired to whatever fed the node's first linked input
+            graph.bypass(node.id)
     
     # Fix workflow parameters and model names
-    workflow_cleaned = fix_workflow_parameters(workflow_cleaned)
+    fix_workflow_parameters(graph)
     
     # Detect if this is a manual masking workflow (Sebastian Kamph style) 
     # and add automatic face detection if needed
-    workflow_cleaned = add_automatic_face_detection(workflow_cleaned)
+    add_automatic_face_detection(graph)
     
-    return workflow_cleaned
+    return graph.to_workflow()
 
 def create_automatic_face_swap_workflow(original_image_path: str, new_face_image_path: str) -> Dict:
     """Create a complete automatic face swap workflow using ReActor"""
@@ -786,142 +683,55 @@ def create_automatic_face_swap_workflow(original_image_path: str, new_face_image
     
     return workflow
 
-def add_automatic_face_detection(workflow: Dict) -> Dict:
-    """Create a complete automatic face swap workflow using ReActor"""
-    
-    workflow = {
-        # Input: Original image
-        "1": {
-            "inputs": {
-                "image": original_image_path,
-                "upload": "image"
-            },
-            "class_type": "LoadImage",
-            "_meta": {
-                "title": "Load Original Image"
-            }
-        },
-        
-        # Input: New face image  
-        "2": {
-            "inputs": {
-                "image": new_face_image_path,
-                "upload": "image"
-            },
-            "class_type": "LoadImage",
-            "_meta": {
-                "title": "Load New Face"
-            }
-        },
-        
-        # Face swap using ReActor
-        "3": {
-            "inputs": {
-                "enabled": True,
-                "input_image": ["1", 0],
-                "source_image": ["2", 0],
-                "face_model": "inswapper_128.onnx",
-                "face_restore_model": "CodeFormer",
-                "face_restore_visibility": 1.0,
-                "codeformer_weight": 0.5,
-                "detect_gender_input": "no",
-                "detect_gender_source": "no", 
-                "input_faces_index": "0",
-                "source_faces_index": "0",
-                "console_log_level": 1
-            },
-            "class_type": "ReActorFaceSwap",
-            "_meta": {
-                "title": "Face Swap"
-            }
-        },
-        
-        # Save result
-        "4": {
-            "inputs": {
-                "filename_prefix": "FaceSwap",
-                "images": ["3", 0]
-            },
-            "class_type": "SaveImage",
-            "_meta": {
-                "title": "Save Face Swap Result"
-            }
-        }
-    }
-    
-    return workflow
-
-def add_automatic_face_detection(workflow: Dict) -> Dict:
-    import copy
-    workflow_enhanced = copy.deepcopy(workflow)
-    
+def add_automatic_face_detection(graph: WorkflowGraph) -> WorkflowGraph:
+    """Check whether an inpainting workflow relies on manual masks (no face detection nodes)"""
     # Check if this workflow has InpaintModelConditioning but no face detection
-    has_inpaint = False
-    has_face_detection = False
-    
-    for node_id, node_data in workflow_enhanced.items():
-        if isinstance(node_data, dict) and 'class_type' in node_data:
-            class_type = node_data['class_type']
-            
-            if class_type == 'InpaintModelConditioning':
-                has_inpaint = True
-            
-            if any(face_node in class_type for face_node in [
-                'FaceAnalysis', 'ReActorFaceSwap', 'FaceSwap', 'FaceAnalysisFaceSwapper'
-            ]):
-                has_face_detection = True
+    has_inpaint = graph.has_class('InpaintModelConditioning')
+    has_face_detection = any(
+        face_node in class_type
+        for class_type in graph.class_types() if class_type
+        for face_node in ['FaceAnalysis', 'ReActorFaceSwap', 'FaceSwap', 'FaceAnalysisFaceSwapper']
+    )
     
     # If we have inpainting but no face detection, this is likely a manual masking workflow
     # For Sebastian Kamph ACE++ workflow, manual masking is the intended approach
     # Don't add automatic face detection - the workflow expects manual masks
     if has_inpaint and not has_face_detection:
         logger.info("🔧 Sebastian Kamph workflow detected - using manual masking approach")
-        logger.info("� This workflow requires manual face masking (red painted areas)")
+        logger.info("🎭 This workflow requires manual face masking (red painted areas)")
     
-    return workflow_enhanced
+    return graph
 
-def fix_workflow_parameters(workflow: Dict) -> Dict:
+def fix_workflow_parameters(graph: WorkflowGraph) -> WorkflowGraph:
     """Fix common parameter issues in the workflow"""
-    import copy
-    workflow_fixed = copy.deepcopy(workflow)
-    
     # Model name mappings (from what the workflow expects to what's available)
     model_mappings = {
         'flux1FillDevFp8_v10.safetensors': 'Flux-FillDevFP8.safetensors'
     }
     
-    for node_id, node_data in workflow_fixed.items():
-        if isinstance(node_data, dict) and 'class_type' in node_data:
-            class_type = node_data['class_type']
-            
-            # Fix UNETLoader model names
-            if class_type == 'UNETLoader' and 'inputs' in node_data:
-                if 'unet_name' in node_data['inputs']:
-                    current_name = node_data['inputs']['unet_name']
-                    if current_name in model_mappings:
-                        node_data['inputs']['unet_name'] = model_mappings[current_name]
-                        logger.info(f"🔧 Fixed UNET model name: {current_name} -> {model_mappings[current_name]}")
-            
-            # Fix InpaintModelConditioning missing noise_mask parameter
-            elif class_type == 'InpaintModelConditioning' and 'inputs' in node_data:
-                inputs = node_data['inputs']
-                # The noise_mask should be a boolean, not a mask connection
-                if 'noise_mask' not in inputs:
-                    # Check if there's a 'mask' input that should be moved to a different parameter
-                    if 'mask' in inputs:
-                        # Keep the mask connection but add noise_mask as boolean
-                        inputs['noise_mask'] = True  # Default boolean value
-                        logger.info(f"🔧 Fixed InpaintModelConditioning node {node_id}: added noise_mask=True, kept mask connection")
-                    else:
-                        # Add default boolean value for noise_mask
-                        inputs['noise_mask'] = True
-                        logger.info(f"🔧 Fixed InpaintModelConditioning node {node_id}: added noise_mask=True")
-                elif isinstance(inputs.get('noise_mask'), list):
-                    # If noise_mask is incorrectly connected to another node, make it boolean
-                    inputs['noise_mask'] = True
-                    logger.info(f"🔧 Fixed InpaintModelConditioning node {node_id}: changed noise_mask from connection to boolean")
+    # Fix UNETLoader model names
+    for node in graph.by_class('UNETLoader'):
+        current_name = node.inputs.get('unet_name')
+        if current_name in model_mappings:
+            graph.set_input(node.id, 'unet_name', model_mappings[current_name])
+            logger.info(f"🔧 Fixed UNET model name: {current_name} -> {model_mappings[current_name]}")
+    
+    # Fix InpaintModelConditioning missing noise_mask parameter
+    for node in graph.by_class('InpaintModelConditioning'):
+        # The noise_mask should be a boolean, not a mask connection
+        if 'noise_mask' not in node.inputs:
+            # Keep any mask connection but add noise_mask as boolean
+            graph.set_input(node.id, 'noise_mask', True)
+            if 'mask' in node.inputs:
+                logger.info(f"🔧 Fixed InpaintModelConditioning node {node.id}: added noise_mask=True, kept mask connection")
+            else:
+                logger.info(f"🔧 Fixed InpaintModelConditioning node {node.id}: added noise_mask=True")
+        elif isinstance(node.inputs.get('noise_mask'), list):
+            # If noise_mask is incorrectly connected to another node, make it boolean
+            graph.set_input(node.id, 'noise_mask', True)
+            logger.info(f"🔧 Fixed InpaintModelConditioning node {node.id}: changed noise_mask from connection to boolean")
     
-    return workflow_fixed
+    return graph
 
 def create_enhanced_face_swap_workflow(original_filename: str, new_face_filename: str) -> Dict:
     """Create an enhanced face swap workflow with automatic face detection and masking"""
@@ -1104,16 +914,34 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
         if "240" in workflow_cleaned and "inputs" in workflow_cleaned["240"]:
             logger.info(f"👤 New face image: {workflow_cleaned['240']['inputs'].get('image', 'Unknown')}")
         
-        # Queue the workflow
-        response = requests.post(
-            "http://localhost:8188/prompt",
-            json={"prompt": workflow_cleaned},
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow_cleaned = optimize_workflow(workflow_cleaned, job_id, 'face_swap')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing;
+        # the caller falls back to the basic workflow just like on a ComfyUI rejection
+        problems = check_workflow_nodes(workflow_cleaned)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return "MISSING_NODES" if any('unknown class_type' in problem for problem in problems) else "VALIDATION_FAILED"
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow_cleaned)
+        
+        # Queue the workflow under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
+        response = comfyui.post(
+            "/prompt",
+            json={"prompt": workflow_cleaned, "client_id": client_id},
             timeout=30
         )
         
         if response.status_code == 200:
             result = response.json()
             prompt_id = result.get('prompt_id')
+            track_prompt(prompt_id, stream_epoch)
+            attach_prompt(job_id, prompt_id, workflow_cleaned)
+            remember_workflow('face_swap', workflow_cleaned)
+            supervise_prompt(prompt_id, workflow_cleaned)
             logger.info(f"✅ Face swap workflow queued with prompt ID: {prompt_id}")
             return prompt_id
         else:
@@ -1152,14 +980,13 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
 def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> bytes:
     """Download image from ComfyUI and return as raw bytes"""
     try:
-        url = f"http://localhost:8188/view"
         params = {
             'filename': filename,
             'type': type_dir,
             'subfolder': subfolder
         }
         
-        response = requests.get(url, params=params, timeout=30)
+        response = comfyui.get("/view", params=params, timeout=30)
         response.raise_for_status()
         
         logger.info(f"✅ Downloaded image: {filename}")
@@ -1220,29 +1047,126 @@ def monitor_face_swap_progress(prompt_id: str, job_id: str, webhook_url: str, us
         }
         
         current_stage = 'starting'
-        stage_start_time = time.time()
+        progress = 5
+        message = progress_stages['starting']['message']
+        
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        
+        # Progress weighted by the workflow's sampler steps and decode passes, mapped onto the face swap stages
+        tracker = WorkflowProgress(workflow)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        tracker_stages = {
+            'loading_models': 'loading_images',
+            'processing_prompt': 'preprocessing',
+            'processing': 'preprocessing',
+            'sampling': 'face_swapping',
+            'decoding': 'postprocessing',
+            'upscaling': 'postprocessing',
+            'saving': 'saving'
+        }
+        
+        # Extract user_id from parameter or job_id
+        if not user_id:
+            user_id = job_id.split('_')[0] if '_' in job_id else 'default_user'
+        
+        def finalize_face_swap_image(node_id: str, img_info: Dict, image_index: int) -> Optional[Dict]:
+            """Download one face swap result and upload it to AWS S3 as soon as its node executes"""
+            original_filename = img_info['filename']
+            comfyui_subfolder = img_info.get('subfolder', '')  # ComfyUI's subfolder
+            type_dir = img_info.get('type', 'output')
+            
+            # Create unique filename with timestamp (like text-to-image handler)
+            timestamp = int(time.time() * 1000)  # Milliseconds for uniqueness
+            name_part, ext = os.path.splitext(original_filename)
+            unique_filename = f"{name_part}_{timestamp}{ext}"
+            
+            # Download image data as bytes (use ComfyUI's subfolder for retrieval)
+            image_data = get_image_from_comfyui(original_filename, comfyui_subfolder, type_dir)
+            if not image_data:
+                return None
+            
+            try:
+                # Upload to AWS S3 with user's selected subfolder (from workflow)
+                s3_result = upload_image_to_aws_s3(image_data, user_id, unique_filename, subfolder, is_full_prefix=is_shared_folder)
+                
+                if s3_result.get("success"):
+                    logger.info(f"✅ Image uploaded to AWS S3: {s3_result['awsS3Url']}")
+                    logger.info(f"📸 Processing image {image_index}: {unique_filename}")
+                    
+                    # Track image info for webhook (AWS S3 optimized structure)
+                    return {
+                        'aws_s3_paths': {
+                            'filename': unique_filename,
+                            'subfolder': subfolder,
+                            'type': type_dir,
+                            'awsS3Key': s3_result['awsS3Key'],
+                            'awsS3Url': s3_result['awsS3Url'],
+                            'fileSize': s3_result['fileSize']
+                        }
+                    }
+                
+                logger.error(f"❌ Failed to upload image to AWS S3: {s3_result.get('error')}")
+                
+            except Exception as save_error:
+                logger.error(f"❌ Failed to save image {unique_filename}: {save_error}")
+            
+            # Fallback: keep legacy base64 format for webhook
+            return {
+                'fallback_image': {
+                    'filename': unique_filename,
+                    'subfolder': subfolder,
+                    'type': type_dir,
+                    'data': base64.b64encode(image_data).decode('utf-8')
+                }
+            }
+        
+        def is_face_swap_result(node_id: str, img_info: Dict) -> bool:
+            # Only process FaceSwap files (skip comfyui_temp and other intermediate files)
+            # Accept any filename containing "FaceSwap" to support all workflow variants
+            filename = img_info['filename']
+            if 'FaceSwap' not in filename and not filename.startswith('face_swap_result'):
+                logger.info(f"⏭️ Skipping intermediate file: {filename}")
+                return False
+            return True
+        
+        # Upload each face swap result as soon as its SaveImage node executes
+        finalizer = OutputFinalizer(finalize_face_swap_image, accept=is_face_swap_result).attach(watcher)
         
         # Send initial progress update
         if webhook_url:
             initial_webhook_data = {
                 'jobId': job_id,
                 'status': 'processing',
-                'progress': 5,
-                'message': progress_stages['starting']['message'],
+                'progress': progress,
+                'message': message,
                 'stage': 'starting',
-                'estimatedTimeRemaining': max_wait_time
+                'estimatedTimeRemaining': int(tracker.estimated_remaining(0))
             }
             send_webhook(webhook_url, initial_webhook_data)
         
         while time.time() - start_time < max_wait_time:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             try:
                 current_time = time.time()
                 elapsed_time = current_time - start_time
                 
                 # Check ComfyUI queue and execution status
-                queue_response = requests.get("http://localhost:8188/queue", timeout=10)
-                if queue_response.status_code == 200:
-                    queue_data = queue_response.json()
+                queue_data = None
+                if watcher.live:
+                    # The event stream stands in for /queue (exact queue position isn't tracked)
+                    queue_data = {
+                        'queue_running': [[0, prompt_id]] if watcher.status == 'running' else [],
+                        'queue_pending': [[0, prompt_id]] if watcher.status == 'pending' else []
+                    }
+                else:
+                    queue_response = comfyui.get("/queue", timeout=10)
+                    if queue_response.status_code == 200:
+                        queue_data = queue_response.json()
+                
+                if queue_data is not None:
                     
                     # Check if our job is still in queue
                     running_jobs = queue_data.get('queue_running', [])
@@ -1258,75 +1182,19 @@ def monitor_face_swap_progress(prompt_id: str, job_id: str, webhook_url: str, us
                         message = f'⏳ Job queued (position {queue_position} in queue)'
                         
                     elif job_in_running:
-                        # Job is actively running - estimate progress based on time and node execution
-                        try:
-                            # Try to get more detailed progress from ComfyUI
-                            progress_response = requests.get(f"http://localhost:8188/progress", timeout=5)
-                            if progress_response.status_code == 200:
-                                progress_data = progress_response.json()
-                                if progress_data.get('value', 0) > 0:
-                                    # Use ComfyUI's internal progress if available
-                                    comfy_progress = progress_data.get('value', 0)
-                                    max_progress = progress_data.get('max', 100)
-                                    node_progress = min(85, (comfy_progress / max_progress) * 85) if max_progress > 0 else 15
-                                    
-                                    # Determine stage based on progress
-                                    if node_progress < 20:
-                                        current_stage = 'loading_images'
-                                    elif node_progress < 35:
-                                        current_stage = 'face_detection'
-                                    elif node_progress < 50:
-                                        current_stage = 'preprocessing'
-                                    elif node_progress < 85:
-                                        current_stage = 'face_swapping'
-                                    else:
-                                        current_stage = 'postprocessing'
-                                        
-                                    progress = max(15, node_progress)
-                                    message = progress_stages[current_stage]['message']
-                                    
-                                    # Add node-specific info if available
-                                    current_node = progress_data.get('node', '')
-                                    if current_node:
-                                        message += f" (Node: {current_node})"
-                                else:
-                                    # Fallback to time-based estimation
-                                    elapsed_minutes = elapsed_time / 60
-                                    if elapsed_minutes < 1:
-                                        current_stage = 'loading_images'
-                                        progress = 15
-                                    elif elapsed_minutes < 2:
-                                        current_stage = 'face_detection' 
-                                        progress = 25
-                                    elif elapsed_minutes < 4:
-                                        current_stage = 'preprocessing'
-                                        progress = 40
-                                    elif elapsed_minutes < 8:
-                                        current_stage = 'face_swapping'
-                                        progress = min(75, 40 + (elapsed_minutes - 4) * 8)
-                                    else:
-                                        current_stage = 'face_swapping'
-                                        progress = min(85, 75 + (elapsed_minutes - 8) * 2)
-                                    
-                                    message = progress_stages[current_stage]['message']
-                                    
-                            else:
-                                # Fallback time-based progress
-                                elapsed_minutes = elapsed_time / 60
-                                progress = min(80, 15 + elapsed_minutes * 8)
-                                message = '🎭 Face swap processing...'
-                                
-                        except Exception as progress_error:
-                            # Fallback to simple time-based progress
-                            elapsed_minutes = elapsed_time / 60
-                            progress = min(80, 15 + elapsed_minutes * 8)
-                            message = '🎭 Face swap processing...'
+                        # Progress from the workflow graph and the execution events (elapsed time when not live)
+                        tracker.update(watcher, elapsed_time)
+                        current_stage = tracker_stages.get(tracker.stage, 'face_swapping')
+                        progress = max(progress, tracker.percent(10, 95))
+                        message = progress_stages[current_stage]['message']
+                        if tracker.step_label():
+                            message = f"{message} ({tracker.step_label()})"
                         
                     else:
                         # Job not in queue - check if completed
                         logger.info(f"✅ Face swap job {job_id} completed, checking for results...")
                         
-                        history_response = requests.get(f"http://localhost:8188/history/{prompt_id}", timeout=10)
+                        history_response = comfyui.get(f"/history/{prompt_id}", timeout=10)
                         if history_response.status_code == 200:
                             history_data = history_response.json()
                             
@@ -1348,75 +1216,12 @@ def monitor_face_swap_progress(prompt_id: str, job_id: str, webhook_url: str, us
                                         }
                                         send_webhook(webhook_url, webhook_data)
                                     
-                                    # Get output images and save to S3
+                                    # Collect results; images seen on the event stream are already in S3
                                     outputs = job_data.get('outputs', {})
-                                    result_images = []
-                                    network_volume_paths = []
-                                    
-                                    # Extract user_id from parameter or job_id
-                                    if not user_id:
-                                        user_id = job_id.split('_')[0] if '_' in job_id else 'default_user'
-                                    
-                                    for node_id, node_output in outputs.items():
-                                        if 'images' in node_output:
-                                            for img_info in node_output['images']:
-                                                original_filename = img_info['filename']
-                                                comfyui_subfolder = img_info.get('subfolder', '')  # ComfyUI's subfolder
-                                                type_dir = img_info.get('type', 'output')
-                                                
-                                                # Only process FaceSwap files (skip comfyui_temp and other intermediate files)
-                                                # Accept any filename containing "FaceSwap" to support all workflow variants
-                                                if 'FaceSwap' not in original_filename and not original_filename.startswith('face_swap_result'):
-                                                    logger.info(f"⏭️ Skipping intermediate file: {original_filename}")
-                                                    continue
-                                                
-                                                # Create unique filename with timestamp (like text-to-image handler)
-                                                timestamp = int(time.time() * 1000)  # Milliseconds for uniqueness
-                                                name_part, ext = os.path.splitext(original_filename)
-                                                unique_filename = f"{name_part}_{timestamp}{ext}"
-                                                
-                                                # Download image data as bytes (use ComfyUI's subfolder for retrieval)
-                                                image_data = get_image_from_comfyui(original_filename, comfyui_subfolder, type_dir)
-                                                if image_data:
-                                                    try:
-                                                        # Upload to AWS S3 with user's selected subfolder (from workflow)
-                                                        s3_result = upload_image_to_aws_s3(image_data, user_id, unique_filename, subfolder, is_full_prefix=is_shared_folder)
-                                                        
-                                                        if s3_result.get("success"):
-                                                            # Track image info for webhook (AWS S3 optimized structure)
-                                                            aws_s3_paths = {
-                                                                'filename': unique_filename,
-                                                                'subfolder': subfolder,
-                                                                'type': type_dir,
-                                                                'awsS3Key': s3_result['awsS3Key'],
-                                                                'awsS3Url': s3_result['awsS3Url'],
-                                                                'fileSize': s3_result['fileSize']
-                                                            }
-                                                            
-                                                            # For backward compatibility, still populate network_volume_paths but with AWS S3 data
-                                                            network_volume_paths.append(aws_s3_paths)
-                                                            
-                                                            logger.info(f"✅ Image uploaded to AWS S3: {s3_result['awsS3Url']}")
-                                                            logger.info(f"� Processing image {len(network_volume_paths)}: {unique_filename}")
-                                                        else:
-                                                            logger.error(f"❌ Failed to upload image to AWS S3: {s3_result.get('error')}")
-                                                            # Fallback to base64 in result_images
-                                                            result_images.append({
-                                                                'filename': unique_filename,
-                                                                'subfolder': subfolder,
-                                                                'type': type_dir,
-                                                                'data': base64.b64encode(image_data).decode('utf-8')
-                                                            })
-                                                        
-                                                    except Exception as save_error:
-                                                        logger.error(f"❌ Failed to save image {unique_filename}: {save_error}")
-                                                        # Fallback: keep legacy format for webhook
-                                                        result_images.append({
-                                                            'filename': unique_filename,
-                                                            'subfolder': subfolder,
-                                                            'type': type_dir,
-                                                            'data': base64.b64encode(image_data).decode('utf-8')
-                                                        })
+                                    finalized = finalizer.collect(outputs)
+                                    finalizer.close()
+                                    network_volume_paths = [item['aws_s3_paths'] for item in finalized if item.get('aws_s3_paths')]
+                                    result_images = [item['fallback_image'] for item in finalized if item.get('fallback_image')]
                                     
                                     # Generate resultUrls for frontend display (AWS S3 optimized URLs)
                                     resultUrls = []
@@ -1441,12 +1246,16 @@ def monitor_face_swap_progress(prompt_id: str, job_id: str, webhook_url: str, us
                                         send_webhook(webhook_url, webhook_data)
                                     
                                     logger.info(f"📤 Sent completion webhook with {len(network_volume_paths)} AWS S3 paths and {len(resultUrls)} result URLs")
+                                    node_profile = finish_node_profile(watcher, workflow, 'face_swap')
+                                    timings.record()
                                     
                                     return {
                                         'status': 'completed',
                                         'aws_s3_paths': network_volume_paths,  # AWS S3 optimized data
                                         'resultUrls': resultUrls,  # Direct AWS S3 URLs
                                         'images': result_images,  # Legacy fallback
+                                        'node_profile': node_profile,
+                                        'model_residency': residency_report(job_id),
                                         'message': 'Face swap generation completed successfully'
                                     }
                                 
@@ -1472,7 +1281,8 @@ def monitor_face_swap_progress(prompt_id: str, job_id: str, webhook_url: str, us
                 
                 # Send progress webhook updates (every 5 seconds)
                 if webhook_url and (current_time - last_webhook_time) >= 5:
-                    estimated_remaining = max(0, max_wait_time - elapsed_time)
+                    # Historical duration for this workflow signature, or the pace so far
+                    estimated_remaining = tracker.estimated_remaining(elapsed_time)
                     
                     webhook_data = {
                         'jobId': job_id,
@@ -1486,7 +1296,7 @@ def monitor_face_swap_progress(prompt_id: str, job_id: str, webhook_url: str, us
                     send_webhook(webhook_url, webhook_data)
                     last_webhook_time = current_time
                 
-                time.sleep(3)  # Check every 3 seconds for more responsive updates
+                watcher.sleep(3)  # Check every 3 seconds, waking as soon as the prompt finishes
                 
             except Exception as check_error:
                 logger.warning(f"⚠️ Error checking face swap progress: {check_error}")
@@ -1541,25 +1351,15 @@ def download_image_for_comfyui(image_filename: str, job_input: dict, base64_key:
         os.makedirs(input_dir, exist_ok=True)
         image_path = os.path.join(input_dir, image_filename)
         
-        # Priority 1: Use base64 data if available
+        # Priority 1: Use base64 data if available (decoded in chunks straight to disk)
         if base64_key and base64_key in job_input:
-            base64_data = job_input[base64_key]
-            if base64_data and base64_data != "None":
-                try:
-                    # Remove data URL prefix if present
-                    if base64_data.startswith('data:image/'):
-                        base64_data = base64_data.split(',', 1)[1]
-                    
-                    # Decode and save base64 image
-                    image_data = base64.b64decode(base64_data)
-                    with open(image_path, 'wb') as f:
-                        f.write(image_data)
-                    
+            try:
+                if save_base64_input(job_input, base64_key, image_filename, input_dir) is not None:
                     logger.info(f"✅ Saved base64 image to: {image_path}")
                     return True
-                except Exception as base64_error:
-                    logger.warning(f"⚠️ Failed to process base64 data for {image_filename}: {base64_error}")
-                    # Fall back to URL download
+            except Exception as base64_error:
+                logger.warning(f"⚠️ Failed to process base64 data for {image_filename}: {base64_error}")
+                # Fall back to URL download
         
         # Priority 2: Try URL download if base64 failed or not available
         image_url = job_input.get('imageUrl')
@@ -1599,8 +1399,9 @@ def run_face_swap_generation(job_input, job_id, webhook_url):
         
         # Get workflow and validate it
         workflow = job_input['workflow']
-        if not validate_face_swap_workflow(workflow):
-            error_msg = "Invalid face swap workflow structure"
+        validation_errors = workflow_errors(workflow, 'face_swap')
+        if validation_errors:
+            error_msg = f"Invalid face swap workflow structure: {'; '.join(validation_errors[:5])}"
             logger.error(f"❌ {error_msg}")
             return {'status': 'failed', 'error': error_msg}
         
@@ -1613,7 +1414,7 @@ def run_face_swap_generation(job_input, job_id, webhook_url):
             # Prepare job input with both URL and base64 data
             image_input = {
                 'imageUrl': job_input.get('originalImageUrl'),
-                'originalImageData': job_input.get('originalImageData')
+                'originalImageData': job_input.pop('originalImageData', None)  # not kept twice while it is decoded
             }
             if not download_image_for_comfyui(original_filename, image_input, 'originalImageData'):
                 error_msg = "Failed to download original image"
@@ -1624,7 +1425,7 @@ def run_face_swap_generation(job_input, job_id, webhook_url):
             # Prepare job input with both URL and base64 data
             image_input = {
                 'imageUrl': job_input.get('newFaceImageUrl'),
-                'newFaceImageData': job_input.get('newFaceImageData')
+                'newFaceImageData': job_input.pop('newFaceImageData', None)  # not kept twice while it is decoded
             }
             if not download_image_for_comfyui(new_face_filename, image_input, 'newFaceImageData'):
                 error_msg = "Failed to download new face image"
@@ -1635,7 +1436,7 @@ def run_face_swap_generation(job_input, job_id, webhook_url):
             # Prepare job input with both URL and base64 data
             image_input = {
                 'imageUrl': job_input.get('maskImageUrl'),
-                'maskImageData': job_input.get('maskImageData')
+                'maskImageData': job_input.pop('maskImageData', None)  # not kept twice while it is decoded
             }
             if not download_image_for_comfyui(mask_filename, image_input, 'maskImageData'):
                 logger.warning("⚠️ Failed to download mask image, proceeding without mask")
@@ -1760,7 +1561,7 @@ def handler(job):
     # Use the job ID passed from the API, or generate one if not provided
     job_id = job_input.get('jobId')
     if not job_id:
-        job_id = f"face_swap_{int(time.time())}_{hash(str(job_input)) % 10000}"
+        job_id = job.get('id') or f"face_swap_{int(time.time())}_{hash(str(job_input)) % 10000}"
     
     webhook_url = job_input.get('webhookUrl')
     
@@ -1768,14 +1569,16 @@ def handler(job):
     
     try:
         # Prepare ComfyUI environment
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             error_msg = "Failed to prepare ComfyUI environment"
             logger.error(f"❌ {error_msg}")
             return {'status': 'failed', 'error': error_msg}
         
         # Handle face swap generation
         if action == 'generate_face_swap':
-            return run_face_swap_generation(job_input, job_id, webhook_url)
+            # Interrupt ComfyUI and return right away if the job is cancelled
+            with watch_job_cancellation(job, job_id):
+                return run_face_swap_generation(job_input, job_id, webhook_url)
         else:
             error_msg = f"Unsupported action: {action}"
             logger.error(f"❌ {error_msg}")
@@ -1807,4 +1610,6 @@ if __name__ == "__main__":
     except Exception as e:
         logger.warning(f"⚠️ Model setup failed: {str(e)} - continuing anyway")
     
-    runpod.serverless.start({"handler": handler})
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, lambda: warm_up_models('face_swap'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
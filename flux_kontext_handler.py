@@ -14,19 +14,40 @@ import json
 import time
 import requests
 import runpod
-import base64
 import logging
 import boto3
-import subprocess
 import uuid
 from pathlib import Path
 from typing import Dict, List, Any, Optional
+
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.previews import PreviewForwarder, live_preview_mode, preview_launch_args
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.templates import resolve_workflow
+from comfyui_worker.inputs import save_base64_input
+from comfyui_worker.fetch import is_reference
 from botocore.exceptions import ClientError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # AWS S3 Configuration for direct storage (bandwidth optimization)
 AWS_REGION = os.environ.get('AWS_REGION', 'us-east-1')
 AWS_S3_BUCKET = os.environ.get('AWS_S3_BUCKET', 'tastycreative')
@@ -113,16 +134,8 @@ def upload_image_to_aws_s3(image_data: bytes, user_id: str, filename: str, subfo
 def get_image_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> bytes:
     """Download image from ComfyUI and return raw bytes"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
-        
-        # Construct the image URL
-        if subfolder:
-            url = f"{comfyui_url}/view?filename={filename}&subfolder={subfolder}&type={type_dir}"
-        else:
-            url = f"{comfyui_url}/view?filename={filename}&type={type_dir}"
-        
-        logger.info(f"📥 Downloading image from ComfyUI: {url}")
-        response = requests.get(url, timeout=30)
+        logger.info(f"📥 Downloading image from ComfyUI: {filename}")
+        response = comfyui.view(filename, subfolder, type_dir, timeout=30)
         response.raise_for_status()
         
         return response.content
@@ -136,6 +149,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=10)
         return response.status_code == 200
@@ -143,78 +159,23 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
         logger.error(f"❌ Webhook error: {e}")
         return False
 
-def validate_flux_kontext_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure for Flux Kontext"""
-    try:
-        # Updated required nodes for single image workflow
-        required_nodes = ["37", "38", "39", "6", "142", "42", "124", "177", "35", "135", "31", "8", "199"]
-        
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"❌ Missing required node: {node_id}")
-                return False
-        
-        # Validate node types
-        expected_types = {
-            "37": "UNETLoader",
-            "38": "DualCLIPLoader",
-            "39": "VAELoader",
-            "6": "CLIPTextEncode",
-            "142": "LoadImage",  # Single image input
-            "42": "FluxKontextImageScale",
-            "124": "VAEEncode",
-            "177": "ReferenceLatent",
-            "35": "FluxGuidance",
-            "135": "ConditioningZeroOut",
-            "31": "KSampler",
-            "8": "VAEDecode",
-            "199": "SaveImage"
-        }
-        
-        for node_id, expected_type in expected_types.items():
-            if workflow[node_id].get("class_type") != expected_type:
-                logger.error(f"❌ Node {node_id} has wrong type. Expected {expected_type}, got {workflow[node_id].get('class_type')}")
-                return False
-        
-        logger.info("✅ Flux Kontext workflow validation passed")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Workflow validation error: {e}")
-        return False
-
 def process_base64_image_input(workflow, job_id):
     """
     Process base64 image data in LoadImage nodes.
     Extracts base64 images, decodes them, saves to ComfyUI input directory,
     and replaces the base64 data with the filename.
     """
-    import base64
-    from PIL import Image
-    from io import BytesIO
-    
     try:
         # Process single image (node 142)
         if "142" in workflow and "inputs" in workflow["142"]:
             image_data = workflow["142"]["inputs"].get("image", "")
-            if image_data and image_data.startswith("data:image"):
-                logger.info("📸 Processing image (base64)")
-                
-                # Extract base64 data
-                image_data = image_data.split(",")[1] if "," in image_data else image_data
-                image_bytes = base64.b64decode(image_data)
-                
-                # Save to ComfyUI input directory
-                input_dir = Path("/app/comfyui/input")
-                input_dir.mkdir(parents=True, exist_ok=True)
+            inline = isinstance(image_data, str) and image_data.startswith("data:image")
+            if inline or is_reference(image_data):
+                logger.info(f"📸 Processing image ({'base64' if inline else 'reference'})")
                 
+                # Decode (or fetch) straight to the ComfyUI input directory, replacing the data with the filename
                 filename = f"flux_kontext_{job_id}_{uuid.uuid4().hex[:8]}.png"
-                filepath = input_dir / filename
-                
-                with open(filepath, "wb") as f:
-                    f.write(image_bytes)
-                
-                # Replace base64 with filename
+                save_base64_input(workflow["142"]["inputs"], "image", filename, "/app/comfyui/input")
                 workflow["142"]["inputs"]["image"] = filename
                 logger.info(f"✅ Image saved as {filename}")
         
@@ -227,26 +188,38 @@ def process_base64_image_input(workflow, job_id):
 def queue_flux_kontext_workflow(workflow, job_id):
     """Queue Flux Kontext workflow with ComfyUI"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
-        
         # Process base64 image inputs
         workflow = process_base64_image_input(workflow, job_id)
         
         # Validate workflow
-        if not validate_flux_kontext_workflow(workflow):
-            raise ValueError("Workflow validation failed")
+        validation_errors = workflow_errors(workflow, 'flux_kontext')
+        if validation_errors:
+            raise ValueError(f"Workflow validation failed: {'; '.join(validation_errors[:5])}")
+        
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'flux_kontext')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            raise ValueError(f"Workflow not runnable on this ComfyUI build: {problems[0]}")
         
-        # Prepare prompt structure
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Prepare prompt structure (event stream client_id so execution events reach this worker)
+        client_id, stream_epoch = subscribe()
         prompt = {
             "prompt": workflow,
-            "client_id": job_id
+            "client_id": client_id
         }
         
         logger.info(f"🎬 Queueing Flux Kontext workflow for job {job_id}")
         
         # Queue the prompt
-        response = requests.post(
-            f"{comfyui_url}/prompt",
+        response = comfyui.post(
+            "/prompt",
             json=prompt,
             timeout=30
         )
@@ -267,6 +240,10 @@ def queue_flux_kontext_workflow(workflow, job_id):
         if not prompt_id:
             raise ValueError("No prompt_id returned from ComfyUI")
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('flux_kontext', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
         
@@ -277,7 +254,7 @@ def queue_flux_kontext_workflow(workflow, job_id):
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://127.0.0.1:8188", timeout=2)
+        response = comfyui.get("/", timeout=2)
         return True
     except requests.exceptions.RequestException:
         return False
@@ -292,17 +269,7 @@ def prepare_comfyui_environment() -> bool:
             return True
         
         logger.info("🚀 Starting ComfyUI...")
-        start_comfyui()
-        
-        # Wait for ComfyUI to start (max 60 seconds)
-        for i in range(60):
-            if is_comfyui_running():
-                logger.info(f"✅ ComfyUI started successfully after {i+1} seconds")
-                return True
-            time.sleep(1)
-        
-        logger.error("❌ ComfyUI failed to start within 60 seconds")
-        return False
+        return start_comfyui()
         
     except Exception as e:
         logger.error(f"❌ Error preparing ComfyUI environment: {e}")
@@ -371,45 +338,66 @@ def start_comfyui():
         if extra_model_paths:
             cmd.extend(["--extra-model-paths-config", extra_model_paths])
         
-        logger.info(f"🚀 Starting ComfyUI with command: {' '.join(cmd)}")
-        
-        # Start ComfyUI in background
-        process = subprocess.Popen(
-            cmd,
-            cwd=comfyui_path,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            universal_newlines=True,
-            bufsize=1
-        )
+        # Sampler preview frames for jobs that ask for live previews
+        cmd.extend(preview_launch_args())
         
-        logger.info(f"✅ ComfyUI started with PID: {process.pid}")
+        logger.info(f"🚀 Starting ComfyUI with command: {' '.join(cmd)}")
         
-        # Log first few lines of output
-        for i in range(10):
-            line = process.stdout.readline()
-            if line:
-                logger.info(f"ComfyUI: {line.strip()}")
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_path, timeout=300)
         
     except Exception as e:
         logger.error(f"❌ Error starting ComfyUI: {e}")
         raise
 
-def monitor_flux_kontext_progress(prompt_id: str, job_id: str, webhook_url: str, user_id: str = 'unknown', workflow: Dict = None) -> Dict:
+def monitor_flux_kontext_progress(prompt_id: str, job_id: str, webhook_url: str, user_id: str = 'unknown', workflow: Dict = None, live_preview: Optional[str] = None) -> Dict:
     """Monitor ComfyUI progress for Flux Kontext with real-time updates"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
         start_time = time.time()
         last_webhook_time = 0
         webhook_interval = 2  # Send webhook every 2 seconds
         
         logger.info(f"👀 Monitoring progress for prompt_id: {prompt_id}")
         
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        
+        # Progress weighted by the workflow's sampler steps and decode passes
+        tracker = WorkflowProgress(workflow)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        
+        # Opt-in low-res sampler previews, at most one every couple of seconds
+        preview_forwarder = None
+        if live_preview and webhook_url:
+            preview_forwarder = PreviewForwarder(
+                lambda preview: send_webhook(webhook_url, {
+                    "jobId": job_id,
+                    "status": "PROCESSING",
+                    "stage": "processing",
+                    "message": "AI transforming images",
+                    "preview": preview
+                }),
+                s3_client=get_aws_s3_client() if live_preview == 's3' else None,
+                s3_bucket=AWS_S3_BUCKET,
+                s3_prefix=f"previews/{job_id}"
+            ).attach(watcher)
+        
         while True:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             # Get queue status
             try:
-                queue_response = requests.get(f"{comfyui_url}/queue", timeout=5)
-                queue_data = queue_response.json()
+                if watcher.live:
+                    # The event stream stands in for /queue
+                    queue_data = {
+                        "queue_running": [[0, prompt_id]] if watcher.status == 'running' else [],
+                        "queue_pending": [[0, prompt_id]] if watcher.status == 'pending' else []
+                    }
+                else:
+                    queue_response = comfyui.get("/queue", timeout=5)
+                    queue_data = queue_response.json()
                 
                 # Check if prompt is still in queue
                 queue_pending = queue_data.get("queue_pending", [])
@@ -426,27 +414,35 @@ def monitor_flux_kontext_progress(prompt_id: str, job_id: str, webhook_url: str,
                             "status": "PROCESSING",
                             "stage": "queued",
                             "message": "Job is queued",
-                            "progress": 10
+                            "progress": 5,
+                            "estimatedTimeRemaining": int(tracker.estimated_remaining(time.time() - start_time))
                         })
                         last_webhook_time = time.time()
                 
                 elif is_running:
-                    logger.info(f"🎨 Job {job_id} is processing")
+                    tracker.update(watcher, time.time() - start_time)
+                    message = "AI transforming images"
+                    if tracker.step_label():
+                        message = f"{message} ({tracker.step_label()})"
+                    logger.info(f"🎨 Job {job_id} is processing: {tracker.percent()}% ({tracker.stage})")
                     if time.time() - last_webhook_time > webhook_interval:
                         send_webhook(webhook_url, {
                             "jobId": job_id,
                             "status": "PROCESSING",
                             "stage": "processing",
-                            "message": "AI transforming images",
-                            "progress": 50
+                            "message": message,
+                            "progress": tracker.percent(10, 95),
+                            "estimatedTimeRemaining": int(tracker.estimated_remaining(time.time() - start_time))
                         })
                         last_webhook_time = time.time()
                 
                 else:
                     # Job completed, check for outputs
                     logger.info(f"✅ Job {job_id} completed, fetching outputs")
+                    if preview_forwarder:
+                        preview_forwarder.close()
                     
-                    history_response = requests.get(f"{comfyui_url}/history/{prompt_id}", timeout=10)
+                    history_response = comfyui.get(f"/history/{prompt_id}", timeout=10)
                     history_data = history_response.json()
                     
                     if prompt_id in history_data:
@@ -529,11 +525,15 @@ def monitor_flux_kontext_progress(prompt_id: str, job_id: str, webhook_url: str,
                             })
                             
                             logger.info(f"✅ Flux Kontext generation completed in {elapsed_time}s")
+                            node_profile = finish_node_profile(watcher, workflow, 'flux_kontext')
+                            timings.record()
                             
                             return {
                                 "status": "COMPLETED",
                                 "images": result_images,
-                                "elapsedTime": elapsed_time
+                                "elapsedTime": elapsed_time,
+                                "model_residency": residency_report(job_id),
+                                "node_profile": node_profile
                             }
                         else:
                             logger.error("❌ No images found in outputs")
@@ -554,12 +554,14 @@ def monitor_flux_kontext_progress(prompt_id: str, job_id: str, webhook_url: str,
             # Check timeout (10 minutes)
             if time.time() - start_time > 600:
                 logger.error("❌ Job timeout after 10 minutes")
+                if preview_forwarder:
+                    preview_forwarder.close()
                 return {
                     "status": "FAILED",
                     "error": "Job timeout"
                 }
             
-            time.sleep(2)
+            watcher.sleep(2)
     
     except Exception as e:
         logger.error(f"❌ Error in monitor_flux_kontext_progress: {e}")
@@ -573,14 +575,15 @@ def run_flux_kontext_generation(job_input, job_id, webhook_url):
     logger.info(f"🎨 Starting Flux Kontext generation for job: {job_id}")
     
     try:
-        workflow = job_input.get("workflow")
+        # Raw workflow, or the flux_kontext template rendered with the job's params
+        workflow = resolve_workflow(job_input, 'flux_kontext')
         user_id = job_input.get("userId", "unknown")
         
         if not workflow:
-            raise ValueError("No workflow provided")
+            raise ValueError("No workflow or template params provided")
         
         # Prepare ComfyUI environment
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             raise RuntimeError("Failed to prepare ComfyUI environment")
         
         # Verify models
@@ -590,7 +593,7 @@ def run_flux_kontext_generation(job_input, job_id, webhook_url):
         prompt_id = queue_flux_kontext_workflow(workflow, job_id)
         
         # Monitor progress and get results (pass workflow for shared folder detection)
-        result = monitor_flux_kontext_progress(prompt_id, job_id, webhook_url, user_id, workflow)
+        result = monitor_flux_kontext_progress(prompt_id, job_id, webhook_url, user_id, workflow, live_preview_mode(job_input))
         
         return result
     
@@ -620,7 +623,9 @@ def handler(job):
             job_id = job_input.get('jobId', job.get('id', str(uuid.uuid4())))
             webhook_url = job_input.get('webhook_url', '')
             
-            result = run_flux_kontext_generation(job_input, job_id, webhook_url)
+            # Interrupt ComfyUI and return right away if the job is cancelled
+            with watch_job_cancellation(job, job_id):
+                result = run_flux_kontext_generation(job_input, job_id, webhook_url)
             
             return result
         
@@ -647,4 +652,6 @@ def handler(job):
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎨 Starting RunPod Flux Kontext handler...")
-    runpod.serverless.start({"handler": handler})
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, verify_flux_kontext_models, lambda: warm_up_models('flux_kontext'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
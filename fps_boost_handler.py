@@ -14,20 +14,39 @@ import os
 import sys
 import json
 import time
-import base64
 import logging
 import requests
-import subprocess
 import traceback
 import boto3
 from pathlib import Path
 from typing import Dict, Any, List, Optional
+
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.templates import resolve_workflow
+from comfyui_worker.inputs import save_base64_input
 from botocore.exceptions import ClientError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # AWS S3 Configuration for primary storage
 AWS_S3_ENDPOINT = None  # Use default AWS endpoint
 AWS_S3_REGION = os.getenv('AWS_REGION') or os.getenv('S3_REGION') or 'us-east-1'
@@ -118,6 +137,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=10)
         response.raise_for_status()
@@ -127,30 +149,10 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
         logger.error(f"❌ Webhook failed: {e}")
         return False
 
-def validate_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure"""
-    try:
-        if not isinstance(workflow, dict):
-            logger.error("❌ Workflow must be a dictionary")
-            return False
-        
-        required_nodes = ["1", "2", "3"]  # VHS_LoadVideo, RIFE VFI, VHS_VideoCombine
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"❌ Missing required node: {node_id}")
-                return False
-        
-        logger.info("✅ Workflow validation passed")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Workflow validation error: {e}")
-        return False
-
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://127.0.0.1:8188/", timeout=5)
+        response = comfyui.get("/", timeout=5)
         return response.status_code == 200
     except requests.exceptions.RequestException:
         return False
@@ -167,19 +169,7 @@ def prepare_comfyui_environment() -> bool:
         
         # Start ComfyUI
         logger.info("🚀 Starting ComfyUI server...")
-        start_comfyui()
-        
-        # Wait for ComfyUI to be ready
-        max_retries = 60
-        for i in range(max_retries):
-            if is_comfyui_running():
-                logger.info(f"✅ ComfyUI is ready after {i+1} attempts")
-                return True
-            logger.info(f"⏳ Waiting for ComfyUI to start... ({i+1}/{max_retries})")
-            time.sleep(2)
-        
-        logger.error("❌ ComfyUI failed to start within timeout period")
-        return False
+        return start_comfyui()
         
     except Exception as e:
         logger.error(f"❌ Error preparing ComfyUI environment: {e}")
@@ -192,24 +182,19 @@ def start_comfyui():
         
         if not os.path.exists(comfyui_dir):
             logger.error(f"❌ ComfyUI directory not found: {comfyui_dir}")
-            return
+            return False
         
         # Start ComfyUI with output capture
         logger.info(f"🚀 Starting ComfyUI from {comfyui_dir}...")
         
-        subprocess.Popen(
-            ["python", "main.py", "--listen", "0.0.0.0", "--port", "8188"],
-            cwd=comfyui_dir,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            start_new_session=True
-        )
-        
-        logger.info("✅ ComfyUI startup command executed")
+        # The supervisor owns the process (and drains its output): it restarts ComfyUI if it
+        # crashes and recycles it between jobs
+        return get_supervisor().start(["python", "main.py", "--listen", "0.0.0.0", "--port", "8188"], cwd=comfyui_dir, timeout=120)
         
     except Exception as e:
         logger.error(f"❌ Error starting ComfyUI: {e}")
         logger.error(traceback.format_exc())
+        return False
 
 def queue_workflow_with_comfyui(workflow: Dict, job_id: str, video_path: str) -> Optional[str]:
     """Queue workflow with ComfyUI and return prompt ID"""
@@ -226,10 +211,23 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str, video_path: str) ->
             existing_prefix = workflow["3"]["inputs"].get("filename_prefix", "fps_boost/fps_boosted")
             logger.info(f"✅ Using filename prefix from frontend: {existing_prefix}")
         
-        # Send to ComfyUI
-        response = requests.post(
-            "http://127.0.0.1:8188/prompt",
-            json={"prompt": workflow},
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'fps_boost')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return None
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Send to ComfyUI under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
+        response = comfyui.post(
+            "/prompt",
+            json={"prompt": workflow, "client_id": client_id},
             timeout=30
         )
         
@@ -244,6 +242,10 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str, video_path: str) ->
             logger.error("❌ No prompt_id returned from ComfyUI")
             return None
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('fps_boost', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Workflow queued successfully. Prompt ID: {prompt_id}")
         return prompt_id
         
@@ -260,7 +262,17 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
         max_wait_time = 600  # 10 minutes max
         last_progress = 0
         
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        
+        # Progress weighted by the frames the workflow loads, interpolates and encodes
+        tracker = WorkflowProgress(workflow)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        
         while True:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             elapsed = time.time() - start_time
             
             if elapsed > max_wait_time:
@@ -271,14 +283,16 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                     "status": "failed"
                 }
             
-            # Check queue status
+            # Check queue status (history only once the event stream reports completion, unless polling)
             try:
-                history_response = requests.get(
-                    f"http://127.0.0.1:8188/history/{prompt_id}",
-                    timeout=10
-                )
+                history_response = None
+                if watcher.finished or not watcher.live:
+                    history_response = comfyui.get(
+                        f"/history/{prompt_id}",
+                        timeout=10
+                    )
                 
-                if history_response.status_code == 200:
+                if history_response is not None and history_response.status_code == 200:
                     history = history_response.json()
                     
                     if prompt_id in history:
@@ -369,29 +383,35 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                                     "elapsedTime": int(elapsed)
                                 })
                             
+                            node_profile = finish_node_profile(watcher, workflow, 'fps_boost')
+                            timings.record()
                             return {
                                 "success": True,
                                 "status": "completed",
                                 "videos": uploaded_videos,
-                                "elapsedTime": int(elapsed)
+                                "elapsedTime": int(elapsed),
+                                "model_residency": residency_report(job_id),
+                                "node_profile": node_profile
                             }
                 
-                # Send progress update
-                progress = min(90, int((elapsed / max_wait_time) * 100))
+                # Send progress update (from the execution events, elapsed time when not live)
+                tracker.update(watcher, elapsed)
+                progress = tracker.percent(5, 90)
                 if progress != last_progress and webhook_url:
                     send_webhook(webhook_url, {
                         "jobId": job_id,
                         "status": "processing",
                         "progress": progress,
                         "stage": "Interpolating frames",
-                        "elapsedTime": int(elapsed)
+                        "elapsedTime": int(elapsed),
+                        "estimatedTimeRemaining": int(tracker.estimated_remaining(elapsed))
                     })
                     last_progress = progress
                 
             except Exception as e:
                 logger.error(f"❌ Error checking progress: {e}")
             
-            time.sleep(3)
+            watcher.sleep(3)
         
     except Exception as e:
         logger.error(f"❌ Error monitoring progress: {e}")
@@ -410,8 +430,8 @@ def get_video_from_comfyui(filename: str, subfolder: str = '', type_dir: str = '
             "type": type_dir
         }
         
-        response = requests.get(
-            "http://127.0.0.1:8188/view",
+        response = comfyui.get(
+            "/view",
             params=params,
             timeout=60
         )
@@ -426,21 +446,17 @@ def get_video_from_comfyui(filename: str, subfolder: str = '', type_dir: str = '
         logger.error(f"❌ Error downloading video: {e}")
         return None
 
-def save_uploaded_video(video_data: str, filename: str) -> str:
-    """Save uploaded video to ComfyUI input directory"""
+def save_uploaded_video(job_input: Dict, filename: str) -> str:
+    """Save the uploaded base64 video (job_input['videoData']) to ComfyUI input directory"""
     try:
-        # Decode base64 video data
-        video_bytes = base64.b64decode(video_data)
-        
-        # Save to ComfyUI input directory
+        # Decode in chunks straight to disk; the base64 string is dropped from the job input
         input_dir = "/app/comfyui/input"
-        os.makedirs(input_dir, exist_ok=True)
-        
-        video_path = os.path.join(input_dir, filename)
-        with open(video_path, 'wb') as f:
-            f.write(video_bytes)
+        video_size = save_base64_input(job_input, 'videoData', filename, input_dir)
+        if video_size is None:
+            logger.error("❌ No video data to save")
+            return None
         
-        logger.info(f"✅ Video saved to: {video_path}")
+        logger.info(f"✅ Video saved to: {os.path.join(input_dir, filename)} ({video_size} bytes)")
         return filename
         
     except Exception as e:
@@ -453,30 +469,30 @@ def run_fps_boost_generation(job_input, job_id, webhook_url):
     
     try:
         # Prepare ComfyUI environment
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             return {
                 "error": "Failed to prepare ComfyUI environment",
                 "status": "failed"
             }
         
         # Extract parameters
-        workflow = job_input.get('workflow', {})
-        video_data = job_input.get('videoData')
+        workflow = resolve_workflow(job_input, 'fps_boost')
         user_id = job_input.get('user_id', 'unknown')
         
         if not workflow:
-            return {"error": "No workflow provided", "status": "failed"}
+            return {"error": "No workflow or template params provided", "status": "failed"}
         
-        if not video_data:
+        if not job_input.get('videoData'):
             return {"error": "No video data provided", "status": "failed"}
         
         # Validate workflow
-        if not validate_workflow(workflow):
-            return {"error": "Invalid workflow", "status": "failed"}
+        validation_errors = workflow_errors(workflow, 'fps_boost')
+        if validation_errors:
+            return {"error": f"Invalid workflow: {'; '.join(validation_errors[:5])}", "status": "failed"}
         
         # Save uploaded video
         video_filename = f"fps_boost_input_{job_id}.mp4"
-        saved_filename = save_uploaded_video(video_data, video_filename)
+        saved_filename = save_uploaded_video(job_input, video_filename)
         
         if not saved_filename:
             return {"error": "Failed to save uploaded video", "status": "failed"}
@@ -512,13 +528,15 @@ def run_fps_boost_generation(job_input, job_id, webhook_url):
 def handler(job):
     """RunPod serverless handler for FPS boost"""
     job_input = job['input']
-    job_id = job_input.get('job_id', 'unknown')  # Use our database job_id from input
     runpod_job_id = job.get('id', 'unknown')  # RunPod's internal job ID
+    job_id = job_input.get('job_id') or runpod_job_id  # Use our database job_id from input
     webhook_url = job_input.get('webhook_url')
     
     logger.info(f"🎬 FPS Boost handler started for job: {job_id} (RunPod: {runpod_job_id})")
     
-    result = run_fps_boost_generation(job_input, job_id, webhook_url)
+    # Interrupt ComfyUI and return right away if the job is cancelled
+    with watch_job_cancellation(job, job_id):
+        result = run_fps_boost_generation(job_input, job_id, webhook_url)
     
     logger.info(f"✅ FPS Boost handler completed for job: {job_id}")
     return result
@@ -540,4 +558,6 @@ except ImportError:
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎯 Starting RunPod FPS Boost handler...")
-    runpod.serverless.start({"handler": handler})
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, lambda: warm_up_models('fps_boost'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
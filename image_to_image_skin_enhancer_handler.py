@@ -13,20 +13,41 @@ import os
 import sys
 import time
 import uuid
-import subprocess
-import threading
 import logging
 import runpod
 import requests
 import boto3
 from pathlib import Path
 from typing import Dict, List, Any, Optional
+
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.templates import resolve_workflow
+from comfyui_worker.graph import WorkflowGraph
+from comfyui_worker.inputs import save_base64_input
+from comfyui_worker.fetch import is_reference
 from botocore.exceptions import ClientError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # AWS S3 Configuration for direct storage (bandwidth optimization)
 AWS_REGION = os.environ.get('AWS_REGION') or os.environ.get('S3_REGION') or 'us-east-1'
 AWS_S3_BUCKET = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET') or 'tastycreative'
@@ -114,8 +135,6 @@ def upload_image_to_aws_s3(image_data: bytes, user_id: str, filename: str, subfo
 def get_image_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> bytes:
     """Download image from ComfyUI and return raw bytes"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
-        
         # Construct the image URL
         params = {
             'filename': filename,
@@ -123,7 +142,7 @@ def get_image_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: s
             'type': type_dir
         }
         
-        response = requests.get(f"{comfyui_url}/view", params=params, timeout=30)
+        response = comfyui.get("/view", params=params, timeout=30)
         
         if response.status_code == 200:
             logger.info(f"✅ Downloaded image bytes from ComfyUI: {filename}")
@@ -141,6 +160,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=120)
         response.raise_for_status()
@@ -150,97 +172,41 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
         logger.error(f"❌ Webhook failed: {e}")
         return False
 
-def validate_image_to_image_skin_enhancement_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure for image-to-image skin enhancement"""
-    try:
-        if not isinstance(workflow, dict):
-            logger.error("❌ Workflow must be a dictionary")
-            return False
-        
-        # Check for required nodes for image-to-image skin enhancement
-        required_nodes = [
-            "1", "2", "3", "4", "5", "6", "7", "8", "9", "10", 
-            "11", "12", "13", "14", "15", "16", "17", "18", "19", "20",
-            "21", "22", "23", "24", "25", "26", "28", "29", "30",
-            "31", "32", "33", "34", "38", "39", "40"
-        ]
-        
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"❌ Missing required node: {node_id}")
-                return False
-        
-        # Validate key nodes
-        key_node_types = {
-            "40": "LoadImage",  # Input image
-            "39": "CheckpointLoaderSimple",  # Model loader
-            "29": "Lora Loader Stack (rgthree)",  # LoRA loader
-            "31": "KSampler",  # Main generation
-            "38": "SaveImage",  # Output
-            "14": "LayerMask: PersonMaskUltra V2",  # Person mask
-            "4": "FaceParse(FaceParsing)",  # Face parsing
-        }
-        
-        for node_id, expected_type in key_node_types.items():
-            if node_id in workflow:
-                node = workflow[node_id]
-                if not isinstance(node, dict):
-                    logger.error(f"❌ Node {node_id} must be a dictionary")
-                    return False
-                
-                if "class_type" not in node:
-                    logger.error(f"❌ Node {node_id} missing class_type")
-                    return False
-                
-                if node["class_type"] != expected_type:
-                    logger.warning(f"⚠️ Node {node_id} has unexpected class_type: {node['class_type']} (expected: {expected_type})")
-        
-        logger.info("✅ Image-to-image skin enhancement workflow validation passed")
-        return True
-    
-    except Exception as e:
-        logger.error(f"❌ Workflow validation error: {e}")
-        return False
+def _user_lora_path(lora_name):
+    """user_<id>_..._name.safetensors -> user_<id>/user_<id>_..._name.safetensors (None if not a user LoRA)"""
+    if lora_name and lora_name != 'None' and lora_name.startswith('user_') and '/' not in lora_name:
+        # Extract user directory from filename
+        parts = lora_name.split('_')
+        if len(parts) >= 3:
+            return f"{parts[0]}_{parts[1]}/{lora_name}"
+    return None
 
-def fix_lora_paths(workflow):
+def fix_lora_paths(graph: WorkflowGraph) -> WorkflowGraph:
     """Fix LoRA paths to match ComfyUI's expected format"""
     try:
-        for node_id, node in workflow.items():
-            # Check for both LoraLoader and LoraLoaderModelOnly and Lora Loader Stack
-            if isinstance(node, dict) and node.get('class_type') in ['LoraLoader', 'LoraLoaderModelOnly', 'Lora Loader Stack (rgthree)']:
-                
-                if node.get('class_type') == 'Lora Loader Stack (rgthree)':
-                    # Handle multi-LoRA stack
-                    inputs = node.get('inputs', {})
-                    for lora_key in ['lora_01', 'lora_02', 'lora_03', 'lora_04']:
-                        if lora_key in inputs:
-                            lora_name = inputs[lora_key]
-                            if lora_name and lora_name != 'None' and lora_name.startswith('user_') and '/' not in lora_name:
-                                # Extract user directory from filename
-                                parts = lora_name.split('_')
-                                if len(parts) >= 3:
-                                    user_dir = f"{parts[0]}_{parts[1]}"
-                                    fixed_path = f"{user_dir}/{lora_name}"
-                                    logger.info(f"🔧 Fixing LoRA path in stack {lora_key}: {lora_name} -> {fixed_path}")
-                                    inputs[lora_key] = fixed_path
-                else:
-                    # Handle single LoRA
-                    lora_name = node['inputs'].get('lora_name', '')
-                    
-                    # If LoRA name starts with user_ and doesn't contain /, add the subdirectory
-                    if lora_name.startswith('user_') and '/' not in lora_name and lora_name not in ['Real.People.safetensors', 'more_details.safetensors']:
-                        # Extract user directory from filename
-                        parts = lora_name.split('_')
-                        if len(parts) >= 3:
-                            user_dir = f"{parts[0]}_{parts[1]}"
-                            fixed_path = f"{user_dir}/{lora_name}"
-                            logger.info(f"🔧 Fixing LoRA path for {node.get('class_type')}: {lora_name} -> {fixed_path}")
-                            node['inputs']['lora_name'] = fixed_path
+        # Handle multi-LoRA stack
+        for node in graph.by_class('Lora Loader Stack (rgthree)'):
+            for lora_key in ['lora_01', 'lora_02', 'lora_03', 'lora_04']:
+                lora_name = node.inputs.get(lora_key)
+                fixed_path = _user_lora_path(lora_name) if isinstance(lora_name, str) else None
+                if fixed_path:
+                    logger.info(f"🔧 Fixing LoRA path in stack {lora_key}: {lora_name} -> {fixed_path}")
+                    graph.set_input(node.id, lora_key, fixed_path)
+        
+        # Handle single LoRA
+        for node in graph.by_class('LoraLoader') + graph.by_class('LoraLoaderModelOnly'):
+            lora_name = node.inputs.get('lora_name', '')
+            if lora_name in ['Real.People.safetensors', 'more_details.safetensors']:
+                continue
+            fixed_path = _user_lora_path(lora_name)
+            if fixed_path:
+                logger.info(f"🔧 Fixing LoRA path for {node.class_type}: {lora_name} -> {fixed_path}")
+                graph.set_input(node.id, 'lora_name', fixed_path)
         
-        return workflow
+        return graph
     except Exception as e:
         logger.error(f"❌ Error fixing LoRA paths: {e}")
-        return workflow
+        return graph
 
 def process_base64_image_input(workflow, job_id):
     """
@@ -248,9 +214,7 @@ def process_base64_image_input(workflow, job_id):
     Extracts base64 image from node 40, decodes it, saves to ComfyUI input directory,
     and replaces the base64 data with the filename.
     """
-    import base64
     from PIL import Image
-    from io import BytesIO
     
     try:
         # Find LoadImage node (node 40)
@@ -265,45 +229,41 @@ def process_base64_image_input(workflow, job_id):
         
         # Get base64 image data
         image_data = node_40['inputs'].get('image', '')
-        if not image_data or not isinstance(image_data, str):
+        if not image_data or not (isinstance(image_data, str) or is_reference(image_data)):
             logger.warning("⚠️ No base64 image data found in node 40")
             return workflow
         
-        # Check if it's already a filename (not base64)
-        if not image_data.startswith('iVBOR') and not image_data.startswith('/9j/'):  # PNG or JPEG headers
+        # Check if it's already a filename (not base64 or a URL / S3 reference)
+        if not is_reference(image_data) and not image_data.startswith('iVBOR') and not image_data.startswith('/9j/'):  # PNG or JPEG headers
             logger.info(f"✅ Image is already a filename: {image_data}")
             return workflow
         
         logger.info("🖼️ Processing base64 image data...")
         
-        # Decode base64 image
+        # Decode base64 image in chunks straight to the ComfyUI input directory
+        timestamp = int(time.time() * 1000)
+        comfyui_input_dir = Path("/app/comfyui/input")
+        decoded_path = comfyui_input_dir / f"input_{job_id}_{timestamp}.upload"
         try:
-            image_bytes = base64.b64decode(image_data)
+            save_base64_input(node_40['inputs'], 'image', decoded_path.name, str(comfyui_input_dir))
         except Exception as e:
             logger.error(f"❌ Failed to decode base64 image: {e}")
             return workflow
         
-        # Open image with PIL to ensure it's valid and get format
+        # Open image with PIL to ensure it's valid and get format (reads only the header)
         try:
-            img = Image.open(BytesIO(image_bytes))
-            img_format = img.format.lower() if img.format else 'png'
-            logger.info(f"📸 Decoded image: {img.size[0]}x{img.size[1]} {img_format.upper()}")
+            with Image.open(decoded_path) as img:
+                img_format = img.format.lower() if img.format else 'png'
+                logger.info(f"📸 Decoded image: {img.size[0]}x{img.size[1]} {img_format.upper()}")
         except Exception as e:
             logger.error(f"❌ Invalid image data: {e}")
+            decoded_path.unlink(missing_ok=True)
             return workflow
         
-        # Generate unique filename
-        timestamp = int(time.time() * 1000)
+        # Keep the uploaded bytes under a name with the detected format
         filename = f"input_{job_id}_{timestamp}.{img_format}"
-        
-        # Save to ComfyUI input directory
-        comfyui_input_dir = Path("/app/comfyui/input")
-        comfyui_input_dir.mkdir(parents=True, exist_ok=True)
-        
         filepath = comfyui_input_dir / filename
-        
-        # Save image
-        img.save(str(filepath), format=img_format.upper())
+        os.replace(decoded_path, filepath)
         logger.info(f"✅ Saved input image to: {filepath}")
         
         # Update workflow node with filename instead of base64
@@ -325,9 +285,8 @@ def queue_image_to_image_skin_enhancement_workflow(workflow, job_id):
         workflow = process_base64_image_input(workflow, job_id)
         
         # Fix LoRA paths before sending workflow
-        workflow = fix_lora_paths(workflow)
+        workflow = fix_lora_paths(WorkflowGraph(workflow)).to_workflow()
         
-        queue_url = "http://localhost:8188/prompt"
         
         # Debug: Log LoRA usage in workflow
         lora_nodes_found = 0
@@ -354,18 +313,30 @@ def queue_image_to_image_skin_enhancement_workflow(workflow, job_id):
         logger.info(f"📊 Total enhancement LoRA nodes found: {lora_nodes_found}")
         logger.info(f"🎭 Enhancement LoRAs: {enhancement_loras}")
         
-        # Prepare payload with unique client_id to prevent caching
-        unique_client_id = f"runpod-img2img-skin-enhancer-{job_id}-{int(time.time())}-{os.urandom(4).hex()}"
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'image_to_image_skin_enhancement')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return None
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Queue under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
         payload = {
             "prompt": workflow,
-            "client_id": unique_client_id
+            "client_id": client_id
         }
         
-        logger.info(f"📡 Sending image-to-image skin enhancement to ComfyUI: {queue_url}")
+        logger.info(f"📡 Sending image-to-image skin enhancement to ComfyUI: {comfyui.url('/prompt')}")
         
         # Send request to ComfyUI
-        response = requests.post(
-            queue_url,
+        response = comfyui.post(
+            "/prompt",
             json=payload,
             timeout=30,
             headers={'Content-Type': 'application/json'}
@@ -382,6 +353,10 @@ def queue_image_to_image_skin_enhancement_workflow(workflow, job_id):
             logger.error(f"❌ No prompt_id in ComfyUI response: {result}")
             return None
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('image_to_image_skin_enhancement', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Image-to-image skin enhancement workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
     
@@ -392,7 +367,7 @@ def queue_image_to_image_skin_enhancement_workflow(workflow, job_id):
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://localhost:8188/system_stats", timeout=5)
+        response = comfyui.get("/system_stats", timeout=5)
         if response.status_code == 200:
             logger.info("✅ ComfyUI is already running")
             return True
@@ -528,49 +503,9 @@ def start_comfyui():
         
         print(f"🔧 Starting ComfyUI with cold start optimizations: {' '.join(cmd)}")
         
-        def log_output(process, stream_name):
-            """Log ComfyUI output"""
-            for line in iter(process.stdout.readline, b''):
-                try:
-                    line_str = line.decode('utf-8').strip()
-                    if line_str:
-                        print(f"ComfyUI [{stream_name}]: {line_str}")
-                except:
-                    pass
-        
-        # Start ComfyUI as background process from the ComfyUI directory
-        process = subprocess.Popen(cmd, 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.STDOUT,
-                                 cwd=comfyui_dir,
-                                 bufsize=1,
-                                 universal_newlines=False,
-                                 env=env)
-        
-        # Start logging thread
-        log_thread = threading.Thread(target=log_output, args=(process, "stdout"))
-        log_thread.daemon = True
-        log_thread.start()
-        
-        # Wait for ComfyUI to start up
-        print("⏳ Waiting for ComfyUI to start...")
-        max_wait = 120  # 2 minutes (face_parsing node takes ~52s to load)
-        for i in range(max_wait):
-            if i % 5 == 0:
-                print(f"⏳ Still waiting for ComfyUI... ({i}/{max_wait}s)")
-            
-            if process.poll() is not None:
-                print(f"❌ ComfyUI process died with return code: {process.returncode}")
-                return False
-            
-            if is_comfyui_running():
-                print(f"✅ ComfyUI started successfully after {i} seconds")
-                return True
-                
-            time.sleep(1)
-        
-        print(f"❌ ComfyUI failed to start within {max_wait} seconds")
-        return False
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_dir, env=env, timeout=120)
         
     except Exception as e:
         print(f"❌ Error starting ComfyUI: {str(e)}")
@@ -581,6 +516,23 @@ def monitor_image_to_image_skin_enhancement_progress(prompt_id: str, job_id: str
     try:
         logger.info(f"👀 Starting image-to-image skin enhancement progress monitoring for prompt {prompt_id}")
         
+        # Progress weighted by the workflow's sampler steps, face parsing and upscale passes
+        tracker = WorkflowProgress(workflow)
+        stage_messages = {
+            'loading_models': "🧠 Loading AI models and face parsing components...",
+            'processing_prompt': "📝 Encoding prompt...",
+            'processing': "🎭 Analyzing faces and generating masks...",
+            'sampling': "✨ Enhancing skin details with AI...",
+            'upscaling': "🎯 Upscaling enhanced image...",
+            'decoding': "🎯 Applying final touches and optimizations...",
+            'saving': "📸 Finalizing enhanced images..."
+        }
+        
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        start_time = time.time()
+        
         # Send initial monitoring webhook
         send_webhook(webhook_url, {
             'job_id': job_id,
@@ -589,23 +541,27 @@ def monitor_image_to_image_skin_enhancement_progress(prompt_id: str, job_id: str
             'message': '🎨 Initializing image-to-image skin enhancement monitoring...',
             'stage': 'starting',
             'workflow_type': 'image_to_image_skin_enhancement',
-            'estimated_time': '4-6 minutes',
-            'steps_total': 85  # More complex workflow with face parsing
+            'estimated_remaining': tracker.estimated_remaining(0),
+            'steps_total': tracker.total_steps  # all sampler passes in the submitted workflow
         })
         
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        history_url = f"{comfyui_url}/history/{prompt_id}"
+        history_url = f"/history/{prompt_id}"
         
         max_attempts = 1200  # 20 minutes for complex image-to-image skin enhancement
         attempt = 0
         last_progress_update = 5
         
         while attempt < max_attempts:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             try:
-                # Check if generation is complete
-                response = requests.get(history_url, timeout=10)
+                # Check if generation is complete (only once the event stream reports completion, unless polling)
+                response = None
+                if watcher.finished or not watcher.live:
+                    response = comfyui.get(history_url, timeout=10)
                 
-                if response.status_code == 200:
+                if response is not None and response.status_code == 200:
                     history = response.json()
                     
                     if prompt_id in history:
@@ -740,11 +696,15 @@ def monitor_image_to_image_skin_enhancement_progress(prompt_id: str, job_id: str
                                     send_webhook(webhook_url, completion_data)
                                     logger.info(f"📤 Sent completion webhook with {len(aws_s3_paths)} AWS S3 paths and {len(resultUrls)} result URLs")
                                 
+                                node_profile = finish_node_profile(watcher, workflow, 'image_to_image_skin_enhancement')
+                                timings.record()
                                 return {
                                     'success': True,
                                     'status': 'completed',
                                     'images': result_images,
                                     'aws_s3_paths': aws_s3_paths,
+                                    'node_profile': node_profile,
+                                    'model_residency': residency_report(job_id),
                                     'message': f'Successfully enhanced {len(result_images)} images with image-to-image skin enhancement'
                                 }
                             else:
@@ -763,24 +723,13 @@ def monitor_image_to_image_skin_enhancement_progress(prompt_id: str, job_id: str
                                     'error': 'No valid enhanced images found'
                                 }
                 
-                # Send progress updates with enhanced staging
-                elapsed_time = attempt * 1
-                if elapsed_time < 20:
-                    current_progress = 15 + (elapsed_time / 20) * 15  # 15% to 30% - Loading models
-                    stage_message = "🧠 Loading AI models and face parsing components..."
-                elif elapsed_time < 60:
-                    # Face parsing and mask generation (40 seconds)
-                    face_progress = (elapsed_time - 20) / 40
-                    current_progress = 30 + face_progress * 25  # 30% to 55% - Face analysis
-                    stage_message = f"🎭 Analyzing faces and generating masks... ({int(face_progress * 100)}%)"
-                elif elapsed_time < 120:
-                    # Image enhancement phase (60 seconds)
-                    enhance_progress = (elapsed_time - 60) / 60
-                    current_progress = 55 + enhance_progress * 30  # 55% to 85% - Enhancement
-                    stage_message = f"✨ Enhancing skin details with AI... ({int(enhance_progress * 100)}%)"
-                else:
-                    current_progress = min(90, 85 + (elapsed_time - 120) / 60 * 5)  # 85% to 90% - Finalizing
-                    stage_message = "🎯 Applying final touches and optimizations..."
+                # Progress from the workflow graph and the execution events (elapsed time when not live)
+                elapsed_time = time.time() - start_time
+                tracker.update(watcher, elapsed_time)
+                current_progress = tracker.percent(15, 90)
+                stage_message = stage_messages.get(tracker.stage, stage_messages['processing'])
+                if tracker.step_label():
+                    stage_message = f"{stage_message} ({tracker.step_label()})"
                 
                 # Send enhanced progress updates every 5% or stage change
                 if current_progress - last_progress_update >= 5:
@@ -789,15 +738,15 @@ def monitor_image_to_image_skin_enhancement_progress(prompt_id: str, job_id: str
                         'status': 'PROCESSING',
                         'progress': int(current_progress),
                         'message': stage_message,
-                        'elapsed_time': elapsed_time,
-                        'stage': 'processing',
-                        'estimated_remaining': max(0, 360 - elapsed_time)  # 6 min estimate
+                        'elapsed_time': int(elapsed_time),
+                        'stage': tracker.stage,
+                        'estimated_remaining': tracker.estimated_remaining(elapsed_time)
                     })
                     last_progress_update = current_progress
                     logger.info(f"📊 Enhanced progress: {int(current_progress)}% - {stage_message}")
                 
                 attempt += 1
-                time.sleep(1)
+                watcher.sleep(1)
                 
             except Exception as e:
                 logger.error(f"❌ Error checking progress: {e}")
@@ -851,7 +800,7 @@ def run_image_to_image_skin_enhancement_generation(job_input, job_id, webhook_ur
             })
         
         # Prepare ComfyUI environment
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             error_msg = "Failed to prepare ComfyUI environment"
             if webhook_url:
                 send_webhook(webhook_url, {
@@ -875,18 +824,19 @@ def run_image_to_image_skin_enhancement_generation(job_input, job_id, webhook_ur
                 'message': 'ComfyUI environment ready, starting generation...'
             })
         
-        # Validate inputs
-        if 'workflow' not in job_input:
-            raise ValueError("No workflow provided")
+        # Raw workflow, or the image_to_image_skin_enhancement template rendered with the job's params
+        workflow = resolve_workflow(job_input, 'image_to_image_skin_enhancement')
+        if not workflow:
+            raise ValueError("No workflow or template params provided")
         
-        workflow = job_input['workflow']
         params = job_input.get('params', {})
         
         logger.info(f"📋 Enhancement params: {params}")
         
         # Validate workflow
-        if not validate_image_to_image_skin_enhancement_workflow(workflow):
-            raise ValueError("Invalid image-to-image skin enhancement workflow")
+        validation_errors = workflow_errors(workflow, 'image_to_image_skin_enhancement')
+        if validation_errors:
+            raise ValueError(f"Invalid image-to-image skin enhancement workflow: {'; '.join(validation_errors[:5])}")
         
         # Queue workflow with ComfyUI
         send_webhook(webhook_url, {
@@ -962,7 +912,9 @@ def handler(job):
         
         # Handle image-to-image skin enhancement
         if action == 'enhance_skin_image_to_image':
-            result = run_image_to_image_skin_enhancement_generation(job_input, job_id, webhook_url)
+            # Interrupt ComfyUI and return right away if the job is cancelled
+            with watch_job_cancellation(job, job_id):
+                result = run_image_to_image_skin_enhancement_generation(job_input, job_id, webhook_url)
             
             return {
                 'job_id': job_id,
@@ -971,6 +923,8 @@ def handler(job):
                 'status': result['status'],
                 'images': result.get('images', []),
                 'aws_s3_paths': result.get('aws_s3_paths', []),
+                'node_profile': result.get('node_profile'),
+                'model_residency': result.get('model_residency'),
                 'message': result.get('message', result.get('error', 'Unknown')),
                 'error': result.get('error') if not result['success'] else None
             }
@@ -1009,4 +963,6 @@ def handler(job):
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎨 Starting RunPod Image-to-Image Skin Enhancement handler...")
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, lambda: warm_up_models('image_to_image_skin_enhancement'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
\ No newline at end of file
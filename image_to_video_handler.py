@@ -10,18 +10,36 @@ import time
 import os
 import sys
 import logging
-import base64
-import subprocess
-import threading
 import boto3
 from botocore.exceptions import ClientError
 from pathlib import Path
 from typing import Dict, List, Any, Optional
 
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.templates import resolve_workflow
+from comfyui_worker.inputs import decode_base64_to_file, save_base64_input
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # S3 Configuration for RunPod Network Volume
 S3_ENDPOINT = 'https://s3api-us-ks-2.runpod.io'
 S3_REGION = 'us-ks-2'
@@ -197,6 +215,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=120)
         response.raise_for_status()
@@ -206,67 +227,6 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
         logger.error(f"❌ Webhook failed: {e}")
         return False
 
-def validate_video_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure for image-to-video"""
-    try:
-        if not isinstance(workflow, dict):
-            logger.error("Video workflow must be a dictionary")
-            return False
-        
-        # Check for required video nodes
-        required_nodes = ["6", "7", "37", "38", "39", "48", "56", "65", "81", "89", "90", "91", "92", "93", "94", "8", "57", "131"]
-        
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"Missing required video node: {node_id}")
-                return False
-        
-        # Validate node structure
-        for node_id, node in workflow.items():
-            if not isinstance(node, dict) or 'class_type' not in node or 'inputs' not in node:
-                logger.error(f"Invalid video node structure for node {node_id}")
-                return False
-        
-        logger.info("✅ Video workflow validation passed")
-        return True
-    
-    except Exception as e:
-        logger.error(f"❌ Video workflow validation error: {e}")
-        return False
-
-def get_video_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> str:
-    """Download video from ComfyUI and return as base64 encoded string"""
-    try:
-        import base64
-        logger.info(f"📥 Downloading video: {filename} from {subfolder}/{type_dir}")
-        
-        # Construct the URL for downloading the video
-        params = {
-            'filename': filename,
-            'subfolder': subfolder,
-            'type': type_dir
-        }
-        
-        response = requests.get(
-            "http://127.0.0.1:8188/view",
-            params=params,
-            timeout=60
-        )
-        
-        if response.status_code != 200:
-            logger.error(f"❌ Failed to download video: {response.status_code}")
-            return ""
-        
-        # Encode video as base64
-        video_b64 = base64.b64encode(response.content).decode('utf-8')
-        logger.info(f"✅ Video downloaded and encoded: {len(video_b64)} characters")
-        
-        return video_b64
-        
-    except Exception as e:
-        logger.error(f"❌ Error downloading video: {e}")
-        return ""
-
 def get_video_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> bytes:
     """Download video from ComfyUI and return as raw bytes for S3 storage"""
     try:
@@ -279,8 +239,8 @@ def get_video_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: s
             'type': type_dir
         }
         
-        response = requests.get(
-            "http://127.0.0.1:8188/view",
+        response = comfyui.get(
+            "/view",
             params=params,
             timeout=60
         )
@@ -299,7 +259,7 @@ def get_video_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: s
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://localhost:8188/system_stats", timeout=5)
+        response = comfyui.get("/system_stats", timeout=5)
         if response.status_code == 200:
             logger.info("✅ ComfyUI is already running")
             return True
@@ -394,43 +354,9 @@ def start_comfyui():
         
         print(f"🔧 Starting ComfyUI with command: {' '.join(cmd)}")
         
-        def log_output(process, stream_name):
-            for line in iter(process.stdout.readline, b''):
-                if line:
-                    print(f"ComfyUI [{stream_name}]: {line.decode().strip()}")
-        
-        # Start ComfyUI as background process from the ComfyUI directory
-        process = subprocess.Popen(cmd, 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.STDOUT,
-                                 cwd=comfyui_dir,
-                                 bufsize=1,
-                                 universal_newlines=False)
-        
-        # Start logging thread
-        log_thread = threading.Thread(target=log_output, args=(process, "stdout"))
-        log_thread.daemon = True
-        log_thread.start()
-        
-        # Wait for ComfyUI to start up
-        print("⏳ Waiting for ComfyUI to start...")
-        max_wait = 300  # 5 minutes - increased timeout for dependency installation
-        for i in range(max_wait):
-            if i % 10 == 0:
-                print(f"⏳ Still waiting for ComfyUI... ({i}/{max_wait}s)")
-            
-            try:
-                response = requests.get("http://localhost:8188/system_stats", timeout=5)
-                if response.status_code == 200:
-                    print("✅ ComfyUI is running!")
-                    return True
-            except requests.exceptions.RequestException:
-                pass
-            
-            time.sleep(1)
-            
-        print(f"❌ ComfyUI failed to start within {max_wait} seconds")
-        return False
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_dir, timeout=300)
         
     except Exception as e:
         print(f"❌ Error starting ComfyUI: {str(e)}")
@@ -441,22 +367,31 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
     try:
         logger.info(f"🎬 Queueing workflow with ComfyUI for job {job_id}")
         
-        # ComfyUI API endpoint (using network volume ComfyUI instance)
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        queue_url = f"{comfyui_url}/prompt"
         
-        # Prepare payload with unique client_id to prevent caching
-        unique_client_id = f"runpod-{job_id}-{int(time.time())}-{os.urandom(4).hex()}"
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'image_to_video')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return None
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Queue under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
         payload = {
             "prompt": workflow,
-            "client_id": unique_client_id
+            "client_id": client_id
         }
         
-        logger.info(f"📡 Sending to ComfyUI: {queue_url}")
+        logger.info(f"📡 Sending to ComfyUI: {comfyui.url('/prompt')}")
         
         # Send request to ComfyUI
-        response = requests.post(
-            queue_url,
+        response = comfyui.post(
+            "/prompt",
             json=payload,
             timeout=30,
             headers={'Content-Type': 'application/json'}
@@ -473,6 +408,10 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
             logger.error(f"❌ No prompt_id in response: {result}")
             return None
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('image_to_video', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
     
@@ -486,38 +425,32 @@ def download_image_for_comfyui(image_filename: str, job_input: dict, base64_key:
         logger.info(f"📦 Using base64 image data directly for {image_filename} (key: {base64_key})")
         
         # Try to get base64 data from the provided key or kwargs
-        base64_data = job_input.get(base64_key) or kwargs.get('base64_data')
+        data_key = base64_key if job_input.get(base64_key) else None
         
-        if not base64_data:
+        if not data_key and not kwargs.get('base64_data'):
             # Try alternative keys
             for alt_key in ['originalImageData', 'imageData', 'referenceImageData']:
                 if alt_key in job_input and job_input[alt_key]:
-                    base64_data = job_input[alt_key]
+                    data_key = alt_key
                     logger.info(f"📦 Found base64 data in alternative key: {alt_key}")
                     break
         
-        if not base64_data:
+        if not data_key and not kwargs.get('base64_data'):
             logger.error(f"❌ No base64 image data found for {image_filename}")
             return False
         
-        # Decode base64 and save to ComfyUI input directory
+        # Decode base64 in chunks straight to the ComfyUI input directory
         try:
-            # Remove data URL prefix if present
-            if base64_data.startswith('data:'):
-                base64_data = base64_data.split(',', 1)[1]
-            
-            image_data = base64.b64decode(base64_data)
-            
-            # Ensure input directory exists
             input_dir = "/app/comfyui/input"
-            os.makedirs(input_dir, exist_ok=True)
-            
-            # Write image file
             image_path = os.path.join(input_dir, image_filename)
-            with open(image_path, 'wb') as f:
-                f.write(image_data)
+            if data_key:
+                # Drops the string from the job input once it is on disk
+                image_size = save_base64_input(job_input, data_key, image_filename, input_dir)
+            else:
+                os.makedirs(input_dir, exist_ok=True)
+                image_size = decode_base64_to_file(kwargs['base64_data'], image_path)
             
-            logger.info(f"✅ Base64 image saved to ComfyUI input: {image_path} ({len(image_data)} bytes)")
+            logger.info(f"✅ Base64 image saved to ComfyUI input: {image_path} ({image_size} bytes)")
             return True
             
         except Exception as decode_error:
@@ -583,6 +516,22 @@ def monitor_video_generation_progress(prompt_id: str, job_id: str, webhook_url:
         progress = 5
         message = progress_stages['starting']['message']
         
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        
+        # Progress weighted by sampler steps, video length and decode passes
+        tracker = WorkflowProgress(workflow)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        tracker_stages = {
+            'loading_models': 'loading_models',
+            'processing_prompt': 'processing_image',
+            'processing': 'processing_image',
+            'sampling': 'generating_frames',
+            'decoding': 'encoding_video',
+            'upscaling': 'encoding_video',
+            'saving': 'saving'
+        }
+        
         # Send initial progress update
         if webhook_url:
             send_webhook(webhook_url, {
@@ -591,19 +540,32 @@ def monitor_video_generation_progress(prompt_id: str, job_id: str, webhook_url:
                 "progress": progress,
                 "message": message,
                 "stage": current_stage,
-                "estimatedTimeRemaining": max_wait_time
+                "estimatedTimeRemaining": int(tracker.estimated_remaining(0))
             })
         
         while time.time() - start_time < max_wait_time:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             try:
                 current_time = time.time()
                 elapsed_time = current_time - start_time
                 
                 # Check ComfyUI queue and progress
                 try:
-                    queue_response = requests.get("http://127.0.0.1:8188/queue", timeout=10)
-                    if queue_response.status_code == 200:
-                        queue_data = queue_response.json()
+                    queue_data = None
+                    if watcher.live:
+                        # The event stream stands in for /queue (exact queue position isn't tracked)
+                        queue_data = {
+                            'queue_running': [[0, prompt_id]] if watcher.status == 'running' else [],
+                            'queue_pending': [[0, prompt_id]] if watcher.status == 'pending' else []
+                        }
+                    else:
+                        queue_response = comfyui.get("/queue", timeout=10)
+                        if queue_response.status_code == 200:
+                            queue_data = queue_response.json()
+                    
+                    if queue_data is not None:
                         
                         running_jobs = queue_data.get('queue_running', [])
                         pending_jobs = queue_data.get('queue_pending', [])
@@ -619,25 +581,16 @@ def monitor_video_generation_progress(prompt_id: str, job_id: str, webhook_url:
                             current_stage = 'starting'
                             
                         elif job_in_running:
-                            # Job is actively running - use time-based progress for video
-                            elapsed_minutes = elapsed_time / 60
-                            if elapsed_minutes < 1:
-                                current_stage = 'loading_models'
-                                progress = 20
-                            elif elapsed_minutes < 2:
-                                current_stage = 'processing_image'
-                                progress = 30
-                            elif elapsed_minutes < 7:
-                                current_stage = 'generating_frames'
-                                progress = min(70, 30 + (elapsed_minutes - 2) * 8)
-                            else:
-                                current_stage = 'encoding_video'
-                                progress = min(85, 70 + (elapsed_minutes - 7) * 3)
-                            
+                            # Job is actively running - progress through the workflow's passes
+                            tracker.update(watcher, elapsed_time)
+                            current_stage = tracker_stages.get(tracker.stage, 'generating_frames')
+                            progress = max(progress, tracker.percent(10, 95))
                             message = progress_stages[current_stage]['message']
+                            if current_stage == 'generating_frames' and tracker.step_label():
+                                message = f"{message} ({tracker.step_label()})"
                         else:
                             # Job not in queue, check for completion
-                            history_response = requests.get("http://127.0.0.1:8188/history", timeout=10)
+                            history_response = comfyui.get("/history", timeout=10)
                             if history_response.status_code == 200:
                                 history_data = history_response.json()
                                 
@@ -859,10 +812,13 @@ def monitor_video_generation_progress(prompt_id: str, job_id: str, webhook_url:
                                                     "totalTime": int(elapsed_time)
                                                 })
                                             
+                                            node_profile = finish_node_profile(watcher, workflow, 'image_to_video')
+                                            timings.record()
                                             return {
                                                 'success': True,
                                                 'status': 'completed',
-                                                'videos': webhook_videos  # Return S3 metadata instead of blob data
+                                                'videos': webhook_videos,  # Return S3 metadata instead of blob data
+                                                'node_profile': node_profile
                                             }
                                             
                                         elif isinstance(status, dict) and status.get('status_str') == 'error':
@@ -887,15 +843,15 @@ def monitor_video_generation_progress(prompt_id: str, job_id: str, webhook_url:
                             
                 except Exception as queue_error:
                     logger.warning(f"⚠️ Error checking video queue status: {queue_error}")
-                    # Continue with basic time-based progress
-                    elapsed_minutes = elapsed_time / 60
-                    progress = min(85, 15 + elapsed_minutes * 10)
+                    # Continue with time-based progress against the workflow's expected duration
+                    tracker.update(None, elapsed_time)
+                    progress = max(progress, tracker.percent(10, 95))
                     message = '🎬 Generating video...'
                     current_stage = 'generating_frames'
                 
                 # Send progress webhook updates (every 5 seconds)
                 if webhook_url and (current_time - last_webhook_time) >= 5:
-                    estimated_remaining = max(0, max_wait_time - elapsed_time)
+                    estimated_remaining = tracker.estimated_remaining(elapsed_time)
                     
                     send_webhook(webhook_url, {
                         "job_id": job_id,
@@ -908,7 +864,7 @@ def monitor_video_generation_progress(prompt_id: str, job_id: str, webhook_url:
                     })
                     last_webhook_time = current_time
                 
-                time.sleep(3)  # Check every 3 seconds for video generation
+                watcher.sleep(3)  # Check every 3 seconds, waking as soon as the prompt finishes
                 
             except Exception as e:
                 logger.warning(f"⚠️ Error checking video progress: {e}")
@@ -966,7 +922,7 @@ def run_image_to_video_generation(job_input, job_id, webhook_url):
         
         # Download the image with unique name to avoid caching
         params = job_input.get('params', {})
-        uploaded_image = params.get('uploadedImage')
+        uploaded_image = params.get('uploadedImage') or params.get('image')
         final_image_filename = uploaded_image  # Default to original filename
         
         if uploaded_image:
@@ -992,7 +948,8 @@ def run_image_to_video_generation(job_input, job_id, webhook_url):
             logger.info(f"🎯 Using unique filename: {final_image_filename}")
         
         # Get and update workflow with the correct uploaded image filename
-        workflow = job_input.get('workflow', {})
+        # (raw workflow, or the image_to_video template rendered with the job's params)
+        workflow = resolve_workflow(job_input, 'image_to_video') or {}
         
         # Debug workflow and uploaded image info
         logger.info(f"🔍 DEBUG: final_image_filename = {final_image_filename}")
@@ -1041,8 +998,9 @@ def run_image_to_video_generation(job_input, job_id, webhook_url):
         else:
             logger.warning("⚠️ Node 131 (SaveVideo) not found in workflow!")
         
-        if not validate_video_workflow(workflow):
-            error_msg = "Invalid workflow for image-to-video generation"
+        validation_errors = workflow_errors(workflow, 'image_to_video')
+        if validation_errors:
+            error_msg = f"Invalid workflow for image-to-video generation: {'; '.join(validation_errors[:5])}"
             send_webhook(webhook_url, {
                 "job_id": job_id,
                 "status": "FAILED",
@@ -1060,7 +1018,7 @@ def run_image_to_video_generation(job_input, job_id, webhook_url):
             "message": "Preparing ComfyUI environment..."
         })
         
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             error_msg = "Failed to prepare ComfyUI environment"
             send_webhook(webhook_url, {
                 "job_id": job_id,
@@ -1175,7 +1133,7 @@ def handler(job):
     job_input = job['input']
     
     # Generate job ID
-    job_id = job_input.get('job_id', f"video_{int(time.time())}")
+    job_id = job_input.get('job_id') or job.get('id') or f"video_{int(time.time() * 1000)}"
     
     # Get webhook URL
     webhook_url = job_input.get('webhook_url')
@@ -1183,7 +1141,9 @@ def handler(job):
     logger.info(f"🎬 Starting RunPod Image-to-Video handler for job: {job_id}")
     
     try:
-        result = run_image_to_video_generation(job_input, job_id, webhook_url)
+        # Interrupt ComfyUI and return right away if the job is cancelled
+        with watch_job_cancellation(job, job_id):
+            result = run_image_to_video_generation(job_input, job_id, webhook_url)
         
         # Return result
         return {
@@ -1191,6 +1151,8 @@ def handler(job):
             'job_id': job_id,
             'status': result.get('status', 'unknown'),
             'videos': result.get('videos', []),
+            'node_profile': result.get('node_profile'),
+            'model_residency': residency_report(job_id),
             'error': result.get('error'),
             'message': result.get('message', 'Video generation completed')
         }
@@ -1218,4 +1180,6 @@ def handler(job):
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎬 Starting RunPod Image-to-Video handler...")
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, lambda: warm_up_models('image_to_video'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
\ No newline at end of file
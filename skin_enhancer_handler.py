@@ -18,20 +18,41 @@ import os
 import sys
 import time
 import uuid
-import subprocess
-import threading
 import logging
 import runpod
 import requests
 import boto3
 from pathlib import Path
 from typing import Dict, List, Any, Optional
+
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.finalize import OutputFinalizer, latent_batch_size
+from comfyui_worker.previews import PreviewForwarder, live_preview_mode, preview_launch_args
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.graph import WorkflowGraph
+from comfyui_worker.lora_affinity import lora_affinity_report, queue_with_lora_affinity
 from botocore.exceptions import ClientError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # AWS S3 Configuration for direct storage (bandwidth optimization)
 AWS_REGION = os.environ.get('AWS_REGION') or os.environ.get('S3_REGION') or 'us-east-1'
 AWS_S3_BUCKET = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET') or 'tastycreative'
@@ -150,8 +171,6 @@ def upload_image_to_aws_s3(image_data: bytes, user_id: str, filename: str, subfo
 def get_image_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> bytes:
     """Download image from ComfyUI and return raw bytes"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
-        
         # Construct the image URL
         params = {
             'filename': filename,
@@ -159,7 +178,7 @@ def get_image_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: s
             'type': type_dir
         }
         
-        response = requests.get(f"{comfyui_url}/view", params=params, timeout=30)
+        response = comfyui.get("/view", params=params, timeout=30)
         
         if response.status_code == 200:
             logger.info(f"✅ Downloaded image bytes from ComfyUI: {filename}")
@@ -177,6 +196,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=120)
         response.raise_for_status()
@@ -186,79 +208,43 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
         logger.error(f"❌ Webhook failed: {e}")
         return False
 
-def validate_skin_enhancement_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure for skin enhancement (simplified)"""
-    try:
-        if not isinstance(workflow, dict):
-            logger.error("❌ Workflow must be a dictionary")
-            return False
-        
-        # Check for required nodes for simplified skin enhancement
-        required_nodes = ["8", "31", "39", "41", "114", "104", "115", "115_2"]  # Removed complex mask nodes
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"❌ Missing required node: {node_id}")
-                return False
-        
-        # Validate node structure and clean up problematic LoRA configurations
-        for node_id, node in workflow.items():
-            if not isinstance(node, dict):
-                logger.error(f"❌ Node {node_id} must be a dictionary")
-                return False
-                
-            if "class_type" not in node:
-                logger.error(f"❌ Node {node_id} missing class_type")
-                return False
-            
-            # Optimize LoRA loading to prevent shape errors
-            if node.get('class_type') == 'LoraLoader':
-                inputs = node.get('inputs', {})
-                lora_name = inputs.get('lora_name', '')
-                
-                # Ensure strength is reasonable to prevent model conflicts
-                if 'strength_model' in inputs:
-                    strength = inputs['strength_model']
-                    if strength > 1.0:
-                        inputs['strength_model'] = min(strength, 1.0)
-                        logger.info(f"🔧 Capped LoRA strength for {lora_name}: {strength} -> {inputs['strength_model']}")
-        
-        logger.info("✅ Simplified skin enhancement workflow validation passed")
-        return True
-    
-    except Exception as e:
-        logger.error(f"❌ Workflow validation error: {e}")
-        return False
+def cap_lora_strengths(graph: WorkflowGraph) -> WorkflowGraph:
+    """Cap LoraLoader model strength at 1.0 to prevent shape errors from model conflicts"""
+    for node in graph.by_class('LoraLoader'):
+        strength = node.inputs.get('strength_model')
+        if isinstance(strength, (int, float)) and strength > 1.0:
+            graph.set_input(node.id, 'strength_model', 1.0)
+            logger.info(f"🔧 Capped LoRA strength for {node.inputs.get('lora_name', '')}: {strength} -> 1.0")
+    return graph
 
-def fix_lora_paths(workflow):
+def fix_lora_paths(graph: WorkflowGraph) -> WorkflowGraph:
     """Fix LoRA paths to match ComfyUI's expected format"""
     try:
-        for node_id, node in workflow.items():
-            # Check for both LoraLoader and LoraLoaderModelOnly
-            if isinstance(node, dict) and node.get('class_type') in ['LoraLoader', 'LoraLoaderModelOnly']:
-                lora_name = node['inputs'].get('lora_name', '')
-                
-                # If LoRA name starts with user_ and doesn't contain /, add the subdirectory
-                if lora_name.startswith('user_') and '/' not in lora_name and lora_name != 'real-humans-PublicPrompts.safetensors' and lora_name != 'more_details.safetensors':
-                    # Extract user directory from filename
-                    parts = lora_name.split('_')
-                    if len(parts) >= 3:
-                        user_dir = f"{parts[0]}_{parts[1]}"
-                        fixed_path = f"{user_dir}/{lora_name}"
-                        logger.info(f"🔧 Fixing LoRA path for {node.get('class_type')}: {lora_name} -> {fixed_path}")
-                        node['inputs']['lora_name'] = fixed_path
-        
-        return workflow
+        # Check for both LoraLoader and LoraLoaderModelOnly
+        for node in graph.by_class('LoraLoader') + graph.by_class('LoraLoaderModelOnly'):
+            lora_name = node.inputs.get('lora_name', '')
+            
+            # If LoRA name starts with user_ and doesn't contain /, add the subdirectory
+            if lora_name.startswith('user_') and '/' not in lora_name and lora_name != 'real-humans-PublicPrompts.safetensors' and lora_name != 'more_details.safetensors':
+                # Extract user directory from filename
+                parts = lora_name.split('_')
+                if len(parts) >= 3:
+                    user_dir = f"{parts[0]}_{parts[1]}"
+                    fixed_path = f"{user_dir}/{lora_name}"
+                    logger.info(f"🔧 Fixing LoRA path for {node.class_type}: {lora_name} -> {fixed_path}")
+                    graph.set_input(node.id, 'lora_name', fixed_path)
+        
+        return graph
     except Exception as e:
         logger.error(f"❌ Error fixing LoRA paths: {e}")
-        return workflow
+        return graph
 
 def queue_skin_enhancement_workflow(workflow, job_id):
     """Queue skin enhancement workflow with ComfyUI"""
     try:
         # Fix LoRA paths before sending workflow
-        workflow = fix_lora_paths(workflow)
+        workflow = fix_lora_paths(WorkflowGraph(workflow)).to_workflow()
         
-        queue_url = "http://localhost:8188/prompt"
         
         # Debug: Log LoRA usage in workflow
         lora_nodes_found = 0
@@ -274,18 +260,30 @@ def queue_skin_enhancement_workflow(workflow, job_id):
         logger.info(f"📊 Total enhancement LoRA nodes found: {lora_nodes_found}")
         logger.info(f"🎭 Enhancement LoRAs: {enhancement_loras}")
         
-        # Prepare payload with unique client_id to prevent caching
-        unique_client_id = f"runpod-skin-enhancer-{job_id}-{int(time.time())}-{os.urandom(4).hex()}"
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'skin_enhancement')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return None
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Queue under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
         payload = {
             "prompt": workflow,
-            "client_id": unique_client_id
+            "client_id": client_id
         }
         
-        logger.info(f"📡 Sending skin enhancement to ComfyUI: {queue_url}")
+        logger.info(f"📡 Sending skin enhancement to ComfyUI: {comfyui.url('/prompt')}")
         
         # Send request to ComfyUI
-        response = requests.post(
-            queue_url,
+        response = comfyui.post(
+            "/prompt",
             json=payload,
             timeout=30,
             headers={'Content-Type': 'application/json'}
@@ -302,6 +300,10 @@ def queue_skin_enhancement_workflow(workflow, job_id):
             logger.error(f"❌ No prompt_id in ComfyUI response: {result}")
             return None
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('skin_enhancement', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Skin enhancement workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
     
@@ -312,7 +314,7 @@ def queue_skin_enhancement_workflow(workflow, job_id):
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://localhost:8188/system_stats", timeout=5)
+        response = comfyui.get("/system_stats", timeout=5)
         if response.status_code == 200:
             logger.info("✅ ComfyUI is already running")
             return True
@@ -591,6 +593,7 @@ def start_comfyui():
             "--use-split-cross-attention",  # Memory optimization
             "--disable-metadata"  # Skip metadata processing for faster startup
         ]
+        cmd.extend(preview_launch_args())  # Sampler preview frames for jobs that ask for live previews
         
         # Set environment variables to speed up startup
         env = os.environ.copy()
@@ -606,87 +609,23 @@ def start_comfyui():
         else:
             print(f"🔧 Starting ComfyUI with cold start optimizations: {' '.join(cmd)}")
         
-        def log_output(process, stream_name):
-            """Log ComfyUI output"""
-            for line in iter(process.stdout.readline, b''):
-                try:
-                    line_str = line.decode('utf-8').strip()
-                    if line_str:
-                        print(f"ComfyUI [{stream_name}]: {line_str}")
-                except:
-                    pass
-        
-        # Start ComfyUI as background process from the ComfyUI directory
-        process = subprocess.Popen(cmd, 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.STDOUT,
-                                 cwd=comfyui_dir,
-                                 bufsize=1,
-                                 universal_newlines=False,
-                                 env=env)
-        
-        # Start logging thread
-        log_thread = threading.Thread(target=log_output, args=(process, "stdout"))
-        log_thread.daemon = True
-        log_thread.start()
-        
-        # Wait for ComfyUI to start up
-        print("⏳ Waiting for ComfyUI to start...")
-        max_wait = 60  # 1 minute - aggressive cold start optimization 
-        for i in range(max_wait):
-            if i % 3 == 0:  # More frequent status updates for faster feedback
-                print(f"⏳ Still waiting for ComfyUI... ({i}/{max_wait}s)")
-            
-            if process.poll() is not None:
-                print(f"❌ ComfyUI process died with return code: {process.returncode}")
-                return False
-            
-            if is_comfyui_running():
-                print(f"✅ ComfyUI started successfully after {i} seconds")
-                
-                # Skip model preloading for faster cold start
-                print("⚡ Skipping model preloading for faster cold start")
-                print("📝 Models will load on-demand during first generation")
-                
-                return True
-                
-            time.sleep(1)
-        
-        print(f"❌ ComfyUI failed to start within {max_wait} seconds")
-        return False
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_dir, env=env, timeout=60)
         
     except Exception as e:
         print(f"❌ Error starting ComfyUI: {str(e)}")
         return False
 
 def preload_essential_models():
-    """Skip preloading to reduce cold start time - models will load during actual generation"""
-    try:
-        print("⚡ Skipping model preloading for faster cold start")
-        print("📝 Models will load on-demand during first generation")
-        # Models will be loaded lazily during the actual workflow execution
-        # This reduces cold start time from 6+ minutes to ~30 seconds
-        return True
-            
-    except Exception as e:
-        print(f"⚠️ Preload check failed: {e}, but ComfyUI is ready")
-        return True
-        
-    except Exception as e:
-        print(f"❌ Error starting ComfyUI: {str(e)}")
-        return False
+    """Load the production models with a tiny warm-up graph so the first job doesn't pay for them"""
+    return warm_up_models('skin_enhancement')
 
 def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
     """Queue workflow with ComfyUI and return prompt ID"""
     try:
         logger.info(f"🎨 Queueing skin enhancement workflow with ComfyUI for job {job_id}")
         
-        # Fix LoRA paths before sending workflow
-        workflow = fix_lora_paths(workflow)
-        
-        # ComfyUI API endpoint
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        queue_url = f"{comfyui_url}/prompt"
         
         # Debug: Show the workflow being sent
         logger.info("🔍 === SKIN ENHANCEMENT WORKFLOW DEBUG ===")
@@ -712,18 +651,30 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
         logger.info(f"📊 Total LoRA nodes found: {lora_nodes_found}")
         logger.info(f"🎭 Enhancement LoRAs: {enhancement_loras}")
         
-        # Prepare payload with unique client_id to prevent caching
-        unique_client_id = f"runpod-skin-enhancer-{job_id}-{int(time.time())}-{os.urandom(4).hex()}"
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'skin_enhancement')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return None
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Queue under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
         payload = {
             "prompt": workflow,
-            "client_id": unique_client_id
+            "client_id": client_id
         }
         
-        logger.info(f"📡 Sending skin enhancement to ComfyUI: {queue_url}")
+        logger.info(f"📡 Sending skin enhancement to ComfyUI: {comfyui.url('/prompt')}")
         
         # Send request to ComfyUI
-        response = requests.post(
-            queue_url,
+        response = comfyui.post(
+            "/prompt",
             json=payload,
             timeout=30,
             headers={'Content-Type': 'application/json'}
@@ -740,6 +691,10 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
             logger.error(f"❌ No prompt_id in ComfyUI response: {result}")
             return None
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('skin_enhancement', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Skin enhancement workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
     
@@ -750,8 +705,6 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
 def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> str:
     """Download image from ComfyUI and return as base64 encoded string"""
     try:
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        
         # Construct the image URL
         params = {
             'filename': filename,
@@ -760,7 +713,7 @@ def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = '
         if subfolder:
             params['subfolder'] = subfolder
             
-        response = requests.get(f"{comfyui_url}/view", params=params, timeout=30)
+        response = comfyui.get("/view", params=params, timeout=30)
         
         if response.status_code == 200:
             import base64
@@ -773,10 +726,10 @@ def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = '
         logger.error(f"Error downloading image {filename}: {e}")
         return None
 
-def get_comfyui_queue_status(comfyui_url: str):
+def get_comfyui_queue_status():
     """Get current queue status from ComfyUI"""
     try:
-        response = requests.get(f"{comfyui_url}/queue", timeout=5)
+        response = comfyui.get("/queue", timeout=5)
         if response.status_code == 200:
             queue_data = response.json()
             return queue_data
@@ -784,22 +737,10 @@ def get_comfyui_queue_status(comfyui_url: str):
         pass
     return None
 
-def get_comfyui_progress_status(comfyui_url: str) -> Optional[Dict]:
-    """Get ComfyUI internal progress status for more accurate tracking"""
-    try:
-        response = requests.get(f"{comfyui_url}/progress", timeout=5)
-        if response.status_code == 200:
-            progress_data = response.json()
-            # ComfyUI progress format: {'max': total_steps, 'value': current_step, 'node': current_node}
-            return progress_data
-    except:
-        pass
-    return None
-
-def get_comfyui_history_status(comfyui_url: str, prompt_id: str) -> Optional[Dict]:
+def get_comfyui_history_status(prompt_id: str) -> Optional[Dict]:
     """Get specific prompt execution history from ComfyUI"""
     try:
-        response = requests.get(f"{comfyui_url}/history/{prompt_id}", timeout=5)
+        response = comfyui.get(f"/history/{prompt_id}", timeout=5)
         if response.status_code == 200:
             history_data = response.json()
             if prompt_id in history_data:
@@ -808,11 +749,127 @@ def get_comfyui_history_status(comfyui_url: str, prompt_id: str) -> Optional[Dic
         pass
     return None
 
-def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url: str, user_id: str = 'unknown', workflow: Dict = None) -> Dict:
+def finalize_enhanced_image(img_info: Dict, image_index: int, expected_images: int, job_id: str, webhook_url: str, user_id: str = 'unknown', workflow: Dict = None, start_time: float = None) -> Optional[Dict]:
+    """Download one enhanced image, upload it to AWS S3 and announce it via an IMAGE_READY webhook"""
+    filename = img_info['filename']
+    subfolder = img_info.get('subfolder', '')
+    total_images = max(expected_images, image_index)
+    
+    logger.info(f"📸 Processing enhanced image: {filename}")
+    
+    # Download raw image bytes from ComfyUI
+    image_data_bytes = get_image_bytes_from_comfyui(filename, subfolder)
+    
+    if not image_data_bytes:
+        logger.error(f"❌ Failed to download enhanced image: {filename}")
+        return None
+    
+    # Create unique filename with timestamp and job_id
+    timestamp = int(time.time() * 1000)
+    base_name = os.path.splitext(filename)[0]
+    extension = os.path.splitext(filename)[1]
+    unique_filename = f"{base_name}_{timestamp}_{job_id.split('_')[-1]}{extension}"
+    
+    # Extract folder info from the workflow's filename_prefix
+    # The prefix might be like "outputs/user_123/nov-5/subfolder/SkinEnhancer" for subfolders
+    # or just "nov-5/SkinEnhancer" for regular folders
+    is_full_prefix = False
+    folder_prefix = subfolder
+    
+    if workflow:
+        # Check SaveImage node (114) for filename_prefix
+        save_image_node = workflow.get('114', {})
+        if save_image_node.get('class_type') == 'SaveImage':
+            filename_prefix = save_image_node.get('inputs', {}).get('filename_prefix', '')
+            
+            # Check if this is a full S3 prefix path (starts with "outputs/")
+            if filename_prefix.startswith('outputs/'):
+                is_full_prefix = True
+                # Remove the file prefix portion and keep the full folder hierarchy
+                sanitized_prefix = filename_prefix.rstrip('/')
+                prefix_parts = sanitized_prefix.split('/')
+                if len(prefix_parts) >= 3:
+                    # Drop the last segment (the generated filename prefix) and keep the rest
+                    folder_prefix = '/'.join(prefix_parts[:-1]) + '/'
+                    logger.info(f"📂 Using full folder prefix with subfolders: {folder_prefix}")
+            else:
+                logger.info(f"📁 Using user's own folder: {filename_prefix}")
+    
+    # Upload to AWS S3 if user_id is provided
+    aws_s3_result = {}
+    aws_s3_path = None
+    if user_id and user_id != 'unknown':
+        aws_s3_result = upload_image_to_aws_s3(
+            image_data_bytes, 
+            user_id, 
+            unique_filename,
+            folder_prefix,
+            is_full_prefix=is_full_prefix
+        )
+        if aws_s3_result.get('success'):
+            aws_s3_path = {
+                'filename': unique_filename,
+                'subfolder': subfolder,
+                'type': img_info.get('type', 'output'),
+                'awsS3Key': aws_s3_result.get('awsS3Key'),
+                'awsS3Url': aws_s3_result.get('awsS3Url'),
+                'file_size': aws_s3_result.get('fileSize', len(image_data_bytes))
+            }
+            logger.info(f"✅ Enhanced image saved to AWS S3: {aws_s3_result.get('awsS3Url')}")
+    
+    # Store AWS S3 data for the database
+    image_data = {
+        'filename': unique_filename,
+        'subfolder': subfolder,
+        'type': img_info.get('type', 'output'),
+        'awsS3Key': aws_s3_result.get('awsS3Key') if user_id != 'unknown' else None,
+        'awsS3Url': aws_s3_result.get('awsS3Url') if user_id != 'unknown' else None,
+        'fileSize': aws_s3_result.get('fileSize', len(image_data_bytes))
+    }
+    logger.info(f"✅ Enhanced image processed: {unique_filename}")
+    
+    # Send IMAGE_READY webhook for individual enhanced skin image (chunked upload to avoid 413 errors)
+    if webhook_url and total_images > 1:
+        try:
+            chunk_progress = 95 + (image_index / total_images) * 5  # 95-100% for image processing
+            logger.info(f"📤 Sending chunked enhanced skin image {image_index}/{total_images} via webhook")
+            send_webhook(webhook_url, {
+                "job_id": job_id,
+                "status": "IMAGE_READY",
+                "progress": chunk_progress,
+                "message": f"🎨 Enhanced skin image {image_index} of {total_images} ready",
+                "stage": "uploading_images",
+                "elapsedTime": int(time.time() - start_time) if start_time else 0,
+                "imageCount": image_index,
+                "totalImages": total_images,
+                "image": image_data  # Single image for chunked upload (S3 path only)
+            })
+        except Exception as e:
+            logger.error(f"❌ Failed to send chunked enhanced skin image {image_index}: {e}")
+    
+    return {'image': image_data, 'aws_s3_path': aws_s3_path}
+
+def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url: str, user_id: str = 'unknown', workflow: Dict = None, live_preview: Optional[str] = None) -> Dict:
     """Monitor ComfyUI progress for skin enhancement with real-time updates and ComfyUI integration"""
     try:
         logger.info(f"👀 Starting enhanced real-time progress monitoring for prompt {prompt_id}")
         
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        
+        # Progress weighted by the workflow's sampler steps and decode/upscale passes
+        tracker = WorkflowProgress(workflow)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        stage_messages = {
+            'loading_models': ("🧠 Loading AI models and LoRAs...", "🔧"),
+            'processing_prompt': ("📝 Encoding prompt...", "🔧"),
+            'sampling': ("✨ Generating and enhancing skin details...", "🎨"),
+            'upscaling': ("🎯 Upscaling enhanced image...", "🔥"),
+            'decoding': ("🎯 Decoding enhanced image...", "🔥"),
+            'saving': ("📸 Finalizing enhanced images...", "✨"),
+            'processing': ("💫 Enhancing skin details and texture...", "💎")
+        }
+        
         # Send initial monitoring webhook with enhanced data
         send_webhook(webhook_url, {
             'job_id': job_id,
@@ -822,20 +879,55 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
             'stage': 'starting',
             'workflow_type': 'skin_enhancement',
             'estimated_time': '3-5 minutes',
-            'steps_total': 65  # 40 FLUX steps + 25 enhancement steps
+            'steps_total': tracker.total_steps,  # all sampler passes in the submitted workflow
+            'estimated_remaining': tracker.estimated_remaining(0)
         })
         
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        history_url = f"{comfyui_url}/history/{prompt_id}"
+        history_url = f"/history/{prompt_id}"
         
         max_attempts = 900  # 15 minutes for complex skin enhancement
         attempt = 0
         last_progress_update = 5
         
+        # Upload and announce each enhanced image as soon as its SaveImage node executes
+        monitor_start = time.time()
+        expected_images = latent_batch_size(workflow)
+        finalizer = OutputFinalizer(
+            lambda node_id, img_info, index: finalize_enhanced_image(
+                img_info, index, expected_images, job_id, webhook_url, user_id, workflow, monitor_start
+            ),
+            accept=lambda node_id, img_info: 'flux_initial' not in img_info['filename']
+        ).attach(watcher)
+        
+        # Opt-in low-res sampler previews, at most one every couple of seconds
+        preview_forwarder = None
+        if live_preview and webhook_url:
+            preview_forwarder = PreviewForwarder(
+                lambda preview: send_webhook(webhook_url, {
+                    'job_id': job_id,
+                    'status': 'PROCESSING',
+                    'stage': 'generating',
+                    'workflow_type': 'skin_enhancement',
+                    'preview': preview
+                }),
+                s3_client=get_aws_s3_client() if live_preview == 's3' else None,
+                s3_bucket=AWS_S3_BUCKET,
+                s3_prefix=f"previews/{job_id}"
+            ).attach(watcher)
+        
         while attempt < max_attempts:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             try:
                 # Get queue status for better progress tracking
-                queue_status = get_comfyui_queue_status(comfyui_url)
+                if watcher.live:
+                    queue_status = {
+                        'queue_running': [[0, prompt_id]] if watcher.status == 'running' else [],
+                        'queue_pending': [[0, prompt_id]] if watcher.status == 'pending' else []
+                    }
+                else:
+                    queue_status = get_comfyui_queue_status()
                 if queue_status:
                     running = queue_status.get('queue_running', [])
                     pending = queue_status.get('queue_pending', [])
@@ -844,57 +936,12 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                         # Job is currently running - get accurate ComfyUI progress
                         elapsed_time = attempt * 1  # 1 second per attempt
                         
-                        # Try to get accurate progress from ComfyUI progress API
-                        progress_status = get_comfyui_progress_status(comfyui_url)
-                        
-                        if progress_status and progress_status.get('max', 0) > 0:
-                            # Use actual ComfyUI progress when available
-                            current_step = progress_status.get('value', 0)
-                            total_steps = progress_status.get('max', 1)
-                            current_node = progress_status.get('node', 'unknown')
-                            
-                            # Calculate accurate progress percentage
-                            step_progress = (current_step / total_steps) * 100
-                            
-                            # Map to our workflow stages for better UX
-                            if step_progress < 20:
-                                current_progress = 15 + step_progress  # 15% to 35%
-                                stage_message = f"🧠 Loading AI models... ({current_step}/{total_steps} steps)"
-                                stage_emoji = "🔧"
-                            elif step_progress < 65:  # FLUX generation (40 steps)
-                                current_progress = 35 + (step_progress - 20) * 0.6  # 35% to 62%
-                                stage_message = f"✨ FLUX AI generation... ({current_step}/{total_steps} steps)"
-                                stage_emoji = "🎨"
-                            else:  # Enhancement phase (25 steps)
-                                current_progress = 62 + (step_progress - 65) * 0.8  # 62% to 90%
-                                stage_message = f"💫 Enhancing skin details... ({current_step}/{total_steps} steps)"
-                                stage_emoji = "💎"
-                        else:
-                            # Fallback to time-based progress estimation
-                            if elapsed_time < 15:
-                                current_progress = 15 + (elapsed_time / 15) * 10  # 15% to 25% - Loading models
-                                stage_message = "🧠 Loading AI models and LoRAs..."
-                                stage_emoji = "🔧"
-                            elif elapsed_time < 45:
-                                # FLUX generation stage (40 steps, ~30 seconds)
-                                flux_progress = (elapsed_time - 15) / 30  # 0 to 1
-                                current_progress = 25 + flux_progress * 35  # 25% to 60% - FLUX generation
-                                stage_message = f"✨ Generating initial image with FLUX AI... ({int(flux_progress * 40)}/40 steps)"
-                                stage_emoji = "🎨"
-                            elif elapsed_time < 75:
-                                # Skin enhancement stage (25 steps, ~30 seconds)
-                                enhance_progress = (elapsed_time - 45) / 30  # 0 to 1
-                                current_progress = 60 + enhance_progress * 25  # 60% to 85% - Enhancement
-                                stage_message = f"💫 Enhancing skin details and texture... ({int(enhance_progress * 25)}/25 steps)"
-                                stage_emoji = "💎"
-                            elif elapsed_time < 90:
-                                current_progress = 85 + ((elapsed_time - 75) / 15) * 10  # 85% to 95% - Processing
-                                stage_message = "🎯 Applying final enhancements and optimizations..."
-                                stage_emoji = "🔥"
-                            else:
-                                current_progress = min(95, 95 + (elapsed_time - 90) / 30 * 3)  # 95% to 98% - Finalizing
-                                stage_message = "📸 Finalizing enhanced images..."
-                                stage_emoji = "✨"
+                        # Global progress across every sampler/decode pass of the workflow
+                        tracker.update(watcher, elapsed_time)
+                        current_progress = tracker.percent(15, 95)
+                        stage_message, stage_emoji = stage_messages.get(tracker.stage, stage_messages['processing'])
+                        if tracker.step_label():
+                            stage_message = f"{stage_message} ({tracker.step_label()})"
                         
                         # Send enhanced progress updates every 2% or stage change
                         if current_progress - last_progress_update >= 2:
@@ -908,7 +955,7 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                                 'elapsed_time': elapsed_time,
                                 'stage': 'processing',
                                 'workflow_stage': stage_emoji,
-                                'estimated_remaining': max(0, 300 - elapsed_time)  # 5 min estimate
+                                'estimated_remaining': tracker.estimated_remaining(elapsed_time)
                             })
                             last_progress_update = current_progress
                             logger.info(f"📊 Enhanced progress: {int(current_progress)}% - {stage_message}")
@@ -942,10 +989,12 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                             'stage': 'queued'
                         })
                 
-                # Check if generation is complete
-                response = requests.get(history_url, timeout=10)
+                # Check if generation is complete (only once the event stream reports completion, unless polling)
+                response = None
+                if watcher.finished or not watcher.live:
+                    response = comfyui.get(history_url, timeout=10)
                 
-                if response.status_code == 200:
+                if response is not None and response.status_code == 200:
                     history = response.json()
                     
                     if prompt_id in history:
@@ -966,95 +1015,13 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                                     'stage': 'processing_images'
                                 })
                             
-                            # Process all generated images with AWS S3 storage
-                            result_images = []
-                            aws_s3_paths = []
-                            
-                            # Get user_id from function parameter (passed from run_skin_enhancement_generation)
-                            # user_id already available as function parameter
-                            
-                            for node_id, node_output in outputs.items():
-                                if 'images' in node_output:
-                                    for img_info in node_output['images']:
-                                        filename = img_info['filename']
-                                        subfolder = img_info.get('subfolder', '')
-                                        
-                                        # Only process the final enhanced skin image, skip intermediate flux_initial
-                                        if 'flux_initial' in filename:
-                                            logger.info(f"⏭️ Skipping intermediate image: {filename}")
-                                            continue
-                                        
-                                        logger.info(f"📸 Processing enhanced image: {filename}")
-                                        
-                                        # Download raw image bytes from ComfyUI
-                                        image_data_bytes = get_image_bytes_from_comfyui(filename, subfolder)
-                                        
-                                        if image_data_bytes:
-                                            # Create unique filename with timestamp and job_id
-                                            timestamp = int(time.time() * 1000)
-                                            base_name = os.path.splitext(filename)[0]
-                                            extension = os.path.splitext(filename)[1]
-                                            unique_filename = f"{base_name}_{timestamp}_{job_id.split('_')[-1]}{extension}"
-                                            
-                                            # Extract folder info from the workflow's filename_prefix
-                                            # The prefix might be like "outputs/user_123/nov-5/subfolder/SkinEnhancer" for subfolders
-                                            # or just "nov-5/SkinEnhancer" for regular folders
-                                            is_full_prefix = False
-                                            folder_prefix = subfolder
-                                            
-                                            if workflow:
-                                                # Check SaveImage node (114) for filename_prefix
-                                                save_image_node = workflow.get('114', {})
-                                                if save_image_node.get('class_type') == 'SaveImage':
-                                                    filename_prefix = save_image_node.get('inputs', {}).get('filename_prefix', '')
-                                                    
-                                                    # Check if this is a full S3 prefix path (starts with "outputs/")
-                                                    if filename_prefix.startswith('outputs/'):
-                                                        is_full_prefix = True
-                                                        # Remove the file prefix portion and keep the full folder hierarchy
-                                                        sanitized_prefix = filename_prefix.rstrip('/')
-                                                        prefix_parts = sanitized_prefix.split('/')
-                                                        if len(prefix_parts) >= 3:
-                                                            # Drop the last segment (the generated filename prefix) and keep the rest
-                                                            folder_prefix = '/'.join(prefix_parts[:-1]) + '/'
-                                                            logger.info(f"� Using full folder prefix with subfolders: {folder_prefix}")
-                                                    else:
-                                                        logger.info(f"📁 Using user's own folder: {filename_prefix}")
-                                            
-                                            # Upload to AWS S3 if user_id is provided
-                                            aws_s3_result = {}
-                                            if user_id and user_id != 'unknown':
-                                                aws_s3_result = upload_image_to_aws_s3(
-                                                    image_data_bytes, 
-                                                    user_id, 
-                                                    unique_filename,
-                                                    folder_prefix,
-                                                    is_full_prefix=is_full_prefix
-                                                )
-                                                if aws_s3_result.get('success'):
-                                                    aws_s3_paths.append({
-                                                        'filename': unique_filename,
-                                                        'subfolder': subfolder,
-                                                        'type': img_info.get('type', 'output'),
-                                                        'awsS3Key': aws_s3_result.get('awsS3Key'),
-                                                        'awsS3Url': aws_s3_result.get('awsS3Url'),
-                                                        'file_size': aws_s3_result.get('fileSize', len(image_data_bytes))
-                                                    })
-                                                    logger.info(f"✅ Enhanced image saved to AWS S3: {aws_s3_result.get('awsS3Url')}")
-                                            
-                                            # Store AWS S3 data for the database
-                                            image_data = {
-                                                'filename': unique_filename,
-                                                'subfolder': subfolder,
-                                                'type': img_info.get('type', 'output'),
-                                                'awsS3Key': aws_s3_result.get('awsS3Key') if user_id != 'unknown' else None,
-                                                'awsS3Url': aws_s3_result.get('awsS3Url') if user_id != 'unknown' else None,
-                                                'fileSize': aws_s3_result.get('fileSize', len(image_data_bytes))
-                                            }
-                                            result_images.append(image_data)
-                                            logger.info(f"✅ Enhanced image processed: {unique_filename}")
-                                        else:
-                                            logger.error(f"❌ Failed to download enhanced image: {filename}")
+                            # Collect results; images seen on the event stream are already uploaded and announced
+                            finalized = finalizer.collect(outputs)
+                            finalizer.close()
+                            if preview_forwarder:
+                                preview_forwarder.close()
+                            result_images = [item['image'] for item in finalized]
+                            aws_s3_paths = [item['aws_s3_path'] for item in finalized if item.get('aws_s3_path')]
                             
                             if result_images:
                                 logger.info(f"✅ Skin enhancement completed with {len(result_images)} images")
@@ -1064,32 +1031,6 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                                 total_images = len(result_images)
                                 
                                 if webhook_url:
-                                    # Send enhanced skin images one by one to avoid 413 payload size errors (chunked upload)
-                                    logger.info(f"📤 Sending {total_images} enhanced skin image{'s' if total_images > 1 else ''} via chunked webhooks")
-                                    
-                                    for image_count, img in enumerate(result_images, 1):
-                                        try:
-                                            logger.info(f"🎨 Processing enhanced skin image {image_count} of {total_images}: {img['filename']}")
-                                            
-                                            # Send IMAGE_READY webhook for individual enhanced skin image
-                                            if webhook_url and total_images > 1:
-                                                chunk_progress = 95 + (image_count / total_images) * 5  # 95-100% for image processing
-                                                logger.info(f"📤 Sending chunked enhanced skin image {image_count}/{total_images} via webhook")
-                                                send_webhook(webhook_url, {
-                                                    "job_id": job_id,
-                                                    "status": "IMAGE_READY",
-                                                    "progress": chunk_progress,
-                                                    "message": f"🎨 Enhanced skin image {image_count} of {total_images} ready",
-                                                    "stage": "uploading_images",
-                                                    "elapsedTime": elapsed_time,
-                                                    "imageCount": image_count,
-                                                    "totalImages": total_images,
-                                                    "image": img  # Single image for chunked upload (S3 path only)
-                                                })
-                                        
-                                        except Exception as e:
-                                            logger.error(f"❌ Failed to send chunked enhanced skin image {image_count}: {e}")
-                                    
                                     # Send final completion webhook with AWS S3 paths
                                     logger.info(f"📤 Sending completion webhook with {len(aws_s3_paths)} AWS S3 paths")
                                     
@@ -1125,12 +1066,15 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                                         "aws_s3_paths": aws_s3_paths,
                                     }
                                 
+                                node_profile = finish_node_profile(watcher, workflow, 'skin_enhancement')
+                                timings.record()
                                 return {
                                     'success': True,
                                     'status': 'completed',
                                     'images': result_images,
                                     'aws_s3_paths': aws_s3_paths,
-                                    'message': f'Successfully enhanced skin in {len(result_images)} images'
+                                    'message': f'Successfully enhanced skin in {len(result_images)} images',
+                                    'node_profile': node_profile
                                 }
                             else:
                                 logger.error("❌ No valid enhanced images found")
@@ -1149,7 +1093,7 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                                 }
                 
                 # Check for errors in ComfyUI execution
-                if response.status_code == 200 and prompt_id in history:
+                if response is not None and response.status_code == 200 and prompt_id in history:
                     result_data = history[prompt_id]
                     if 'status' in result_data and result_data['status'].get('status_str') == 'error':
                         error_details = result_data['status'].get('messages', [])
@@ -1179,7 +1123,7 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
                     })
                 
                 attempt += 1
-                time.sleep(1)
+                watcher.sleep(1)
                 
             except Exception as e:
                 logger.error(f"❌ Error checking progress: {e}")
@@ -1188,6 +1132,8 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
         
         # Timeout reached
         logger.error(f"❌ Skin enhancement timeout for prompt {prompt_id}")
+        if preview_forwarder:
+            preview_forwarder.close()
         if webhook_url:
             send_webhook(webhook_url, {
                 'job_id': job_id,
@@ -1218,7 +1164,7 @@ def monitor_skin_enhancement_progress(prompt_id: str, job_id: str, webhook_url:
             'error': str(e)
         }
 
-def optimize_workflow_for_portrait(workflow: Dict, params: Dict) -> Dict:
+def optimize_workflow_for_portrait(graph: WorkflowGraph, params: Dict) -> WorkflowGraph:
     """Optimize workflow for portrait mode and apply user parameters"""
     try:
         # Portrait dimensions (3:4 aspect ratio optimized for faces)
@@ -1238,20 +1184,17 @@ def optimize_workflow_for_portrait(workflow: Dict, params: Dict) -> Dict:
         logger.info(f"📐 Setting portrait dimensions: {dimensions['width']}x{dimensions['height']} ({size_mode})")
         
         # Update workflow nodes with portrait dimensions
-        for node_id, node in workflow.items():
-            if node.get('class_type') in ['FluxGuidance', 'EmptyLatentImage']:
-                if 'inputs' in node:
-                    if 'width' in node['inputs']:
-                        node['inputs']['width'] = dimensions['width']
-                    if 'height' in node['inputs']:
-                        node['inputs']['height'] = dimensions['height']
-                    logger.info(f"✅ Updated node {node_id} to {dimensions['width']}x{dimensions['height']}")
+        for node in graph.by_class('FluxGuidance') + graph.by_class('EmptyLatentImage'):
+            for key in ('width', 'height'):
+                if key in node.inputs:
+                    graph.set_input(node.id, key, dimensions[key])
+            logger.info(f"✅ Updated node {node.id} to {dimensions['width']}x{dimensions['height']}")
         
-        return workflow
+        return graph
         
     except Exception as e:
         logger.error(f"❌ Error optimizing workflow for portrait: {e}")
-        return workflow
+        return graph
 
 def run_skin_enhancement_generation(job_input, job_id, webhook_url):
     """Execute the actual skin enhancement generation process"""
@@ -1276,7 +1219,7 @@ def run_skin_enhancement_generation(job_input, job_id, webhook_url):
                 'message': 'Checking models in network volume storage...'
             })
         
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             error_msg = "Failed to prepare ComfyUI environment"
             if webhook_url:
                 send_webhook(webhook_url, {
@@ -1317,8 +1260,6 @@ def run_skin_enhancement_generation(job_input, job_id, webhook_url):
             'message': 'Optimizing for portrait mode...'
         })
         
-        workflow = optimize_workflow_for_portrait(workflow, params)
-        
         # Validate workflow
         send_webhook(webhook_url, {
             'job_id': job_id,
@@ -1327,8 +1268,16 @@ def run_skin_enhancement_generation(job_input, job_id, webhook_url):
             'message': 'Validating skin enhancement workflow...'
         })
         
-        if not validate_skin_enhancement_workflow(workflow):
-            raise ValueError("Invalid skin enhancement workflow")
+        validation_errors = workflow_errors(workflow, 'skin_enhancement')
+        if validation_errors:
+            raise ValueError(f"Invalid skin enhancement workflow: {'; '.join(validation_errors[:5])}")
+        
+        # Portrait size, LoRA strength caps and LoRA paths in one pass over the indexed graph
+        graph = WorkflowGraph(workflow)
+        optimize_workflow_for_portrait(graph, params)
+        cap_lora_strengths(graph)
+        fix_lora_paths(graph)
+        workflow = graph.to_workflow()
         
         # Check if ComfyUI is already running (cold start optimization)
         send_webhook(webhook_url, {
@@ -1355,7 +1304,7 @@ def run_skin_enhancement_generation(job_input, job_id, webhook_url):
                 'message': 'Starting ComfyUI (cold start)...'
             })
             
-            if not prepare_comfyui_environment():
+            if not wait_for_comfyui(prepare_comfyui_environment):
                 raise RuntimeError("Failed to prepare ComfyUI environment")
             
             send_webhook(webhook_url, {
@@ -1373,8 +1322,11 @@ def run_skin_enhancement_generation(job_input, job_id, webhook_url):
             'message': 'Queueing skin enhancement workflow...'
         })
         
-        prompt_id = queue_workflow_with_comfyui(workflow, job_id)
+        # Prompts with the same LoRA stack run back to back when the worker has several jobs
+        prompt_id = queue_with_lora_affinity(job_id, workflow, lambda: queue_workflow_with_comfyui(workflow, job_id))
         if not prompt_id:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
             raise RuntimeError("Failed to queue skin enhancement workflow")
         
         # Monitor progress and wait for completion
@@ -1390,7 +1342,7 @@ def run_skin_enhancement_generation(job_input, job_id, webhook_url):
         user_id = job_input.get('user_id', 'unknown')
         
         # Monitor progress and get results (pass workflow for shared folder detection)
-        result = monitor_skin_enhancement_progress(prompt_id, job_id, webhook_url, user_id, workflow)
+        result = monitor_skin_enhancement_progress(prompt_id, job_id, webhook_url, user_id, workflow, live_preview_mode(job_input))
         
         if result['success']:
             logger.info(f"✅ Skin enhancement completed successfully for job: {job_id}")
@@ -1439,7 +1391,9 @@ def handler(job):
         
         # Handle skin enhancement
         if action == 'enhance_skin':
-            result = run_skin_enhancement_generation(job_input, job_id, webhook_url)
+            # Interrupt ComfyUI and return right away if the job is cancelled
+            with watch_job_cancellation(job, job_id):
+                result = run_skin_enhancement_generation(job_input, job_id, webhook_url)
             
             return {
                 'job_id': job_id,
@@ -1448,6 +1402,9 @@ def handler(job):
                 'status': result['status'],
                 'images': result.get('images', []),
                 'aws_s3_paths': result.get('aws_s3_paths', []),
+                'node_profile': result.get('node_profile'),
+                'model_residency': residency_report(job_id),
+                'lora_affinity': lora_affinity_report(job_id),
                 'message': result.get('message', result.get('error', 'Unknown')),
                 'error': result.get('error') if not result['success'] else None
             }
@@ -1486,4 +1443,6 @@ def handler(job):
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎨 Starting RunPod Skin Enhancement handler...")
-    runpod.serverless.start({"handler": handler})
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, preload_essential_models)
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
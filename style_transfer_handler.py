@@ -11,19 +11,38 @@ import time
 import uuid
 import logging
 import requests
-import subprocess
-import threading
 import runpod
 import boto3
 import base64
 from pathlib import Path
 from typing import Dict, List, Any, Optional
+
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes, node_available
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.graph import WorkflowGraph
+from comfyui_worker.inputs import save_base64_input
 from botocore.exceptions import ClientError, NoCredentialsError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 def upload_image_to_aws_s3(image_data: str, filename: str, user_id: str, subfolder: str = '', is_full_prefix: bool = False) -> Optional[tuple]:
     """Upload base64 image data to AWS S3 and return the S3 key and public URL
     
@@ -36,10 +55,10 @@ def upload_image_to_aws_s3(image_data: str, filename: str, user_id: str, subfold
     """
     try:
         # Get AWS S3 credentials from environment
-    aws_access_key = os.environ.get('AWS_ACCESS_KEY_ID') or os.environ.get('S3_ACCESS_KEY_ID')
-    aws_secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY') or os.environ.get('S3_SECRET_ACCESS_KEY')
-    aws_region = os.environ.get('AWS_REGION') or os.environ.get('S3_REGION') or 'us-east-1'
-    s3_bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET') or 'tastycreative'
+        aws_access_key = os.environ.get('AWS_ACCESS_KEY_ID') or os.environ.get('S3_ACCESS_KEY_ID')
+        aws_secret_key = os.environ.get('AWS_SECRET_ACCESS_KEY') or os.environ.get('S3_SECRET_ACCESS_KEY')
+        aws_region = os.environ.get('AWS_REGION') or os.environ.get('S3_REGION') or 'us-east-1'
+        s3_bucket = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET') or 'tastycreative'
         
         if not all([aws_access_key, aws_secret_key, s3_bucket]):
             logger.warning("⚠️ AWS S3 credentials not configured, skipping S3 upload")
@@ -110,6 +129,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=120)
         response.raise_for_status()
@@ -122,7 +144,7 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://localhost:8188/system_stats", timeout=5)
+        response = comfyui.get("/system_stats", timeout=5)
         if response.status_code == 200:
             logger.info("✅ ComfyUI is already running")
             return True
@@ -219,58 +241,9 @@ def start_comfyui():
         
         print(f"🔧 Starting ComfyUI with command: {' '.join(cmd)}")
         
-        def log_output(process, stream_name):
-            """Log ComfyUI output in real time"""
-            for line in iter(process.stdout.readline, b''):
-                line_str = line.decode().strip()
-                if line_str:
-                    print(f"ComfyUI [{stream_name}]: {line_str}")
-        
-        # Start ComfyUI as background process from the ComfyUI directory
-        process = subprocess.Popen(cmd, 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.STDOUT,
-                                 cwd=comfyui_dir,
-                                 bufsize=1,
-                                 universal_newlines=False)
-        
-        # Start logging thread
-        log_thread = threading.Thread(target=log_output, args=(process, "stdout"))
-        log_thread.daemon = True
-        log_thread.start()
-        
-        # Wait for ComfyUI to start up
-        print("⏳ Waiting for ComfyUI to start...")
-        max_wait = 600  # 10 minutes - increased timeout for dependency installation and GPU initialization
-        for i in range(max_wait):
-            try:
-                response = requests.get("http://localhost:8188/system_stats", timeout=5)
-                if response.status_code == 200:
-                    print("✅ ComfyUI is running!")
-                    return True
-            except requests.exceptions.RequestException:
-                pass
-            
-            # Check if process died
-            if process.poll() is not None:
-                print(f"❌ ComfyUI process died with return code: {process.returncode}")
-                # Try to read any error output
-                try:
-                    stdout, stderr = process.communicate(timeout=5)
-                    if stdout:
-                        print(f"ComfyUI stdout: {stdout.decode()}")
-                    if stderr:
-                        print(f"ComfyUI stderr: {stderr.decode()}")
-                except:
-                    pass
-                return False
-                
-            if i % 10 == 0:  # Log every 10 seconds
-                print(f"⏳ Still waiting for ComfyUI... ({i}/{max_wait}s)")
-            time.sleep(1)
-            
-        print(f"❌ ComfyUI failed to start within {max_wait} seconds")
-        return False
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_dir, timeout=600)
         
     except Exception as e:
         print(f"❌ Error starting ComfyUI: {str(e)}")
@@ -294,20 +267,10 @@ def download_image_for_comfyui(image_filename: str, job_input: dict, base64_key:
         if base64_key in job_input and job_input[base64_key]:
             logger.info(f"📦 Using base64 image data directly for {image_filename} (key: {base64_key})")
             
-            # Decode base64 data
-            import base64
-            image_data = base64.b64decode(job_input[base64_key])
-            
-            # ComfyUI input directory
+            # Decode base64 data in chunks straight to the ComfyUI input directory
             comfyui_input_dir = "/app/comfyui/input"
-            os.makedirs(comfyui_input_dir, exist_ok=True)
-            
-            # Target path for the image
             target_path = os.path.join(comfyui_input_dir, image_filename)
-            
-            # Save base64 image data to file
-            with open(target_path, 'wb') as f:
-                f.write(image_data)
+            save_base64_input(job_input, base64_key, image_filename, comfyui_input_dir)
             
             # Verify the image was saved correctly
             if os.path.exists(target_path):
@@ -416,23 +379,31 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
         else:
             logger.info("ℹ️  No LoRA models detected in workflow")
         
-        # ComfyUI API endpoint (using network volume ComfyUI instance)
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        queue_url = f"{comfyui_url}/prompt"
         
-        # Prepare payload with unique client_id to prevent caching
-        import time
-        unique_client_id = f"runpod-{job_id}-{int(time.time())}-{os.urandom(4).hex()}"
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'style_transfer')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return None
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Queue under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
         payload = {
             "prompt": workflow,
-            "client_id": unique_client_id
+            "client_id": client_id
         }
         
-        logger.info(f"📡 Sending to ComfyUI: {queue_url}")
+        logger.info(f"📡 Sending to ComfyUI: {comfyui.url('/prompt')}")
         
         # Send request to ComfyUI
-        response = requests.post(
-            queue_url,
+        response = comfyui.post(
+            "/prompt",
             json=payload,
             timeout=30,
             headers={'Content-Type': 'application/json'}
@@ -449,6 +420,10 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
             logger.error(f"❌ No prompt_id in ComfyUI response: {result}")
             return None
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('style_transfer', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
     
@@ -459,8 +434,6 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
 def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> str:
     """Download image from ComfyUI and return as base64 encoded string"""
     try:
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        
         # Construct the image URL
         params = {
             'filename': filename,
@@ -469,7 +442,7 @@ def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = '
         if subfolder:
             params['subfolder'] = subfolder
             
-        response = requests.get(f"{comfyui_url}/view", params=params, timeout=30)
+        response = comfyui.get("/view", params=params, timeout=30)
         
         if response.status_code == 200:
             # Convert image to base64
@@ -492,7 +465,6 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
         max_wait_time = 600  # 10 minutes
         start_time = time.time()
         last_webhook_time = 0
-        last_progress_check = 0
         
         # Enhanced progress stages with more granular tracking
         progress_stages = {
@@ -506,99 +478,67 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
         }
         
         current_stage = 'initializing'
-        generation_started = False
-        current_step = 0
-        total_steps = 40  # Default, will be updated from actual progress
-        steps_per_second = 1.8  # Average from logs
+        progress = 2
+        
+        # Progress weighted by the workflow's sampler steps and decode passes, mapped onto the style transfer stages
+        tracker = WorkflowProgress(workflow)
+        tracker_stages = {
+            'loading_models': 'loading_models',
+            'processing_prompt': 'encoding_prompt',
+            'processing': 'encoding_prompt',
+            'sampling': 'generating',
+            'decoding': 'decoding',
+            'upscaling': 'decoding',
+            'saving': 'saving'
+        }
+        
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
         
         # Send initial progress update
         if webhook_url:
             send_webhook(webhook_url, {
                 'job_id': job_id,
                 'status': 'PROCESSING',
-                'progress': 2,
+                'progress': progress,
                 'message': progress_stages['initializing']['message'],
                 'stage': 'initializing',
-                'estimatedTimeRemaining': max_wait_time,
+                'estimatedTimeRemaining': int(tracker.estimated_remaining(0)),
                 'currentStep': 0,
-                'totalSteps': total_steps,
+                'totalSteps': tracker.total_steps,
                 'prompt_id': prompt_id
             })
         
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        history_url = f"{comfyui_url}/history/{prompt_id}"
-        queue_url = f"{comfyui_url}/queue"
-        progress_url = f"{comfyui_url}/progress"
+        history_url = f"/history/{prompt_id}"
+        queue_url = "/queue"
         
         attempt = 0
         max_attempts = 600  # 10 minutes with 1-second intervals
         
         while attempt < max_attempts:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             try:
                 current_time = time.time()
                 elapsed_time = current_time - start_time
                 
-                # Check actual ComfyUI progress first
-                try:
-                    progress_response = requests.get(progress_url, timeout=5)
-                    if progress_response.status_code == 200:
-                        progress_data = progress_response.json()
-                        
-                        if progress_data and 'value' in progress_data and 'max' in progress_data:
-                            # We have actual generation progress!
-                            current_step = progress_data['value']
-                            total_steps = progress_data['max']
-                            
-                            if current_step > 0:
-                                generation_started = True
-                                current_stage = 'generating'
-                                
-                                # Calculate progress within generation stage (45-85%)
-                                generation_progress = (current_step / total_steps) if total_steps > 0 else 0
-                                stage_min = progress_stages['generating']['min']
-                                stage_max = progress_stages['generating']['max']
-                                progress = stage_min + (generation_progress * (stage_max - stage_min))
-                                
-                                # Calculate estimated time remaining
-                                if current_step > 1:
-                                    steps_remaining = total_steps - current_step
-                                    estimated_remaining = steps_remaining / steps_per_second
-                                    generation_eta = estimated_remaining + 10  # Add buffer for post-processing
-                                else:
-                                    generation_eta = (total_steps / steps_per_second) + 10
-                                
-                                message = progress_stages['generating']['message'].format(
-                                    current_step=current_step, 
-                                    total_steps=total_steps
-                                )
-                                
-                                # Send progress update every 2 steps or every 3 seconds
-                                if (current_time - last_progress_check > 3 or 
-                                    (current_step > 0 and current_step % 2 == 0)):
-                                    
-                                    if webhook_url:
-                                        send_webhook(webhook_url, {
-                                            'job_id': job_id,
-                                            'status': 'PROCESSING',
-                                            'progress': int(progress),
-                                            'message': message,
-                                            'stage': 'generating',
-                                            'currentStep': current_step,
-                                            'totalSteps': total_steps,
-                                            'estimatedTimeRemaining': generation_eta,
-                                            'stepsPerSecond': round(steps_per_second, 2),
-                                            'prompt_id': prompt_id
-                                        })
-                                    last_progress_check = current_time
-                
-                except Exception as progress_error:
-                    logger.debug(f"Progress check failed (normal during early stages): {progress_error}")
-                
                 # Check ComfyUI queue status for workflow state
                 try:
-                    queue_response = requests.get(queue_url, timeout=5)
-                    if queue_response.status_code == 200:
-                        queue_data = queue_response.json()
+                    queue_data = None
+                    if watcher.live:
+                        # The event stream stands in for /queue (exact queue position isn't tracked)
+                        queue_data = {
+                            'queue_running': [[0, prompt_id]] if watcher.status == 'running' else [],
+                            'queue_pending': [[0, prompt_id]] if watcher.status == 'pending' else []
+                        }
+                    else:
+                        queue_response = comfyui.get(queue_url, timeout=5)
+                        if queue_response.status_code == 200:
+                            queue_data = queue_response.json()
+                    
+                    if queue_data is not None:
                         
                         # Check if our prompt is in the running queue
                         running_queue = queue_data.get('queue_running', [])
@@ -606,12 +546,10 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                         
                         # Update stage based on queue status
                         if any(item[1] == prompt_id for item in running_queue):
-                            if not generation_started:
-                                # In running queue but no generation progress yet
-                                if current_stage == 'initializing':
-                                    current_stage = 'loading_models'
-                                elif elapsed_time > 30 and current_stage == 'loading_models':
-                                    current_stage = 'encoding_prompt'
+                            # Progress from the workflow graph and the execution events (elapsed time when not live)
+                            tracker.update(watcher, elapsed_time)
+                            current_stage = tracker_stages.get(tracker.stage, 'generating')
+                            progress = max(progress, tracker.percent(15, 90))
                             
                         elif any(item[1] == prompt_id for item in pending_queue):
                             current_stage = 'queue_waiting'
@@ -634,7 +572,7 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                         
                         else:
                             # Not in queue, check history for completion
-                            history_response = requests.get(history_url, timeout=5)
+                            history_response = comfyui.get(history_url, timeout=5)
                             if history_response.status_code == 200:
                                 history_data = history_response.json()
                                 
@@ -856,7 +794,9 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                                                 send_webhook(webhook_url, completion_data)
                                                 logger.info(f"📤 Sent style transfer completion webhook with {len(webhook_aws_s3_paths)} AWS S3 paths and {len(result_urls)} result URLs")
                                             
-                                            return {'success': True, 'images': images}
+                                            node_profile = finish_node_profile(watcher, workflow, 'style_transfer')
+                                            timings.record()
+                                            return {'success': True, 'images': images, 'node_profile': node_profile}
                                         else:
                                             logger.error("❌ No images found in ComfyUI output")
                                             return {'success': False, 'error': 'No images generated'}
@@ -869,25 +809,31 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                 except Exception as queue_error:
                     logger.warning(f"⚠️ Queue check failed: {queue_error}")
                 
-                # Send periodic stage updates for non-generating stages
-                if not generation_started and current_time - last_webhook_time > 8:
+                # Send periodic progress updates while the prompt runs
+                if current_stage not in ('queue_waiting', 'saving') and current_time - last_webhook_time > 3:
                     stage_info = progress_stages.get(current_stage, progress_stages['initializing'])
-                    base_progress = stage_info['min'] + min(5, elapsed_time // 2)
-                    estimated_remaining = max(30, max_wait_time - elapsed_time)
+                    message = stage_info['message'].format(
+                        current_step=min(tracker.steps_done, tracker.total_steps),
+                        total_steps=tracker.total_steps
+                    )
+                    # Historical duration for this workflow signature, or the pace so far
+                    estimated_remaining = int(tracker.estimated_remaining(elapsed_time))
                     
                     if webhook_url:
                         send_webhook(webhook_url, {
                             'job_id': job_id,
                             'status': 'PROCESSING',
-                            'progress': int(base_progress),
-                            'message': stage_info['message'],
+                            'progress': int(progress),
+                            'message': message,
                             'stage': current_stage,
+                            'currentStep': min(tracker.steps_done, tracker.total_steps),
+                            'totalSteps': tracker.total_steps,
                             'estimatedTimeRemaining': estimated_remaining,
                             'prompt_id': prompt_id
                         })
                     last_webhook_time = current_time
                 
-                time.sleep(1)
+                watcher.sleep(1)
                 attempt += 1
                 
             except Exception as e:
@@ -902,103 +848,56 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
         logger.error(f"❌ Progress monitoring error: {e}")
         return {'success': False, 'error': f'Progress monitoring error: {str(e)}'}
 
-def validate_style_transfer_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure for style transfer"""
-    try:
-        if not isinstance(workflow, dict):
-            logger.error("Style transfer workflow must be a dictionary")
-            return False
-        
-        # Check for required style transfer nodes (flexible for different implementations)
-        required_nodes = ["8", "31", "33", "37", "38", "41", "50", "51", "6", "27", "154", "155"]  # Removed 42, 43, 44 as they may vary
-        
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"Missing required style transfer node: {node_id}")
-                return False
-        
-        # Validate node structure
-        for node_id, node in workflow.items():
-            if not isinstance(node, dict) or 'class_type' not in node or 'inputs' not in node:
-                logger.error(f"Invalid style transfer node structure for node {node_id}")
-                return False
-        
-        # Check for style transfer implementation (flexible approach)
-        has_style_nodes = False
-        
-        # Check for StyleModelLoader (Redux approach)
-        if any(node.get("class_type") == "StyleModelLoader" for node in workflow.values()):
-            has_style_nodes = True
-            
-        # Check for CLIPVisionEncode approach (alternative)
-        if any(node.get("class_type") == "CLIPVisionEncode" for node in workflow.values()):
-            has_style_nodes = True
-            
-        # Check for ConditioningConcat (for combining text and image conditioning)
-        if any(node.get("class_type") == "ConditioningConcat" for node in workflow.values()):
-            has_style_nodes = True
-            
-        if not has_style_nodes:
-            logger.error("No style transfer implementation found (StyleModelLoader, CLIPVisionEncode, or ConditioningConcat)")
-            return False
-        
-        logger.info("✅ Style transfer workflow validation passed")
-        return True
-    
-    except Exception as e:
-        logger.error(f"❌ Style transfer workflow validation error: {e}")
-        return False
-
 def adapt_style_transfer_workflow(workflow: Dict) -> Dict:
     """Adapt style transfer workflow to use available nodes if ReduxAdvanced is missing"""
     try:
+        graph = WorkflowGraph(workflow)
+        
         # Check if ReduxAdvanced node exists in node 44
-        redux_node = workflow.get("44", {})
-        if redux_node.get("class_type") == "ReduxAdvanced":
-            logger.info("🔄 ReduxAdvanced node detected, attempting to use alternative approach...")
+        redux_node = graph.get("44")
+        is_redux = redux_node is not None and redux_node.class_type == "ReduxAdvanced"
+        if is_redux and node_available("ReduxAdvanced"):
+            logger.info("✅ ReduxAdvanced is installed on this ComfyUI build, keeping it")
+        elif is_redux:
+            logger.info("🔄 ReduxAdvanced node detected but not installed, attempting to use alternative approach...")
             
             # Replace with proper FLUX Redux workflow
             logger.warning("🔄 Replacing ReduxAdvanced with StyleModelApplyAdvanced")
             
             # Keep node 44 as CLIPVisionEncode
-            workflow["44"] = {
-                "class_type": "CLIPVisionEncode",
-                "inputs": {
-                    "clip_vision": redux_node["inputs"]["clip_vision"],
-                    "image": redux_node["inputs"]["image"],
-                    "crop": "center"  # Add required crop parameter
-                }
-            }
+            graph.replace("44", "CLIPVisionEncode", {
+                "clip_vision": redux_node.inputs["clip_vision"],
+                "image": redux_node.inputs["image"],
+                "crop": "center"  # Add required crop parameter
+            })
             
             # Use StyleModelApplyAdvanced to apply the style
-            workflow["44_redux"] = {
-                "class_type": "StyleModelApplyAdvanced",
-                "inputs": {
-                    "conditioning": ["6", 0],  # Text conditioning
-                    "style_model": ["42", 0],  # Style model
-                    "clip_vision_output": ["44", 0],  # CLIPVision output
-                    "strength": 0.8,
-                    "strength_type": "multiply"
-                }
-            }
+            graph.add("44_redux", "StyleModelApplyAdvanced", {
+                "conditioning": ["6", 0],  # Text conditioning
+                "style_model": ["42", 0],  # Style model
+                "clip_vision_output": ["44", 0],  # CLIPVision output
+                "strength": 0.8,
+                "strength_type": "multiply"
+            })
             
             # Update FluxGuidance to use the redux output instead of concat
-            if "41" in workflow and "44_concat" in workflow["41"]["inputs"]["conditioning"]:
-                workflow["41"]["inputs"]["conditioning"] = ["44_redux", 0]
+            guidance = graph.get("41")
+            if guidance is not None and guidance.links.get("conditioning", ("",))[0] == "44_concat":
+                graph.set_input("41", "conditioning", ["44_redux", 0])
             
             # Remove the problematic ConditioningConcat node if it exists
-            if "44_concat" in workflow:
-                del workflow["44_concat"]
+            if "44_concat" in graph:
+                graph.remove("44_concat")
                 
             logger.info("✅ Successfully adapted workflow to use StyleModelApplyAdvanced")
             
         # Ensure CLIPVisionEncode has crop parameter if it exists
-        if "44" in workflow and workflow["44"].get("class_type") == "CLIPVisionEncode":
-            if "crop" not in workflow["44"]["inputs"]:
-                workflow["44"]["inputs"]["crop"] = "center"
-                logger.info("🖼️ Added missing crop parameter to CLIPVisionEncode")
+        clip_vision = graph.get("44")
+        if clip_vision is not None and clip_vision.class_type == "CLIPVisionEncode" and "crop" not in clip_vision.inputs:
+            graph.set_input("44", "crop", "center")
+            logger.info("🖼️ Added missing crop parameter to CLIPVisionEncode")
         
-        return workflow
+        return graph.to_workflow()
         
     except Exception as e:
         logger.error(f"❌ Failed to adapt style transfer workflow: {str(e)}")
@@ -1030,7 +929,7 @@ def run_style_transfer_generation(job_input, job_id, webhook_url):
     
     try:
         # Prepare ComfyUI environment
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             error_msg = "Failed to prepare ComfyUI environment for style transfer"
             logger.error(f"💥 {error_msg}")
             if webhook_url:
@@ -1090,7 +989,7 @@ def run_style_transfer_generation(job_input, job_id, webhook_url):
                     
                     # Create a temporary job input for mask download
                     mask_job_input = job_input.copy()
-                    mask_job_input['referenceImageData'] = job_input.get('maskImageData')
+                    mask_job_input['referenceImageData'] = job_input.pop('maskImageData', None)
                     
                     if download_image_for_comfyui(mask_image_filename, mask_job_input):
                         # Update workflow with mask filename
@@ -1169,8 +1068,9 @@ def run_style_transfer_generation(job_input, job_id, webhook_url):
         except Exception as e:
             logger.error(f"❌ Failed to fix LoRA paths: {str(e)}")
         
-        if not validate_style_transfer_workflow(workflow):
-            error_msg = "Invalid style transfer workflow structure"
+        validation_errors = workflow_errors(workflow, 'style_transfer')
+        if validation_errors:
+            error_msg = f"Invalid style transfer workflow structure: {'; '.join(validation_errors[:5])}"
             logger.error(f"💥 {error_msg}")
             if webhook_url:
                 send_webhook(webhook_url, {
@@ -1238,7 +1138,8 @@ def run_style_transfer_generation(job_input, job_id, webhook_url):
                 "success": True,
                 "status": "completed",
                 "images": result.get('images', []),
-                "comfyUIPromptId": prompt_id
+                "comfyUIPromptId": prompt_id,
+                "node_profile": result.get('node_profile')
             }
         else:
             error_msg = result.get('error', 'Style transfer generation failed')
@@ -1284,7 +1185,9 @@ def handler(job):
             logger.warning("⚠️ No webhook URL provided, updates won't be sent")
         
         try:
-            result = run_style_transfer_generation(job_input, job_id, webhook_url)
+            # Interrupt ComfyUI and return right away if the job is cancelled
+            with watch_job_cancellation(job, job_id):
+                result = run_style_transfer_generation(job_input, job_id, webhook_url)
             
             if result['success']:
                 logger.info(f"✅ Style transfer generation completed: {job_id}")
@@ -1293,6 +1196,8 @@ def handler(job):
                     'job_id': job_id,
                     'status': 'completed',
                     'images': result.get('images', []),
+                    'node_profile': result.get('node_profile'),
+                    'model_residency': residency_report(job_id),
                     'message': 'Style transfer generation completed successfully'
                 }
             else:
@@ -1300,7 +1205,7 @@ def handler(job):
                 return {
                     'success': False,
                     'job_id': job_id,
-                    'status': 'failed',
+                    'status': 'cancelled' if result.get('status') == 'cancelled' else 'failed',
                     'error': result.get('error', 'Unknown error'),
                     'message': 'Style transfer generation failed'
                 }
@@ -1336,4 +1241,6 @@ def handler(job):
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎨 Starting RunPod Style Transfer handler...")
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, lambda: warm_up_models('style_transfer'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
\ No newline at end of file
@@ -17,8 +17,6 @@ import json
 import uuid
 import base64
 import requests
-import subprocess
-import threading
 from pathlib import Path
 from typing import Dict, Any, List, Optional, Union
 from urllib.parse import urlparse, parse_qs
@@ -121,17 +119,40 @@ import time
 import base64
 import logging
 import requests
-import subprocess
-import threading
 import boto3
 from botocore.exceptions import ClientError
 from pathlib import Path
 from typing import Dict, List, Any, Optional
 
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.finalize import OutputFinalizer, latent_batch_size
+from comfyui_worker.previews import PreviewForwarder, live_preview_mode, preview_launch_args
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.templates import resolve_workflow
+from comfyui_worker.result_cache import cache_requested, lookup_result, store_result, workflow_cache_key
+from comfyui_worker.lora_affinity import lora_affinity_report, queue_with_lora_affinity
+from comfyui_worker.inputs import decode_base64_to_file
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # S3 Configuration for RunPod Network Volume
 S3_ENDPOINT = 'https://s3api-us-ks-2.runpod.io'
 S3_REGION = 'us-ks-2'
@@ -200,6 +221,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         # Add headers for ngrok compatibility
         headers = {
@@ -216,42 +240,10 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
         logger.error(f"❌ Webhook failed: {e}")
         return False
 
-def validate_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure"""
-    try:
-        if not isinstance(workflow, dict):
-            logger.error("Workflow must be a dictionary")
-            return False
-        
-        # Check for required nodes
-        required_nodes = ["1", "2", "3", "4", "5", "6", "12", "13"]  # Basic nodes for FLUX generation
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"Missing required node: {node_id}")
-                return False
-        
-        # Validate node structure
-        for node_id, node in workflow.items():
-            if not isinstance(node, dict) or 'class_type' not in node or 'inputs' not in node:
-                logger.error(f"Invalid node structure for node {node_id}")
-                return False
-                
-        # Check for proper FLUX configuration
-        if "UNETLoader" not in [node.get("class_type") for node in workflow.values()]:
-            logger.error("No UNETLoader found in workflow")
-            return False
-        
-        logger.info("✅ Workflow validation passed")
-        return True
-    
-    except Exception as e:
-        logger.error(f"❌ Workflow validation error: {e}")
-        return False
-
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://localhost:8188/system_stats", timeout=5)
+        response = comfyui.get("/system_stats", timeout=5)
         if response.status_code == 200:
             logger.info("✅ ComfyUI is already running")
             return True
@@ -343,57 +335,13 @@ def start_comfyui():
             "--extra-model-paths-config", "/app/extra_model_paths.yaml",
             "--disable-auto-launch"  # Disable browser launch in serverless environment
         ]
+        cmd.extend(preview_launch_args())  # Sampler preview frames for jobs that ask for live previews
         
         print(f"🔧 Starting ComfyUI with command: {' '.join(cmd)}")
         
-        def log_output(process, stream_name):
-            try:
-                for line in iter(process.stdout.readline, b''):
-                    print(f"[ComfyUI] {line.decode('utf-8', errors='ignore').strip()}")
-            except Exception as e:
-                print(f"Error reading {stream_name}: {e}")
-        
-        # Start ComfyUI as background process from the ComfyUI directory
-        process = subprocess.Popen(cmd, 
-                                 stdout=subprocess.PIPE, 
-                                 stderr=subprocess.STDOUT,
-                                 cwd=comfyui_dir,
-                                 bufsize=1,
-                                 universal_newlines=False)
-        
-        # Start logging thread
-        log_thread = threading.Thread(target=log_output, args=(process, "stdout"))
-        log_thread.daemon = True
-        log_thread.start()
-        
-        # Wait for ComfyUI to start up
-        print("⏳ Waiting for ComfyUI to start...")
-        max_wait = 600  # 10 minutes - increased timeout for dependency installation and GPU initialization
-        for i in range(max_wait):
-            try:
-                response = requests.get("http://localhost:8188/system_stats", timeout=5)
-                if response.status_code == 200:
-                    print(f"✅ ComfyUI started successfully after {i+1} seconds")
-                    
-                    # Additional verification - check if queue endpoint is available
-                    queue_response = requests.get("http://localhost:8188/queue", timeout=5)
-                    if queue_response.status_code == 200:
-                        print("✅ ComfyUI queue endpoint is ready")
-                        return True
-                    else:
-                        print(f"⚠️ ComfyUI queue endpoint not ready yet: {queue_response.status_code}")
-                        
-            except requests.exceptions.RequestException:
-                pass
-            
-            time.sleep(1)
-            
-            # Log progress every 30 seconds
-            if (i + 1) % 30 == 0:
-                print(f"⏳ Still waiting for ComfyUI... ({i+1}/{max_wait}s)")
-            
-        print(f"❌ ComfyUI failed to start within {max_wait} seconds")
-        return False
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_dir, timeout=600)
         
     except Exception as e:
         print(f"❌ Error starting ComfyUI: {str(e)}")
@@ -421,9 +369,6 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
         else:
             logger.info(f"ℹ️ No LoRAs in workflow - using base model only")
         
-        # ComfyUI API endpoint
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        queue_url = f"{comfyui_url}/prompt"
         
         # Debug: Show the workflow being sent
         logger.info("🔍 === WORKFLOW DEBUG ===")
@@ -452,18 +397,30 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
         # Show complete workflow for debugging
         logger.info(f"🔧 Complete workflow JSON: {json.dumps(workflow, indent=2)}")
         
-        # Prepare payload with unique client_id to prevent caching
-        unique_client_id = f"runpod-{job_id}-{int(time.time())}-{os.urandom(4).hex()}"
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'text_to_image')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            return None
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Queue under the event stream's client_id so execution events reach this worker
+        client_id, stream_epoch = subscribe()
         payload = {
             "prompt": workflow,
-            "client_id": unique_client_id
+            "client_id": client_id
         }
         
-        logger.info(f"📡 Sending to ComfyUI: {queue_url}")
+        logger.info(f"📡 Sending to ComfyUI: {comfyui.url('/prompt')}")
         
         # Send request to ComfyUI
-        response = requests.post(
-            queue_url,
+        response = comfyui.post(
+            "/prompt",
             json=payload,
             timeout=30,
             headers={'Content-Type': 'application/json'}
@@ -480,6 +437,10 @@ def queue_workflow_with_comfyui(workflow: Dict, job_id: str) -> Optional[str]:
             logger.error(f"❌ No prompt_id returned: {result}")
             return None
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('text_to_image', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
     
@@ -516,8 +477,6 @@ def save_image_to_network_volume(filename: str, image_data: bytes, user_id: str,
 def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> str:
     """Download image from ComfyUI and return as base64 encoded string"""
     try:
-        comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-        
         # Build URL parameters
         params = {
             'filename': filename,
@@ -525,10 +484,8 @@ def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = '
             'type': type_dir
         }
         
-        view_url = f"{comfyui_url}/view"
-        
         # Download the image
-        response = requests.get(view_url, params=params, timeout=30)
+        response = comfyui.get("/view", params=params, timeout=30)
         response.raise_for_status()
         
         # Convert to base64
@@ -541,7 +498,123 @@ def get_image_from_comfyui(filename: str, subfolder: str = '', type_dir: str = '
         logger.error(f"❌ Error downloading image {filename}: {str(e)}")
         return ""
 
-def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user_id: str = None, workflow: Dict = None) -> Dict:
+def count_expected_images(workflow: Dict) -> int:
+    """Estimate how many images the workflow saves (latent batch size x SaveImage nodes)"""
+    if not workflow:
+        return 1
+    
+    save_nodes = sum(1 for node in workflow.values() if isinstance(node, dict) and node.get('class_type') == 'SaveImage')
+    return latent_batch_size(workflow) * max(save_nodes, 1)
+
+def finalize_generated_image(img_info: Dict, image_index: int, expected_images: int, job_id: str, webhook_url: str, user_id: str = None, workflow: Dict = None, start_time: float = None) -> Optional[Dict]:
+    """Download one generated image, upload it to AWS S3 and announce it via an IMAGE_READY webhook"""
+    filename = img_info.get('filename')
+    subfolder = img_info.get('subfolder', '')
+    total_images = max(expected_images, image_index)
+    
+    logger.info(f"📸 Processing image {image_index} of {total_images}: {filename}")
+    
+    # Download image data from ComfyUI
+    params = {
+        'filename': filename,
+        'subfolder': subfolder,
+        'type': img_info.get('type', 'output')
+    }
+    
+    response = comfyui.get("/view", params=params, timeout=30)
+    
+    if response.status_code != 200:
+        logger.error(f"❌ Failed to download image {filename}: {response.status_code}")
+        return None
+    
+    image_data_bytes = response.content
+    
+    # Detect shared folder from workflow
+    is_shared_folder = False
+    folder_prefix = subfolder
+    
+    if workflow:
+        # Check SaveImage node (13) for filename_prefix
+        save_image_node = workflow.get('13', {})
+        if save_image_node.get('class_type') == 'SaveImage':
+            filename_prefix = save_image_node.get('inputs', {}).get('filename_prefix', '')
+            
+            # If filename_prefix starts with "outputs/", it's a shared folder with full path
+            if filename_prefix.startswith('outputs/'):
+                is_shared_folder = True
+                # Extract the folder path by removing filename part (last segment after /)
+                path_parts = filename_prefix.split('/')
+                if len(path_parts) >= 3:
+                    # Keep all parts except the filename (last part)
+                    folder_prefix = '/'.join(path_parts[:-1]) + '/'
+                    logger.info(f"📂 Detected full folder path: {folder_prefix}")
+            else:
+                logger.info(f"📁 Using user's own folder: {filename_prefix}")
+    
+    # Save to AWS S3 (primary and only storage)
+    aws_s3_result = None
+    if user_id and AWS_S3_BUCKET:
+        aws_s3_result = upload_to_aws_s3(
+            filename, 
+            image_data_bytes, 
+            user_id, 
+            folder_prefix,
+            is_full_prefix=is_shared_folder
+        )
+        if aws_s3_result.get('success'):
+            logger.info(f"✅ Image uploaded to AWS S3: {aws_s3_result['public_url']}")
+        else:
+            logger.error(f"❌ AWS S3 upload failed: {aws_s3_result.get('error')}")
+    else:
+        logger.error("❌ AWS S3 configuration missing - user_id or bucket not provided")
+    
+    # Prepare path info with AWS S3 only
+    path_info = {
+        'filename': filename,
+        'subfolder': subfolder,
+        'type': img_info.get('type', 'output'),
+        'file_size': len(image_data_bytes)
+    }
+    
+    # Add AWS S3 info if successful
+    if aws_s3_result and aws_s3_result.get('success'):
+        path_info.update({
+            'aws_s3_key': aws_s3_result['s3_key'],
+            'aws_s3_url': aws_s3_result['public_url']
+        })
+    else:
+        logger.error(f"❌ Failed to upload {filename} to AWS S3 - skipping image")
+        return None  # Skip this image if AWS S3 upload failed
+    
+    # Only send essential data to webhook with direct AWS S3 URL
+    image_data = {
+        'filename': filename,
+        'subfolder': subfolder,
+        'type': img_info.get('type', 'output'),
+        'aws_s3_key': path_info.get('aws_s3_key'),
+        'aws_s3_url': path_info.get('aws_s3_url'),
+        'direct_url': path_info.get('aws_s3_url')  # Direct S3 URL for immediate use
+    }
+    
+    # Send individual image via webhook (chunked upload) as soon as it is stored
+    if webhook_url and total_images > 1:
+        chunk_progress = 95 + (image_index / total_images) * 5  # 95-100% for image processing
+        logger.info(f"📤 Sending chunked image {image_index}/{total_images} via webhook")
+        send_webhook(webhook_url, {
+            "job_id": job_id,
+            "status": "IMAGE_READY",
+            "progress": chunk_progress,
+            "message": f"📸 Image {image_index} of {total_images} ready",
+            "stage": "uploading_images",
+            "elapsedTime": time.time() - start_time if start_time else 0,
+            "imageCount": image_index,
+            "totalImages": total_images,
+            "image": image_data  # Single image for chunked upload
+        })
+    
+    return {'image': image_data, 'path_info': path_info}
+
+def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user_id: str = None, workflow: Dict = None, live_preview: Optional[str] = None) -> Dict:
     """Monitor ComfyUI progress and return final result with detailed progress"""
     try:
         logger.info(f"👁️ Starting progress monitoring for job: {job_id}, user: {user_id}")
@@ -563,6 +636,38 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
         progress = 5
         message = progress_stages['starting']['message']
         
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        
+        # Progress weighted by the workflow's sampler steps and decode/upscale passes
+        tracker = WorkflowProgress(workflow)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        
+        # Upload and announce each SaveImage output as soon as its node executes
+        expected_images = count_expected_images(workflow)
+        finalizer = OutputFinalizer(
+            lambda node_id, img_info, index: finalize_generated_image(
+                img_info, index, expected_images, job_id, webhook_url, user_id, workflow, start_time
+            )
+        ).attach(watcher)
+        
+        # Opt-in low-res sampler previews, at most one every couple of seconds
+        preview_forwarder = None
+        if live_preview and webhook_url:
+            preview_forwarder = PreviewForwarder(
+                lambda preview: send_webhook(webhook_url, {
+                    "job_id": job_id,
+                    "status": "PROCESSING",
+                    "stage": "generating",
+                    "message": progress_stages['generating']['message'],
+                    "elapsedTime": time.time() - start_time,
+                    "preview": preview
+                }),
+                s3_client=get_aws_s3_client() if live_preview == 's3' else None,
+                s3_bucket=AWS_S3_BUCKET,
+                s3_prefix=f"previews/{job_id}"
+            ).attach(watcher)
+        
         # Send initial progress update
         if webhook_url:
             send_webhook(webhook_url, {
@@ -571,45 +676,59 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                 "progress": progress,
                 "message": message,
                 "stage": current_stage,
-                "estimatedTimeRemaining": max_wait_time
+                "estimatedTimeRemaining": tracker.estimated_remaining(0)
             })
         
         while time.time() - start_time < max_wait_time:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             try:
                 current_time = time.time()
                 elapsed_time = current_time - start_time
                 
                 # Check ComfyUI queue and progress
                 try:
-                    queue_response = requests.get("http://127.0.0.1:8188/queue", timeout=10)
-                    if queue_response.status_code == 200:
-                        queue_data = queue_response.json()
-                        
-                        # Check if our job is in the running queue
-                        running_queue = queue_data.get('queue_running', [])
-                        pending_queue = queue_data.get('queue_pending', [])
-                        
-                        found_in_running = any(item[1] == prompt_id for item in running_queue if len(item) > 1)
-                        found_in_pending = any(item[1] == prompt_id for item in pending_queue if len(item) > 1)
-                        
-                        if found_in_running:
-                            if current_stage != 'generating':
-                                current_stage = 'generating'
-                                message = progress_stages['generating']['message']
-                                progress = min(progress + 10, 80)
-                        elif found_in_pending:
-                            if current_stage != 'loading_models':
-                                current_stage = 'loading_models'
-                                message = progress_stages['loading_models']['message']
-                                progress = min(progress + 5, 30)
+                    found_in_running = False
+                    found_in_pending = False
+                    
+                    if watcher.live:
+                        found_in_running = watcher.status == 'running'
+                        found_in_pending = watcher.status == 'pending'
+                    else:
+                        queue_response = comfyui.get("/queue", timeout=10)
+                        if queue_response.status_code == 200:
+                            queue_data = queue_response.json()
+                            
+                            # Check if our job is in the running queue
+                            running_queue = queue_data.get('queue_running', [])
+                            pending_queue = queue_data.get('queue_pending', [])
+                            
+                            found_in_running = any(item[1] == prompt_id for item in running_queue if len(item) > 1)
+                            found_in_pending = any(item[1] == prompt_id for item in pending_queue if len(item) > 1)
+                    
+                    if found_in_running:
+                        tracker.update(watcher, elapsed_time)
+                        current_stage = tracker.stage if tracker.stage in progress_stages else 'generating'
+                        message = progress_stages[current_stage]['message']
+                        if current_stage == 'generating' and tracker.step_label():
+                            message = f"{message} ({tracker.step_label()})"
+                        progress = max(progress, tracker.percent(10, 95))
+                    elif found_in_pending:
+                        if current_stage != 'loading_models':
+                            current_stage = 'loading_models'
+                            message = progress_stages['loading_models']['message']
+                            progress = min(progress + 5, 30)
                         
                 except Exception as queue_error:
                     logger.warning(f"⚠️ Could not check ComfyUI queue: {queue_error}")
                 
-                # Check for completed results
+                # Check for completed results (only once the event stream reports completion, unless polling)
                 try:
-                    history_response = requests.get(f"http://127.0.0.1:8188/history/{prompt_id}", timeout=10)
-                    if history_response.status_code == 200:
+                    history_response = None
+                    if watcher.finished or not watcher.live:
+                        history_response = comfyui.get(f"/history/{prompt_id}", timeout=10)
+                    if history_response is not None and history_response.status_code == 200:
                         history_data = history_response.json()
                         
                         if prompt_id in history_data:
@@ -634,129 +753,15 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                                     })
                                     last_webhook_time = current_time
                                 
-                                # Extract results and save to network volume
+                                # Collect results; outputs seen on the event stream are already uploaded
                                 outputs = job_history['outputs']
-                                image_results = []
-                                network_volume_paths = []
-                                total_images = 0
-                                
-                                # First count total images expected
-                                for node_id, output in outputs.items():
-                                    if 'images' in output:
-                                        total_images += len(output['images'])
-                                
-                                image_count = 0
-                                for node_id, output in outputs.items():
-                                    if 'images' in output:
-                                        for img_info in output['images']:
-                                            filename = img_info.get('filename')
-                                            subfolder = img_info.get('subfolder', '')
-                                            
-                                            if filename:
-                                                image_count += 1
-                                                logger.info(f"📸 Processing image {image_count} of {total_images}: {filename}")
-                                                
-                                                # Download image data from ComfyUI
-                                                comfyui_url = os.environ.get('COMFYUI_URL', 'http://localhost:8188')
-                                                params = {
-                                                    'filename': filename,
-                                                    'subfolder': subfolder,
-                                                    'type': img_info.get('type', 'output')
-                                                }
-                                                
-                                                view_url = f"{comfyui_url}/view"
-                                                response = requests.get(view_url, params=params, timeout=30)
-                                                
-                                                if response.status_code == 200:
-                                                    image_data_bytes = response.content
-                                                    
-                                                    # Detect shared folder from workflow
-                                                    is_shared_folder = False
-                                                    folder_prefix = subfolder
-                                                    
-                                                    if workflow:
-                                                        # Check SaveImage node (13) for filename_prefix
-                                                        save_image_node = workflow.get('13', {})
-                                                        if save_image_node.get('class_type') == 'SaveImage':
-                                                            filename_prefix = save_image_node.get('inputs', {}).get('filename_prefix', '')
-                                                            
-                                                            # If filename_prefix starts with "outputs/", it's a shared folder with full path
-                                                            if filename_prefix.startswith('outputs/'):
-                                                                is_shared_folder = True
-                                                                # Extract the folder path by removing filename part (last segment after /)
-                                                                path_parts = filename_prefix.split('/')
-                                                                if len(path_parts) >= 3:
-                                                                    # Keep all parts except the filename (last part)
-                                                                    folder_prefix = '/'.join(path_parts[:-1]) + '/'
-                                                                    logger.info(f"� Detected full folder path: {folder_prefix}")
-                                                            else:
-                                                                logger.info(f"📁 Using user's own folder: {filename_prefix}")
-                                                    
-                                                    # Save to AWS S3 (primary and only storage)
-                                                    aws_s3_result = None
-                                                    if user_id and AWS_S3_BUCKET:
-                                                        aws_s3_result = upload_to_aws_s3(
-                                                            filename, 
-                                                            image_data_bytes, 
-                                                            user_id, 
-                                                            folder_prefix,
-                                                            is_full_prefix=is_shared_folder
-                                                        )
-                                                        if aws_s3_result.get('success'):
-                                                            logger.info(f"✅ Image uploaded to AWS S3: {aws_s3_result['public_url']}")
-                                                        else:
-                                                            logger.error(f"❌ AWS S3 upload failed: {aws_s3_result.get('error')}")
-                                                    else:
-                                                        logger.error("❌ AWS S3 configuration missing - user_id or bucket not provided")
-                                                    
-                                                    # Prepare path info with AWS S3 only
-                                                    path_info = {
-                                                        'filename': filename,
-                                                        'subfolder': subfolder,
-                                                        'type': img_info.get('type', 'output'),
-                                                        'file_size': len(image_data_bytes)
-                                                    }
-                                                    
-                                                    # Add AWS S3 info if successful
-                                                    if aws_s3_result and aws_s3_result.get('success'):
-                                                        path_info.update({
-                                                            'aws_s3_key': aws_s3_result['s3_key'],
-                                                            'aws_s3_url': aws_s3_result['public_url']
-                                                        })
-                                                    else:
-                                                        logger.error(f"❌ Failed to upload {filename} to AWS S3 - skipping image")
-                                                        continue  # Skip this image if AWS S3 upload failed
-                                                    
-                                                    network_volume_paths.append(path_info)
-                                                    
-                                                    # Only send essential data to webhook with direct AWS S3 URL
-                                                    image_data = {
-                                                        'filename': filename,
-                                                        'subfolder': subfolder,
-                                                        'type': img_info.get('type', 'output'),
-                                                        'aws_s3_key': path_info.get('aws_s3_key'),
-                                                        'aws_s3_url': path_info.get('aws_s3_url'),
-                                                        'direct_url': path_info.get('aws_s3_url')  # Direct S3 URL for immediate use
-                                                    }
-                                                    image_results.append(image_data)
-                                                    
-                                                    # Send individual image via webhook (chunked upload)
-                                                    if webhook_url and total_images > 1:
-                                                        chunk_progress = 95 + (image_count / total_images) * 5  # 95-100% for image processing
-                                                        logger.info(f"📤 Sending chunked image {image_count}/{total_images} via webhook")
-                                                        send_webhook(webhook_url, {
-                                                            "job_id": job_id,
-                                                            "status": "IMAGE_READY",
-                                                            "progress": chunk_progress,
-                                                            "message": f"📸 Image {image_count} of {total_images} ready",
-                                                            "stage": "uploading_images",
-                                                            "elapsedTime": elapsed_time,
-                                                            "imageCount": image_count,
-                                                            "totalImages": total_images,
-                                                            "image": image_data  # Single image for chunked upload
-                                                        })
-                                                else:
-                                                    logger.error(f"❌ Failed to download image {filename}: {response.status_code}")
+                                finalized = finalizer.collect(outputs)
+                                finalizer.close()
+                                if preview_forwarder:
+                                    preview_forwarder.close()
+                                image_results = [item['image'] for item in finalized]
+                                network_volume_paths = [item['path_info'] for item in finalized]
+                                total_images = finalizer.submitted
                                 
                                 # Send final completion webhook
                                 if webhook_url:
@@ -787,32 +792,21 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                                     send_webhook(webhook_url, completion_data)
                                     logger.info(f"📤 Sent completion webhook with {len(network_volume_paths)} network volume paths and {len(resultUrls)} result URLs")
                                 
+                                node_profile = finish_node_profile(watcher, workflow, 'text_to_image')
+                                timings.record()
                                 return {
                                     "status": "success",
                                     "images": image_results,
                                     "network_volume_paths": network_volume_paths,
-                                    "message": f"Text-to-image generation completed successfully - {total_images} image{'' if total_images == 1 else 's'} generated"
+                                    "message": f"Text-to-image generation completed successfully - {total_images} image{'' if total_images == 1 else 's'} generated",
+                                    "node_profile": node_profile
                                 }
                 
                 except Exception as history_error:
                     logger.warning(f"⚠️ Could not check ComfyUI history: {history_error}")
                 
-                # Progressive updates
-                if elapsed_time > 60 and current_stage == 'starting':
-                    current_stage = 'loading_models'
-                    message = progress_stages['loading_models']['message']
-                    progress = min(progress + 10, 40)
-                elif elapsed_time > 120 and current_stage == 'loading_models':
-                    current_stage = 'processing_prompt'
-                    message = progress_stages['processing_prompt']['message']
-                    progress = min(progress + 10, 50)
-                elif elapsed_time > 180 and current_stage == 'processing_prompt':
-                    current_stage = 'generating'
-                    message = progress_stages['generating']['message']
-                    progress = min(progress + 10, 70)
-                
-                # Estimate remaining time
-                estimated_remaining = max(0, max_wait_time - elapsed_time)
+                # Estimate remaining time from the pace through the workflow so far
+                estimated_remaining = tracker.estimated_remaining(elapsed_time)
                 
                 # Send periodic webhook updates
                 if webhook_url and current_time - last_webhook_time > 5:
@@ -827,7 +821,7 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
                     })
                     last_webhook_time = current_time
                 
-                time.sleep(2)  # Check every 2 seconds
+                watcher.sleep(2)  # Check every 2 seconds, waking as soon as the prompt finishes
                 
             except Exception as loop_error:
                 logger.warning(f"⚠️ Error in monitoring loop: {loop_error}")
@@ -835,6 +829,8 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
         
         # Timeout reached
         logger.error(f"❌ Monitoring timeout reached for job {job_id}")
+        if preview_forwarder:
+            preview_forwarder.close()
         if webhook_url:
             send_webhook(webhook_url, {
                 "job_id": job_id,
@@ -865,21 +861,49 @@ def monitor_comfyui_progress(prompt_id: str, job_id: str, webhook_url: str, user
             "error": f"Monitoring error: {str(e)}"
         }
 
+def replay_cached_result(cached: Dict, job_id: str, webhook_url: str) -> Dict:
+    """Deliver a cached generation through the normal completion webhook and result"""
+    network_volume_paths = cached.get('network_volume_paths', [])
+    total_images = len(network_volume_paths)
+    if webhook_url:
+        send_webhook(webhook_url, {
+            "job_id": job_id,
+            "status": "COMPLETED",
+            "progress": 100,
+            "message": f"✅ All {total_images} image{'' if total_images == 1 else 's'} completed!",
+            "stage": "completed",
+            "elapsedTime": 0,
+            "imageCount": total_images,
+            "totalImages": total_images,
+            "network_volume_paths": network_volume_paths,
+            "resultUrls": [path['aws_s3_url'] for path in network_volume_paths if path.get('aws_s3_url')],
+            "aws_s3_direct": True,
+            "cached": True
+        })
+    return {
+        'success': True,
+        'images': cached.get('images', []),
+        'network_volume_paths': network_volume_paths,
+        'cached': True,
+        'message': 'Text-to-image generation completed successfully (cached result)'
+    }
+
 def run_text_to_image_generation(job_input, job_id, webhook_url):
     """Execute the actual text-to-image generation process"""
     logger.info(f"🎯 Starting text-to-image generation for job: {job_id}")
     
     try:
-        # Validate input
-        if 'workflow' not in job_input:
-            raise ValueError("No workflow provided")
+        # Raw workflow, or the text_to_image template rendered with the job's params
+        workflow = resolve_workflow(job_input, 'text_to_image')
+        if not workflow:
+            raise ValueError("No workflow or template params provided")
         
-        workflow = job_input['workflow']
         user_id = job_input.get('user_id')  # Extract user_id from job input
         
         # Validate workflow
-        if not validate_workflow(workflow):
-            raise ValueError("Invalid workflow structure")
+        validation_errors = workflow_errors(workflow, 'text_to_image')
+        if validation_errors:
+            raise ValueError(f"Invalid workflow structure: {'; '.join(validation_errors[:5])}")
         
         # Fix LoRA paths - transform user LoRA names to include subdirectory structure
         try:
@@ -934,24 +958,40 @@ def run_text_to_image_generation(job_input, job_id, webhook_url):
         except Exception as e:
             logger.error(f"❌ Failed to fix LoRA paths: {str(e)}")
         
+        # Identical resubmissions are answered from the shared result cache without touching the GPU
+        cache_key = workflow_cache_key(workflow, 'text_to_image', user_id) if cache_requested(job_input) else None
+        cached = lookup_result(cache_key)
+        if cached:
+            return replay_cached_result(cached, job_id, webhook_url)
+        
         # Prepare ComfyUI environment
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             raise Exception("Failed to prepare ComfyUI environment")
         
-        # Queue workflow with ComfyUI
-        prompt_id = queue_workflow_with_comfyui(workflow, job_id)
+        # Queue workflow with ComfyUI, ordered so prompts with the same LoRA stack run back to back
+        prompt_id = queue_with_lora_affinity(job_id, workflow, lambda: queue_workflow_with_comfyui(workflow, job_id))
         if not prompt_id:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
             raise Exception("Failed to queue workflow with ComfyUI")
         
         # Monitor progress and get results (pass workflow for shared folder detection)
-        result = monitor_comfyui_progress(prompt_id, job_id, webhook_url, user_id, workflow)
+        result = monitor_comfyui_progress(prompt_id, job_id, webhook_url, user_id, workflow, live_preview_mode(job_input))
         
         if result['status'] == 'success':
             logger.info(f"✅ Text-to-image generation completed for job: {job_id}")
+            network_volume_paths = result.get('network_volume_paths', [])
+            store_result(cache_key, {
+                'images': result['images'],
+                'network_volume_paths': network_volume_paths
+            }, [path.get('aws_s3_url') for path in network_volume_paths if path.get('aws_s3_url')], job_id)
             return {
                 'success': True,
                 'images': result['images'],
                 'network_volume_paths': result.get('network_volume_paths', []),
+                'node_profile': result.get('node_profile'),
+                'model_residency': residency_report(job_id),
+                'lora_affinity': lora_affinity_report(job_id),
                 'message': 'Text-to-image generation completed successfully'
             }
         else:
@@ -973,21 +1013,16 @@ def run_text_to_image_generation(job_input, job_id, webhook_url):
 def upload_lora_to_network_volume(file_data: str, file_name: str, user_id: str) -> Dict:
     """Upload LoRA file to network volume storage"""
     try:
-        # Decode base64 file data
-        import base64
-        file_bytes = base64.b64decode(file_data)
-        
         # Create user-specific directory on network volume
         network_volume_path = "/runpod-volume"
         user_lora_dir = os.path.join(network_volume_path, "loras", f"user_{user_id}")
         os.makedirs(user_lora_dir, exist_ok=True)
         
-        # Save LoRA file
+        # Decode base64 file data in chunks straight to the LoRA file
         file_path = os.path.join(user_lora_dir, file_name)
-        with open(file_path, 'wb') as f:
-            f.write(file_bytes)
+        file_size = decode_base64_to_file(file_data, file_path)
         
-        logger.info(f"✅ LoRA uploaded to: {file_path}")
+        logger.info(f"✅ LoRA uploaded to: {file_path} ({file_size} bytes)")
         
         return {
             'success': True,
@@ -1029,10 +1064,12 @@ def handler(job):
     else:
         logger.info(f"🎯 Processing text-to-image generation request for job: {job_input.get('job_id', 'unknown')}")
         
-        job_id = job_input.get('job_id', f'job_{int(time.time())}')
+        job_id = job_input.get('job_id') or job.get('id') or f'job_{int(time.time() * 1000)}'
         webhook_url = job_input.get('webhook_url')
         
-        return run_text_to_image_generation(job_input, job_id, webhook_url)
+        # Interrupt ComfyUI and return right away if the job is cancelled
+        with watch_job_cancellation(job, job_id):
+            return run_text_to_image_generation(job_input, job_id, webhook_url)
 
 # Import runpod at the end to handle potential import issues
 try:
@@ -1054,4 +1091,6 @@ except ImportError:
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎯 Starting RunPod Text-to-Image handler...")
-    runpod.serverless.start({"handler": handler})
\ No newline at end of file
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(prepare_comfyui_environment, lambda: warm_up_models('text_to_image'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))
\ No newline at end of file
@@ -17,15 +17,35 @@ import logging
 import requests
 import runpod
 import boto3
-import subprocess
 from pathlib import Path
 from typing import Dict, List, Any, Optional
+
+from comfyui_worker.client import get_comfyui_client
+from comfyui_worker.events import subscribe, track_prompt, watch_prompt
+from comfyui_worker.cancel import watch_job_cancellation, attach_prompt, job_cancelled, cancelled_result
+from comfyui_worker.progress import WorkflowProgress
+from comfyui_worker.timings import JobTimings
+from comfyui_worker.profiler import finish_node_profile
+from comfyui_worker.prewarm import start_prewarm, wait_for_comfyui
+from comfyui_worker.warmup import remember_workflow, warm_up_models
+from comfyui_worker.supervisor import get_supervisor, supervise_prompt, supervised_handler
+from comfyui_worker.concurrency import serverless_config
+from comfyui_worker.residency import ensure_model_residency, residency_report
+from comfyui_worker.logsink import with_log_tail
+from comfyui_worker.catalog import check_workflow_nodes, get_node_catalog
+from comfyui_worker.optimize import optimize_workflow
+from comfyui_worker.validation import workflow_errors
+from comfyui_worker.templates import resolve_workflow
+from comfyui_worker.result_cache import cache_requested, lookup_result, store_result, workflow_cache_key
 from botocore.exceptions import ClientError
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive connection to the local ComfyUI server
+comfyui = get_comfyui_client()
+
 # AWS S3 Configuration for direct storage (bandwidth optimization)
 AWS_REGION = os.environ.get('AWS_REGION') or os.environ.get('S3_REGION') or 'us-east-1'
 AWS_S3_BUCKET = os.environ.get('AWS_S3_BUCKET') or os.environ.get('S3_BUCKET') or 'tastycreative'
@@ -110,16 +130,8 @@ def upload_video_to_aws_s3(video_data: bytes, user_id: str, filename: str, subfo
 def get_video_bytes_from_comfyui(filename: str, subfolder: str = '', type_dir: str = 'output') -> bytes:
     """Download video from ComfyUI and return raw bytes"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
-        
-        # Construct the video URL
-        if subfolder:
-            url = f"{comfyui_url}/view?filename={filename}&subfolder={subfolder}&type={type_dir}"
-        else:
-            url = f"{comfyui_url}/view?filename={filename}&type={type_dir}"
-        
-        logger.info(f"📥 Downloading video from ComfyUI: {url}")
-        response = requests.get(url, timeout=60)
+        logger.info(f"📥 Downloading video from ComfyUI: {filename}")
+        response = comfyui.view(filename, subfolder, type_dir, timeout=60)
         response.raise_for_status()
         
         return response.content
@@ -133,6 +145,9 @@ def send_webhook(webhook_url: str, data: Dict) -> bool:
     if not webhook_url:
         return False
         
+    # Failure webhooks carry the last ComfyUI log lines
+    data = with_log_tail(data)
+
     try:
         response = requests.post(webhook_url, json=data, timeout=10)
         return response.status_code == 200
@@ -164,57 +179,13 @@ def fix_lora_paths(workflow):
         logger.error(f"❌ Error fixing LoRA paths: {e}")
         return workflow
 
-def validate_text_to_video_workflow(workflow: Dict) -> bool:
-    """Validate the ComfyUI workflow JSON structure for Text to Video"""
-    try:
-        # Required nodes for Wan 2.2 Text to Video workflow (nodes 90, 91, 114, 115 are optional custom LoRAs)
-        required_nodes = ["71", "72", "73", "74", "75", "76", "78", "80", "81", "82", "83", "85", "86", "87", "88", "89"]
-        
-        for node_id in required_nodes:
-            if node_id not in workflow:
-                logger.error(f"❌ Missing required node: {node_id}")
-                return False
-        
-        # Validate node types
-        expected_types = {
-            "71": "CLIPLoader",
-            "72": "CLIPTextEncode",  # Negative prompt
-            "73": "VAELoader",
-            "74": "EmptyHunyuanLatentVideo",
-            "75": "UNETLoader",  # High noise model
-            "76": "UNETLoader",  # Low noise model
-            "78": "KSamplerAdvanced",  # Low noise sampler
-            "80": "SaveVideo",
-            "81": "KSamplerAdvanced",  # High noise sampler
-            "82": "ModelSamplingSD3",  # High noise sampling
-            "83": "LoraLoaderModelOnly",  # High noise LoRA
-            "85": "LoraLoaderModelOnly",  # Low noise LoRA
-            "86": "ModelSamplingSD3",  # Low noise sampling
-            "87": "VAEDecode",
-            "88": "CreateVideo",
-            "89": "CLIPTextEncode"  # Positive prompt
-        }
-        
-        for node_id, expected_type in expected_types.items():
-            if workflow[node_id].get("class_type") != expected_type:
-                logger.error(f"❌ Node {node_id} has incorrect type. Expected {expected_type}, got {workflow[node_id].get('class_type')}")
-                return False
-        
-        logger.info("✅ Text to Video workflow validation passed")
-        return True
-        
-    except Exception as e:
-        logger.error(f"❌ Workflow validation error: {e}")
-        return False
-
 def queue_text_to_video_workflow(workflow, job_id):
     """Queue Text to Video workflow with ComfyUI"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
-        
         # Validate workflow
-        if not validate_text_to_video_workflow(workflow):
-            raise Exception("Workflow validation failed")
+        validation_errors = workflow_errors(workflow, 'text_to_video')
+        if validation_errors:
+            raise Exception(f"Workflow validation failed: {'; '.join(validation_errors[:5])}")
         
         # Fix LoRA paths before sending workflow (adds user subdirectories)
         workflow = fix_lora_paths(workflow)
@@ -246,17 +217,30 @@ def queue_text_to_video_workflow(workflow, job_id):
             logger.info(f"    class_type: {workflow['115'].get('class_type')}")
             logger.info(f"    inputs: {workflow['115'].get('inputs')}")
         
-        # Prepare prompt structure
+        # Drop nodes no output depends on and no-op pass-throughs before ComfyUI sees them
+        workflow = optimize_workflow(workflow, job_id, 'text_to_video')
+        
+        # Check the optimized graph's classes and required inputs against the cached node catalog before queueing
+        problems = check_workflow_nodes(workflow)
+        if problems:
+            logger.error(f"❌ Workflow not runnable on this ComfyUI build: {'; '.join(problems[:10])}")
+            raise Exception(f"Workflow not runnable on this ComfyUI build: {problems[0]}")
+        
+        # Free ComfyUI memory only if this workflow's models won't fit next to the resident ones
+        ensure_model_residency(job_id, workflow)
+        
+        # Prepare prompt structure (event stream client_id so execution events reach this worker)
+        client_id, stream_epoch = subscribe()
         prompt = {
             "prompt": workflow,
-            "client_id": job_id
+            "client_id": client_id
         }
         
         logger.info(f"🎬 Queueing Text to Video workflow for job {job_id}")
         
         # Queue the prompt
-        response = requests.post(
-            f"{comfyui_url}/prompt",
+        response = comfyui.post(
+            "/prompt",
             json=prompt,
             timeout=30
         )
@@ -275,6 +259,10 @@ def queue_text_to_video_workflow(workflow, job_id):
         if not prompt_id:
             raise Exception("No prompt_id returned from ComfyUI")
         
+        track_prompt(prompt_id, stream_epoch)
+        attach_prompt(job_id, prompt_id, workflow)
+        remember_workflow('text_to_video', workflow)
+        supervise_prompt(prompt_id, workflow)
         logger.info(f"✅ Workflow queued successfully with prompt_id: {prompt_id}")
         return prompt_id
         
@@ -285,7 +273,7 @@ def queue_text_to_video_workflow(workflow, job_id):
 def is_comfyui_running() -> bool:
     """Check if ComfyUI is already running on port 8188"""
     try:
-        response = requests.get("http://127.0.0.1:8188", timeout=2)
+        response = comfyui.get("/", timeout=2)
         return True
     except requests.exceptions.RequestException:
         return False
@@ -300,22 +288,13 @@ def prepare_comfyui_environment() -> bool:
             return True
         
         logger.info("🚀 Starting ComfyUI...")
-        start_comfyui()
-        
-        # Wait for ComfyUI to start (max 60 seconds)
-        for i in range(60):
-            if is_comfyui_running():
-                logger.info("✅ ComfyUI started successfully")
-                
-                # Check if ComfyUI can see LoRA files and rgthree node
-                time.sleep(2)  # Give ComfyUI a moment to fully initialize
-                check_comfyui_lora_availability()
-                
-                return True
-            time.sleep(1)
+        if not start_comfyui():
+            logger.error("❌ ComfyUI failed to start")
+            return False
         
-        logger.error("❌ ComfyUI failed to start within 60 seconds")
-        return False
+        # Check if ComfyUI can see LoRA files and rgthree node
+        check_comfyui_lora_availability()
+        return True
         
     except Exception as e:
         logger.error(f"❌ Error preparing ComfyUI environment: {e}")
@@ -414,32 +393,25 @@ def verify_rgthree_installation() -> bool:
 def check_comfyui_lora_availability() -> bool:
     """Check if ComfyUI API can see the LoRA files"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
+        # Node catalog of this ComfyUI build (cached on disk per build)
+        catalog = get_node_catalog()
         
-        # Get object info from ComfyUI API
-        response = requests.get(f"{comfyui_url}/object_info", timeout=10)
-        
-        if not response.ok:
+        if catalog is None:
             logger.warning("⚠️  Could not fetch ComfyUI object_info")
             return False
         
-        object_info = response.json()
-        
         # Check if Power Lora Loader is available
-        if "Power Lora Loader (rgthree)" in object_info:
+        if catalog.has("Power Lora Loader (rgthree)"):
             logger.info("✅ ComfyUI recognizes 'Power Lora Loader (rgthree)' node")
-            
-            # Get the node info
-            node_info = object_info["Power Lora Loader (rgthree)"]
-            logger.info(f"📋 Power Lora Loader input types: {node_info.get('input', {})}")
+            logger.info(f"📋 Power Lora Loader input types: {catalog.nodes['Power Lora Loader (rgthree)']}")
         else:
             logger.error("❌ ComfyUI does NOT recognize 'Power Lora Loader (rgthree)' node")
-            logger.info(f"Available nodes: {list(object_info.keys())[:10]}...")
+            logger.info(f"Available nodes: {list(catalog.nodes.keys())[:10]}...")
             return False
         
         # Try to get available LoRAs
         try:
-            response = requests.get(f"{comfyui_url}/extensions", timeout=5)
+            response = comfyui.get("/extensions", timeout=5)
             if response.ok:
                 logger.info("✅ ComfyUI extensions endpoint accessible")
         except:
@@ -451,23 +423,6 @@ def check_comfyui_lora_availability() -> bool:
         logger.error(f"❌ Error checking ComfyUI LoRA availability: {e}")
         return False
 
-def stream_comfyui_logs(process):
-    """Stream ComfyUI stdout/stderr to RunPod logs"""
-    def log_output(pipe, prefix):
-        try:
-            for line in iter(pipe.readline, ''):
-                if line:
-                    logger.info(f"{prefix} {line.rstrip()}")
-        except Exception as e:
-            logger.error(f"Error streaming {prefix}: {e}")
-    
-    # Start threads to stream stdout and stderr
-    import threading
-    stdout_thread = threading.Thread(target=log_output, args=(process.stdout, "[ComfyUI]"), daemon=True)
-    stderr_thread = threading.Thread(target=log_output, args=(process.stderr, "[ComfyUI ERROR]"), daemon=True)
-    stdout_thread.start()
-    stderr_thread.start()
-
 def start_comfyui():
     """Start ComfyUI server in background with cold start optimizations"""
     try:
@@ -496,20 +451,9 @@ def start_comfyui():
         logger.info(f"🚀 Starting ComfyUI with command: {' '.join(cmd)}")
         logger.info("📺 ComfyUI logs will be streamed below...")
         
-        process = subprocess.Popen(
-            cmd,
-            cwd=comfyui_path,
-            env=env,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1  # Line buffered
-        )
-        
-        logger.info(f"✅ ComfyUI process started with PID: {process.pid}")
-        
-        # Start streaming logs in background threads
-        stream_comfyui_logs(process)
+        # The supervisor owns the process: it waits for readiness, restarts ComfyUI if it crashes
+        # and recycles it between jobs
+        return get_supervisor().start(cmd, cwd=comfyui_path, env=env, timeout=600)
         
     except Exception as e:
         logger.error(f"❌ Error starting ComfyUI: {e}")
@@ -518,13 +462,20 @@ def start_comfyui():
 def monitor_text_to_video_progress(prompt_id: str, job_id: str, webhook_url: str, user_id: str = 'unknown', workflow: Dict = None) -> Dict:
     """Monitor ComfyUI progress for Text to Video with real-time updates"""
     try:
-        comfyui_url = "http://127.0.0.1:8188"
         max_wait_time = 600  # 10 minutes timeout
         start_time = time.time()
         last_progress_update = 0
         
         logger.info(f"📊 Monitoring progress for prompt_id: {prompt_id}")
         
+        # Execution events from the websocket; polling below is only the fallback
+        watcher = watch_prompt(prompt_id)
+        
+        # Progress weighted by sampler steps, video length and decode passes
+        tracker = WorkflowProgress(workflow)
+        timings = JobTimings(tracker, watcher)  # historical ETA for this workflow signature; recorded on success
+        logger.info(f"📐 Workflow progress model: {tracker.summary()}")
+        
         # Send initial webhook
         send_webhook(webhook_url, {
             "job_id": job_id,
@@ -534,6 +485,9 @@ def monitor_text_to_video_progress(prompt_id: str, job_id: str, webhook_url: str
         })
         
         while True:
+            if job_cancelled(job_id):
+                return cancelled_result(job_id)
+            
             # Check timeout
             if time.time() - start_time > max_wait_time:
                 logger.error(f"❌ Job {job_id} timed out after {max_wait_time} seconds")
@@ -549,29 +503,35 @@ def monitor_text_to_video_progress(prompt_id: str, job_id: str, webhook_url: str
                 elapsed = time.time() - start_time
                 if elapsed - last_progress_update >= 10:  # Update every 10 seconds
                     try:
-                        queue_response = requests.get(f"{comfyui_url}/queue", timeout=5)
-                        queue_data = queue_response.json()
+                        if not watcher.live:
+                            queue_response = comfyui.get("/queue", timeout=5)
+                            queue_data = queue_response.json()
                         
-                        # Calculate rough progress based on elapsed time
-                        estimated_total_time = 360  # ~6 minutes for text-to-video
-                        progress = min(95, int((elapsed / estimated_total_time) * 100))
+                        # Progress through the workflow's passes (time-based only without the event stream)
+                        tracker.update(watcher, elapsed)
+                        progress = tracker.percent(0, 95)
+                        step_label = f" {tracker.step_label()}," if tracker.step_label() else ""
                         
-                        logger.info(f"⏳ Progress: {progress}% | Elapsed: {int(elapsed)}s")
+                        logger.info(f"⏳ Progress: {progress}% | Stage: {tracker.stage} | Elapsed: {int(elapsed)}s")
                         
                         send_webhook(webhook_url, {
                             "job_id": job_id,
                             "status": "PROCESSING",
                             "progress": progress,
-                            "message": f"Generating video... {int(elapsed)}s elapsed"
+                            "stage": tracker.stage,
+                            "message": f"Generating video...{step_label} {int(elapsed)}s elapsed",
+                            "estimatedTimeRemaining": int(tracker.estimated_remaining(elapsed))
                         })
                         
                         last_progress_update = elapsed
                     except Exception as e:
                         logger.warning(f"⚠️ Could not fetch queue status: {e}")
                 
-                # Get history
-                history_response = requests.get(f"{comfyui_url}/history/{prompt_id}", timeout=10)
-                history_data = history_response.json()
+                # Get history (only once the event stream reports completion, unless polling)
+                history_data = {}
+                if watcher.finished or not watcher.live:
+                    history_response = comfyui.get(f"/history/{prompt_id}", timeout=10)
+                    history_data = history_response.json()
                 
                 if prompt_id in history_data:
                     job_data = history_data[prompt_id]
@@ -684,10 +644,14 @@ def monitor_text_to_video_progress(prompt_id: str, job_id: str, webhook_url: str
                                 "totalTime": int(elapsed_time)
                             })
                             
+                            node_profile = finish_node_profile(watcher, workflow, 'text_to_video')
+                            timings.record()
                             return {
                                 "success": True,
                                 "status": "completed",
-                                "videos": webhook_videos
+                                "videos": webhook_videos,
+                                "node_profile": node_profile,
+                                "model_residency": residency_report(job_id)
                             }
                         else:
                             logger.error("❌ No video outputs found")
@@ -699,8 +663,9 @@ def monitor_text_to_video_progress(prompt_id: str, job_id: str, webhook_url: str
                             return {"success": False, "error": "No outputs"}
                 
                 # Check queue status for progress
-                queue_response = requests.get(f"{comfyui_url}/queue", timeout=10)
-                queue_data = queue_response.json()
+                if not watcher.live:
+                    queue_response = comfyui.get("/queue", timeout=10)
+                    queue_data = queue_response.json()
                 
                 # Update progress periodically
                 current_time = time.time()
@@ -722,7 +687,7 @@ def monitor_text_to_video_progress(prompt_id: str, job_id: str, webhook_url: str
             except Exception as e:
                 logger.error(f"❌ Error checking progress: {e}")
             
-            time.sleep(2)
+            watcher.sleep(2)
     
     except Exception as e:
         logger.error(f"❌ Error monitoring progress: {e}")
@@ -740,7 +705,7 @@ def run_text_to_video_generation(job_input, job_id, webhook_url):
     try:
         # Check what LoRA files ComfyUI can see
         try:
-            lora_check = requests.get("http://127.0.0.1:8188/object_info/LoraLoader", timeout=5)
+            lora_check = comfyui.get("/object_info/LoraLoader", timeout=5)
             if lora_check.status_code == 200:
                 lora_info = lora_check.json()
                 if "LoraLoader" in lora_info and "input" in lora_info["LoraLoader"]:
@@ -774,7 +739,8 @@ def run_text_to_video_generation(job_input, job_id, webhook_url):
         logger.info(f"User ID: {job_input.get('userId', 'unknown')}")
         
         # Extract workflow to show actual parameters being used
-        workflow = job_input.get('workflow', {})
+        # (raw workflow, or the text_to_video template rendered with the job's params)
+        workflow = resolve_workflow(job_input, 'text_to_video') or {}
         
         # Log prompts
         if '89' in workflow and 'inputs' in workflow['89']:
@@ -891,19 +857,36 @@ def run_text_to_video_generation(job_input, job_id, webhook_url):
         
         logger.info("=" * 80)
         
+        # Identical resubmissions are answered from the shared result cache without touching the GPU
+        cache_key = None
+        if workflow and cache_requested(job_input):
+            cache_key = workflow_cache_key(workflow, 'text_to_video', job_input.get('userId'))
+        cached = lookup_result(cache_key)
+        if cached:
+            send_webhook(webhook_url, {
+                "job_id": job_id,
+                "status": "COMPLETED",
+                "progress": 100,
+                "message": "Video generation completed successfully! 🎉",
+                "aws_s3_paths": cached.get("videos", []),
+                "totalTime": 0,
+                "cached": True
+            })
+            return {"success": True, "status": "completed", "videos": cached.get("videos", []), "cached": True}
+        
         # Verify models exist
         if not verify_text_to_video_models():
             raise Exception("Required models not found")
         
         # Prepare ComfyUI environment
-        if not prepare_comfyui_environment():
+        if not wait_for_comfyui(prepare_comfyui_environment):
             raise Exception("Failed to prepare ComfyUI environment")
         
         # Get user_id
         user_id = job_input.get('userId', 'unknown')
         
         if not workflow:
-            raise Exception("No workflow provided")
+            raise Exception("No workflow or template params provided")
         
         # Queue the workflow
         prompt_id = queue_text_to_video_workflow(workflow, job_id)
@@ -911,6 +894,10 @@ def run_text_to_video_generation(job_input, job_id, webhook_url):
         # Monitor progress
         result = monitor_text_to_video_progress(prompt_id, job_id, webhook_url, user_id, workflow)
         
+        if result.get("success") and result.get("videos"):
+            store_result(cache_key, {"videos": result["videos"]},
+                         [video["awsS3Url"] for video in result["videos"] if video.get("awsS3Url")], job_id)
+        
         return result
     
     except Exception as e:
@@ -941,7 +928,9 @@ def handler(job):
             webhook_url = job_input.get('webhook_url', '')
             
             logger.info(f"🎬 Starting Text to Video generation job: {job_id}")
-            result = run_text_to_video_generation(job_input, job_id, webhook_url)
+            # Interrupt ComfyUI and return right away if the job is cancelled
+            with watch_job_cancellation(job, job_id):
+                result = run_text_to_video_generation(job_input, job_id, webhook_url)
             
             return result
         
@@ -956,4 +945,6 @@ def handler(job):
 # Start the RunPod handler
 if __name__ == "__main__":
     logger.info("🎬 Starting RunPod Text to Video (Wan 2.2) handler...")
-    runpod.serverless.start({"handler": handler})
+    # Start ComfyUI while the worker registers; the first job awaits this instead of booting it
+    start_prewarm(verify_text_to_video_models, prepare_comfyui_environment, lambda: warm_up_models('text_to_video'))
+    runpod.serverless.start(serverless_config(supervised_handler(handler)))